@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of local mode scoring every term against scoring only
+the candidate terms found by the MinHash index
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+
+sys.path.insert(0, ROOT_DIR)
+
+from enrichment_service import genesetlibrary  # noqa: E402
+from enrichment_service import localenrichment  # noqa: E402
+from enrichment_service import minhash  # noqa: E402
+
+REPORT_COLUMNS = [('minoverlap', 'minoverlap', '{}'),
+                  ('permutations', 'lsh_permutations', '{}'),
+                  ('bands', 'bands', '{}'),
+                  ('rows', 'rows', '{}'),
+                  ('build sec', 'build_seconds', '{:.2f}'),
+                  ('score sec', 'seconds', '{:.2f}'),
+                  ('speedup', 'speedup', '{:.2f}'),
+                  ('candidates', 'candidates', '{}'),
+                  ('results', 'rows_with_result', '{}'),
+                  ('same result', 'same_result_fraction', '{:.4f}')]
+
+
+def _parse_arguments(desc, args):
+    """
+    Parses command line arguments
+
+    :param desc:
+    :param args:
+    :return:
+    """
+    help_fm = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('--gmt', action='append',
+                        help='Gene set library in GMT format ie a '
+                             'g:Profiler export, in form [SOURCE=]PATH. '
+                             'If unset a random library is used')
+    parser.add_argument('--terms', default=20000, type=int,
+                        help='Number of terms in random library')
+    parser.add_argument('--universe', default=20000, type=int,
+                        help='Number of distinct genes in random library')
+    parser.add_argument('--gene_lists', default=1000, type=int,
+                        help='Number of gene lists to score, each made '
+                             'from genes of a random term with some '
+                             'genes dropped and others added')
+    parser.add_argument('--minoverlap', default='0.05,0.1,0.3',
+                        help='Comma delimited list of minimum Jaccard')
+    parser.add_argument('--maxpval', default=0.00000001, type=float,
+                        help='Max p value')
+    parser.add_argument('--lsh_permutations', default='64,128',
+                        help='Comma delimited list of signature sizes')
+    parser.add_argument('--lsh_recall', default=0.95, type=float,
+                        help='Probability of finding a term whose '
+                             'Jaccard is exactly minoverlap')
+    parser.add_argument('--seed', default=1, type=int,
+                        help='Seed for random library and gene lists')
+    parser.add_argument('--json_out',
+                        help='If set, measurements are also written '
+                             'as JSON to this file')
+    return parser.parse_args(args)
+
+
+def get_random_library(terms, universe, rand):
+    """
+    Gets library of **terms** random terms of log normal size with
+    genes drawn so a few genes are in many terms, as in GO
+
+    :param rand: random number generator
+    :type rand: :py:class:`numpy.random.RandomState`
+    :rtype: :py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+    """
+    popularity = 1.0 / numpy.arange(1, universe + 1) ** 0.8
+    cumulative = numpy.cumsum(popularity / popularity.sum())
+    term_indptr = [0]
+    term_indices = []
+    for term in range(terms):
+        size = int(min(universe // 10, rand.lognormal(3.0, 1.2))) + 3
+        genes = numpy.searchsorted(cumulative, rand.random_sample(size))
+        term_indices.extend(numpy.unique(genes.clip(0, universe - 1)).tolist())
+        term_indptr.append(len(term_indices))
+    names = ['T' + str(term) for term in range(terms)]
+    return genesetlibrary.GeneSetLibrary(['G' + str(gene) for gene in range(universe)],
+                                         ['RANDOM'] * terms, names, names,
+                                         numpy.array(term_indptr, dtype=numpy.int64),
+                                         numpy.array(term_indices, dtype=numpy.int32))
+
+
+def get_gene_lists(library, number_of_gene_lists, rand):
+    """
+    Gets gene lists each made of genes of a random term of
+    **library** with about 40% of them dropped and a third as
+    many random genes added
+
+    :rtype: list
+    """
+    gene_lists = []
+    for index in range(number_of_gene_lists):
+        term_genes = library.get_term_genes(rand.randint(library.get_number_of_terms()))
+        genes = [gene for gene in term_genes if rand.random_sample() < 0.6]
+        extra = rand.randint(library.get_number_of_genes(),
+                             size=max(2, len(term_genes) // 3))
+        genes.extend([library.genes[gene] for gene in extra])
+        gene_lists.append(genes[:500])
+    return gene_lists
+
+
+def get_best_term_names(results):
+    """
+    Gets name of best term of each result or ``None``
+
+    :rtype: list
+    """
+    return [None if res is None else res['CD_CommunityName']
+            for res in results]
+
+
+def format_report(results):
+    """
+    Formats **results** as a table
+
+    :param results: measurements
+    :type results: list
+    :rtype: str
+    """
+    header = [name for name, key, fmt in REPORT_COLUMNS]
+    lines = [header]
+    for res in results:
+        line = []
+        for name, key, fmt in REPORT_COLUMNS:
+            value = res.get(key)
+            line.append('-' if value is None else fmt.format(value))
+        lines.append(line)
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    return '\n'.join(['  '.join(value.rjust(width)
+                                for value, width in zip(line, widths))
+                      for line in lines]) + '\n'
+
+
+def main(args):
+    """
+    Main entry point
+
+    :param args: command line arguments usually :py:const:`sys.argv`
+    :return: 0 for success otherwise failure
+    :rtype: int
+    """
+    desc = """
+    Scores gene lists against every term of a gene set library as
+    local mode does and again scoring only the candidate terms of
+    MinHash indexes of each size in --lsh_permutations, for each
+    --minoverlap. Reports time taken, number of gene list and term
+    pairs scored and fraction of gene lists whose best term is the
+    same as when every term is scored
+    """
+    theargs = _parse_arguments(desc, args[1:])
+    rand = numpy.random.RandomState(theargs.seed)
+    if theargs.gmt is not None:
+        library = genesetlibrary.read_gmt_files(theargs.gmt)
+    else:
+        library = get_random_library(theargs.terms, theargs.universe, rand)
+    gene_lists = get_gene_lists(library, theargs.gene_lists, rand)
+    # built once and reused by every run in local mode
+    library.get_inverted_index()
+
+    results = []
+    for minoverlap in [float(x) for x in theargs.minoverlap.split(',')]:
+        start = time.time()
+        expected = localenrichment.run_local_enrichment(gene_lists, library,
+                                                        theargs.maxpval,
+                                                        minoverlap, None)
+        exhaustive_seconds = time.time() - start
+        expected_names = get_best_term_names(expected)
+        results.append({'minoverlap': minoverlap,
+                        'seconds': exhaustive_seconds,
+                        'speedup': 1.0,
+                        'rows_with_result': sum(1 for name in expected_names
+                                                if name is not None),
+                        'same_result_fraction': 1.0})
+        sys.stderr.write('Scored every term for minoverlap ' +
+                         str(minoverlap) + ' in ' +
+                         '{:.2f}'.format(exhaustive_seconds) + ' seconds\n')
+
+        for num_perm in [int(x) for x in theargs.lsh_permutations.split(',')]:
+            bands, rows = minhash.get_bands_and_rows(num_perm, minoverlap,
+                                                     theargs.lsh_recall)
+            start = time.time()
+            index = minhash.MinHashIndex(library, num_perm=num_perm,
+                                         bands=bands, rows=rows)
+            build_seconds = time.time() - start
+            start = time.time()
+            res = localenrichment.run_local_enrichment(gene_lists, library,
+                                                       theargs.maxpval,
+                                                       minoverlap, None,
+                                                       index=index)
+            seconds = time.time() - start
+            names = get_best_term_names(res)
+            same = sum(1 for name, expected_name in zip(names, expected_names)
+                       if name == expected_name)
+            results.append({'minoverlap': minoverlap,
+                            'lsh_permutations': num_perm,
+                            'bands': bands,
+                            'rows': rows,
+                            'build_seconds': build_seconds,
+                            'seconds': seconds,
+                            'speedup': exhaustive_seconds / max(seconds, 1e-9),
+                            'candidates': len(index.get_candidates(gene_lists)),
+                            'rows_with_result': sum(1 for name in names
+                                                    if name is not None),
+                            'same_result_fraction': same / max(1, len(gene_lists))})
+
+    sys.stdout.write(format_report(results))
+    if theargs.json_out is not None:
+        with open(theargs.json_out, 'w') as f:
+            json.dump({'settings': vars(theargs),
+                       'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Runs enrichment_service command line tool once in this process
+and writes throughput, row latency and peak memory as JSON to
+standard out. Invoked by run_benchmarks.py in a new process per
+run so peak memory of one run does not carry over to the next
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import contextlib
+
+from enrichment_service import enrichment_servicecmd
+
+
+def get_percentile(values, percentile):
+    """
+    Gets **percentile** of **values** using nearest rank
+
+    :param values: sorted values
+    :type values: list
+    :param percentile: value from 0 to 100
+    :type percentile: float
+    :return: value or ``None`` if **values** is empty
+    :rtype: float
+    """
+    if len(values) == 0:
+        return None
+    index = int(round((len(values) - 1) * percentile / 100.0))
+    return values[index]
+
+
+def get_peak_rss():
+    """
+    Gets peak resident set size of this process
+
+    :return: bytes
+    :rtype: int
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def _record_latency(func, latencies, rows_per_call=None):
+    """
+    Wraps **func** so time of each call is appended to
+    **latencies** once per row handled by the call
+
+    :param rows_per_call: gets number of rows from call arguments,
+                          if ``None`` each call is one row
+    :type rows_per_call: function
+    """
+    def wrapper(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.monotonic() - start
+            count = 1 if rows_per_call is None else rows_per_call(*args)
+            latencies.extend([elapsed] * count)
+    return wrapper
+
+
+def _record_async_latency(func, latencies):
+    """
+    Coroutine version of :py:func:`_record_latency`
+    """
+    async def wrapper(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            latencies.append(time.monotonic() - start)
+    return wrapper
+
+
+def instrument(latencies):
+    """
+    Replaces the functions that run enrichment on one row or on one
+    g:Profiler batch with versions that record their latency
+    """
+    cmd = enrichment_servicecmd
+    cmd.run_enrichment_for_genes = _record_latency(cmd.run_enrichment_for_genes,
+                                                   latencies)
+    cmd._run_gprofiler_batch_for_rows = _record_latency(cmd._run_gprofiler_batch_for_rows,
+                                                        latencies,
+                                                        rows_per_call=lambda genes_by_query,
+                                                        *args: len(genes_by_query))
+    cmd.run_iquery_async = _record_async_latency(cmd.run_iquery_async,
+                                                 latencies)
+
+
+def count_rows_with_result(outputfile):
+    """
+    Counts rows in updateTables output in **outputfile**
+
+    :rtype: int
+    """
+    try:
+        with open(outputfile, 'r') as f:
+            return len(json.load(f)[0]['data']['rows'])
+    except (ValueError, IndexError, KeyError):
+        return 0
+
+
+def run(config):
+    """
+    Runs enrichment as set in **config** which has the keys
+    ``inputfile``, ``outputfile``, ``mode``, ``rows`` and
+    ``enrichment_args``
+
+    :param config: benchmark run settings
+    :type config: dict
+    :return: measurements
+    :rtype: dict
+    """
+    latencies = []
+    instrument(latencies)
+    args = ['enrichment_servicecmd.py', config['inputfile'],
+            '--mode', config['mode']] + config['enrichment_args']
+
+    start = time.monotonic()
+    with open(config['outputfile'], 'w') as out, open(os.devnull, 'w') as err:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            exit_code = enrichment_servicecmd.main(args)
+    seconds = time.monotonic() - start
+    peak_rss = get_peak_rss()
+
+    latencies.sort()
+    p50 = get_percentile(latencies, 50)
+    p99 = get_percentile(latencies, 99)
+    return {'mode': config['mode'],
+            'rows': config['rows'],
+            'exit_code': exit_code,
+            'seconds': seconds,
+            'rows_per_second': config['rows'] / seconds if seconds > 0 else None,
+            'rows_with_result': count_rows_with_result(config['outputfile']),
+            'calls': len(latencies),
+            'p50_latency_ms': None if p50 is None else p50 * 1000.0,
+            'p99_latency_ms': None if p99 is None else p99 * 1000.0,
+            'peak_rss_bytes': peak_rss}
+
+
+def main(args):
+    """
+    Main entry point
+
+    :param args: command line arguments, second one is path
+                 to JSON file with settings, see :py:func:`run`
+    :return: 0 for success
+    :rtype: int
+    """
+    with open(args[1], 'r') as f:
+        config = json.load(f)
+    json.dump(run(config), sys.stdout)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local stand ins for the g:Profiler ``profile`` API and the NDEx
+iQuery ``integratedsearch/v1`` API used by the benchmarks. Latency,
+task duration, error rate and response size are configurable so
+runs do not depend on the real services
+"""
+
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+GPROFILER_PROFILE_PATH = '/api/gost/profile/'
+
+IQUERY_PATH = '/integratedsearch/v1/'
+
+SOURCES = ['GO:BP', 'GO:CC', 'GO:MF', 'REAC', 'KEGG', 'WP']
+
+
+class MockServiceConfig(object):
+    """
+    Behavior of a mock service
+    """
+
+    def __init__(self, latency=0.0, job_duration=0.0, error_rate=0.0,
+                 terms_per_query=10, seed=None):
+        """
+        Constructor
+
+        :param latency: seconds added to every response
+        :type latency: float
+        :param job_duration: mean seconds an iQuery task runs before
+                             it completes, actual duration varies
+                             +/- 50%
+        :type job_duration: float
+        :param error_rate: fraction of requests answered with a
+                           503 error
+        :type error_rate: float
+        :param terms_per_query: number of terms returned per query
+                                which sets the size of responses
+        :type terms_per_query: int
+        :param seed: seed for random number generator
+        :type seed: int
+        """
+        self.latency = latency
+        self.job_duration = job_duration
+        self.error_rate = error_rate
+        self.terms_per_query = terms_per_query
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def get_random(self):
+        """
+        Gets random value in [0, 1) in a thread safe way
+
+        :rtype: float
+        """
+        with self.lock:
+            return self.random.random()
+
+
+class _MockRequestHandler(BaseHTTPRequestHandler):
+    """
+    Base handler that adds latency, injects errors and counts
+    requests on the server
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, data):
+        """
+        Sends **data** as JSON with **status**
+        """
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        """
+        Reads JSON body of request
+        """
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def _start_request(self):
+        """
+        Counts request, sleeps configured latency and decides if an
+        error should be returned, in which case it is sent
+
+        :return: True if request should be handled
+        :rtype: bool
+        """
+        config = self.server.config
+        self.server.count_request()
+        if config.latency > 0:
+            time.sleep(config.latency)
+        if config.get_random() < config.error_rate:
+            self.server.count_error()
+            self._send_json(503, {'message': 'Injected error'})
+            return False
+        return True
+
+    def log_message(self, format, *args):
+        """
+        Turns off request log
+        """
+        pass
+
+
+class MockGProfilerRequestHandler(_MockRequestHandler):
+    """
+    Answers ``POST`` to :py:const:`GPROFILER_PROFILE_PATH` with
+    random terms in the format the g:Profiler client expects
+    """
+
+    def do_POST(self):
+        """
+        Handles profile request
+        """
+        if urlparse(self.path).path != GPROFILER_PROFILE_PATH:
+            self._send_json(404, {'message': 'Not found'})
+            return
+        body = self._read_json()
+        if not self._start_request():
+            return
+        query = body['query']
+        if not isinstance(query, dict):
+            query = {'query_1': query}
+        self._send_json(200, get_gprofiler_response(query,
+                                                    self.server.config))
+
+
+def get_gprofiler_response(genes_by_query, config):
+    """
+    Gets g:Profiler profile response with
+    **config.terms_per_query** random terms for each query
+    in **genes_by_query**
+
+    :param genes_by_query: query name => list of genes
+    :type genes_by_query: dict
+    :param config: settings of mock service
+    :type config: :py:class:`MockServiceConfig`
+    :rtype: dict
+    """
+    queries = {}
+    genes_metadata = {}
+    results = []
+    for query_name, genes in genes_by_query.items():
+        ensgs = ['ENSG' + gene for gene in genes]
+        queries[query_name] = {}
+        genes_metadata[query_name] = {'ensgs': ensgs,
+                                      'mapping': {gene: [ensg] for gene, ensg in
+                                                  zip(genes, ensgs)}}
+        if len(genes) == 0:
+            continue
+        for index in range(config.terms_per_query):
+            hits = [config.get_random() < 0.5 for gene in genes]
+            overlap = max(1, sum(hits))
+            term_size = overlap + int(config.get_random() * 500)
+            source = SOURCES[index % len(SOURCES)]
+            results.append({'query': query_name,
+                            'source': source,
+                            'native': source + ':' + str(index),
+                            'name': 'term ' + str(index),
+                            'description': 'mock term',
+                            'p_value': config.get_random() * 0.01,
+                            'significant': True,
+                            'term_size': term_size,
+                            'query_size': len(genes),
+                            'intersection_size': overlap,
+                            'effective_domain_size': 20000,
+                            'precision': overlap / len(genes),
+                            'recall': overlap / term_size,
+                            'parents': [],
+                            'intersections': [['IEA'] if hit else []
+                                              for hit in hits]})
+    return {'meta': {'query_metadata': {'queries': queries},
+                     'genes_metadata': {'query': genes_metadata}},
+            'result': results}
+
+
+class MockIQueryRequestHandler(_MockRequestHandler):
+    """
+    Implements submit, status and result calls of iQuery under
+    :py:const:`IQUERY_PATH`. Tasks complete after a random
+    duration around **config.job_duration**
+    """
+
+    def do_POST(self):
+        """
+        Handles task submission
+        """
+        if urlparse(self.path).path != IQUERY_PATH:
+            self._send_json(404, {'message': 'Not found'})
+            return
+        body = self._read_json()
+        if not self._start_request():
+            return
+        config = self.server.config
+        duration = config.job_duration * (0.5 + config.get_random())
+        taskid = self.server.add_task(body['geneList'], duration)
+        self._send_json(202, {'id': taskid})
+
+    def do_GET(self):
+        """
+        Handles status and result requests
+        """
+        path = urlparse(self.path).path
+        if not path.startswith(IQUERY_PATH):
+            self._send_json(404, {'message': 'Not found'})
+            return
+        parts = path[len(IQUERY_PATH):].split('/')
+        task = self.server.get_task(parts[0])
+        if task is None:
+            self._send_json(404, {'message': 'No such task'})
+            return
+        if not self._start_request():
+            return
+        genes, done_time = task
+        progress = 100 if time.monotonic() >= done_time else 50
+        if len(parts) > 1 and parts[1] == 'status':
+            self._send_json(200, {'progress': progress,
+                                  'status': 'complete' if progress == 100
+                                  else 'processing'})
+            return
+        if progress != 100:
+            self._send_json(404, {'message': 'Task not complete'})
+            return
+        self._send_json(200, get_iquery_response(genes, self.server.config))
+
+
+def get_iquery_response(genes, config):
+    """
+    Gets iQuery result with **config.terms_per_query** random
+    hits for **genes**
+
+    :param genes: genes of task
+    :type genes: list
+    :param config: settings of mock service
+    :type config: :py:class:`MockServiceConfig`
+    :rtype: dict
+    """
+    results = []
+    for index in range(config.terms_per_query):
+        hitgenes = [gene for gene in genes if config.get_random() < 0.5]
+        source = SOURCES[index % len(SOURCES)]
+        results.append({'description': source + ': term ' + str(index),
+                        'hitGenes': hitgenes,
+                        'details': {'similarity': config.get_random(),
+                                    'PValue': config.get_random() * 0.01}})
+    return {'sources': [{'results': results}]}
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    Threaded server for one of the mock request handlers that
+    keeps request counts and iQuery tasks
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler_class, config, host='127.0.0.1', port=0):
+        """
+        Constructor
+
+        :param handler_class: :py:class:`MockGProfilerRequestHandler`
+                              or :py:class:`MockIQueryRequestHandler`
+        :param config: settings of mock service
+        :type config: :py:class:`MockServiceConfig`
+        :param host: address to listen on
+        :type host: str
+        :param port: port to listen on, 0 picks a free port
+        :type port: int
+        """
+        super(MockServer, self).__init__((host, port), handler_class)
+        self.config = config
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self._request_count = 0
+        self._error_count = 0
+        self._thread = None
+
+    def get_url(self):
+        """
+        Gets base URL of server
+
+        :rtype: str
+        """
+        host, port = self.server_address[:2]
+        return 'http://' + host + ':' + str(port)
+
+    def count_request(self):
+        """
+        Increments number of requests
+        """
+        with self._lock:
+            self._request_count += 1
+
+    def count_error(self):
+        """
+        Increments number of injected errors
+        """
+        with self._lock:
+            self._error_count += 1
+
+    def get_counts(self):
+        """
+        Gets number of requests and injected errors
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {'requests': self._request_count,
+                    'errors': self._error_count}
+
+    def reset_counts(self):
+        """
+        Sets request and error counts to 0 and drops tasks
+        """
+        with self._lock:
+            self._request_count = 0
+            self._error_count = 0
+            self._tasks = {}
+
+    def add_task(self, genes, duration):
+        """
+        Adds iQuery task for **genes** that completes after
+        **duration** seconds
+
+        :return: id of task
+        :rtype: str
+        """
+        taskid = str(uuid.uuid4())
+        with self._lock:
+            self._tasks[taskid] = (genes, time.monotonic() + duration)
+        return taskid
+
+    def get_task(self, taskid):
+        """
+        Gets (genes, completion time) of task **taskid**
+
+        :return: tuple or ``None`` if task does not exist
+        :rtype: tuple
+        """
+        with self._lock:
+            return self._tasks.get(taskid)
+
+    def start(self):
+        """
+        Serves requests on a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops serving requests and closes socket
+        """
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End to end benchmarks of enrichment_service command line tool
+against local stand in g:Profiler and iQuery servers
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from mockservers import MockServer, MockServiceConfig
+from mockservers import MockGProfilerRequestHandler, MockIQueryRequestHandler
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+
+WORKER_SCRIPT = os.path.join(BENCHMARK_DIR, 'benchmark_worker.py')
+
+MODES = ['gprofiler', 'iquery']
+
+# must match GPROFILER_URL_ENV in enrichment_servicecmd, not
+# imported so this process does not load the package
+GPROFILER_URL_ENV = 'ENRICHMENT_SERVICE_GPROFILER_URL'
+
+REPORT_COLUMNS = [('mode', 'mode', '{}'),
+                  ('rows', 'rows', '{}'),
+                  ('seconds', 'seconds', '{:.2f}'),
+                  ('rows/sec', 'rows_per_second', '{:.1f}'),
+                  ('p50 ms', 'p50_latency_ms', '{:.1f}'),
+                  ('p99 ms', 'p99_latency_ms', '{:.1f}'),
+                  ('peak RSS MB', 'peak_rss_mb', '{:.1f}'),
+                  ('results', 'rows_with_result', '{}'),
+                  ('requests', 'server_requests', '{}'),
+                  ('errors', 'server_errors', '{}')]
+
+
+def _parse_arguments(desc, args):
+    """
+    Parses command line arguments. Arguments not known to this
+    parser are passed to enrichment_service for every run
+
+    :param desc:
+    :param args:
+    :return: (parsed arguments, remaining arguments)
+    :rtype: tuple
+    """
+    help_fm = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='Comma delimited list of modes to benchmark')
+    parser.add_argument('--rows', default='10,100,1000,10000',
+                        help='Comma delimited list of node table sizes')
+    parser.add_argument('--genes_per_row', default='5,50',
+                        help='Minimum and maximum number of genes per row')
+    parser.add_argument('--universe', default=20000, type=int,
+                        help='Number of distinct genes rows are drawn from')
+    parser.add_argument('--duplicate_fraction', default=0.0, type=float,
+                        help='Fraction of rows that repeat the gene list '
+                             'of an earlier row')
+    parser.add_argument('--latency', default=0.01, type=float,
+                        help='Seconds mock servers wait before answering '
+                             'each request')
+    parser.add_argument('--job_duration', default=0.5, type=float,
+                        help='Mean seconds before mock iQuery tasks complete')
+    parser.add_argument('--error_rate', default=0.0, type=float,
+                        help='Fraction of requests mock servers answer '
+                             'with a 503 error')
+    parser.add_argument('--terms_per_query', default=10, type=int,
+                        help='Number of terms mock servers return per '
+                             'query, sets size of responses')
+    parser.add_argument('--seed', default=1, type=int,
+                        help='Seed for random node tables and responses')
+    parser.add_argument('--json_out',
+                        help='If set, measurements are also written '
+                             'as JSON to this file')
+    return parser.parse_known_args(args)
+
+
+def get_genes_per_row(value):
+    """
+    Parses minimum and maximum genes per row from **value**
+
+    :param value: min,max
+    :type value: str
+    :rtype: tuple
+    """
+    parts = [int(x) for x in value.split(',')]
+    if len(parts) == 1:
+        return parts[0], parts[0]
+    return parts[0], parts[1]
+
+
+def write_node_table(path, rows, genes_per_row, universe,
+                     duplicate_fraction, seed):
+    """
+    Writes node table with **rows** rows of random genes to **path**
+
+    :param path: file to write
+    :type path: str
+    :param rows: number of rows
+    :type rows: int
+    :param genes_per_row: (minimum, maximum) genes in a row
+    :type genes_per_row: tuple
+    :param universe: number of distinct genes
+    :type universe: int
+    :param duplicate_fraction: fraction of rows reusing genes of
+                               an earlier row
+    :type duplicate_fraction: float
+    :param seed: seed for random number generator
+    :type seed: int
+    """
+    rand = random.Random(seed)
+    gene_rows = []
+    with open(path, 'w') as f:
+        f.write('{"columns": [{"id": "genes"}], "rows": {')
+        for index in range(rows):
+            if len(gene_rows) > 0 and rand.random() < duplicate_fraction:
+                genes = rand.choice(gene_rows)
+            else:
+                size = rand.randint(genes_per_row[0], genes_per_row[1])
+                genes = ' '.join(['G' + str(rand.randrange(universe))
+                                  for x in range(size)])
+                gene_rows.append(genes)
+            if index > 0:
+                f.write(',')
+            f.write('\n' + json.dumps(str(index)) + ': ' +
+                    json.dumps({'genes': genes}))
+        f.write('\n}}\n')
+
+
+def run_worker(workdir, mode, rows, enrichment_args, env):
+    """
+    Runs benchmark_worker.py in a new process
+
+    :return: measurements from worker
+    :rtype: dict
+    """
+    config = {'inputfile': os.path.join(workdir, 'input_' + str(rows) + '.json'),
+              'outputfile': os.path.join(workdir, 'output.json'),
+              'mode': mode,
+              'rows': rows,
+              'enrichment_args': enrichment_args}
+    configfile = os.path.join(workdir, 'config.json')
+    with open(configfile, 'w') as f:
+        json.dump(config, f)
+    res = subprocess.run([sys.executable, WORKER_SCRIPT, configfile],
+                         stdout=subprocess.PIPE, env=env, check=True)
+    return json.loads(res.stdout.decode('utf-8'))
+
+
+def format_report(results):
+    """
+    Formats **results** as a table
+
+    :param results: measurements
+    :type results: list
+    :rtype: str
+    """
+    header = [name for name, key, fmt in REPORT_COLUMNS]
+    lines = [header]
+    for res in results:
+        line = []
+        for name, key, fmt in REPORT_COLUMNS:
+            value = res.get(key)
+            line.append('-' if value is None else fmt.format(value))
+        lines.append(line)
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    return '\n'.join(['  '.join(value.rjust(width)
+                                for value, width in zip(line, widths))
+                      for line in lines]) + '\n'
+
+
+def main(args):
+    """
+    Main entry point
+
+    :param args: command line arguments usually :py:const:`sys.argv`
+    :return: 0 for success otherwise failure
+    :rtype: int
+    """
+    desc = """
+    Starts local stand ins for g:Profiler and iQuery, runs
+    enrichment_service on random node tables of each size in
+    --rows for each mode in --modes and reports throughput,
+    median and 99th percentile row latency and peak memory of
+    the enrichment process. Options not listed below are passed
+    to enrichment_service ie --workers 8 --gprofiler_batchsize 50
+    """
+    theargs, enrichment_args = _parse_arguments(desc, args[1:])
+    modes = theargs.modes.split(',')
+    row_counts = [int(x) for x in theargs.rows.split(',')]
+
+    gprofiler_server = MockServer(MockGProfilerRequestHandler,
+                                  MockServiceConfig(latency=theargs.latency,
+                                                    error_rate=theargs.error_rate,
+                                                    terms_per_query=theargs.terms_per_query,
+                                                    seed=theargs.seed))
+    iquery_server = MockServer(MockIQueryRequestHandler,
+                               MockServiceConfig(latency=theargs.latency,
+                                                 job_duration=theargs.job_duration,
+                                                 error_rate=theargs.error_rate,
+                                                 terms_per_query=theargs.terms_per_query,
+                                                 seed=theargs.seed))
+    servers = {'gprofiler': gprofiler_server, 'iquery': iquery_server}
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT_DIR] +
+                                        [x for x in [env.get('PYTHONPATH')] if x])
+    env[GPROFILER_URL_ENV] = gprofiler_server.get_url()
+    # benchmarks measure the services so never read a result cache
+    env.pop('ENRICHMENT_SERVICE_CACHE_DIR', None)
+
+    workdir = tempfile.mkdtemp(prefix='enrichment_benchmark_')
+    results = []
+    try:
+        for server in servers.values():
+            server.start()
+        for rows in row_counts:
+            write_node_table(os.path.join(workdir, 'input_' + str(rows) + '.json'),
+                             rows, get_genes_per_row(theargs.genes_per_row),
+                             theargs.universe, theargs.duplicate_fraction,
+                             theargs.seed)
+            for mode in modes:
+                server = servers[mode]
+                server.reset_counts()
+                res = run_worker(workdir, mode, rows,
+                                 ['--url', iquery_server.get_url()] +
+                                 enrichment_args, env)
+                counts = server.get_counts()
+                res['server_requests'] = counts['requests']
+                res['server_errors'] = counts['errors']
+                res['peak_rss_mb'] = res['peak_rss_bytes'] / 1048576.0
+                results.append(res)
+                sys.stderr.write('Ran ' + mode + ' on ' + str(rows) +
+                                 ' rows in ' + '{:.2f}'.format(res['seconds']) +
+                                 ' seconds\n')
+    finally:
+        for server in servers.values():
+            server.stop()
+        shutil.rmtree(workdir)
+
+    sys.stdout.write(format_report(results))
+    if theargs.json_out is not None:
+        with open(theargs.json_out, 'w') as f:
+            json.dump({'settings': vars(theargs),
+                       'enrichment_args': enrichment_args,
+                       'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
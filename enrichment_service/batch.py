@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+
+"""
+Runs enrichment on many node table files using a pool of processes
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+from enrichment_service import httpclient
+from enrichment_service import metrics
+from enrichment_service import enrichment_servicecmd
+
+
+# input file extensions removed when naming output files
+INPUT_EXTENSIONS = ['.gz', '.json']
+
+OUTPUT_EXTENSION = '.json'
+
+LOG_EXTENSION = '.log'
+
+STATUS_FILENAME = 'batch_status.json'
+
+# exit status of an input whose node table has no results
+NO_RESULTS_EXIT_CODE = 1
+
+# exit status of an input that raised an exception
+EXCEPTION_EXIT_CODE = 2
+
+# placeholder for input positional argument when validating
+# enrichment arguments
+INPUT_PLACEHOLDER = '-'
+
+# enrichment arguments set in each worker process by
+# :py:func:`_init_worker`
+_worker_args = None
+
+
+def _parse_arguments(desc, args):
+    """
+    Parses command line arguments. Arguments not known to
+    this parser are returned and used as enrichment arguments
+    for every input
+
+    :param desc:
+    :param args:
+    :return: (parsed arguments, remaining arguments)
+    :rtype: tuple
+    """
+    help_fm = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('inputs',
+                        help='Directory of node table files, every file '
+                             'ending in .json or .json.gz is processed, or '
+                             'manifest file listing one node table file '
+                             'per line. Relative paths in a manifest are '
+                             'relative to the manifest')
+    parser.add_argument('--outdir', required=True,
+                        help='Directory to write output of each input, '
+                             'its standard error as a ' + LOG_EXTENSION +
+                             ' file and ' + STATUS_FILENAME + ' to')
+    parser.add_argument('--processes', default=os.cpu_count() or 1,
+                        type=int,
+                        help='Number of worker processes')
+    return parser.parse_known_args(args)
+
+
+def get_input_files(inputs):
+    """
+    Gets node table files in directory **inputs** or listed in
+    manifest file **inputs**. Blank lines and lines starting with
+    ``#`` in a manifest are ignored
+
+    :param inputs: directory or manifest file
+    :type inputs: str
+    :raises ValueError: if **inputs** does not exist
+    :return: paths of node table files
+    :rtype: list
+    """
+    if os.path.isdir(inputs):
+        return [os.path.join(inputs, name) for name in sorted(os.listdir(inputs))
+                if name.endswith('.json') or name.endswith('.json.gz')]
+    if not os.path.isfile(inputs):
+        raise ValueError(inputs + ' is not a directory or manifest file')
+    manifest_dir = os.path.dirname(os.path.abspath(inputs))
+    input_files = []
+    with open(inputs, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            input_files.append(os.path.join(manifest_dir, line))
+    return input_files
+
+
+def get_output_names(input_files):
+    """
+    Gets name, unique within the batch, to use for the output
+    and log of each input file. The name is the file name with
+    extensions in :py:const:`INPUT_EXTENSIONS` removed and a
+    numeric suffix added if another input has the same name
+
+    :param input_files: node table files
+    :type input_files: list
+    :rtype: list
+    """
+    names = []
+    used = set()
+    for input_file in input_files:
+        name = os.path.basename(input_file)
+        for extension in INPUT_EXTENSIONS:
+            if name.endswith(extension) and len(name) > len(extension):
+                name = name[:-len(extension)]
+        unique_name = name
+        suffix = 1
+        while unique_name in used:
+            unique_name = name + '_' + str(suffix)
+            suffix += 1
+        used.add(unique_name)
+        names.append(unique_name)
+    return names
+
+
+def _init_worker(enrichment_args):
+    """
+    Sets up worker process so every input it processes uses
+    the same enrichment arguments and HTTP client configuration
+
+    :param enrichment_args: enrichment arguments other than input
+    :type enrichment_args: list
+    """
+    global _worker_args
+    _worker_args = enrichment_args
+    theargs = enrichment_servicecmd._parse_arguments('batch',
+                                                     [INPUT_PLACEHOLDER] +
+                                                     enrichment_args)
+    httpclient.set_session(enrichment_servicecmd.create_http_session(theargs))
+
+
+def run_input(input_file, output_file, log_file):
+    """
+    Runs enrichment on **input_file** writing result to
+    **output_file** and standard error to **log_file**. Output
+    is written to a temporary file first so **output_file** only
+    exists if enrichment succeeded. Metrics files are not written
+    since every input would overwrite them
+
+    :param input_file: node table file
+    :type input_file: str
+    :param output_file: where to write updateTables action list
+    :type output_file: str
+    :param log_file: where to write standard error
+    :type log_file: str
+    :return: status of input with exit_code 0 for success,
+             :py:const:`NO_RESULTS_EXIT_CODE` or
+             :py:const:`EXCEPTION_EXIT_CODE`
+    :rtype: dict
+    """
+    status = {'input': input_file,
+              'output': None,
+              'log': log_file,
+              'exit_code': 0,
+              'error': None,
+              'stats': {}}
+    start = time.monotonic()
+    tmp_file = output_file + '.tmp'
+    with open(log_file, 'w') as log, contextlib.redirect_stderr(log):
+        try:
+            theargs = enrichment_servicecmd._parse_arguments('batch',
+                                                             [input_file] +
+                                                             _worker_args)
+            metrics.set_metrics(metrics.RunMetrics())
+            with open(tmp_file, 'w') as out:
+                has_results = enrichment_servicecmd.write_enrichment(theargs, out,
+                                                                     stats=status['stats'])
+            if has_results is False:
+                os.remove(tmp_file)
+                status['exit_code'] = NO_RESULTS_EXIT_CODE
+                status['error'] = 'No results'
+                sys.stderr.write('No results\n')
+            else:
+                os.replace(tmp_file, output_file)
+                status['output'] = output_file
+                sys.stderr.write('Run stats: ' +
+                                 json.dumps(status['stats']) + '\n')
+        except (Exception, SystemExit) as e:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+            status['exit_code'] = EXCEPTION_EXIT_CODE
+            status['error'] = str(e)
+            sys.stderr.write('Caught exception: ' + str(e) + '\n')
+    status['seconds'] = time.monotonic() - start
+    return status
+
+
+def _get_shared_cache_dir(theargs):
+    """
+    Creates temporary cache directory shared by the workers for
+    the duration of the batch if no `--cache-dir` is set, so
+    gene lists repeated across inputs are only queried once
+
+    :param theargs: enrichment arguments
+    :return: temporary directory or ``None`` if `--cache-dir` or
+             `--no-cache` is set
+    :rtype: str
+    """
+    if theargs.no_cache or theargs.cache_dir is not None:
+        return None
+    return tempfile.mkdtemp(prefix='enrichment_batch_cache_')
+
+
+def run_batch(input_files, outdir, enrichment_args, processes=1):
+    """
+    Runs enrichment on each of **input_files** on a pool of
+    **processes** worker processes. A failed input is recorded
+    in its status and does not stop the others
+
+    :param input_files: node table files
+    :type input_files: list
+    :param outdir: directory to write output and log of
+                   each input to
+    :type outdir: str
+    :param enrichment_args: enrichment arguments other than input
+    :type enrichment_args: list
+    :param processes: number of worker processes
+    :type processes: int
+    :raises ValueError: if **enrichment_args** are invalid
+    :return: status of each input in order of **input_files**,
+             see :py:func:`run_input`
+    :rtype: list
+    """
+    try:
+        theargs = enrichment_servicecmd._parse_arguments('batch',
+                                                         [INPUT_PLACEHOLDER] +
+                                                         enrichment_args)
+    except SystemExit:
+        raise ValueError('Invalid enrichment arguments: ' +
+                         ' '.join(enrichment_args))
+    os.makedirs(outdir, exist_ok=True)
+
+    temp_cache_dir = _get_shared_cache_dir(theargs)
+    if temp_cache_dir is not None:
+        enrichment_args = enrichment_args + ['--cache-dir', temp_cache_dir]
+        theargs.cache_dir = temp_cache_dir
+    if theargs.cache_dir is not None and not theargs.no_cache:
+        # create cache file before workers start so they do not
+        # race to create it
+        from enrichment_service import resultcache
+        resultcache.ResultCache(theargs.cache_dir)
+
+    names = get_output_names(input_files)
+    statuses = []
+    try:
+        with ProcessPoolExecutor(max_workers=max(processes, 1),
+                                 initializer=_init_worker,
+                                 initargs=(enrichment_args,)) as executor:
+            futures = []
+            for input_file, name in zip(input_files, names):
+                futures.append(executor.submit(run_input, input_file,
+                                               os.path.join(outdir, name +
+                                                            OUTPUT_EXTENSION),
+                                               os.path.join(outdir, name +
+                                                            LOG_EXTENSION)))
+            for input_file, name, future in zip(input_files, names, futures):
+                try:
+                    status = future.result()
+                except Exception as e:
+                    # worker process died
+                    status = {'input': input_file,
+                              'output': None,
+                              'log': os.path.join(outdir, name + LOG_EXTENSION),
+                              'exit_code': EXCEPTION_EXIT_CODE,
+                              'error': 'Worker failed: ' + str(e),
+                              'stats': {}}
+                sys.stderr.write(('Finished ' if status['exit_code'] == 0
+                                  else 'Failed ') + input_file +
+                                 ' with exit code ' + str(status['exit_code']) +
+                                 '\n')
+                statuses.append(status)
+    finally:
+        if temp_cache_dir is not None:
+            shutil.rmtree(temp_cache_dir, ignore_errors=True)
+    return statuses
+
+
+def main(args):
+    """
+    Main entry point for batch command
+
+    :param args: arguments after batch
+    :type args: list
+    :return: 0 if every input succeeded otherwise failure
+    :rtype: int
+    """
+    desc = """
+    Runs enrichment on every node table in a directory or
+    listed in a manifest file using a pool of worker processes.
+    Any enrichment option other than input can be passed after
+    the options below and is used for every input. Workers share
+    one result cache, a temporary one unless --cache-dir is set.
+    The output of each input is written to --outdir with the
+    same name and the exit code, error and run stats of every
+    input to """ + STATUS_FILENAME + """ in --outdir
+    """
+    theargs, enrichment_args = _parse_arguments(desc, args)
+    try:
+        input_files = get_input_files(theargs.inputs)
+        statuses = run_batch(input_files, theargs.outdir, enrichment_args,
+                             processes=theargs.processes)
+    except ValueError as e:
+        sys.stderr.write(str(e) + '\n')
+        return 2
+    failed = len([status for status in statuses if status['exit_code'] != 0])
+    with open(os.path.join(theargs.outdir, STATUS_FILENAME), 'w') as f:
+        json.dump({'inputs': statuses,
+                   'succeeded': len(statuses) - failed,
+                   'failed': failed}, f, indent=2)
+    sys.stderr.write(str(len(statuses) - failed) + ' of ' +
+                     str(len(statuses)) + ' inputs succeeded\n')
+    if failed > 0:
+        return 1
+    return 0
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+Circuit breaker that stops sending rows to a remote service
+that keeps failing
+"""
+
+import time
+import threading
+
+
+# requests are sent to the service
+CLOSED = 'closed'
+
+# requests are refused without contacting the service
+OPEN = 'open'
+
+# one request at a time is let through to probe whether
+# the service recovered
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request to a service
+    whose circuit is open
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive failures of requests to a service. After
+    **failure_threshold** of them in a row the circuit opens and
+    :py:meth:`allow_request` returns False so callers can skip the
+    service instead of waiting out its timeouts. Once open for
+    **reset_timeout** seconds the circuit is half open and lets a
+    single request through every **reset_timeout** seconds. The
+    first success closes the circuit, a failure opens it again.
+
+    Instances are thread safe and meant to be shared by all
+    requests sent to the same service
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0,
+                 clock=time.monotonic):
+        """
+        Constructor
+
+        :param name: name of service used in messages
+        :type name: str
+        :param failure_threshold: consecutive failures after which
+                                  circuit opens
+        :type failure_threshold: int
+        :param reset_timeout: seconds between requests let through
+                              while circuit is open
+        :type reset_timeout: float
+        :param clock: gets current time in seconds
+        :type clock: callable
+        """
+        self._name = name
+        self._failure_threshold = max(1, failure_threshold)
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+        self._state = CLOSED
+        self._failures = 0
+        self._next_probe = 0.0
+        self._opened = 0
+        self._refused = 0
+        self._lock = threading.Lock()
+
+    def get_name(self):
+        """
+        Gets name of service
+
+        :rtype: str
+        """
+        return self._name
+
+    def get_state(self):
+        """
+        Gets :py:const:`CLOSED`, :py:const:`OPEN` or
+        :py:const:`HALF_OPEN`
+
+        :rtype: str
+        """
+        with self._lock:
+            return self._state
+
+    def allow_request(self):
+        """
+        Checks if a request can be sent to the service. While the
+        circuit is open, True is returned at most once every
+        **reset_timeout** seconds and the circuit becomes half open
+
+        :return: True if request should be sent
+        :rtype: bool
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            now = self._clock()
+            if now >= self._next_probe:
+                self._state = HALF_OPEN
+                self._next_probe = now + self._reset_timeout
+                return True
+            self._refused += 1
+            return False
+
+    def check(self):
+        """
+        Same as :py:meth:`allow_request` but raises if request
+        should not be sent
+
+        :raises CircuitOpenError: if circuit is open
+        """
+        if not self.allow_request():
+            raise CircuitOpenError('Circuit of ' + self._name +
+                                   ' is open after ' +
+                                   str(self._failure_threshold) +
+                                   ' consecutive failures')
+
+    def record_success(self):
+        """
+        Records that a request succeeded, closing the circuit
+        """
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        """
+        Records that a request failed or timed out, opening the
+        circuit if it was half open or this is the
+        **failure_threshold** consecutive failure
+        """
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or \
+                    (self._state == CLOSED and
+                     self._failures >= self._failure_threshold):
+                self._state = OPEN
+                self._next_probe = self._clock() + self._reset_timeout
+                self._opened += 1
+
+    def get_report(self):
+        """
+        Gets state, consecutive failures, number of times circuit
+        opened and number of requests refused
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {'state': self._state,
+                    'failures': self._failures,
+                    'opened': self._opened,
+                    'refused': self._refused}
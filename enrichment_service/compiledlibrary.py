@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+"""
+Binary, memory mapped format of
+:py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary` so local
+enrichment does not parse GMT files on every run and processes
+loading the same library share its pages
+"""
+
+import os
+import sys
+import json
+import struct
+import argparse
+from collections.abc import Sequence
+
+import numpy
+
+from enrichment_service import genesetlibrary
+
+
+COMPILED_EXTENSION = '.gslib'
+
+MAGIC = b'ENRGSLIB'
+
+FORMAT_VERSION = 1
+
+# arrays start at multiples of this many bytes
+ALIGNMENT = 64
+
+# magic followed by header length as little endian unsigned 64 bit int
+_PREAMBLE = struct.Struct('<8sQ')
+
+
+class PackedStrings(Sequence):
+    """
+    Read only sequence of strings stored as one UTF-8 encoded byte
+    array and offsets into it, decoded on access
+    """
+
+    def __init__(self, data, offsets):
+        """
+        Constructor
+
+        :param data: encoded strings one after another
+        :type data: :py:class:`numpy.ndarray`
+        :param offsets: start of each string in **data** followed
+                        by length of **data**
+        :type offsets: :py:class:`numpy.ndarray`
+        """
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('index out of range')
+        return self._data[self._offsets[index]:
+                          self._offsets[index + 1]].tobytes().decode('utf-8')
+
+
+class SortedStrings(Sequence):
+    """
+    Read only sequence of strings stored as a sorted fixed width
+    byte string array so they can be looked up with a binary search
+    """
+
+    def __init__(self, values):
+        """
+        Constructor
+
+        :param values: sorted UTF-8 encoded strings
+        :type values: :py:class:`numpy.ndarray` of ``S`` dtype
+        """
+        self._values = values
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, index):
+        return self._values[index].decode('utf-8')
+
+    def get_indices(self, strings):
+        """
+        Gets position of each of **strings**
+
+        :param strings: strings to look up
+        :type strings: list
+        :return: index of each string or -1 if not found
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        indices = numpy.full(len(strings), -1, dtype=numpy.int64)
+        if len(strings) == 0 or len(self._values) == 0:
+            return indices
+        width = self._values.dtype.itemsize
+        encoded = [value.encode('utf-8') for value in strings]
+        # longer strings can not be present and would be truncated
+        candidates = numpy.flatnonzero([len(value) <= width
+                                        for value in encoded])
+        queries = numpy.array([encoded[i] for i in candidates],
+                              dtype=self._values.dtype)
+        positions = numpy.minimum(numpy.searchsorted(self._values, queries),
+                                  len(self._values) - 1)
+        found = self._values[positions] == queries
+        indices[candidates[found]] = positions[found]
+        return indices
+
+
+class InternedStrings(Sequence):
+    """
+    Read only sequence of strings stored as indices into a
+    short list of distinct strings
+    """
+
+    def __init__(self, values, ids):
+        """
+        Constructor
+
+        :param values: distinct strings
+        :type values: list
+        :param ids: index into **values** of each string
+        :type ids: :py:class:`numpy.ndarray`
+        """
+        self._values = values
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, index):
+        return self._values[self._ids[index]]
+
+
+class CompiledGeneSetLibrary(genesetlibrary.GeneSetLibrary):
+    """
+    :py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+    backed by arrays memory mapped from a file written by
+    :py:func:`write_compiled_library`. Nothing is copied on load,
+    pages are read when used and shared by every process that
+    maps the same file
+    """
+
+    def __init__(self, path):
+        """
+        Constructor
+
+        :param path: compiled library
+        :type path: str
+        :raises ValueError: if **path** is not a compiled library
+        """
+        header, data_start = read_header(path)
+        self._path = path
+        self._mmap = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            arrays[name] = numpy.frombuffer(self._mmap,
+                                            dtype=numpy.dtype(spec['dtype']),
+                                            count=spec['count'],
+                                            offset=data_start + spec['offset'])
+        self._sorted_genes = SortedStrings(arrays['genes'])
+        sources = header['sources']
+        super(CompiledGeneSetLibrary, self).__init__(self._sorted_genes,
+                                                     InternedStrings(sources,
+                                                                     arrays['term_source_ids']),
+                                                     PackedStrings(arrays['term_natives_data'],
+                                                                   arrays['term_natives_offsets']),
+                                                     PackedStrings(arrays['term_names_data'],
+                                                                   arrays['term_names_offsets']),
+                                                     arrays['term_indptr'],
+                                                     arrays['term_indices'],
+                                                     gene_indptr=arrays['gene_indptr'],
+                                                     gene_indices=arrays['gene_indices'])
+        self._term_source_ids = (sources, arrays['term_source_ids'])
+
+    def get_path(self):
+        """
+        Gets path of compiled library
+
+        :rtype: str
+        """
+        return self._path
+
+    def get_gene_indices(self, genes):
+        """
+        Gets position in vocabulary of each gene in **genes** with
+        a binary search of the sorted vocabulary instead of
+        building a dict of all genes
+
+        :param genes: genes
+        :type genes: list
+        :return: index of each gene or -1 if gene is not in library
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        return self._sorted_genes.get_indices(genes)
+
+
+def _align(offset):
+    """
+    Rounds **offset** up to a multiple of :py:const:`ALIGNMENT`
+    """
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _pack_strings(strings):
+    """
+    Encodes **strings** into a byte array and offsets as
+    read by :py:class:`PackedStrings`
+
+    :return: (data, offsets)
+    :rtype: tuple
+    """
+    encoded = [value.encode('utf-8') for value in strings]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(value) for value in encoded], out=offsets[1:])
+    data = numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8)
+    return data, offsets
+
+
+def get_compiled_arrays(library):
+    """
+    Gets arrays of compiled format for **library**. The gene
+    vocabulary is sorted so genes can be found with a binary search
+    and term gene indices are renumbered to match
+
+    :param library: library to compile
+    :type library: :py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+    :return: (list of distinct sources, array name => array)
+    :rtype: tuple
+    """
+    encoded_genes = [gene.encode('utf-8') for gene in library.genes]
+    width = max([len(gene) for gene in encoded_genes] + [1])
+    genes = numpy.array(encoded_genes, dtype='S' + str(width))
+    order = numpy.argsort(genes, kind='stable')
+    new_index = numpy.empty(len(order), dtype=numpy.int32)
+    new_index[order] = numpy.arange(len(order), dtype=numpy.int32)
+    term_indices = new_index[library.term_indices]
+
+    sorted_library = genesetlibrary.GeneSetLibrary(genes[order],
+                                                   library.term_sources,
+                                                   library.term_natives,
+                                                   library.term_names,
+                                                   numpy.asarray(library.term_indptr,
+                                                                 dtype=numpy.int64),
+                                                   term_indices)
+    gene_indptr, gene_indices = sorted_library.get_inverted_index()
+    sources, source_ids = sorted_library.get_term_source_ids()
+    natives_data, natives_offsets = _pack_strings(library.term_natives)
+    names_data, names_offsets = _pack_strings(library.term_names)
+    return sources, {'genes': genes[order],
+                     'term_indptr': sorted_library.term_indptr,
+                     'term_indices': term_indices.astype(numpy.int32),
+                     'gene_indptr': gene_indptr.astype(numpy.int64),
+                     'gene_indices': gene_indices.astype(numpy.int32),
+                     'term_source_ids': source_ids.astype(numpy.int32),
+                     'term_natives_data': natives_data,
+                     'term_natives_offsets': natives_offsets,
+                     'term_names_data': names_data,
+                     'term_names_offsets': names_offsets}
+
+
+def write_compiled_library(library, path):
+    """
+    Writes **library** to **path** in compiled format: a magic
+    string, length of a JSON header describing each array and the
+    arrays themselves, each aligned to :py:const:`ALIGNMENT` bytes.
+    The file is written to a temporary name and renamed so readers
+    never see a partial file
+
+    :param library: library to compile
+    :type library: :py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+    :param path: output file
+    :type path: str
+    """
+    sources, arrays = get_compiled_arrays(library)
+    specs = {}
+    offset = 0
+    for name, array in arrays.items():
+        specs[name] = {'dtype': array.dtype.str,
+                       'count': len(array),
+                       'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({'version': FORMAT_VERSION,
+                         'number_of_genes': library.get_number_of_genes(),
+                         'number_of_terms': library.get_number_of_terms(),
+                         'sources': sources,
+                         'arrays': specs}).encode('utf-8')
+    data_start = _align(_PREAMBLE.size + len(header))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + specs[name]['offset'])
+            f.write(numpy.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    """
+    Reads header of compiled library in **path**
+
+    :param path: compiled library
+    :type path: str
+    :raises ValueError: if **path** is not a compiled library or
+                        was written by an unsupported version
+    :return: (header, offset of first array)
+    :rtype: tuple
+    """
+    with open(path, 'rb') as f:
+        preamble = f.read(_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size:
+            raise ValueError(path + ' is not a compiled gene set library')
+        magic, header_length = _PREAMBLE.unpack(preamble)
+        if magic != MAGIC:
+            raise ValueError(path + ' is not a compiled gene set library')
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    if header.get('version') != FORMAT_VERSION:
+        raise ValueError(path + ' has unsupported compiled gene set library '
+                                'version ' + str(header.get('version')))
+    return header, _align(_PREAMBLE.size + header_length)
+
+
+def is_compiled_library(path):
+    """
+    Checks if **path** starts with :py:const:`MAGIC`
+
+    :param path: file to check
+    :type path: str
+    :rtype: bool
+    """
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def load_compiled_library(path):
+    """
+    Memory maps compiled library in **path**
+
+    :param path: compiled library
+    :type path: str
+    :raises ValueError: if **path** is not a compiled library
+    :rtype: :py:class:`CompiledGeneSetLibrary`
+    """
+    return CompiledGeneSetLibrary(path)
+
+
+def _parse_arguments(desc, args):
+    """
+    Parses command line arguments
+
+    :param desc:
+    :param args:
+    :return:
+    """
+    help_fm = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('output',
+                        help='Compiled library to write, by convention '
+                             'ending in ' + COMPILED_EXTENSION)
+    parser.add_argument('--gmt', action='append', required=True,
+                        help='Gene set file in GMT format of form '
+                             '[SOURCE=]PATH. Can be set multiple times')
+    return parser.parse_args(args)
+
+
+def main(args):
+    """
+    Main entry point for compile-library command
+
+    :param args: arguments after compile-library
+    :type args: list
+    :return: 0 for success otherwise failure
+    :rtype: int
+    """
+    desc = """
+    Compiles gene set files in GMT format into a single binary
+    library that local mode memory maps instead of parsing the
+    GMT files on every run. Pass the compiled library to --gmt
+    of local mode in place of the GMT files
+    """
+    theargs = _parse_arguments(desc, args)
+    try:
+        library = genesetlibrary.read_gmt_files(theargs.gmt)
+        write_compiled_library(library, theargs.output)
+    except (IOError, OSError) as e:
+        sys.stderr.write('Unable to compile library: ' + str(e) + '\n')
+        return 2
+    sys.stderr.write('Compiled ' + str(library.get_number_of_terms()) +
+                     ' terms over ' + str(library.get_number_of_genes()) +
+                     ' genes to ' + theargs.output + '\n')
+    return 0
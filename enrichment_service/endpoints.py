@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""
+Health of equivalent endpoints of a remote service, used to pick
+where to submit each task and to limit hedged duplicate submissions
+"""
+
+import time
+import threading
+
+
+class EndpointPool(object):
+    """
+    Picks one of several equivalent endpoints for each new task.
+    Each endpoint has a smoothed completion time, updated with the
+    time taken by its tasks, that is multiplied by one plus its
+    outstanding tasks to score it. The endpoint with the lowest
+    score is picked, so slow or busy endpoints get fewer new tasks.
+    An endpoint whose last **failure_threshold** tasks failed is
+    only picked if every other endpoint is also failing, until
+    **cooldown** seconds have passed.
+
+    The pool also keeps a budget of hedged tasks, duplicates of a
+    slow task submitted to another endpoint, so at most
+    **hedge_fraction** of outstanding tasks, but always at least
+    one, are hedges.
+
+    Instances are thread safe and meant to be shared by all tasks
+    sent to the same endpoints
+    """
+
+    def __init__(self, urls, smoothing=0.2, failure_threshold=3,
+                 cooldown=30.0, hedge_fraction=0.1):
+        """
+        Constructor
+
+        :param urls: endpoints, in order of preference when
+                     nothing is known about them
+        :type urls: list
+        :param smoothing: weight of newest completion time in the
+                          smoothed completion time
+        :type smoothing: float
+        :param failure_threshold: consecutive failed tasks after
+                                  which an endpoint is avoided
+        :type failure_threshold: int
+        :param cooldown: seconds a failing endpoint is avoided
+        :type cooldown: float
+        :param hedge_fraction: maximum fraction of outstanding tasks
+                               that can be hedges
+        :type hedge_fraction: float
+        :raises ValueError: if **urls** is empty
+        """
+        if urls is None or len(urls) == 0:
+            raise ValueError('At least one endpoint is required')
+        self._urls = list(urls)
+        self._smoothing = smoothing
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._hedge_fraction = hedge_fraction
+        self._seconds = {url: None for url in self._urls}
+        self._inflight = {url: 0 for url in self._urls}
+        self._failures = {url: 0 for url in self._urls}
+        self._avoid_until = {url: 0.0 for url in self._urls}
+        self._completed = {url: 0 for url in self._urls}
+        self._hedges = 0
+        self._lock = threading.Lock()
+
+    def get_urls(self):
+        """
+        Gets endpoints of pool
+
+        :rtype: list
+        """
+        return list(self._urls)
+
+    def _get_score(self, url, default_seconds):
+        """
+        Gets score of **url**, lower is better. Must be called
+        with lock held
+
+        :rtype: float
+        """
+        seconds = self._seconds[url]
+        if seconds is None:
+            seconds = default_seconds
+        return seconds * (1 + self._inflight[url])
+
+    def acquire(self, exclude=None):
+        """
+        Picks endpoint for a new task and counts the task as
+        outstanding on it until :py:meth:`release` is called
+
+        :param exclude: endpoints not to pick
+        :type exclude: list
+        :return: endpoint or ``None`` if every endpoint is excluded
+        :rtype: str
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [url for url in self._urls
+                          if exclude is None or url not in exclude]
+            if len(candidates) == 0:
+                return None
+            healthy = [url for url in candidates
+                       if self._avoid_until[url] <= now]
+            if len(healthy) > 0:
+                candidates = healthy
+
+            # endpoints without completed tasks are scored as if
+            # they are as fast as the average of the others
+            known = [seconds for seconds in self._seconds.values()
+                     if seconds is not None]
+            default_seconds = sum(known) / len(known) if len(known) > 0 else 1.0
+            url = min(candidates,
+                      key=lambda candidate: self._get_score(candidate,
+                                                            default_seconds))
+            self._inflight[url] += 1
+            return url
+
+    def release(self, url, seconds=None, failed=False, abandoned=False):
+        """
+        Records that a task on **url** finished
+
+        :param url: endpoint from :py:meth:`acquire`
+        :type url: str
+        :param seconds: time from submission to completion, or to
+                        when the task was abandoned
+        :type seconds: float
+        :param failed: True if task failed or timed out
+        :type failed: bool
+        :param abandoned: True if task was still running when its
+                          result was no longer needed, in which case
+                          **seconds** is only a lower bound of its
+                          completion time and only used to raise the
+                          smoothed completion time
+        :type abandoned: bool
+        """
+        with self._lock:
+            self._inflight[url] = max(0, self._inflight[url] - 1)
+            if failed:
+                self._failures[url] += 1
+                if self._failures[url] >= self._failure_threshold:
+                    self._avoid_until[url] = time.monotonic() + self._cooldown
+                return
+            if seconds is None:
+                return
+            current = self._seconds[url]
+            if abandoned:
+                if current is not None and seconds <= current:
+                    return
+            else:
+                self._failures[url] = 0
+                self._avoid_until[url] = 0.0
+                self._completed[url] += 1
+            if current is None:
+                self._seconds[url] = seconds
+            else:
+                self._seconds[url] = (self._smoothing * seconds +
+                                      (1.0 - self._smoothing) * current)
+
+    def try_start_hedge(self):
+        """
+        Checks budget allows another hedged task and if so counts
+        it until :py:meth:`finish_hedge` is called. A pool with one
+        endpoint never allows hedges
+
+        :return: True if a hedge can be started
+        :rtype: bool
+        """
+        with self._lock:
+            if len(self._urls) < 2:
+                return False
+            tasks = sum(self._inflight.values())
+            if self._hedges >= max(1, int(self._hedge_fraction * tasks)):
+                return False
+            self._hedges += 1
+            return True
+
+    def finish_hedge(self):
+        """
+        Records that a hedged task started with
+        :py:meth:`try_start_hedge` finished
+        """
+        with self._lock:
+            self._hedges = max(0, self._hedges - 1)
+
+    def get_report(self):
+        """
+        Gets health of each endpoint
+
+        :return: endpoint => dict with smoothed completion
+                 ``seconds``, ``inflight`` tasks, ``completed``
+                 tasks, consecutive ``failures`` and ``healthy``
+                 which is False while endpoint is avoided
+        :rtype: dict
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {url: {'seconds': self._seconds[url],
+                          'inflight': self._inflight[url],
+                          'completed': self._completed[url],
+                          'failures': self._failures[url],
+                          'healthy': self._avoid_until[url] <= now}
+                    for url in self._urls}
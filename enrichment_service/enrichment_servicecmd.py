@@ -1,22 +1,167 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import argparse
 import json
 import time
 import re
-
-import pandas
-import requests
-from gprofiler import GProfiler
-
+import heapq
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# pandas, requests, gprofiler, asyncio and the numpy based local
+# enrichment modules are imported by the code paths that need them
+# to keep start up fast for --help and modes that do not use them
 import enrichment_service
+from enrichment_service import circuitbreaker
+from enrichment_service import endpoints
+from enrichment_service import httpclient
+from enrichment_service import metrics
+from enrichment_service import polling
+from enrichment_service import scheduler
+from enrichment_service import streaming
 
 SOURCES_KEY = 'sources'
 RESULTS_KEY = 'results'
 DETAILS_KEY = 'details'
 SIMILARITY_KEY = 'similarity'
 
+VALID_MODES = ['gprofiler', 'iquery', 'local']
+
+# --fallback_mode that only serves results already in the result
+# cache of another mode
+CACHE_FALLBACK = 'cache'
+
+NO_FALLBACK = 'none'
+
+VALID_FALLBACK_MODES = [NO_FALLBACK, CACHE_FALLBACK] + VALID_MODES
+
+# columns set for each term when more then one term is returned
+# per row, see --top-k
+RANKED_COLUMNS = [('CD_CommunityName', 'string'),
+                  ('CD_AnnotatedMembers', 'string'),
+                  ('CD_AnnotatedMembers_Size', 'integer'),
+                  ('CD_AnnotatedMembers_Overlap', 'double'),
+                  ('CD_AnnotatedMembers_Pvalue', 'double'),
+                  ('CD_AnnotatedMembers_SourceDB', 'string'),
+                  ('CD_AnnotatedMembers_SourceTerm', 'string')]
+
+# column holding fingerprint of gene list and parameters of each
+# row, see --fingerprint and --previous-output
+FINGERPRINT_COLUMN = 'CD_EnrichmentFingerprint'
+
+# first argument that runs the long running HTTP service
+SERVE_COMMAND = 'serve'
+
+# first argument that compiles GMT files for local mode
+COMPILE_LIBRARY_COMMAND = 'compile-library'
+
+# first argument that runs enrichment on many node table files
+BATCH_COMMAND = 'batch'
+
+# first argument that runs g:Profiler enrichment once for many
+# combinations of thresholds
+SWEEP_COMMAND = 'sweep'
+
+# modes whose results are stored in the result cache
+CACHED_MODES = ['gprofiler', 'iquery']
+
+CACHE_DIR_ENV = 'ENRICHMENT_SERVICE_CACHE_DIR'
+
+# base URL of g:Profiler, if unset DEFAULT_GPROFILER_URL is used
+GPROFILER_URL_ENV = 'ENRICHMENT_SERVICE_GPROFILER_URL'
+
+# base URL of g:Profiler used by its client by default
+DEFAULT_GPROFILER_URL = 'https://biit.cs.ut.ee/gprofiler'
+
+# iQuery endpoint used when --url is not set
+DEFAULT_IQUERY_URL = 'https://www.ndexbio.org'
+
+# completed iQuery tasks needed before the completion time
+# percentile set by --hedge_percentile is trusted for hedging
+HEDGE_MIN_COMPLETIONS = 10
+
+# seconds to wait for an iQuery task if neither --task_deadline
+# nor --retrycount is set
+DEFAULT_TASK_DEADLINE = 180
+
+# shortest timeout for a request to a remote service when it
+# is cut short by --deadline, requests does not allow 0
+MIN_REQUEST_TIMEOUT = 0.1
+
+# default limit on simultaneous remote requests per mode, used
+# when --maxinflight is not set
+DEFAULT_MAX_INFLIGHT = {'gprofiler': 4,
+                        'iquery': 8}
+
+_gprofiler = None
+_gprofiler_lock = threading.Lock()
+
+_inflight_semaphores = {}
+_inflight_lock = threading.Lock()
+
+_local_libraries = {}
+_local_libraries_lock = threading.Lock()
+
+_minhash_indexes = {}
+_minhash_indexes_lock = threading.Lock()
+
+_result_caches = {}
+_result_caches_lock = threading.Lock()
+
+_poll_schedules = {}
+_poll_schedules_lock = threading.Lock()
+
+_previous_results = {}
+_previous_results_lock = threading.Lock()
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+_journaled_results = {}
+_journaled_results_lock = threading.Lock()
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+_endpoint_pools = {}
+_endpoint_pools_lock = threading.Lock()
+
+
+class IQueryError(Exception):
+    """
+    Raised when an iQuery task fails, as opposed to completing
+    without a matching term, so its outcome is not cached
+    """
+
+    def __init__(self, reason, message):
+        """
+        Constructor
+
+        :param reason: reason the gene list is skipped in the
+                       metrics such as ``submit_failed``,
+                       ``task_failed``, ``task_timeout`` or
+                       ``result_failed``
+        :type reason: str
+        :param message: description of the failure
+        :type message: str
+        """
+        super(IQueryError, self).__init__(message)
+        self._reason = reason
+
+    def get_reason(self):
+        """
+        Gets reason the gene list is skipped in the metrics
+
+        :rtype: str
+        """
+        return self._reason
+
 
 def _parse_arguments(desc, args):
     """
@@ -29,11 +174,15 @@ def _parse_arguments(desc, args):
     parser = argparse.ArgumentParser(description=desc,
                                      formatter_class=help_fm)
     parser.add_argument('input',
-                        help='Input: data in node table format.')
+                        help='Input: data in node table format. '
+                             'If name ends with .gz input is '
+                             'decompressed')
     parser.add_argument('--mode',
-                        choices=['gprofiler', 'iquery'],
+                        choices=VALID_MODES,
                         default='gprofiler',
-                        help='Mode. Default: gprofiler.')
+                        help='Mode. Default: gprofiler. local mode '
+                             'scores against gene sets passed via --gmt '
+                             'without any remote calls')
     parser.add_argument('--maxpval', type=float, default=0.00000001,
                         help='Max p value')
     parser.add_argument('--minoverlap', default=0.05, type=float,
@@ -49,88 +198,445 @@ def _parse_arguments(desc, args):
                                           'error')
     parser.add_argument('--precision', type=int, default=3,
                         help='Number of decimal places to round '
-                             'jaccard')
+                             'jaccard. Not used since jaccard is not '
+                             'part of the result, kept for compatibility')
+    parser.add_argument('--top-k', dest='top_k', default=1, type=int,
+                        help='Number of best terms to return per row in '
+                             'gprofiler and iquery mode. Terms after the '
+                             'best are '
+                             'put in CD_* columns suffixed with their '
+                             'rank ie CD_CommunityName_2')
     parser.add_argument('--organism', default='hsapiens',
                         help='Organism to use')
-    parser.add_argument('--url', default='https://www.ndexbio.org',
-                        help='Endpoint of REST service')
-    parser.add_argument('--polling_interval', default=1,
-                        type=float, help='Time in seconds to'
+    parser.add_argument('--url', action='append',
+                        help='Endpoint of REST service. Can be repeated, '
+                             'or set to a comma delimited list, to spread '
+                             'iQuery tasks over several equivalent '
+                             'endpoints, favoring the fastest and '
+                             'avoiding failing ones. If unset, ' +
+                             DEFAULT_IQUERY_URL + ' is used')
+    parser.add_argument('--hedge_percentile', default=95, type=float,
+                        help='With more than one --url, an iQuery task '
+                             'still running after this percentile of '
+                             'recent task completion times is submitted '
+                             'again to another endpoint and the first '
+                             'result is used. At most a tenth of '
+                             'outstanding tasks are hedged. Set to 0 '
+                             'to disable')
+    parser.add_argument('--polling_interval', default=0.25,
+                        type=float, help='Initial time in seconds to '
                                          'wait between '
                                          'checks on task '
+                                         'completion. The wait backs '
+                                         'off exponentially up to '
+                                         '--max_polling_interval')
+    parser.add_argument('--max_polling_interval', default=5.0,
+                        type=float, help='Maximum time in seconds to '
+                                         'wait between checks on task '
                                          'completion')
+    parser.add_argument('--task_deadline', type=float,
+                        help='Time in seconds to wait for a task to '
+                             'complete. If unset, --retrycount times '
+                             '--polling_interval is used if --retrycount '
+                             'is set, otherwise ' +
+                             str(DEFAULT_TASK_DEADLINE))
     parser.add_argument('--timeout', default=30,
                         type=int, help='Timeout for http '
                                        'requests in seconds')
-    parser.add_argument('--retrycount', default=180, type=int,
-                        help='Number times to check for completed'
-                             'request. Take this value times'
-                             'the --polling_interval to determine'
-                             'how long this tool will wait'
+    parser.add_argument('--retrycount', type=int,
+                        help='Deprecated, use --task_deadline. '
+                             'Take this value times '
+                             'the --polling_interval to determine '
+                             'how long this tool will wait '
                              'for a completed result')
+    parser.add_argument('--gmt', action='append',
+                        help='Gene set library in GMT format used by '
+                             'local mode, in form [SOURCE=]PATH where '
+                             'SOURCE is used as CD_AnnotatedMembers_SourceDB '
+                             'and defaults to file name without .gmt. '
+                             'Can be set multiple times. Can instead be '
+                             'set once to a library made with the ' +
+                             COMPILE_LIBRARY_COMMAND + ' command')
+    parser.add_argument('--lsh_permutations', default=0, type=int,
+                        help='If set, local mode builds MinHash '
+                             'signatures of this many values for the '
+                             'terms of --gmt and only scores terms whose '
+                             'signature suggests their Jaccard with the '
+                             'gene list could reach --minoverlap. Faster '
+                             'on large libraries but a term at '
+                             '--minoverlap is only found with '
+                             'probability --lsh_recall. Only used if '
+                             '--minoverlap and --lsh_recall allow bands '
+                             'of more than one signature value, '
+                             'otherwise every term is scored. 0 scores '
+                             'every term')
+    parser.add_argument('--lsh_recall', default=0.95, type=float,
+                        help='Probability of finding a term whose '
+                             'Jaccard is exactly --minoverlap when '
+                             '--lsh_permutations is set, terms above it '
+                             'are found more often. Higher values score '
+                             'more terms')
+    parser.add_argument('--cache-dir', dest='cache_dir',
+                        default=os.environ.get(CACHE_DIR_ENV),
+                        help='Directory of persistent cache of '
+                             'g:Profiler and iQuery results. If unset, '
+                             'value of ' + CACHE_DIR_ENV + ' environment '
+                             'variable is used and if that is unset no '
+                             'cache is used')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='If set, do NOT read or write result cache')
+    parser.add_argument('--cache-ttl', dest='cache_ttl', default=604800,
+                        type=float,
+                        help='Seconds a cached result is valid')
+    parser.add_argument('--cache-negative-ttl', dest='cache_negative_ttl',
+                        default=3600, type=float,
+                        help='Seconds a cached empty result is valid')
+    parser.add_argument('--cache-maxsize', dest='cache_maxsize',
+                        default=1024, type=float,
+                        help='Maximum size of result cache in megabytes, '
+                             'least recently used results are removed '
+                             'once exceeded')
+    parser.add_argument('--pool_size', default=httpclient.DEFAULT_POOL_SIZE,
+                        type=int,
+                        help='Number of connections to keep alive per '
+                             'host for calls to iQuery')
+    parser.add_argument('--http_retries', default=scheduler.DEFAULT_RETRIES,
+                        type=int,
+                        help='Number of times to retry requests to the '
+                             'remote service that are throttled with a '
+                             'status of ' +
+                             str(scheduler.THROTTLE_STATUS_CODES) +
+                             ', get a status of ' +
+                             str(scheduler.ERROR_STATUS_CODES) +
+                             ' or fail to connect. Retries wait a '
+                             'random exponential backoff or the delay '
+                             'in Retry-After. iQuery task submissions '
+                             'are only retried when throttled')
+    parser.add_argument('--deadline', type=float,
+                        help='Seconds the whole run may take. Once '
+                             'passed, outstanding requests to the remote '
+                             'service are cancelled and the result is '
+                             'written with the rows finished so far. '
+                             'Rows left out are counted and listed in '
+                             'the run stats')
+    parser.add_argument('--breaker_threshold', default=0, type=int,
+                        help='Number of consecutive failed or timed out '
+                             'requests to g:Profiler, or iQuery tasks, '
+                             'after which the circuit of that backend '
+                             'opens and new rows are sent to '
+                             '--fallback_mode instead of waiting out '
+                             'timeouts. 0 disables the circuit breaker '
+                             'so every row is sent to the backend')
+    parser.add_argument('--breaker_reset', default=30.0, type=float,
+                        help='Seconds between rows let through to a '
+                             'backend whose circuit is open, to probe '
+                             'whether it recovered. The first success '
+                             'closes the circuit')
+    parser.add_argument('--fallback_mode', default=NO_FALLBACK,
+                        choices=VALID_FALLBACK_MODES,
+                        help='Where rows go while the circuit of their '
+                             'backend is open. ' + NO_FALLBACK + ' leaves '
+                             'them without a result, ' + CACHE_FALLBACK +
+                             ' uses results of another mode already in '
+                             'the result cache and a mode runs them '
+                             'with that mode. Rows sent to the fallback '
+                             'are counted and listed in the run stats '
+                             'and never get a fingerprint')
+    parser.add_argument('--rate_limit', type=float,
+                        help='Maximum average number of requests per '
+                             'second to the remote service of the '
+                             'selected --mode. If unset, requests are '
+                             'only limited by --maxinflight and by '
+                             'lowering concurrency when the service '
+                             'throttles, fails or slows down')
+    parser.add_argument('--rate_burst', type=int,
+                        help='Maximum number of requests that can be '
+                             'made at once under --rate_limit. If unset, '
+                             '--rate_limit rounded up is used')
+    parser.add_argument('--stream', action='store_true',
+                        help='If set, parse rows of input one at a time '
+                             'and write results of every '
+                             '--stream_chunksize rows as soon as they are '
+                             'ready so memory use does not grow with '
+                             'number of rows')
+    parser.add_argument('--stream_chunksize', default=100, type=int,
+                        help='Number of rows to process at a time '
+                             'with --stream')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of rows to process at the same '
+                             'time. Not used by iquery mode which '
+                             'submits all rows up front, see '
+                             '--maxinflight')
+    parser.add_argument('--maxinflight', type=int,
+                        help='Maximum number of simultaneous requests '
+                             'to the remote service of the selected '
+                             '--mode, for iquery mode this is the '
+                             'number of tasks outstanding on the '
+                             'service. If unset, ' +
+                             str(DEFAULT_MAX_INFLIGHT) + ' is used')
+    parser.add_argument('--gprofiler_batchsize', default=1, type=int,
+                        help='Number of rows to send to g:Profiler '
+                             'in a single multi-query request. A value '
+                             'of 1 sends one request per row')
+    parser.add_argument('--gprofiler_batchmaxgenes', default=5000,
+                        type=int,
+                        help='Maximum total number of genes in a '
+                             'multi-query g:Profiler request. Batches '
+                             'exceeding this are split')
+    parser.add_argument('--fingerprint', action='store_true',
+                        help='Add ' + FINGERPRINT_COLUMN + ' column '
+                             'holding a fingerprint of the genes and '
+                             'parameters of each row so the output can '
+                             'be passed to --previous-output of a later '
+                             'run')
+    parser.add_argument('--previous-output', dest='previous_output',
+                        help='Output of an earlier run made with '
+                             '--fingerprint. Rows whose genes and '
+                             'parameters match a row of that output '
+                             'reuse its result instead of being '
+                             'queried again. Implies --fingerprint')
+    parser.add_argument('--journal',
+                        help='If set, the result of each gene list is '
+                             'appended to this file as soon as it is '
+                             'done so a run that dies partway through '
+                             'can be continued with --resume. Results '
+                             'are keyed by a fingerprint of the genes '
+                             'and parameters, like --previous-output, '
+                             'so a journal can be shared by runs. Rows '
+                             'that failed or were sent to --fallback_mode '
+                             'are not recorded so --resume retries them')
+    parser.add_argument('--resume', action='store_true',
+                        help='Rows whose genes and parameters match a '
+                             'result in --journal reuse it and only '
+                             'the remaining rows are processed. Output '
+                             'is the same as that of a run that was '
+                             'never interrupted')
+    parser.add_argument('--metrics-out', dest='metrics_out',
+                        help='If set, JSON report of time spent per '
+                             'row and per phase, requests made to '
+                             'remote services, retries, iQuery polls, cache hits '
+                             'and gene lists skipped by reason is '
+                             'written to this file')
+    parser.add_argument('--metrics-prometheus', dest='metrics_prometheus',
+                        help='If set, the metrics of --metrics-out are '
+                             'written in Prometheus text format to '
+                             'this file')
     return parser.parse_args(args)
 
 
+def _iquery_get(session, url, user_agent, timeout, operation,
+                read_body=None):
+    """
+    Makes ``GET`` request to **url** recording it under
+    **operation** in the metrics
+
+    :param read_body: if set, the body is streamed and this is
+                      called with the response, if its status
+                      is 200, before the request is recorded
+    :type read_body: function
+    :rtype: :py:class:`requests.Response`
+    """
+    with metrics.get_metrics().time_request(operation) as request:
+        res = session.get(url,
+                          headers={'Content-Type': 'application/json',
+                                   'User_agent': user_agent},
+                          timeout=timeout, stream=read_body is not None)
+        if read_body is not None:
+            try:
+                if res.status_code == 200:
+                    read_body(res)
+            finally:
+                res.close()
+        request['status'] = res.status_code
+    return res
+
+
 def get_completed_result(resturl, taskid, user_agent,
-                         timeout=30):
+                         timeout=30, session=None, thescheduler=None,
+                         topk=1):
     """
+    Gets result of completed task **taskid**. The body is parsed
+    as it arrives by
+    :py:func:`~enrichment_service.streaming.read_iquery_result`
+    so only the **topk** results of each source with the highest
+    similarity are kept in memory
 
-    :param resultasdict:
-    :return:
+    :param resturl:
+    :param taskid:
+    :param user_agent:
+    :param timeout:
+    :param session: session to use, if ``None`` the one from
+                    :py:func:`~enrichment_service.httpclient.get_session`
+                    is used
+    :type session: :py:class:`requests.Session`
+    :param thescheduler: limits and retries requests, if ``None``
+                         request is made once right away
+    :type thescheduler: :py:class:`~enrichment_service.scheduler.BackendScheduler`
+    :param topk: number of results to keep per source
+    :type topk: int
+    :return: result as dict or ``None`` upon error
+    :rtype: dict
     """
-    res = requests.get(resturl + '/integratedsearch/v1/' + taskid +
-                       '',
-                       headers={'Content-Type': 'application/json',
-                                'User_agent': user_agent},
-                       timeout=timeout)
+    if session is None:
+        session = httpclient.get_session()
+    parsed = {}
+
+    def read_body(res):
+        parsed['result'] = streaming.read_iquery_result(httpclient.ResponseReader(res),
+                                                        topk=topk)
+
+    res = scheduler.call(thescheduler,
+                         lambda: _iquery_get(session, resturl +
+                                             '/integratedsearch/v1/' + taskid,
+                                             user_agent, timeout,
+                                             'iquery_result',
+                                             read_body=read_body))
     if res.status_code != 200:
         sys.stderr.write('Received http error: ' +
                          str(res.status_code) + '\n')
         return None
-    return res.json()
+    return parsed['result']
+
+
+def get_task_status(resturl, taskid, user_agent, timeout=30,
+                    session=None, thescheduler=None):
+    """
+    Checks once if task **taskid** on **resturl** is done
+
+    :param resturl:
+    :param taskid:
+    :param user_agent:
+    :param timeout:
+    :param session: see :py:func:`get_completed_result`
+    :param thescheduler: see :py:func:`get_completed_result`
+    :raises requests.exceptions.RequestException: upon error
+                                                  talking to service
+    :return: (``None`` if task is still running, True if task
+             completed successfully False if it failed, seconds
+             from ``Retry-After`` header or ``None``)
+    :rtype: tuple
+    """
+    if session is None:
+        session = httpclient.get_session()
+    res = scheduler.call(thescheduler,
+                         lambda: _iquery_get(session, resturl +
+                                             '/integratedsearch/v1/' +
+                                             taskid + '/status',
+                                             user_agent, timeout,
+                                             'iquery_status'))
+
+    retry_after = polling.get_retry_after(res)
+    if res.status_code == 200:
+        jsonres = res.json()
+        if jsonres['progress'] == 100:
+            if jsonres['status'] != 'complete':
+                sys.stderr.write('Got error: ' + str(jsonres) + '\n')
+                return False, retry_after
+            return True, retry_after
+    else:
+        sys.stderr.write('Received error : ' +
+                         str(res.status_code) +
+                         ' while polling for completion')
+    return None, retry_after
+
+
+def _check_task_status(resturl, taskid, user_agent, timeout=30,
+                       session=None, thescheduler=None):
+    """
+    Same as :py:func:`get_task_status` but logs errors talking to
+    the service and treats them as task still running
+
+    :return: see :py:func:`get_task_status`
+    :rtype: tuple
+    """
+    import requests
+    try:
+        return get_task_status(resturl, taskid, user_agent, timeout=timeout,
+                               session=session, thescheduler=thescheduler)
+    except requests.exceptions.RequestException as e:
+        sys.stderr.write('Received exception waiting for task'
+                         'completion: ' + str(e))
+        return None, None
+
+
+def _finish_polling(poller, taskid):
+    """
+    Records number of checks made by **poller** in the metrics and
+    logs a message if task **taskid** timed out
+
+    :param poller: poller of task
+    :type poller: :py:class:`~enrichment_service.polling.TaskPoller`
+    :return: see :py:meth:`~enrichment_service.polling.TaskPoller.get_failure_reason`
+    :rtype: str
+    """
+    metrics.get_metrics().observe(metrics.POLLS_PER_TASK, poller.get_polls())
+    reason = poller.get_failure_reason()
+    if reason == 'task_timeout':
+        sys.stderr.write('Task ' + str(taskid) + ' did not complete within ' +
+                         str(poller.get_deadline()) + ' seconds\n')
+    return reason
 
 
 def wait_for_result(resturl, taskid, user_agent, polling_interval=1,
                     timeout=30,
-                    retrycount=180):
+                    retrycount=180, deadline=None, schedule=None,
+                    session=None, thescheduler=None, start=None):
     """
-    Polls **resturl** with **taskid**
+    Polls **resturl** with **taskid** using delays from **schedule**,
+    waiting longer if the service sends a ``Retry-After`` header,
+    until the task completes or **deadline** seconds have passed,
+    see :py:class:`~enrichment_service.polling.TaskPoller`
+
     :param resturl:
     :param taskid:
     :param user_agent:
-    :param polling_interval:
+    :param polling_interval: initial delay if **schedule** is ``None``
     :param timeout:
-    :param retrycount:
+    :param retrycount: if **deadline** is ``None``, this times
+                       **polling_interval** is used as deadline
+    :param deadline: seconds to wait for task to complete
+    :type deadline: float
+    :param schedule: delays between checks, completion times of
+                     successful tasks are recorded in it
+    :type schedule: :py:class:`~enrichment_service.polling.PollSchedule`
+    :param session: see :py:func:`get_completed_result`
+    :param thescheduler: see :py:func:`get_completed_result`
+    :param start: time from :py:func:`time.monotonic` the task was
+                  submitted, **deadline** and completion times count
+                  from it. If ``None`` the current time
+    :type start: float
     :return: True if task completed successfully False otherwise
     :rtype: bool
     """
-    counter = 0
-    while counter < retrycount:
-        try:
-            res = requests.get(resturl + '/integratedsearch/v1/' +
-                               taskid + '/status',
-                               headers={'Content-Type': 'application/json',
-                                        'User_agent': user_agent},
-                               timeout=timeout)
+    if deadline is None:
+        deadline = polling_interval * retrycount
+    if schedule is None:
+        schedule = polling.PollSchedule(initial_interval=polling_interval)
+    poller = polling.TaskPoller(schedule, deadline, start=start)
+    return _poll_task(resturl, taskid, user_agent, poller, timeout=timeout,
+                      session=session, thescheduler=thescheduler) is None
 
-            if res.status_code == 200:
-                jsonres = res.json()
-                if jsonres['progress'] == 100:
-                    if jsonres['status'] != 'complete':
-                        sys.stderr.write('Got error: ' + str(jsonres) + '\n')
-                        return False
-                    return True
-            else:
-                sys.stderr.write('Received error : ' +
-                                 str(res.status_code) +
-                                 ' while polling for completion')
-        except requests.exceptions.RequestException as e:
-            sys.stderr.write('Received exception waiting for task'
-                             'completion: ' + str(e))
 
-        counter += 1
-        time.sleep(polling_interval)
-    return False
+def _poll_task(resturl, taskid, user_agent, poller, timeout=30,
+               session=None, thescheduler=None):
+    """
+    Checks task **taskid** after each delay from **poller**
+    until it is done, see :py:func:`wait_for_result`
+
+    :param poller: poller of task
+    :type poller: :py:class:`~enrichment_service.polling.TaskPoller`
+    :return: see :py:meth:`~enrichment_service.polling.TaskPoller.get_failure_reason`
+    :rtype: str
+    """
+    run_metrics = metrics.get_metrics()
+    for delay in poller.get_delays():
+        with run_metrics.time_phase('iquery_poll_sleep'):
+            time.sleep(delay)
+        poller.record_status(*_check_task_status(resturl, taskid, user_agent,
+                                                 timeout=timeout,
+                                                 session=session,
+                                                 thescheduler=thescheduler))
+    return _finish_polling(poller, taskid)
 
 
 def get_best_result_by_similarity(resultasdict):
@@ -155,10 +661,63 @@ def get_best_result_by_similarity(resultasdict):
     return best_result
 
 
-def get_result_in_mapped_term_json(resultasdict, genes):
+def get_top_results_by_similarity(resultasdict, topk=1):
     """
+    Gets the **topk** results with the highest cosine similarity
+    across all sources, picking the earliest upon ties like
+    :py:func:`get_best_result_by_similarity`. Sources without
+    results are skipped
 
     :param resultasdict:
+    :type resultasdict: dict
+    :param topk: number of results to return
+    :type topk: int
+    :return: results as dicts, best first
+    :rtype: list
+    """
+    return heapq.nlargest(max(1, topk),
+                          (curresult for cursource in resultasdict[SOURCES_KEY]
+                           for curresult in cursource.get(RESULTS_KEY) or []),
+                          key=lambda curresult: curresult[DETAILS_KEY][SIMILARITY_KEY])
+
+
+def _get_iquery_term(curresult, genes):
+    """
+    Gets iQuery result **curresult** for **genes** in CD_* format
+
+    :rtype: dict
+    """
+    colon_loc = curresult['description'].find(':')
+    if colon_loc == -1:
+        source = 'NA'
+    else:
+        source = curresult['description'][0:colon_loc]
+
+    annotated_members = curresult['hitGenes']
+    name = curresult['description'][colon_loc + 1:].lstrip()
+
+    return {'CD_CommunityName': name,
+            'CD_AnnotatedMembers': ' '.join(annotated_members),
+            'CD_AnnotatedMembers_Size': len(annotated_members),
+            'CD_AnnotatedMembers_Overlap': len(annotated_members) / len(genes),
+            'CD_AnnotatedMembers_Pvalue': curresult['details']['PValue'],
+            'CD_Labeled': len(name) > 0,
+            'CD_AnnotatedAlgorithm': 'iQuery',
+            'CD_NonAnnotatedMembers': ' '.join(list(set(genes) - set(annotated_members))),
+            'CD_AnnotatedMembers_SourceDB': source,
+            'CD_AnnotatedMembers_SourceTerm': 'NA'
+            }
+
+
+def get_result_in_mapped_term_json(resultasdict, genes, topk=1):
+    """
+    Gets best result by similarity in CD_* format. If **topk**
+    is greater then 1, the next best results are added with
+    column names from :py:func:`get_ranked_column_name`
+
+    :param resultasdict:
+    :param topk: number of results to return
+    :type topk: int
     :return:
     """
 
@@ -190,134 +749,1032 @@ def get_result_in_mapped_term_json(resultasdict, genes):
         sys.stderr.write('No result found\n')
         return None
 
-    bestresult = get_best_result_by_similarity(resultasdict)
+    theres = {}
+    for rank, curresult in enumerate(get_top_results_by_similarity(resultasdict,
+                                                                   topk=topk),
+                                     start=1):
+        ranked_res = _get_iquery_term(curresult, genes)
+        if rank > 1:
+            ranked_res = {column: ranked_res[column]
+                          for column, column_type in RANKED_COLUMNS}
+        for column, value in ranked_res.items():
+            theres[get_ranked_column_name(column, rank)] = value
+    return theres
 
-    colon_loc = bestresult['description'].find(':')
-    if colon_loc == -1:
-        source = 'NA'
-    else:
-        source = bestresult['description'][0:colon_loc]
-
-    annotated_members = bestresult['hitGenes']
-    name = bestresult['description'][colon_loc + 1:].lstrip()
-
-    theres = {'CD_CommunityName': name,
-              'CD_AnnotatedMembers': ' '.join(annotated_members),
-              'CD_AnnotatedMembers_Size': len(annotated_members),
-              'CD_AnnotatedMembers_Overlap': len(annotated_members) / len(genes),
-              'CD_AnnotatedMembers_Pvalue': bestresult['details']['PValue'],
-              'CD_Labeled': len(name) > 0,
-              'CD_AnnotatedAlgorithm': 'iQuery',
-              'CD_NonAnnotatedMembers': ' '.join(list(set(genes) - set(annotated_members))),
-              'CD_AnnotatedMembers_SourceDB': source,
-              'CD_AnnotatedMembers_SourceTerm': 'NA'
-              }
 
-    return theres
+def get_task_deadline(theargs):
+    """
+    Gets seconds to wait for an iQuery task to complete which is
+    `--task_deadline` if set, otherwise `--retrycount` times
+    `--polling_interval` if `--retrycount` is set, otherwise
+    :py:const:`DEFAULT_TASK_DEADLINE`
+
+    :rtype: float
+    """
+    if theargs.task_deadline is not None:
+        return theargs.task_deadline
+    if theargs.retrycount is not None:
+        return theargs.retrycount * theargs.polling_interval
+    return DEFAULT_TASK_DEADLINE
 
 
-def run_iquery(genes, theargs):
+def get_poll_schedule(theargs):
     """
-    todo
+    Gets process wide poll schedule for `--polling_interval` and
+    `--max_polling_interval` so completion times of all tasks
+    tune the delays of later tasks
 
-    :param inputfile:
-    :param theargs:
-    :param gprofwrapper:
-    :return:
+    :rtype: :py:class:`~enrichment_service.polling.PollSchedule`
     """
-    if genes is None or len(genes) == 0 or (len(genes) == 1 and len(genes[0].strip()) == 0):
+    key = (theargs.polling_interval, theargs.max_polling_interval)
+    with _poll_schedules_lock:
+        if key not in _poll_schedules:
+            _poll_schedules[key] = polling.PollSchedule(initial_interval=theargs.polling_interval,
+                                                        max_interval=theargs.max_polling_interval)
+        return _poll_schedules[key]
+
+
+def get_iquery_urls(theargs):
+    """
+    Gets iQuery endpoints from every `--url`, splitting comma
+    delimited lists and dropping duplicates and trailing slashes.
+    `--url` can also be a single str as set by callers that
+    build the arguments themselves
+
+    :param theargs: parsed command line arguments
+    :return: endpoints in the order given or
+             :py:const:`DEFAULT_IQUERY_URL` if `--url` is not set
+    :rtype: list
+    """
+    if theargs.url is None:
+        return [DEFAULT_IQUERY_URL]
+    values = theargs.url
+    if isinstance(values, str):
+        values = [values]
+    urls = []
+    for value in values:
+        for url in value.split(','):
+            url = url.strip().rstrip('/')
+            if len(url) > 0 and url not in urls:
+                urls.append(url)
+    if len(urls) == 0:
+        return [DEFAULT_IQUERY_URL]
+    return urls
+
+
+def get_endpoint_pool(theargs):
+    """
+    Gets process wide pool of the endpoints from
+    :py:func:`get_iquery_urls` so the health of each endpoint
+    is learned from every task sent to it
+
+    :rtype: :py:class:`~enrichment_service.endpoints.EndpointPool`
+    """
+    key = tuple(get_iquery_urls(theargs))
+    with _endpoint_pools_lock:
+        if key not in _endpoint_pools:
+            _endpoint_pools[key] = endpoints.EndpointPool(list(key))
+        return _endpoint_pools[key]
+
+
+def get_hedge_delay(theargs, schedule):
+    """
+    Gets seconds after submission at which an iQuery task still
+    running is hedged, which is the `--hedge_percentile` of
+    completion times recorded in **schedule**
+
+    :param theargs: parsed command line arguments
+    :param schedule: see :py:func:`get_poll_schedule`
+    :type schedule: :py:class:`~enrichment_service.polling.PollSchedule`
+    :return: seconds or ``None`` if hedging is disabled, there is
+             only one endpoint or fewer than
+             :py:const:`HEDGE_MIN_COMPLETIONS` tasks have completed
+    :rtype: float
+    """
+    if theargs.hedge_percentile <= 0 or len(get_iquery_urls(theargs)) < 2:
         return None
-    user_agent = 'enrichment-service/' + enrichment_service.__version__
-    resturl = theargs.url
+    if schedule.get_completion_count() < HEDGE_MIN_COMPLETIONS:
+        return None
+    return schedule.get_completion_time_percentile(min(theargs.hedge_percentile,
+                                                       100))
 
+
+def submit_iquery_task(resturl, genes, user_agent, timeout=30,
+                       session=None, thescheduler=None):
+    """
+    Submits enrichment task for **genes** to **resturl**. Since
+    a failed submission may still have created a task, it is
+    only retried if the service throttled it
+
+    :param resturl:
+    :param genes: genes to query
+    :type genes: list
+    :param user_agent:
+    :param timeout:
+    :param session: see :py:func:`get_completed_result`
+    :param thescheduler: see :py:func:`get_completed_result`
+    :return: id of task or ``None`` if service did not accept task
+    :rtype: str
+    """
     query = {'geneList': genes,
              'sourceList': ['enrichment']}
-    res = requests.post(resturl + '/integratedsearch/v1/',
-                        json=query, headers={'Content-Type': 'application/json',
-                                             'User-Agent': user_agent},
-                        timeout=theargs.timeout)
+    if session is None:
+        session = httpclient.get_session()
+
+    def submit():
+        with metrics.get_metrics().time_request('iquery_submit') as request:
+            res = session.post(resturl + '/integratedsearch/v1/',
+                               json=query, headers={'Content-Type': 'application/json',
+                                                    'User-Agent': user_agent},
+                               timeout=timeout)
+            request['status'] = res.status_code
+        return res
+
+    res = scheduler.call(thescheduler, submit,
+                         retry_on=scheduler.RETRY_NON_IDEMPOTENT)
     if res.status_code != 202:
         sys.stderr.write('Got error status from service: ' + str(res.status_code) + ' : ' + res.text + '\n')
         return None
 
-    taskid = res.json()['id']
+    return res.json()['id']
+
+
+def _is_valid_iquery_genelist(genes):
+    """
+    Checks **genes** is a non empty list
+
+    :rtype: bool
+    """
+    if genes is None or len(genes) == 0 or (len(genes) == 1 and len(genes[0].strip()) == 0):
+        metrics.get_metrics().skip('empty_genelist')
+        return False
+    return True
+
+
+def _release_endpoint(pool, resturl, start, failed=False, abandoned=False):
+    """
+    Records in **pool** and the metrics that an iQuery task
+    submitted to **resturl** at **start** finished
+
+    :param failed: True if task failed or timed out
+    :param abandoned: True if result of task is no longer needed
+    """
+    if abandoned:
+        outcome = 'abandoned'
+    elif failed:
+        outcome = 'failed'
+    else:
+        outcome = 'completed'
+    metrics.get_metrics().increment(metrics.IQUERY_TASKS,
+                                    labels={'endpoint': resturl,
+                                            'outcome': outcome})
+    pool.release(resturl, seconds=time.monotonic() - start, failed=failed,
+                 abandoned=abandoned)
+
+
+def _record_iquery_outcome(breaker, theargs, completed):
+    """
+    Records in **breaker**, if set, whether an iQuery task
+    completed. Tasks cut short by the run deadline are not
+    recorded since they say nothing about the service
+    """
+    if breaker is None or get_run_deadline(theargs).expired():
+        return
+    if completed:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+
+
+def run_iquery(genes, theargs, session=None):
+    """
+    Submits **genes** to the healthiest iQuery endpoint from
+    :py:func:`get_endpoint_pool`, waits for the task to
+    complete and returns best result as found by
+    :py:func:`get_result_in_mapped_term_json`. If the task
+    fails or the circuit of iQuery is open a message is written
+    to standard error and ``None`` is returned
+
+    :param genes: genes to query
+    :type genes: list
+    :param theargs: parsed command line arguments
+    :param session: see :py:func:`get_completed_result`
+    :return: result in CD_* format or ``None`` if no result
+    :rtype: dict
+    """
+    try:
+        return _run_iquery(genes, theargs, session=session)
+    except IQueryError as e:
+        sys.stderr.write(str(e) + '\n')
+        metrics.get_metrics().skip(e.get_reason())
+    except circuitbreaker.CircuitOpenError as e:
+        sys.stderr.write(str(e) + '\n')
+        metrics.get_metrics().skip('circuit_open')
+    return None
 
-    if wait_for_result(resturl, taskid, user_agent,
-                       timeout=theargs.timeout,
-                       retrycount=theargs.retrycount,
-                       polling_interval=theargs.polling_interval) is False:
+
+def _run_iquery(genes, theargs, session=None):
+    """
+    Same as :py:func:`run_iquery` except failures are raised so
+    they can be told apart from a task without a matching term,
+    which must not be cached
+
+    :raises CircuitOpenError: if circuit of iQuery is open
+    :raises IQueryError: if task was not accepted, failed, did
+                         not complete in time or its result could
+                         not be fetched
+    :return: result in CD_* format or ``None`` if no result
+    :rtype: dict
+    """
+    if not _is_valid_iquery_genelist(genes):
         return None
+    breaker = get_circuit_breaker(theargs, 'iquery')
+    if breaker is not None:
+        breaker.check()
+    user_agent = 'enrichment-service/' + enrichment_service.__version__
+    pool = get_endpoint_pool(theargs)
+    resturl = pool.acquire()
+    thescheduler = get_scheduler(theargs, 'iquery', endpoint=resturl)
+
+    start = time.monotonic()
+    completed = False
+    try:
+        taskid = submit_iquery_task(resturl, genes, user_agent,
+                                    timeout=_get_request_timeout(theargs),
+                                    session=session, thescheduler=thescheduler)
+        if taskid is None:
+            raise IQueryError('submit_failed', 'Task was not accepted by ' +
+                              resturl)
+
+        poller = polling.TaskPoller(get_poll_schedule(theargs),
+                                    get_run_deadline(theargs).cap(get_task_deadline(theargs)),
+                                    start=start)
+        reason = _poll_task(resturl, taskid, user_agent, poller,
+                            timeout=_get_request_timeout(theargs),
+                            session=session, thescheduler=thescheduler)
+        if reason is not None:
+            raise IQueryError(reason, 'Task ' + str(taskid) + ' on ' +
+                              resturl + ' did not complete')
+
+        resjson = get_completed_result(resturl, taskid, user_agent,
+                                       timeout=_get_request_timeout(theargs),
+                                       session=session, thescheduler=thescheduler,
+                                       topk=_get_topk(theargs, 'iquery'))
+        if resjson is None:
+            raise IQueryError('result_failed', 'Could not get result of task ' +
+                              str(taskid) + ' on ' + resturl)
+        completed = True
+    finally:
+        _release_endpoint(pool, resturl, start, failed=not completed)
+        _record_iquery_outcome(breaker, theargs, completed)
+    return _get_iquery_result(resjson, genes, topk=_get_topk(theargs, 'iquery'))
+
+
+def _get_iquery_result(resjson, genes, topk=1):
+    """
+    Wrapper around :py:func:`get_result_in_mapped_term_json` that
+    counts results without a term in the metrics
 
-    resjson = get_completed_result(resturl, taskid, user_agent,
-                                   timeout=theargs.timeout)
-    return get_result_in_mapped_term_json(resjson, genes)
+    :rtype: dict
+    """
+    res = get_result_in_mapped_term_json(resjson, genes, topk=topk)
+    if res is None:
+        metrics.get_metrics().skip('no_result')
+    return res
 
 
-def run_gprofiler(genes, maxgenelistsize, organism, maxpval, omit_intersections, minoverlap, excludesource, precision,
-                  gprofwrapper=GProfiler(user_agent='enrichment-service/' + enrichment_service.__version__,
-                                         return_dataframe=True)):
+async def _run_iquery_task_async(genes, theargs, pool, resturl, executor,
+                                 session=None):
+    """
+    Submits **genes** to **resturl**, which was acquired from
+    **pool**, and polls until the task completes. The outcome is
+    released to **pool**, including when the coroutine is cancelled
+    because another submission of **genes** finished first. Polling
+    stops at `--task_deadline` or the deadline from
+    :py:func:`get_run_deadline`, whichever comes first
+
+    :param genes: genes to query
+    :type genes: list
+    :param theargs: parsed command line arguments
+    :param pool: see :py:func:`get_endpoint_pool`
+    :type pool: :py:class:`~enrichment_service.endpoints.EndpointPool`
+    :param resturl: endpoint to submit task to
+    :type resturl: str
+    :param executor: see :py:func:`run_iquery_async`
+    :param session: see :py:func:`get_completed_result`
+    :return: (result as dict, ``None``) if task completed otherwise
+             (``None``, reason there is no result) where the reason
+             is ``deadline`` if the run deadline passed first
+    :rtype: tuple
     """
-    todo
+    import asyncio
+    user_agent = 'enrichment-service/' + enrichment_service.__version__
+    loop = asyncio.get_running_loop()
+    run_metrics = metrics.get_metrics()
+    thescheduler = get_scheduler(theargs, 'iquery', endpoint=resturl)
+
+    start = time.monotonic()
+    try:
+        submit = functools.partial(submit_iquery_task, resturl, genes,
+                                   user_agent,
+                                   timeout=_get_request_timeout(theargs),
+                                   session=session,
+                                   thescheduler=thescheduler)
+        taskid = await loop.run_in_executor(executor, submit)
+        if taskid is None:
+            _release_endpoint(pool, resturl, start, failed=True)
+            return None, 'submit_failed'
+
+        task_deadline = get_task_deadline(theargs)
+        poll_deadline = get_run_deadline(theargs).cap(task_deadline)
+        poller = polling.TaskPoller(get_poll_schedule(theargs), poll_deadline,
+                                    start=start)
+        for delay in poller.get_delays():
+            with run_metrics.time_phase('iquery_poll_sleep'):
+                await asyncio.sleep(delay)
+            check = functools.partial(_check_task_status, resturl, taskid,
+                                      user_agent,
+                                      timeout=_get_request_timeout(theargs),
+                                      session=session,
+                                      thescheduler=thescheduler)
+            poller.record_status(*await loop.run_in_executor(executor, check))
+        reason = _finish_polling(poller, taskid)
+        if reason == 'task_timeout' and poll_deadline < task_deadline:
+            # cut short by the run, says nothing about the endpoint
+            _release_endpoint(pool, resturl, start, abandoned=True)
+            return None, 'deadline'
+        if reason is not None:
+            _release_endpoint(pool, resturl, start, failed=True)
+            return None, reason
+
+        fetch = functools.partial(get_completed_result, resturl, taskid,
+                                  user_agent,
+                                  timeout=_get_request_timeout(theargs),
+                                  session=session,
+                                  thescheduler=thescheduler,
+                                  topk=_get_topk(theargs, 'iquery'))
+        resjson = await loop.run_in_executor(executor, fetch)
+        if resjson is None:
+            _release_endpoint(pool, resturl, start, failed=True)
+            return None, 'result_failed'
+    except asyncio.CancelledError:
+        _release_endpoint(pool, resturl, start, abandoned=True)
+        raise
+    except Exception:
+        _release_endpoint(pool, resturl, start, failed=True)
+        raise
+    _release_endpoint(pool, resturl, start)
+    return resjson, None
+
+
+async def run_iquery_async(genes, theargs, semaphore, executor,
+                           session=None):
+    """
+    Coroutine version of :py:func:`run_iquery`. The blocking HTTP
+    calls run on **executor** so many tasks can be outstanding
+    while the event loop polls all of them.
+
+    If the task is still running after the delay from
+    :py:func:`get_hedge_delay`, and the budget of the endpoint
+    pool allows it, the genes are submitted again to another
+    endpoint. The first submission to complete is used and the
+    other is abandoned, so a hedged task briefly takes up two
+    places on the service while holding one of **semaphore**
+
+    :param genes: genes to query
+    :type genes: list
+    :param theargs: parsed command line arguments
+    :param semaphore: limits number of tasks outstanding on the service
+    :type semaphore: :py:class:`asyncio.Semaphore`
+    :param executor: runs the HTTP requests
+    :type executor: :py:class:`concurrent.futures.Executor`
+    :param session: see :py:func:`get_completed_result`
+    :raises CircuitOpenError: if circuit of iQuery is open once
+                              the task can start
+    :raises DeadlineExceeded: if the run deadline passed before
+                              the task completed
+    :raises IQueryError: see :py:func:`_run_iquery`
+    :return: result in CD_* format or ``None`` if no result
+    :rtype: dict
     """
-    genelist_size = len(genes)
-    if genes is None or genelist_size == 0 or (genelist_size == 1 and len(genes[0].strip()) == 0):
+    if not _is_valid_iquery_genelist(genes):
         return None
-    if genelist_size > maxgenelistsize:
+    import asyncio
+    run_metrics = metrics.get_metrics()
+    pool = get_endpoint_pool(theargs)
+    breaker = get_circuit_breaker(theargs, 'iquery')
+
+    queued = time.monotonic()
+    async with semaphore:
+        run_metrics.observe(metrics.PHASE_SECONDS, time.monotonic() - queued,
+                            labels={'phase': 'iquery_queue'})
+        if breaker is not None:
+            breaker.check()
+        timeout = get_hedge_delay(theargs, get_poll_schedule(theargs))
+        resturl = pool.acquire()
+        attempts = [asyncio.ensure_future(_run_iquery_task_async(genes, theargs, pool,
+                                                                 resturl, executor,
+                                                                 session=session))]
+        hedge = None
+        winner = None
+        resjson = None
+        reason = None
+        error = None
+        try:
+            pending = set(attempts)
+            while winner is None and len(pending) > 0:
+                done, pending = await asyncio.wait(pending, timeout=timeout,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if len(done) == 0:
+                    # still running after hedge delay
+                    timeout = None
+                    if not pool.try_start_hedge():
+                        continue
+                    hedge_url = pool.acquire(exclude=[resturl])
+                    if hedge_url is None:
+                        pool.finish_hedge()
+                        continue
+                    hedge = asyncio.ensure_future(_run_iquery_task_async(genes, theargs, pool,
+                                                                         hedge_url, executor,
+                                                                         session=session))
+                    attempts.append(hedge)
+                    pending.add(hedge)
+                    continue
+                for attempt in done:
+                    if attempt.exception() is not None:
+                        error = attempt.exception()
+                        continue
+                    resjson, reason = attempt.result()
+                    if reason is None:
+                        winner = attempt
+                        break
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+            await asyncio.gather(*attempts, return_exceptions=True)
+            if hedge is not None:
+                pool.finish_hedge()
+                run_metrics.increment(metrics.HEDGES,
+                                      labels={'outcome': 'won' if winner is hedge
+                                              else 'lost'})
+
+    _record_iquery_outcome(breaker, theargs, winner is not None)
+    if winner is None:
+        if error is not None:
+            raise error
+        if reason == 'deadline':
+            raise scheduler.DeadlineExceeded('Deadline passed waiting for '
+                                             'iQuery task')
+        raise IQueryError(reason, 'No submission of task completed')
+    return _get_iquery_result(resjson, genes, topk=_get_topk(theargs, 'iquery'))
+
+
+async def _run_iquery_for_rows_async(row_genes, theargs, thecache=None,
+                                     session=None, refused=None,
+                                     thejournal=None):
+    """
+    Submits every gene list in **row_genes** to iQuery up front,
+    with at most `--maxinflight` tasks outstanding, and polls all
+    of them from one event loop. Exceptions are logged per row
+    and results are stored in **thecache** and recorded in
+    **thejournal** if set, as soon as each task is done. Rows whose
+    task failed are not stored. Tasks still
+    running at the deadline from :py:func:`get_run_deadline`
+    are cancelled
+
+    :param row_genes: list of (node id, list of genes) tuples
+    :type row_genes: list
+    :param refused: if set, node ids of rows not submitted because
+                    the circuit of iQuery was open are added to it
+    :type refused: set
+    :return: node id => result or ``None``, rows cancelled by the
+             deadline or refused are omitted
+    :rtype: dict
+    """
+    import asyncio
+    maxinflight = theargs.maxinflight
+    if maxinflight is None:
+        maxinflight = DEFAULT_MAX_INFLIGHT['iquery']
+    maxinflight = max(1, maxinflight)
+    semaphore = asyncio.Semaphore(maxinflight)
+
+    run_metrics = metrics.get_metrics()
+
+    async def run_row(node_id, genes):
+        start = time.monotonic()
+        try:
+            res = await run_iquery_async(genes, theargs, semaphore, executor,
+                                         session=session)
+        except (scheduler.DeadlineExceeded, circuitbreaker.CircuitOpenError):
+            raise
+        except IQueryError as e:
+            sys.stderr.write('Failed to process row ' + str(node_id) +
+                             ': ' + str(e) + '\n')
+            run_metrics.skip(e.get_reason())
+            return None
+        except Exception as e:
+            sys.stderr.write('Caught exception processing row ' +
+                             str(node_id) + ': ' + str(e) + '\n')
+            run_metrics.skip('exception')
+            return None
+        finally:
+            run_metrics.observe(metrics.ROW_SECONDS, time.monotonic() - start)
+        if thecache is not None:
+            thecache.put(get_cache_key(genes, theargs, 'iquery'), res)
+        if thejournal is not None:
+            thejournal.record(get_row_fingerprint(genes, theargs, 'iquery'),
+                              res)
+        return res
+
+    deadline = get_run_deadline(theargs)
+    executor = create_thread_pool(maxinflight)
+    try:
+        tasks = [asyncio.ensure_future(run_row(node_id, genes))
+                 for node_id, genes in row_genes]
+        done, pending = await asyncio.wait(tasks, timeout=deadline.remaining())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    finally:
+        # requests still running are cut short by their timeout
+        # so do not wait for them once the deadline has passed
+        executor.shutdown(wait=not deadline.expired(), cancel_futures=True)
+
+    row_results = {}
+    for (node_id, genes), task in zip(row_genes, tasks):
+        if task.cancelled():
+            continue
+        if isinstance(task.exception(), circuitbreaker.CircuitOpenError):
+            if refused is not None:
+                refused.add(node_id)
+            continue
+        if task.exception() is not None:
+            continue
+        row_results[node_id] = task.result()
+    return row_results
+
+
+def run_iquery_for_rows(row_genes, theargs, thecache=None, session=None,
+                        refused=None, thejournal=None):
+    """
+    Runs :py:func:`_run_iquery_for_rows_async` on a new event loop
+    so it can be called from synchronous code
+
+    :param row_genes: list of (node id, list of genes) tuples
+    :type row_genes: list
+    :param refused: see :py:func:`_run_iquery_for_rows_async`
+    :type refused: set
+    :return: node id => result or ``None``
+    :rtype: dict
+    """
+    if len(row_genes) == 0:
+        return {}
+    import asyncio
+    return asyncio.run(_run_iquery_for_rows_async(row_genes, theargs,
+                                                  thecache=thecache,
+                                                  session=session,
+                                                  refused=refused,
+                                                  thejournal=thejournal))
+
+
+def get_gprofiler_url():
+    """
+    Gets base URL of g:Profiler from :py:const:`GPROFILER_URL_ENV`
+    environment variable or :py:const:`DEFAULT_GPROFILER_URL` if
+    it is not set
+
+    :rtype: str
+    """
+    url = os.environ.get(GPROFILER_URL_ENV)
+    if url is None or len(url.strip()) == 0:
+        return DEFAULT_GPROFILER_URL
+    return url.strip()
+
+
+def get_gprofiler():
+    """
+    Gets process wide g:Profiler client, created on first call.
+    The service it talks to is set by :py:func:`get_gprofiler_url`
+
+    :rtype: :py:class:`gprofiler.GProfiler`
+    """
+    global _gprofiler
+    with _gprofiler_lock:
+        if _gprofiler is None:
+            from gprofiler import GProfiler
+            _gprofiler = GProfiler(user_agent='enrichment-service/' + enrichment_service.__version__,
+                                   base_url=get_gprofiler_url(),
+                                   return_dataframe=True)
+        return _gprofiler
+
+
+def classify_gprofiler_call(result, error):
+    """
+    Gets outcome of a call to :py:meth:`gprofiler.GProfiler.profile`
+    for :py:meth:`~enrichment_service.scheduler.BackendScheduler.call`.
+    The client raises :py:class:`AssertionError` upon a failed request
+    with the status code in the message, unless the service sent
+    a message, in which case the status is unknown and the failure
+    is treated as an error worth retrying. The client does not
+    expose headers so ``Retry-After`` is not available
+
+    :return: (outcome, ``None``)
+    :rtype: tuple
+    """
+    if error is None:
+        return scheduler.SUCCESS, None
+    if isinstance(error, AssertionError):
+        status_match = re.search('query failed with error ([0-9]+)', str(error))
+        if status_match is None:
+            return scheduler.ERROR, None
+        outcome = scheduler.get_status_outcome(int(status_match.group(1)))
+        if outcome == scheduler.SUCCESS:
+            # service rejected the query itself
+            return scheduler.FAILED, None
+        return outcome, None
+    return scheduler.classify_response(None, error)
+
+
+def _profile_gprofiler(gprofwrapper, query, organism, maxpval,
+                       omit_intersections, thescheduler, breaker=None):
+    """
+    Queries g:Profiler with **query** via **thescheduler**,
+    recording each attempt in the metrics and the outcome in
+    **breaker**. A query the service rejects with a client error
+    status counts as a success for **breaker** since the service
+    answered
+
+    :raises CircuitOpenError: if circuit of **breaker** is open
+    :raises AssertionError: if request failed
+    :return: result of :py:meth:`gprofiler.GProfiler.profile`
+    """
+    def profile():
+        with metrics.get_metrics().time_request('gprofiler_profile') as request:
+            df_result = gprofwrapper.profile(query=query, domain_scope="known",
+                                             organism=organism,
+                                             user_threshold=maxpval,
+                                             no_evidences=omit_intersections)
+            request['status'] = 200
+        return df_result
+
+    if breaker is None:
+        return scheduler.call(thescheduler, profile,
+                              classify=classify_gprofiler_call)
+    breaker.check()
+    try:
+        df_result = scheduler.call(thescheduler, profile,
+                                   classify=classify_gprofiler_call)
+    except scheduler.DeadlineExceeded:
+        raise
+    except Exception as e:
+        if isinstance(e, AssertionError) and \
+                classify_gprofiler_call(None, e)[0] == scheduler.FAILED:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+        raise
+    breaker.record_success()
+    return df_result
+
+
+def _is_valid_genelist(genes, maxgenelistsize):
+    """
+    Checks **genes** is a non empty list that does not exceed
+    **maxgenelistsize**, writing a message to standard error
+    if the latter is the case
+
+    :return: True if **genes** can be enriched
+    :rtype: bool
+    """
+    if genes is None or len(genes) == 0 or (len(genes) == 1 and len(genes[0].strip()) == 0):
+        metrics.get_metrics().skip('empty_genelist')
+        return False
+    if len(genes) > maxgenelistsize:
+        metrics.get_metrics().skip('too_many_genes')
         sys.stderr.write('Gene list size of ' +
-                         str(genelist_size) +
+                         str(len(genes)) +
                          ' exceeds max gene list size of ' +
                          str(maxgenelistsize))
-        return None
+        return False
+    return True
 
-    df_result = gprofwrapper.profile(query=genes, domain_scope="known",
-                                     organism=organism,
-                                     user_threshold=maxpval,
-                                     no_evidences=omit_intersections)
 
-    if not isinstance(df_result, pandas.DataFrame) or df_result.shape[0] == 0:
-        return None
+def get_ranked_column_name(column, rank):
+    """
+    Gets name of **column** for the term at **rank**, with the
+    best term at rank 1 using the plain column name
+
+    :param column: column name ie CD_CommunityName
+    :type column: str
+    :param rank: rank of term starting at 1
+    :type rank: int
+    :rtype: str
+    """
+    if rank == 1:
+        return column
+    return column + '_' + str(rank)
 
-    df_result['Jaccard'] = 1.0 / (1.0 / df_result['precision'] +
-                                  1.0 / df_result['recall'] - 1)
 
-    # filter out any rows where min overlap is not met
-    df_result.drop(df_result[df_result.Jaccard < minoverlap].index,
-                   inplace=True)
+def get_top_gprofiler_terms(df_result, minoverlap, excludesource, topk=1):
+    """
+    Given g:Profiler result for a single query in **df_result**
+    drops terms whose Jaccard is below **minoverlap** or whose source
+    is in **excludesource** in a single pass and selects the **topk**
+    best by Jaccard and then by p value without sorting all terms
+
+    :param df_result: g:Profiler result for one query
+    :type df_result: :py:class:`pandas.DataFrame`
+    :param minoverlap: minimum Jaccard
+    :type minoverlap: float
+    :param excludesource: comma delimited list of sources to exclude
+    :type excludesource: str
+    :param topk: number of terms to return
+    :type topk: int
+    :return: up to **topk** terms best first with a ``Jaccard``
+             column added or ``None`` if no term passed the filters
+    :rtype: :py:class:`pandas.DataFrame`
+    """
+    if df_result.shape[0] == 0:
+        return None
 
-    # filter out any rows in source exclude list
+    jaccard = 1.0 / (1.0 / df_result['precision'].to_numpy() +
+                     1.0 / df_result['recall'].to_numpy() - 1)
+    keep = ~(jaccard < minoverlap)
     if excludesource is not None:
-        for a_source in excludesource.split(','):
-            df_result.drop(df_result[df_result.source == a_source].index,
-                           inplace=True)
+        keep &= ~df_result['source'].isin(excludesource.split(',')).to_numpy()
 
-    if df_result.shape[0] == 0:
+    if not keep.any():
         return None
 
+    candidates = df_result.loc[keep].assign(Jaccard=jaccard[keep],
+                                            neg_p_value=-df_result['p_value'].to_numpy()[keep])
+
     # sort by Jaccard and fallback to p_value
-    df_result.sort_values(['Jaccard', 'p_value'],
-                          ascending=[False, True], inplace=True)
+    return candidates.nlargest(max(1, topk), ['Jaccard', 'neg_p_value'])
 
-    df_result.reset_index(drop=True, inplace=True)
 
-    df_result = df_result[:1]
-    df_result = df_result.round({'Jaccard': precision})
+def get_best_gprofiler_result(df_result, genes, minoverlap, excludesource, precision,
+                              topk=1):
+    """
+    Given g:Profiler result for a single query in **df_result**
+    returns best term as found by :py:func:`get_top_gprofiler_terms`.
+    If **topk** is greater then 1, the next best terms are added
+    with column names from :py:func:`get_ranked_column_name`
+
+    :param df_result: g:Profiler result for one query
+    :type df_result: :py:class:`pandas.DataFrame`
+    :param genes: genes that were queried
+    :type genes: list
+    :param precision: not used since Jaccard is not part of the
+                      result, kept for compatibility
+    :param topk: number of terms to return
+    :type topk: int
+    :return: best result in CD_* format or ``None`` if no
+             term passed the filters
+    :rtype: dict
+    """
+    top_terms = get_top_gprofiler_terms(df_result, minoverlap,
+                                        excludesource, topk=topk)
+    if top_terms is None:
+        return None
+    return get_gprofiler_terms_result(top_terms, genes)
 
-    annotated_members = df_result['intersections'][0]
 
-    theres = {'CD_CommunityName': df_result['name'][0],
-              'CD_AnnotatedMembers': ' '.join(annotated_members),
-              'CD_AnnotatedMembers_Size': len(annotated_members),
-              'CD_AnnotatedMembers_Overlap': len(annotated_members) / len(genes),
-              'CD_AnnotatedMembers_Pvalue': df_result['p_value'][0],
-              'CD_Labeled': len(df_result['name'][0]) > 0,
-              'CD_AnnotatedAlgorithm': 'gProfiler',
-              'CD_NonAnnotatedMembers': ' '.join(list(set(genes) - set(annotated_members))),
-              'CD_AnnotatedMembers_SourceDB': df_result['source'][0],
-              'CD_AnnotatedMembers_SourceTerm': df_result['native'][0]
-              }
+def get_gprofiler_terms_result(top_terms, genes):
+    """
+    Gets g:Profiler terms in **top_terms** in CD_* format, with
+    the terms after the first in columns named by
+    :py:func:`get_ranked_column_name`
+
+    :param top_terms: terms of one query, best first
+    :type top_terms: :py:class:`pandas.DataFrame`
+    :param genes: genes that were queried
+    :type genes: list
+    :rtype: dict
+    """
+    theres = {}
+    for rank, term in enumerate(top_terms.itertuples(index=False), start=1):
+        annotated_members = term.intersections
+        ranked_res = {'CD_CommunityName': term.name,
+                      'CD_AnnotatedMembers': ' '.join(annotated_members),
+                      'CD_AnnotatedMembers_Size': len(annotated_members),
+                      'CD_AnnotatedMembers_Overlap': len(annotated_members) / len(genes),
+                      'CD_AnnotatedMembers_Pvalue': term.p_value,
+                      'CD_AnnotatedMembers_SourceDB': term.source,
+                      'CD_AnnotatedMembers_SourceTerm': term.native}
+        if rank == 1:
+            ranked_res.update({'CD_Labeled': len(term.name) > 0,
+                               'CD_AnnotatedAlgorithm': 'gProfiler',
+                               'CD_NonAnnotatedMembers': ' '.join(list(set(genes) - set(annotated_members)))})
+        for column, value in ranked_res.items():
+            theres[get_ranked_column_name(column, rank)] = value
 
     return theres
 
+
+def run_gprofiler(genes, maxgenelistsize, organism, maxpval, omit_intersections, minoverlap, excludesource, precision,
+                  gprofwrapper=None, topk=1, thescheduler=None, breaker=None):
+    """
+    Queries g:Profiler with **genes** and returns the best term
+    as found by :py:func:`get_best_gprofiler_result`
+
+    :param gprofwrapper: g:Profiler client, if ``None`` the one from
+                         :py:func:`get_gprofiler` is used
+    :type gprofwrapper: :py:class:`gprofiler.GProfiler`
+    :param topk: number of terms to return, see
+                 :py:func:`get_best_gprofiler_result`
+    :type topk: int
+    :param thescheduler: limits and retries requests, if ``None``
+                         request is made once right away
+    :type thescheduler: :py:class:`~enrichment_service.scheduler.BackendScheduler`
+    :param breaker: records outcome of request, if its circuit is
+                    open the request is not made
+    :type breaker: :py:class:`~enrichment_service.circuitbreaker.CircuitBreaker`
+    :raises CircuitOpenError: if circuit of **breaker** is open
+    :return: result in CD_* format or ``None`` if no result
+    :rtype: dict
+    """
+    if not _is_valid_genelist(genes, maxgenelistsize):
+        return None
+    import pandas
+    if gprofwrapper is None:
+        gprofwrapper = get_gprofiler()
+
+    run_metrics = metrics.get_metrics()
+    df_result = _profile_gprofiler(gprofwrapper, genes, organism, maxpval,
+                                   omit_intersections, thescheduler,
+                                   breaker=breaker)
+
+    if not isinstance(df_result, pandas.DataFrame):
+        run_metrics.skip('no_result')
+        return None
+
+    with run_metrics.time_phase('gprofiler_postprocess'):
+        res = get_best_gprofiler_result(df_result, genes, minoverlap,
+                                        excludesource, precision, topk=topk)
+    if res is None:
+        run_metrics.skip('no_result')
+    return res
+
+
+def get_gprofiler_batches(genes_by_query, batchsize, batchmaxgenes):
+    """
+    Splits **genes_by_query** into batches of at most **batchsize**
+    queries holding no more then **batchmaxgenes** genes in total.
+    A query larger then **batchmaxgenes** is put in a batch by itself
+
+    :param genes_by_query: query name => list of genes
+    :type genes_by_query: dict
+    :param batchsize: maximum number of queries per batch
+    :type batchsize: int
+    :param batchmaxgenes: maximum number of genes per batch
+    :type batchmaxgenes: int
+    :return: list of dicts of query name => list of genes
+    :rtype: list
+    """
+    batches = []
+    cur_batch = {}
+    cur_genecount = 0
+    for query_name, genes in genes_by_query.items():
+        if len(cur_batch) > 0 and (len(cur_batch) >= batchsize or
+                                   cur_genecount + len(genes) > batchmaxgenes):
+            batches.append(cur_batch)
+            cur_batch = {}
+            cur_genecount = 0
+        cur_batch[query_name] = genes
+        cur_genecount += len(genes)
+    if len(cur_batch) > 0:
+        batches.append(cur_batch)
+    return batches
+
+
+def profile_gprofiler_batch(genes_by_query, organism, maxpval,
+                            omit_intersections, gprofwrapper=None,
+                            thescheduler=None, breaker=None):
+    """
+    Queries g:Profiler with all gene lists in **genes_by_query**
+    in a single multi-query request and splits the combined
+    result by the ``query`` column.
+
+    If the request fails, the batch is split in half and each half
+    is retried so one bad or oversized query only costs its own row.
+    If **genes_by_query** holds a single query any error is raised
+
+    :param genes_by_query: query name => list of genes, which
+                           should be valid gene lists
+    :type genes_by_query: dict
+    :param gprofwrapper: see :py:func:`run_gprofiler`
+    :type gprofwrapper: :py:class:`gprofiler.GProfiler`
+    :param thescheduler: see :py:func:`run_gprofiler`
+    :type thescheduler: :py:class:`~enrichment_service.scheduler.BackendScheduler`
+    :param breaker: see :py:func:`run_gprofiler`
+    :type breaker: :py:class:`~enrichment_service.circuitbreaker.CircuitBreaker`
+    :raises CircuitOpenError: if circuit of **breaker** is open,
+                              including while retrying halves of
+                              a failed batch
+    :return: query name => terms of query as
+             :py:class:`pandas.DataFrame` or ``None`` if it has no
+             terms. Queries that failed are omitted
+    :rtype: dict
+    """
+    import pandas
+    if gprofwrapper is None:
+        gprofwrapper = get_gprofiler()
+    if len(genes_by_query) == 0:
+        return {}
+
+    run_metrics = metrics.get_metrics()
+    try:
+        df_result = _profile_gprofiler(gprofwrapper, genes_by_query, organism,
+                                       maxpval, omit_intersections,
+                                       thescheduler, breaker=breaker)
+    except (scheduler.DeadlineExceeded, circuitbreaker.CircuitOpenError):
+        raise
+    except Exception as e:
+        if len(genes_by_query) == 1:
+            raise
+        sys.stderr.write('Batch of ' + str(len(genes_by_query)) +
+                         ' queries failed, splitting batch: ' +
+                         str(e) + '\n')
+        query_names = list(genes_by_query.keys())
+        half = len(query_names) // 2
+        results = {}
+        for sub_names in [query_names[:half], query_names[half:]]:
+            try:
+                results.update(profile_gprofiler_batch({name: genes_by_query[name]
+                                                        for name in sub_names},
+                                                       organism, maxpval,
+                                                       omit_intersections,
+                                                       gprofwrapper=gprofwrapper,
+                                                       thescheduler=thescheduler,
+                                                       breaker=breaker))
+            except (scheduler.DeadlineExceeded, circuitbreaker.CircuitOpenError):
+                raise
+            except Exception as se:
+                sys.stderr.write('Query ' + str(sub_names[0]) +
+                                 ' failed: ' + str(se) + '\n')
+                run_metrics.skip('exception')
+        return results
+
+    if not isinstance(df_result, pandas.DataFrame) or df_result.shape[0] == 0:
+        return {query_name: None for query_name in genes_by_query.keys()}
+
+    grouped = dict(list(df_result.groupby('query', sort=False)))
+    return {query_name: grouped.get(query_name)
+            for query_name in genes_by_query.keys()}
+
+
+def run_gprofiler_batch(genes_by_query, maxgenelistsize, organism, maxpval, omit_intersections, minoverlap,
+                        excludesource, precision, gprofwrapper=None, topk=1,
+                        thescheduler=None, breaker=None):
+    """
+    Queries g:Profiler with all gene lists in **genes_by_query**
+    via :py:func:`profile_gprofiler_batch` and runs
+    :py:func:`get_best_gprofiler_result` on the terms of each
+
+    :param genes_by_query: query name => list of genes
+    :type genes_by_query: dict
+    :param gprofwrapper: see :py:func:`run_gprofiler`
+    :type gprofwrapper: :py:class:`gprofiler.GProfiler`
+    :param topk: see :py:func:`run_gprofiler`
+    :type topk: int
+    :param thescheduler: see :py:func:`run_gprofiler`
+    :type thescheduler: :py:class:`~enrichment_service.scheduler.BackendScheduler`
+    :param breaker: see :py:func:`run_gprofiler`
+    :type breaker: :py:class:`~enrichment_service.circuitbreaker.CircuitBreaker`
+    :raises CircuitOpenError: if circuit of **breaker** is open
+    :return: query name => result in CD_* format or ``None``. Queries
+             that failed are omitted
+    :rtype: dict
+    """
+    results = {}
+    valid_queries = {}
+    for query_name, genes in genes_by_query.items():
+        if _is_valid_genelist(genes, maxgenelistsize):
+            valid_queries[query_name] = genes
+        else:
+            results[query_name] = None
+
+    terms_by_query = profile_gprofiler_batch(valid_queries, organism, maxpval,
+                                             omit_intersections,
+                                             gprofwrapper=gprofwrapper,
+                                             thescheduler=thescheduler,
+                                             breaker=breaker)
+    run_metrics = metrics.get_metrics()
+    with run_metrics.time_phase('gprofiler_postprocess'):
+        for query_name, df_terms in terms_by_query.items():
+            if df_terms is None:
+                results[query_name] = None
+            else:
+                results[query_name] = get_best_gprofiler_result(df_terms,
+                                                                valid_queries[query_name],
+                                                                minoverlap,
+                                                                excludesource,
+                                                                precision, topk=topk)
+            if results[query_name] is None:
+                run_metrics.skip('no_result')
+    return results
+
 def get_genes_from_data(data):
     """
     Given data of either string or list extract a list of genes/proteins
@@ -336,56 +1793,1373 @@ def get_genes_from_data(data):
         genes.append(stripped_entry)
     return genes
 
-def run_enrichment(node_table, theargs, mode):
-    results_for_rows = {}
-    if len(node_table["columns"]) != 1:
-        sys.stderr.write('Only one column should be passed in the input.')
+
+def _get_inflight_semaphore(mode, maxinflight=None):
+    """
+    Gets process wide semaphore that limits the number of
+    simultaneous requests for **mode**. The semaphore is created
+    on first call for a given mode and **maxinflight**, subsequent
+    calls with the same values return the same object
+
+    :param mode: enrichment mode ie gprofiler or iquery
+    :type mode: str
+    :param maxinflight: maximum simultaneous requests, if ``None``
+                        value in :py:const:`DEFAULT_MAX_INFLIGHT` is
+                        used
+    :type maxinflight: int
+    :return: semaphore for mode
+    :rtype: :py:class:`threading.BoundedSemaphore`
+    """
+    if maxinflight is None:
+        maxinflight = DEFAULT_MAX_INFLIGHT.get(mode, 1)
+    key = (mode, maxinflight)
+    with _inflight_lock:
+        if key not in _inflight_semaphores:
+            _inflight_semaphores[key] = threading.BoundedSemaphore(max(1, maxinflight))
+        return _inflight_semaphores[key]
+
+
+def get_scheduler(theargs, backend, endpoint=None):
+    """
+    Gets process wide scheduler for requests to **backend** with
+    `--rate_limit`, `--rate_burst` and `--http_retries`, allowing
+    at most `--maxinflight` simultaneous requests, so all threads
+    talking to a service share its rate and concurrency limits
+
+    :param theargs: parsed command line arguments
+    :param backend: gprofiler or iquery
+    :type backend: str
+    :param endpoint: if set, the scheduler only limits requests
+                     to this endpoint of **backend**
+    :type endpoint: str
+    :rtype: :py:class:`~enrichment_service.scheduler.BackendScheduler`
+    """
+    maxinflight = theargs.maxinflight
+    if maxinflight is None:
+        maxinflight = DEFAULT_MAX_INFLIGHT.get(backend, 1)
+    key = (backend, endpoint, maxinflight, theargs.rate_limit,
+           theargs.rate_burst, theargs.http_retries)
+    with _schedulers_lock:
+        if key not in _schedulers:
+            _schedulers[key] = scheduler.BackendScheduler(backend, maxinflight,
+                                                          rate=theargs.rate_limit,
+                                                          burst=theargs.rate_burst,
+                                                          retries=theargs.http_retries)
+        thescheduler = _schedulers[key]
+    deadline = get_run_deadline(theargs)
+    if deadline.get_seconds() is None:
+        return thescheduler
+    return thescheduler.with_deadline(deadline)
+
+
+def get_circuit_breaker(theargs, backend):
+    """
+    Gets process wide circuit breaker of **backend** with
+    `--breaker_threshold` and `--breaker_reset`, so all rows sent
+    to a service share its record of failures
+
+    :param theargs: parsed command line arguments
+    :param backend: gprofiler or iquery
+    :type backend: str
+    :return: circuit breaker or ``None`` if `--breaker_threshold`
+             is not above 0
+    :rtype: :py:class:`~enrichment_service.circuitbreaker.CircuitBreaker`
+    """
+    if theargs.breaker_threshold <= 0:
         return None
-    column_name = node_table["columns"][0]["id"]
-    for node_id, node_val in node_table["rows"].items():
-        genes = get_genes_from_data(node_val[column_name])
+    key = (backend, theargs.breaker_threshold, theargs.breaker_reset)
+    with _circuit_breakers_lock:
+        if key not in _circuit_breakers:
+            _circuit_breakers[key] = circuitbreaker.CircuitBreaker(backend,
+                                                                   failure_threshold=theargs.breaker_threshold,
+                                                                   reset_timeout=theargs.breaker_reset)
+        return _circuit_breakers[key]
+
+
+def get_run_deadline(theargs):
+    """
+    Gets deadline of the run set by `--deadline`. The deadline
+    starts the first time it is requested for **theargs** and is
+    stored in them so every part of the run shares it
+
+    :param theargs: parsed command line arguments
+    :return: deadline, which never passes if `--deadline` is not set
+    :rtype: :py:class:`~enrichment_service.scheduler.Deadline`
+    """
+    deadline = getattr(theargs, 'run_deadline', None)
+    if deadline is None:
+        deadline = scheduler.Deadline(theargs.deadline)
+        theargs.run_deadline = deadline
+    return deadline
+
+
+def _get_request_timeout(theargs):
+    """
+    Gets `--timeout` cut short so a request does not outlast
+    the deadline from :py:func:`get_run_deadline`
+
+    :rtype: float
+    """
+    return max(MIN_REQUEST_TIMEOUT,
+               get_run_deadline(theargs).cap(theargs.timeout))
+
+
+def _get_finished_results(futures, deadline, refused=None):
+    """
+    Waits for **futures** until **deadline** and cancels those
+    that have not started by then
+
+    :param futures: key => future
+    :type futures: dict
+    :param deadline: when to stop waiting
+    :type deadline: :py:class:`~enrichment_service.scheduler.Deadline`
+    :param refused: if set, keys of futures that raised
+                    :py:class:`~enrichment_service.circuitbreaker.CircuitOpenError`
+                    are added to it
+    :type refused: set
+    :return: key => result of each future that finished in time
+             without raising
+             :py:class:`~enrichment_service.scheduler.DeadlineExceeded`
+             or :py:class:`~enrichment_service.circuitbreaker.CircuitOpenError`
+    :rtype: dict
+    """
+    wait(list(futures.values()), timeout=deadline.remaining())
+    results = {}
+    for key, future in futures.items():
+        if not future.done():
+            future.cancel()
+            continue
+        if future.cancelled():
+            continue
+        try:
+            results[key] = future.result()
+        except scheduler.DeadlineExceeded:
+            pass
+        except circuitbreaker.CircuitOpenError:
+            if refused is not None:
+                refused.add(key)
+    return results
+
+
+def create_http_session(theargs):
+    """
+    Creates session with `--pool_size` connections per host.
+    The session does not retry since requests are retried by
+    the schedulers from :py:func:`get_scheduler`
+
+    :param theargs: parsed command line arguments
+    :rtype: :py:class:`requests.Session`
+    """
+    return httpclient.create_session(pool_size=theargs.pool_size, retries=0)
+
+
+def create_thread_pool(max_workers):
+    """
+    Creates thread pool whose threads record into the metrics
+    returned by :py:func:`~enrichment_service.metrics.get_metrics`
+    on the calling thread
+
+    :param max_workers: number of threads
+    :type max_workers: int
+    :rtype: :py:class:`concurrent.futures.ThreadPoolExecutor`
+    """
+    return ThreadPoolExecutor(max_workers=max_workers,
+                              initializer=metrics.set_thread_metrics,
+                              initargs=(metrics.get_metrics(),))
+
+
+def run_enrichment_for_genes(genes, theargs, mode):
+    """
+    Runs enrichment on **genes** with service set by **mode**
+    with at most `--maxinflight` calls running at once
+
+    :param genes: genes to query
+    :type genes: list
+    :param theargs: parsed command line arguments
+    :param mode: gprofiler or iquery
+    :type mode: str
+    :raises CircuitOpenError: if circuit of **mode** is open
+    :raises IQueryError: if iQuery task failed, see
+                         :py:func:`_run_iquery`
+    :return: result as dict or ``None`` if no result
+    :rtype: dict
+    """
+    semaphore = _get_inflight_semaphore(mode, theargs.maxinflight)
+    with metrics.get_metrics().time_phase(mode + '_queue'):
+        semaphore.acquire()
+    try:
         if mode == 'gprofiler':
-            res = run_gprofiler(genes, theargs.maxgenelistsize, theargs.organism, theargs.maxpval,
-                                                      theargs.omit_intersections, theargs.minoverlap,
-                                                      theargs.excludesource, theargs.precision)
-        elif mode == 'iquery':
-            res = run_iquery(genes, theargs)
+            return run_gprofiler(genes, theargs.maxgenelistsize, theargs.organism, theargs.maxpval,
+                                 theargs.omit_intersections, theargs.minoverlap,
+                                 theargs.excludesource, theargs.precision,
+                                 topk=theargs.top_k,
+                                 thescheduler=get_scheduler(theargs, mode),
+                                 breaker=get_circuit_breaker(theargs, mode))
+        return _run_iquery(genes, theargs)
+    finally:
+        semaphore.release()
+
+
+def _run_enrichment_for_row(node_id, genes, theargs, mode,
+                            thecache=None, thejournal=None):
+    """
+    Wrapper around :py:func:`run_enrichment_for_genes` that
+    catches and logs any exception so one failing row does
+    not abort the remaining rows. Results are stored in
+    **thecache** and recorded in **thejournal** if set, rows
+    that failed are not
+
+    :raises DeadlineExceeded: if the run deadline passed
+    :raises CircuitOpenError: if circuit of **mode** is open
+    :return: result as dict or ``None`` upon error or no result
+    :rtype: dict
+    """
+    run_metrics = metrics.get_metrics()
+    start = time.monotonic()
+    try:
+        res = run_enrichment_for_genes(genes, theargs, mode)
+    except (scheduler.DeadlineExceeded, circuitbreaker.CircuitOpenError):
+        raise
+    except IQueryError as e:
+        sys.stderr.write('Failed to process row ' + str(node_id) +
+                         ': ' + str(e) + '\n')
+        run_metrics.skip(e.get_reason())
+        return None
+    except Exception as e:
+        sys.stderr.write('Caught exception processing row ' +
+                         str(node_id) + ': ' + str(e) + '\n')
+        run_metrics.skip('exception')
+        return None
+    finally:
+        run_metrics.observe(metrics.ROW_SECONDS, time.monotonic() - start)
+    if thecache is not None:
+        thecache.put(get_cache_key(genes, theargs, mode), res)
+    if thejournal is not None:
+        thejournal.record(get_row_fingerprint(genes, theargs, mode), res)
+    return res
+
+
+def _run_gprofiler_batch_for_rows(genes_by_query, theargs, thecache=None,
+                                  thejournal=None):
+    """
+    Wrapper around :py:func:`run_gprofiler_batch` that limits
+    simultaneous requests like :py:func:`run_enrichment_for_genes`
+    and logs any exception so a failing batch does not abort the
+    remaining batches. Results are stored in **thecache** and
+    recorded in **thejournal** if set
+
+    :raises DeadlineExceeded: if the run deadline passed
+    :raises CircuitOpenError: if circuit of g:Profiler is open
+    :return: query name => result or ``None``, failed queries are
+             omitted
+    :rtype: dict
+    """
+    run_metrics = metrics.get_metrics()
+    start = time.monotonic()
+    semaphore = _get_inflight_semaphore('gprofiler', theargs.maxinflight)
+    try:
+        with run_metrics.time_phase('gprofiler_queue'):
+            semaphore.acquire()
+        try:
+            results = run_gprofiler_batch(genes_by_query, theargs.maxgenelistsize,
+                                          theargs.organism, theargs.maxpval,
+                                          theargs.omit_intersections,
+                                          theargs.minoverlap,
+                                          theargs.excludesource,
+                                          theargs.precision,
+                                          topk=theargs.top_k,
+                                          thescheduler=get_scheduler(theargs,
+                                                                     'gprofiler'),
+                                          breaker=get_circuit_breaker(theargs,
+                                                                      'gprofiler'))
+        finally:
+            semaphore.release()
+    except (scheduler.DeadlineExceeded, circuitbreaker.CircuitOpenError):
+        raise
+    except Exception as e:
+        sys.stderr.write('Caught exception processing rows ' +
+                         str(list(genes_by_query.keys())) + ': ' +
+                         str(e) + '\n')
+        run_metrics.skip('exception', value=len(genes_by_query))
+        return {}
+    finally:
+        elapsed = time.monotonic() - start
+        for query_name in genes_by_query.keys():
+            run_metrics.observe(metrics.ROW_SECONDS, elapsed)
+    if thecache is not None:
+        for query_name, res in results.items():
+            thecache.put(get_cache_key(genes_by_query[query_name], theargs,
+                                       'gprofiler'), res)
+    if thejournal is not None:
+        thejournal.record_results([(get_row_fingerprint(genes_by_query[query_name],
+                                                        theargs, 'gprofiler'), res)
+                                   for query_name, res in results.items()])
+    return results
+
+
+def get_gprofiler_queries(row_genes):
+    """
+    Names the gene lists in **row_genes** for a multi-query
+    g:Profiler request. Node ids are not guaranteed to be valid
+    g:Profiler query names so the position of the row is used
+    instead
+
+    :param row_genes: list of (node id, list of genes) tuples
+    :type row_genes: list
+    :return: (query name => list of genes, query name => node id)
+    :rtype: tuple
+    """
+    genes_by_query = {}
+    node_id_by_query = {}
+    for index, (node_id, genes) in enumerate(row_genes):
+        query_name = 'q' + str(index)
+        genes_by_query[query_name] = genes
+        node_id_by_query[query_name] = node_id
+    return genes_by_query, node_id_by_query
+
+
+def _run_gprofiler_batches(row_genes, theargs, thecache=None, refused=None,
+                           thejournal=None):
+    """
+    Packs the gene lists in **row_genes** into multi-query g:Profiler
+    requests of `--gprofiler_batchsize` rows and runs them, `--workers`
+    batches at a time, until the deadline from :py:func:`get_run_deadline`
+
+    :param row_genes: list of (node id, list of genes) tuples
+    :type row_genes: list
+    :param refused: if set, node ids of rows of batches not sent
+                    because the circuit of g:Profiler was open are
+                    added to it
+    :type refused: set
+    :param thejournal: if set, results are recorded in it as soon
+                       as their batch is done
+    :type thejournal: :py:class:`~enrichment_service.journal.ResultJournal`
+    :return: node id => result or ``None``, rows of batches not
+             done by the deadline or refused are omitted
+    :rtype: dict
+    """
+    genes_by_query, node_id_by_query = get_gprofiler_queries(row_genes)
+    batches = get_gprofiler_batches(genes_by_query,
+                                    theargs.gprofiler_batchsize,
+                                    theargs.gprofiler_batchmaxgenes)
+    deadline = get_run_deadline(theargs)
+    executor = create_thread_pool(max(1, theargs.workers))
+    try:
+        futures = {index: executor.submit(_run_gprofiler_batch_for_rows, batch,
+                                          theargs, thecache=thecache,
+                                          thejournal=thejournal)
+                   for index, batch in enumerate(batches)}
+        refused_batches = set()
+        batch_results = _get_finished_results(futures, deadline,
+                                              refused=refused_batches)
+    finally:
+        executor.shutdown(wait=not deadline.expired(), cancel_futures=True)
+
+    if refused is not None:
+        for index in refused_batches:
+            refused.update(node_id_by_query[query_name]
+                           for query_name in batches[index].keys())
+    row_results = {}
+    for index, a_batch_result in batch_results.items():
+        for query_name in batches[index].keys():
+            row_results[node_id_by_query[query_name]] = a_batch_result.get(query_name)
+    return row_results
+
+
+def get_local_library(gmtargs):
+    """
+    Gets gene set library for **gmtargs**, reading the GMT files
+    only the first time a given list of files is requested. A
+    single library made by the ``compile-library`` command is
+    memory mapped instead
+
+    :param gmtargs: values passed to --gmt
+    :type gmtargs: list
+    :raises ValueError: if a compiled library is passed with
+                        other files
+    :return: library
+    :rtype: :py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+    """
+    from enrichment_service import genesetlibrary
+    from enrichment_service import compiledlibrary
+    key = tuple(gmtargs)
+    with _local_libraries_lock:
+        if key not in _local_libraries:
+            compiled = [gmtarg for gmtarg in gmtargs
+                        if compiledlibrary.is_compiled_library(gmtarg)]
+            if len(compiled) > 0 and len(gmtargs) > 1:
+                raise ValueError('Compiled library ' + compiled[0] +
+                                 ' must be the only --gmt file')
+            if len(compiled) == 1:
+                _local_libraries[key] = compiledlibrary.load_compiled_library(compiled[0])
+            else:
+                _local_libraries[key] = genesetlibrary.read_gmt_files(gmtargs)
+        return _local_libraries[key]
+
+
+def get_minhash_index(theargs, library):
+    """
+    Gets MinHash index of **library** for the `--minoverlap` and
+    `--lsh_recall` of **theargs**, building it only the first time
+    it is requested
+
+    :param theargs: parsed arguments
+    :param library: library made from `--gmt` of **theargs**
+    :type library: :py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+    :return: index or ``None`` if `--lsh_permutations` is not set or
+             `--minoverlap` is too low for bands of more than one row.
+             Bands of one row make nearly every term sharing a gene
+             with a gene list a candidate so scoring every term is
+             faster
+    :rtype: :py:class:`~enrichment_service.minhash.MinHashIndex`
+    """
+    if theargs.lsh_permutations <= 0 or theargs.minoverlap <= 0:
+        return None
+    from enrichment_service import minhash
+    bands, rows = minhash.get_bands_and_rows(theargs.lsh_permutations,
+                                             theargs.minoverlap,
+                                             theargs.lsh_recall)
+    if rows == 1:
+        return None
+    key = (tuple(theargs.gmt), theargs.lsh_permutations, bands, rows)
+    with _minhash_indexes_lock:
+        if key not in _minhash_indexes:
+            _minhash_indexes[key] = minhash.MinHashIndex(library,
+                                                         num_perm=theargs.lsh_permutations,
+                                                         bands=bands,
+                                                         rows=rows)
+        return _minhash_indexes[key]
+
+
+def _run_local(row_genes, theargs, thejournal=None):
+    """
+    Scores all gene lists in **row_genes** at once against the
+    gene sets passed via `--gmt`
+
+    :param row_genes: list of (node id, list of genes) tuples
+    :type row_genes: list
+    :param thejournal: if set, results are recorded in it
+    :type thejournal: :py:class:`~enrichment_service.journal.ResultJournal`
+    :return: node id => result or ``None``
+    :rtype: dict
+    """
+    row_results = {}
+    valid_rows = []
+    for node_id, genes in row_genes:
+        if _is_valid_genelist(genes, theargs.maxgenelistsize):
+            valid_rows.append((node_id, genes))
         else:
-            sys.stderr.write('Algorithm must be either gprofiler or iquery.')
-            return None
+            row_results[node_id] = None
+
+    from enrichment_service import localenrichment
+    run_metrics = metrics.get_metrics()
+    with run_metrics.time_phase('local_library'):
+        library = get_local_library(theargs.gmt)
+    with run_metrics.time_phase('local_index'):
+        index = get_minhash_index(theargs, library)
+    with run_metrics.time_phase('local_enrichment'):
+        results = localenrichment.run_local_enrichment([genes for node_id, genes
+                                                        in valid_rows],
+                                                       library, theargs.maxpval,
+                                                       theargs.minoverlap,
+                                                       theargs.excludesource,
+                                                       index=index)
+    for (node_id, genes), res in zip(valid_rows, results):
+        row_results[node_id] = res
+        if res is None:
+            run_metrics.skip('no_result')
+    if thejournal is not None:
+        thejournal.record_results([(get_row_fingerprint(genes, theargs, 'local'),
+                                    row_results[node_id])
+                                   for node_id, genes in row_genes])
+    return row_results
+
+
+def get_result_cache(theargs):
+    """
+    Gets result cache for `--cache-dir`, creating it the first
+    time a given directory is requested
 
+    :param theargs: parsed command line arguments
+    :return: cache or ``None`` if `--no-cache` is set or no
+             cache directory is set
+    :rtype: :py:class:`~enrichment_service.resultcache.ResultCache`
+    """
+    if theargs.no_cache or theargs.cache_dir is None:
+        return None
+    from enrichment_service import resultcache
+    with _result_caches_lock:
+        if theargs.cache_dir not in _result_caches:
+            thecache = resultcache.ResultCache(theargs.cache_dir,
+                                               ttl=theargs.cache_ttl,
+                                               negative_ttl=theargs.cache_negative_ttl,
+                                               maxsize=int(theargs.cache_maxsize *
+                                                           1024 * 1024))
+            _result_caches[theargs.cache_dir] = thecache
+        return _result_caches[theargs.cache_dir]
+
+
+def _get_result_params(theargs, mode):
+    """
+    Gets every parameter that affects the result of **mode**,
+    including the service queried so results of an alternate
+    g:Profiler or iQuery are kept apart
+
+    :rtype: dict
+    """
+    params = {'mode': mode,
+              'organism': theargs.organism,
+              'maxpval': theargs.maxpval,
+              'minoverlap': theargs.minoverlap,
+              'excludesource': theargs.excludesource,
+              'top_k': theargs.top_k,
+              'omit_intersections': theargs.omit_intersections,
+              'maxgenelistsize': theargs.maxgenelistsize}
+    if mode == 'gprofiler':
+        params['url'] = get_gprofiler_url()
+    elif mode == 'iquery':
+        params['url'] = ','.join(get_iquery_urls(theargs))
+    return params
+
+
+def get_cache_key(genes, theargs, mode):
+    """
+    Gets result cache key for **genes** and every parameter
+    that affects the result of **mode**
+
+    :rtype: str
+    """
+    from enrichment_service import resultcache
+    return resultcache.get_cache_key(genes, _get_result_params(theargs, mode))
+
+
+def get_gmt_file_stats(gmtargs):
+    """
+    Gets each value of `--gmt` in **gmtargs** with the modification
+    time and size of its file so a library edited in place gets a
+    new fingerprint
+
+    :param gmtargs: values passed to --gmt
+    :type gmtargs: list
+    :return: list of [gmtarg, modification time in nanoseconds,
+             size in bytes], time and size are ``None`` if the file
+             cannot be read
+    :rtype: list
+    """
+    if gmtargs is None:
+        return None
+    from enrichment_service import genesetlibrary
+    stats = []
+    for gmtarg in gmtargs:
+        source, path = genesetlibrary.get_source_and_path(gmtarg)
+        try:
+            stat = os.stat(path)
+            stats.append([gmtarg, stat.st_mtime_ns, stat.st_size])
+        except OSError:
+            stats.append([gmtarg, None, None])
+    return stats
+
+
+def get_row_fingerprint(genes, theargs, mode):
+    """
+    Gets fingerprint of **genes** and every parameter that affects
+    the result of **mode**. Same as :py:func:`get_cache_key` except
+    for local mode where the gene set files, as given by
+    :py:func:`get_gmt_file_stats`, are included
+
+    :rtype: str
+    """
+    if mode != 'local':
+        return get_cache_key(genes, theargs, mode)
+    from enrichment_service import resultcache
+    params = _get_result_params(theargs, mode)
+    params['gmt'] = get_gmt_file_stats(theargs.gmt)
+    if theargs.lsh_permutations > 0:
+        params['lsh_permutations'] = theargs.lsh_permutations
+        params['lsh_recall'] = theargs.lsh_recall
+    return resultcache.get_cache_key(genes, params)
+
+
+def _is_fingerprint_enabled(theargs):
+    """
+    Checks if rows should get :py:const:`FINGERPRINT_COLUMN`
+
+    :rtype: bool
+    """
+    return theargs.fingerprint or theargs.previous_output is not None
+
+
+def read_previous_results(previous_output):
+    """
+    Reads rows of updateTables action in **previous_output** that
+    have a :py:const:`FINGERPRINT_COLUMN` value
+
+    :param previous_output: path to output of earlier run, can be
+                            gzip compressed
+    :type previous_output: str
+    :return: fingerprint => result
+    :rtype: dict
+    """
+    with streaming.open_inputfile(previous_output) as f:
+        actions = json.load(f)
+    previous = {}
+    for action in actions:
+        if action.get('action') != 'updateTables':
+            continue
+        for res in action['data']['rows'].values():
+            if FINGERPRINT_COLUMN in res:
+                previous[res[FINGERPRINT_COLUMN]] = res
+    return previous
+
+
+def get_previous_results(theargs):
+    """
+    Gets results of `--previous-output`, reading the file only
+    the first time a given path is requested
+
+    :param theargs: parsed command line arguments
+    :return: fingerprint => result or ``None`` if
+             `--previous-output` is not set
+    :rtype: dict
+    """
+    if theargs.previous_output is None:
+        return None
+    with _previous_results_lock:
+        if theargs.previous_output not in _previous_results:
+            _previous_results[theargs.previous_output] = read_previous_results(theargs.previous_output)
+        return _previous_results[theargs.previous_output]
+
+
+def get_journal(theargs):
+    """
+    Gets journal for `--journal`, creating it the first time
+    a given path is requested
+
+    :param theargs: parsed command line arguments
+    :return: journal or ``None`` if `--journal` is not set
+    :rtype: :py:class:`~enrichment_service.journal.ResultJournal`
+    """
+    if theargs.journal is None:
+        return None
+    from enrichment_service import journal
+    with _journals_lock:
+        if theargs.journal not in _journals:
+            _journals[theargs.journal] = journal.ResultJournal(theargs.journal)
+        return _journals[theargs.journal]
+
+
+def get_journaled_results(theargs):
+    """
+    Gets results recorded in `--journal` if `--resume` is set,
+    reading the file only the first time a given path is
+    requested so results recorded by this run are not replayed
+
+    :param theargs: parsed command line arguments
+    :return: fingerprint => result or ``None`` if `--resume`
+             is not set
+    :rtype: dict
+    """
+    if not theargs.resume or theargs.journal is None:
+        return None
+    from enrichment_service import journal
+    with _journaled_results_lock:
+        if theargs.journal not in _journaled_results:
+            _journaled_results[theargs.journal] = journal.read_journal(theargs.journal)
+        return _journaled_results[theargs.journal]
+
+
+def get_canonical_genes(genes):
+    """
+    Gets **genes** stripped, de-duplicated and sorted so rows
+    whose members only differ by order or whitespace map to
+    the same gene list
+
+    :param genes: genes
+    :type genes: list
+    :return: canonical genes
+    :rtype: list
+    """
+    return sorted({gene.strip() for gene in genes
+                   if len(gene.strip()) > 0})
+
+
+def get_unique_genes(row_genes):
+    """
+    Groups rows in **row_genes** by their canonical gene list
+
+    :param row_genes: list of (node id, list of genes) tuples
+    :type row_genes: list
+    :return: (list of (representative node id, canonical genes) tuples
+             for each unique gene list, dict of node id => representative
+             node id)
+    :rtype: tuple
+    """
+    unique_genes = []
+    representative_by_genes = {}
+    representatives = {}
+    for node_id, genes in row_genes:
+        canonical = get_canonical_genes(genes)
+        genes_key = tuple(canonical)
+        if genes_key not in representative_by_genes:
+            representative_by_genes[genes_key] = node_id
+            unique_genes.append((node_id, canonical))
+        representatives[node_id] = representative_by_genes[genes_key]
+    return unique_genes, representatives
+
+
+def get_update_tables_columns(topk=1, fingerprint=False):
+    """
+    Gets CD_* columns of updateTables action including columns
+    for terms ranked 2 to **topk**
+
+    :param topk: number of terms per row
+    :type topk: int
+    :param fingerprint: if True, :py:const:`FINGERPRINT_COLUMN`
+                        is added
+    :type fingerprint: bool
+    :return: list of column id and type dicts
+    :rtype: list
+    """
+    columns = [{"id": "CD_CommunityName", "type": "string"},
+               {"id": "CD_AnnotatedMembers", "type": "string"},
+               {"id": "CD_AnnotatedMembers_Size", "type": "integer"},
+               {"id": "CD_AnnotatedMembers_Overlap", "type": "double"},
+               {"id": "CD_AnnotatedMembers_Pvalue", "type": "double"},
+               {"id": "CD_Labeled", "type": "boolean"},
+               {"id": "CD_AnnotatedAlgorithm", "type": "string"},
+               {"id": "CD_NonAnnotatedMembers", "type": "string"},
+               {"id": "CD_AnnotatedMembers_SourceDB", "type": "string"},
+               {"id": "CD_AnnotatedMembers_SourceTerm", "type": "string"}]
+    for rank in range(2, topk + 1):
+        for column, column_type in RANKED_COLUMNS:
+            columns.append({"id": get_ranked_column_name(column, rank),
+                            "type": column_type})
+    if fingerprint:
+        columns.append({"id": FINGERPRINT_COLUMN, "type": "string"})
+    return columns
+
+
+def get_update_tables_action(results_for_rows, topk=1, fingerprint=False):
+    """
+    Gets updateTables action setting CD_* columns of node
+    table to **results_for_rows**
+
+    :param results_for_rows: node id => result
+    :type results_for_rows: dict
+    :param topk: number of terms per row
+    :type topk: int
+    :param fingerprint: see :py:func:`get_update_tables_columns`
+    :type fingerprint: bool
+    :return: list with updateTables action
+    :rtype: list
+    """
+    return [{"action": 'updateTables',
+             "data": {
+                      "id": "node",
+                      "columns": get_update_tables_columns(topk=topk,
+                                                           fingerprint=fingerprint),
+                      "rows": results_for_rows
+                     }
+             }]
+
+
+def _get_topk(theargs, mode):
+    """
+    Gets number of terms per row returned by **mode**
+
+    :rtype: int
+    """
+    if mode in ['gprofiler', 'iquery']:
+        return max(1, theargs.top_k)
+    return 1
+
+
+def _get_cached_results(row_genes, theargs, mode, thecache):
+    """
+    Looks up result of **mode** for each gene list in **row_genes**
+    in **thecache**
+
+    :param row_genes: list of (node id, list of genes) tuples
+    :type row_genes: list
+    :param thecache: result cache, if ``None`` nothing is found
+    :type thecache: :py:class:`~enrichment_service.resultcache.ResultCache`
+    :return: (node id => result of gene lists found, list of
+             (node id, list of genes) tuples not found)
+    :rtype: tuple
+    """
+    if thecache is None:
+        return {}, row_genes
+    run_metrics = metrics.get_metrics()
+    row_results = {}
+    pending_rows = []
+    with run_metrics.time_phase('cache_lookup'):
+        for node_id, genes in row_genes:
+            found, res = thecache.get(get_cache_key(genes, theargs, mode))
+            if found:
+                row_results[node_id] = res
+            else:
+                pending_rows.append((node_id, genes))
+    run_metrics.increment(metrics.CACHE_HITS, value=len(row_results))
+    run_metrics.increment(metrics.CACHE_MISSES, value=len(pending_rows))
+    return row_results, pending_rows
+
+
+def _run_fallback(fallback_rows, theargs, mode):
+    """
+    Gets result of each gene list in **fallback_rows**, which were
+    not sent to **mode** because its circuit was open, from
+    `--fallback_mode`. Gene lists the fallback has no result for,
+    including when its own circuit is open, get ``None``
+
+    :param fallback_rows: list of (node id, list of genes) tuples
+    :type fallback_rows: list
+    :param mode: mode whose circuit was open
+    :type mode: str
+    :return: node id => result or ``None``, gene lists not done by
+             the deadline from :py:func:`get_run_deadline` are omitted
+    :rtype: dict
+    """
+    run_metrics = metrics.get_metrics()
+    fallback = theargs.fallback_mode
+    run_metrics.increment(metrics.FALLBACKS,
+                          labels={'backend': mode, 'fallback': fallback},
+                          value=len(fallback_rows))
+    row_results = {}
+    pending_rows = fallback_rows
+    if fallback == CACHE_FALLBACK:
+        thecache = get_result_cache(theargs)
+        for other_mode in CACHED_MODES:
+            if other_mode != mode:
+                cached, pending_rows = _get_cached_results(pending_rows, theargs,
+                                                           other_mode, thecache)
+                row_results.update(cached)
+    elif fallback != NO_FALLBACK:
+        thecache = None
+        if fallback in CACHED_MODES:
+            thecache = get_result_cache(theargs)
+        cached, pending_rows = _get_cached_results(pending_rows, theargs,
+                                                   fallback, thecache)
+        row_results.update(cached)
+        refused = set()
+        row_results.update(_run_mode(pending_rows, theargs, fallback,
+                                     thecache=thecache, refused=refused))
+        pending_rows = [(node_id, genes) for node_id, genes in pending_rows
+                        if node_id in refused]
+
+    for node_id, genes in pending_rows:
+        row_results[node_id] = None
+    if len(pending_rows) > 0:
+        run_metrics.skip('circuit_open', value=len(pending_rows))
+    return row_results
+
+
+def _get_results_for_genes(unique_genes, theargs, mode, reused=None,
+                           fallback_rows=None, resumed=None):
+    """
+    Gets result for each gene list in **unique_genes** from
+    `--journal` if `--resume` is set, `--previous-output`, the
+    result cache or by running enrichment with **mode**. Gene lists
+    not sent to **mode** because its circuit was open are run with
+    :py:func:`_run_fallback`. Every result not from `--journal` or
+    the fallback is recorded in `--journal` if set, gene lists whose
+    query failed have no result and are not. If fingerprints
+    are enabled, every result not from the fallback gets
+    :py:const:`FINGERPRINT_COLUMN`
+
+    :param unique_genes: list of (node id, list of genes) tuples
+    :type unique_genes: list
+    :param reused: if set, node ids whose result came from
+                   `--previous-output` are added to it
+    :type reused: set
+    :param resumed: if set, node ids whose result came from
+                    `--journal` are added to it
+    :type resumed: set
+    :param fallback_rows: if set, node ids sent to the fallback
+                          are added to it
+    :type fallback_rows: set
+    :return: node id => result or ``None``, gene lists not done by
+             the deadline from :py:func:`get_run_deadline` are omitted
+    :rtype: dict
+    """
+    row_results = {}
+    pending_rows = unique_genes
+    thecache = None
+    run_metrics = metrics.get_metrics()
+    thejournal = get_journal(theargs)
+    fingerprints = None
+    if _is_fingerprint_enabled(theargs) or thejournal is not None:
+        fingerprints = {node_id: get_row_fingerprint(genes, theargs, mode)
+                        for node_id, genes in unique_genes}
+    journaled = get_journaled_results(theargs)
+    if journaled is not None:
+        pending_rows = []
+        for node_id, genes in unique_genes:
+            if fingerprints[node_id] in journaled:
+                row_results[node_id] = journaled[fingerprints[node_id]]
+                if resumed is not None:
+                    resumed.add(node_id)
+            else:
+                pending_rows.append((node_id, genes))
+    previous = get_previous_results(theargs)
+    if previous is not None:
+        unreused_rows = pending_rows
+        pending_rows = []
+        for node_id, genes in unreused_rows:
+            if fingerprints[node_id] in previous:
+                row_results[node_id] = previous[fingerprints[node_id]]
+                if reused is not None:
+                    reused.add(node_id)
+            else:
+                pending_rows.append((node_id, genes))
+    if mode in CACHED_MODES:
+        thecache = get_result_cache(theargs)
+    cached, pending_rows = _get_cached_results(pending_rows, theargs, mode,
+                                               thecache)
+    row_results.update(cached)
+    if thejournal is not None:
+        thejournal.record_results([(fingerprints[node_id], res)
+                                   for node_id, res in cached.items()])
+
+    refused = set()
+    with run_metrics.time_phase('enrichment'):
+        mode_results = _run_mode(pending_rows, theargs, mode,
+                                 thecache=thecache, refused=refused,
+                                 thejournal=thejournal)
+    if len(refused) > 0:
+        with run_metrics.time_phase('fallback'):
+            mode_results.update(_run_fallback([(node_id, genes) for node_id, genes
+                                               in pending_rows if node_id in refused],
+                                              theargs, mode))
+        if fallback_rows is not None:
+            fallback_rows.update(refused)
+    if len(mode_results) < len(pending_rows):
+        run_metrics.skip('deadline', value=len(pending_rows) - len(mode_results))
+    row_results.update(mode_results)
+
+    if _is_fingerprint_enabled(theargs):
+        for node_id, res in row_results.items():
+            # fallback results must not be reused by a later run
+            # with --previous-output as if they came from mode
+            if res is not None and node_id not in refused:
+                res = dict(res)
+                res[FINGERPRINT_COLUMN] = fingerprints[node_id]
+                row_results[node_id] = res
+    return row_results
+
+
+def _run_mode(pending_rows, theargs, mode, thecache=None, refused=None,
+              thejournal=None):
+    """
+    Runs enrichment with **mode** on every gene list in
+    **pending_rows**, see :py:func:`_get_results_for_genes`
+
+    :param pending_rows: list of (node id, list of genes) tuples
+    :type pending_rows: list
+    :param refused: if set, node ids of rows not sent because the
+                    circuit of **mode** was open are added to it
+    :type refused: set
+    :param thejournal: if set, result of each row is recorded in
+                       it as soon as it is done
+    :type thejournal: :py:class:`~enrichment_service.journal.ResultJournal`
+    :return: node id => result or ``None``, rows not done by the
+             deadline from :py:func:`get_run_deadline` or refused
+             are omitted
+    :rtype: dict
+    """
+    row_results = {}
+    deadline = get_run_deadline(theargs)
+    if deadline.expired():
+        return row_results
+    if mode == 'local':
+        row_results.update(_run_local(pending_rows, theargs,
+                                      thejournal=thejournal))
+    elif mode == 'iquery':
+        row_results.update(run_iquery_for_rows(pending_rows, theargs,
+                                               thecache=thecache,
+                                               refused=refused,
+                                               thejournal=thejournal))
+    elif mode == 'gprofiler' and theargs.gprofiler_batchsize > 1:
+        row_results.update(_run_gprofiler_batches(pending_rows, theargs,
+                                                  thecache=thecache,
+                                                  refused=refused,
+                                                  thejournal=thejournal))
+    elif theargs.workers <= 1 and deadline.get_seconds() is None:
+        for node_id, genes in pending_rows:
+            try:
+                row_results[node_id] = _run_enrichment_for_row(node_id, genes,
+                                                               theargs, mode,
+                                                               thecache=thecache,
+                                                               thejournal=thejournal)
+            except circuitbreaker.CircuitOpenError:
+                if refused is not None:
+                    refused.add(node_id)
+    else:
+        # with a deadline rows run on a pool even if --workers is 1
+        # so waiting can stop while a request is still running
+        executor = create_thread_pool(max(1, theargs.workers))
+        try:
+            futures = {node_id: executor.submit(_run_enrichment_for_row,
+                                                node_id, genes,
+                                                theargs, mode,
+                                                thecache=thecache,
+                                                thejournal=thejournal)
+                       for node_id, genes in pending_rows}
+            row_results.update(_get_finished_results(futures, deadline,
+                                                     refused=refused))
+        finally:
+            executor.shutdown(wait=not deadline.expired(), cancel_futures=True)
+    return row_results
+
+
+def _get_gene_column_name(columns, theargs, mode):
+    """
+    Checks **columns** holds a single column and **mode** can be
+    run with **theargs**, writing a message to standard error if not
+
+    :param columns: columns of node table
+    :type columns: list
+    :return: id of column with genes or ``None`` upon error
+    :rtype: str
+    """
+    if len(columns) != 1:
+        sys.stderr.write('Only one column should be passed in the input.')
+        return None
+    if mode not in VALID_MODES:
+        sys.stderr.write('Algorithm must be one of: ' +
+                         ', '.join(VALID_MODES) + '.')
+        return None
+    if (mode == 'local' or theargs.fallback_mode == 'local') and \
+            not theargs.gmt:
+        sys.stderr.write('At least one --gmt file must be set for '
+                         'local mode.')
+        return None
+    if theargs.fallback_mode == mode:
+        sys.stderr.write('--fallback_mode must differ from mode.')
+        return None
+    if theargs.resume and theargs.journal is None:
+        sys.stderr.write('--journal must be set for --resume.')
+        return None
+    return columns[0]["id"]
+
+
+def _get_row_results(row_genes, representatives, unique_results):
+    """
+    Gets result of each row in **row_genes** from the result of
+    the row holding the same gene list
+
+    :param row_genes: list of (node id, list of genes) tuples
+    :type row_genes: list
+    :param representatives: node id => node id of row holding
+                            same gene list
+    :type representatives: dict
+    :param unique_results: results from :py:func:`_get_results_for_genes`
+    :type unique_results: dict
+    :return: (list of (node id, result) for rows with a result, list
+             of node ids of rows dropped because of the deadline)
+    :rtype: tuple
+    """
+    results = []
+    dropped = []
+    for node_id, genes in row_genes:
+        representative = representatives[node_id]
+        if representative not in unique_results:
+            dropped.append(node_id)
+            continue
+        res = unique_results[representative]
         if res is not None:
-            results_for_rows[node_id] = res
-
-    theres = [{ "action": 'updateTables',
-               "data": {
-                        "id": "node",
-                        "columns": [{"id": "CD_CommunityName", "type": "string"},
-                                    {"id": "CD_AnnotatedMembers", "type": "string"},
-                                    {"id": "CD_AnnotatedMembers_Size", "type": "integer"},
-                                    {"id": "CD_AnnotatedMembers_Overlap", "type": "double"},
-                                    {"id": "CD_AnnotatedMembers_Pvalue", "type": "double"},
-                                    {"id": "CD_Labeled", "type": "boolean"},
-                                    {"id": "CD_AnnotatedAlgorithm", "type": "string"},
-                                    {"id": "CD_NonAnnotatedMembers", "type": "string"},
-                                    {"id": "CD_AnnotatedMembers_SourceDB", "type": "string"},
-                                    {"id": "CD_AnnotatedMembers_SourceTerm", "type": "string"}],
-                        "rows": results_for_rows
-                       }
-               }]
-    return theres
+            results.append((node_id, res))
+    return results, dropped
+
+
+def _update_deadline_stats(stats, theargs, dropped):
+    """
+    Sets ``deadline_exceeded`` of **stats** and adds node ids
+    in **dropped** to ``deadline_dropped_node_ids`` and their count
+    to ``deadline_dropped_rows``. Does nothing if `--deadline` is
+    not set
+    """
+    if stats is None or theargs.deadline is None:
+        return
+    stats['deadline_exceeded'] = get_run_deadline(theargs).expired()
+    stats['deadline_dropped_rows'] = (stats.get('deadline_dropped_rows', 0) +
+                                      len(dropped))
+    stats['deadline_dropped_node_ids'] = (stats.get('deadline_dropped_node_ids', []) +
+                                          dropped)
+
+
+def _update_reuse_stats(stats, theargs, row_genes, representatives, reused):
+    """
+    Adds number of rows in **row_genes** whose result came from
+    `--previous-output` to ``reused_rows`` of **stats** and the
+    rest to ``recomputed_rows``. Does nothing if `--previous-output`
+    is not set
+    """
+    if stats is None or theargs.previous_output is None:
+        return
+    reused_count = sum(1 for node_id, genes in row_genes
+                       if representatives[node_id] in reused)
+    stats['reused_rows'] = stats.get('reused_rows', 0) + reused_count
+    stats['recomputed_rows'] = (stats.get('recomputed_rows', 0) +
+                                len(row_genes) - reused_count)
+
+
+def _update_resume_stats(stats, theargs, row_genes, representatives, resumed):
+    """
+    Adds number of rows in **row_genes** whose result came from
+    `--journal` to ``resumed_rows`` of **stats**. Does nothing if
+    `--resume` is not set
+    """
+    if stats is None or not theargs.resume:
+        return
+    stats['resumed_rows'] = (stats.get('resumed_rows', 0) +
+                             sum(1 for node_id, genes in row_genes
+                                 if representatives[node_id] in resumed))
+
+
+def _update_fallback_stats(stats, theargs, mode, row_genes, representatives,
+                           fallback_rows):
+    """
+    Adds number and node ids of rows in **row_genes** sent to
+    `--fallback_mode` because the circuit of **mode** was open to
+    ``fallback_rows`` and ``fallback_node_ids`` of **stats** and sets
+    ``circuit_breaker`` to the report of the circuit breaker of
+    **mode**. Does nothing if **mode** has no circuit breaker or
+    if `--fallback_mode` is not set and no row was sent to it
+    """
+    if stats is None or mode not in CACHED_MODES:
+        return
+    breaker = get_circuit_breaker(theargs, mode)
+    if breaker is None:
+        return
+    if theargs.fallback_mode == NO_FALLBACK and len(fallback_rows) == 0 \
+            and 'fallback_rows' not in stats:
+        return
+    node_ids = [node_id for node_id, genes in row_genes
+                if representatives[node_id] in fallback_rows]
+    stats['fallback_mode'] = theargs.fallback_mode
+    stats['fallback_rows'] = stats.get('fallback_rows', 0) + len(node_ids)
+    stats['fallback_node_ids'] = stats.get('fallback_node_ids', []) + node_ids
+    stats['circuit_breaker'] = breaker.get_report()
+
+
+def _update_dedup_stats(stats, row_count, unique_count):
+    """
+    Adds **row_count** and **unique_count** to **stats** and
+    updates dedup_ratio, see :py:func:`run_enrichment`
+    """
+    if stats is None:
+        return
+    stats['rows'] = stats.get('rows', 0) + row_count
+    stats['unique_genelists'] = stats.get('unique_genelists', 0) + unique_count
+    if stats['rows'] > 0:
+        stats['dedup_ratio'] = 1.0 - stats['unique_genelists'] / stats['rows']
+    else:
+        stats['dedup_ratio'] = 0.0
+
+
+def run_enrichment(node_table, theargs, mode, stats=None):
+    """
+    Runs enrichment on every row of **node_table**. Rows with the
+    same members, ignoring order, whitespace and duplicates, are
+    only queried once. If `--workers` is greater then 1 rows are
+    processed at the same time on a thread pool. The rows in the
+    output are always in the same order as the input regardless
+    of completion order. If `--journal` is set, each result is
+    recorded there as soon as it is done so an interrupted run
+    can be continued with `--resume`
+
+    :param node_table: node table with one column of genes
+    :type node_table: dict
+    :param theargs: parsed command line arguments
+    :param mode: gprofiler, iquery or local
+    :type mode: str
+    :param stats: if set, updated with run statistics: number of
+                  ``rows``, number of ``unique_genelists`` queried
+                  and ``dedup_ratio`` which is the fraction of rows
+                  that did not need a query of their own. If
+                  `--resume` is set, the number of rows whose result
+                  was replayed from `--journal`, ``resumed_rows``. If
+                  `--previous-output` is set, the number of rows
+                  whose result was copied from it, ``reused_rows``,
+                  and the number of other rows, ``recomputed_rows``.
+                  If `--deadline` is set, whether it passed,
+                  ``deadline_exceeded``, and the number and node ids
+                  of rows left out because they were not done by
+                  then, ``deadline_dropped_rows`` and
+                  ``deadline_dropped_node_ids``. If `--fallback_mode`
+                  is set or the circuit of **mode** opened,
+                  ``fallback_mode``, the number and
+                  node ids of rows sent to it because the circuit
+                  was open, ``fallback_rows`` and
+                  ``fallback_node_ids``, and the state of the
+                  breaker, ``circuit_breaker``
+    :type stats: dict
+    :return: list with updateTables action or ``None`` upon error
+    :rtype: list
+    """
+    # starts --deadline unless the caller already did
+    get_run_deadline(theargs)
+    column_name = _get_gene_column_name(node_table["columns"], theargs, mode)
+    if column_name is None:
+        return None
+
+    row_genes = [(node_id, get_genes_from_data(node_val[column_name]))
+                 for node_id, node_val in node_table["rows"].items()]
+    unique_genes, representatives = get_unique_genes(row_genes)
+
+    _update_dedup_stats(stats, len(row_genes), len(unique_genes))
+
+    reused = set()
+    fallback_rows = set()
+    resumed = set()
+    unique_results = _get_results_for_genes(unique_genes, theargs, mode,
+                                            reused=reused,
+                                            fallback_rows=fallback_rows,
+                                            resumed=resumed)
+    _update_resume_stats(stats, theargs, row_genes, representatives, resumed)
+    _update_reuse_stats(stats, theargs, row_genes, representatives, reused)
+    _update_fallback_stats(stats, theargs, mode, row_genes, representatives,
+                           fallback_rows)
+
+    results, dropped = _get_row_results(row_genes, representatives,
+                                        unique_results)
+    _update_deadline_stats(stats, theargs, dropped)
+    results_for_rows = dict(results)
+
+    return get_update_tables_action(results_for_rows,
+                                    topk=_get_topk(theargs, mode),
+                                    fingerprint=_is_fingerprint_enabled(theargs))
+
+
+def run_enrichment_streaming(inputfile, theargs, mode, out, stats=None):
+    """
+    Streaming version of :py:func:`run_enrichment`. Rows of the node
+    table in **inputfile** are parsed incrementally and processed
+    `--stream_chunksize` rows at a time, with the results of each
+    chunk written to **out** as soon as the chunk is done. Identical
+    gene lists are only de-duplicated within a chunk so memory use
+    stays constant regardless of the number of rows
+
+    :param inputfile: path to node table, can be gzip compressed
+    :type inputfile: str
+    :param theargs: parsed command line arguments
+    :param mode: gprofiler, iquery or local
+    :type mode: str
+    :param out: file object to write updateTables action to
+    :param stats: see :py:func:`run_enrichment`
+    :type stats: dict
+    :return: True upon success or False if input or
+             arguments are invalid
+    :rtype: bool
+    """
+    # starts --deadline unless the caller already did
+    get_run_deadline(theargs)
+    column_name = _get_gene_column_name(streaming.get_node_table_columns(inputfile),
+                                        theargs, mode)
+    if column_name is None:
+        return False
+
+    writer = streaming.UpdateTablesStreamWriter(out,
+                                                get_update_tables_columns(topk=_get_topk(theargs, mode),
+                                                                          fingerprint=_is_fingerprint_enabled(theargs)))
+    writer.start()
+    chunk = []
+
+    def process_chunk():
+        unique_genes, representatives = get_unique_genes(chunk)
+        _update_dedup_stats(stats, len(chunk), len(unique_genes))
+        reused = set()
+        fallback_rows = set()
+        resumed = set()
+        unique_results = _get_results_for_genes(unique_genes, theargs, mode,
+                                                reused=reused,
+                                                fallback_rows=fallback_rows,
+                                                resumed=resumed)
+        _update_resume_stats(stats, theargs, chunk, representatives, resumed)
+        _update_reuse_stats(stats, theargs, chunk, representatives, reused)
+        _update_fallback_stats(stats, theargs, mode, chunk, representatives,
+                               fallback_rows)
+        results, dropped = _get_row_results(chunk, representatives,
+                                            unique_results)
+        _update_deadline_stats(stats, theargs, dropped)
+        with metrics.get_metrics().time_phase('write_output'):
+            for node_id, res in results:
+                writer.write_row(node_id, res)
+
+    _update_dedup_stats(stats, 0, 0)
+    for node_id, node_val in streaming.iter_node_table_rows(inputfile):
+        chunk.append((node_id, get_genes_from_data(node_val[column_name])))
+        if len(chunk) >= theargs.stream_chunksize:
+            process_chunk()
+            chunk = []
+    if len(chunk) > 0:
+        process_chunk()
+    writer.end()
+    return True
 
 
 def read_inputfile(inputfile):
     """
+    Reads node table from **inputfile**
 
-    :param inputfile:
-    :return:
+    :param inputfile: path to JSON file, decompressed if
+                      name ends with .gz
+    :return: node table
+    :rtype: dict
     """
-    with open(inputfile, 'r') as f:
+    with streaming.open_inputfile(inputfile) as f:
         return json.load(f)
 
 
+def write_metrics(run_metrics, theargs, stats):
+    """
+    Writes **run_metrics** to `--metrics-out` and
+    `--metrics-prometheus` if set
+
+    :param run_metrics: metrics of run
+    :type run_metrics: :py:class:`~enrichment_service.metrics.RunMetrics`
+    :param theargs: parsed command line arguments
+    :param stats: run statistics added to JSON report
+    :type stats: dict
+    """
+    if theargs.metrics_out is not None:
+        run_metrics.write_report(theargs.metrics_out, stats=stats)
+    if theargs.metrics_prometheus is not None:
+        run_metrics.write_prometheus(theargs.metrics_prometheus)
+
+
+def write_enrichment(theargs, out, stats=None):
+    """
+    Runs enrichment on node table in `input` writing
+    updateTables action list to **out**
+
+    :param theargs: parsed command line arguments
+    :param out: file like object to write JSON to
+    :param stats: if set, filled with run statistics
+    :type stats: dict
+    :return: ``False`` if input has no results otherwise ``True``
+    :rtype: bool
+    """
+    # deadline covers reading the input too
+    get_run_deadline(theargs)
+    if theargs.stream:
+        return run_enrichment_streaming(theargs.input, theargs,
+                                        theargs.mode, out,
+                                        stats=stats) is not False
+
+    run_metrics = metrics.get_metrics()
+    with run_metrics.time_phase('read_input'):
+        json_input = read_inputfile(theargs.input)
+    theres = run_enrichment(json_input, theargs, theargs.mode,
+                            stats=stats)
+    if theres is None:
+        return False
+    with run_metrics.time_phase('write_output'):
+        json.dump(theres, out, indent=2)
+    out.flush()
+    return True
+
+
 def main(args):
     """
     Main entry point for program
@@ -395,20 +3169,49 @@ def main(args):
     :rtype: int
     """
     desc = """
-    TODO
+    Runs enrichment on each row of node table in input and writes
+    updateTables action with CD_* columns to standard out.
+
+    To instead run a long running HTTP service invoke with
+    """ + SERVE_COMMAND + """ as first argument, see """ + SERVE_COMMAND + """ --help
+
+    To compile GMT files into a library that loads faster in local
+    mode invoke with """ + COMPILE_LIBRARY_COMMAND + """ as first argument, see
+    """ + COMPILE_LIBRARY_COMMAND + """ --help
+
+    To run enrichment on many node table files using a pool of
+    processes invoke with """ + BATCH_COMMAND + """ as first argument, see
+    """ + BATCH_COMMAND + """ --help
+
+    To label a node table with many combinations of g:Profiler
+    thresholds while querying g:Profiler once invoke with
+    """ + SWEEP_COMMAND + """ as first argument, see """ + SWEEP_COMMAND + """ --help
     """
+    if len(args) > 1 and args[1] == SERVE_COMMAND:
+        from enrichment_service import server
+        return server.main(args[2:])
+    if len(args) > 1 and args[1] == COMPILE_LIBRARY_COMMAND:
+        from enrichment_service import compiledlibrary
+        return compiledlibrary.main(args[2:])
+    if len(args) > 1 and args[1] == BATCH_COMMAND:
+        from enrichment_service import batch
+        return batch.main(args[2:])
+    if len(args) > 1 and args[1] == SWEEP_COMMAND:
+        from enrichment_service import sweep
+        return sweep.main(args[2:])
 
     theargs = _parse_arguments(desc, args[1:])
     try:
+        httpclient.set_session(create_http_session(theargs))
+        run_metrics = metrics.RunMetrics()
+        metrics.set_metrics(run_metrics)
 
-        json_input = read_inputfile(theargs.input)
-        theres = run_enrichment(json_input, theargs, theargs.mode)
-
-        if theres is None:
+        stats = {}
+        if write_enrichment(theargs, sys.stdout, stats=stats) is False:
             sys.stderr.write('No results\n')
         else:
-            json.dump(theres, sys.stdout, indent=2)
-        sys.stdout.flush()
+            sys.stderr.write('Run stats: ' + json.dumps(stats) + '\n')
+        write_metrics(run_metrics, theargs, stats)
         return 0
     except Exception as e:
         sys.stderr.write('Caught exception: ' + str(e))
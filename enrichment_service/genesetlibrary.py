@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+"""
+Gene set libraries used by the local enrichment mode
+"""
+
+import os
+import sys
+
+import numpy
+
+
+GMT_EXTENSION = '.gmt'
+
+
+class GeneSetLibrary(object):
+    """
+    Collection of terms each with a set of genes. Genes are
+    interned into a vocabulary and the genes of each term
+    are stored in compressed sparse row format so term ``i``
+    has genes ``genes[term_indices[term_indptr[i]:term_indptr[i+1]]]``.
+    The inverse, terms of each gene, is stored the same way in
+    **gene_indptr** and **gene_indices**
+    """
+
+    def __init__(self, genes, term_sources, term_natives, term_names,
+                 term_indptr, term_indices, gene_indptr=None,
+                 gene_indices=None):
+        """
+        Constructor
+
+        :param genes: gene vocabulary
+        :type genes: list
+        :param term_sources: source database of each term ie GO:BP
+        :type term_sources: list
+        :param term_natives: identifier of each term ie GO:0008150
+        :type term_natives: list
+        :param term_names: human readable name of each term
+        :type term_names: list
+        :param term_indptr: offsets into **term_indices** of length
+                            number of terms + 1
+        :type term_indptr: :py:class:`numpy.ndarray`
+        :param term_indices: indices into **genes**
+        :type term_indices: :py:class:`numpy.ndarray`
+        :param gene_indptr: offsets into **gene_indices** of length
+                            number of genes + 1, if ``None`` it is
+                            built from the term arrays when needed
+        :type gene_indptr: :py:class:`numpy.ndarray`
+        :param gene_indices: indices of terms
+        :type gene_indices: :py:class:`numpy.ndarray`
+        """
+        self._genes = genes
+        self._term_sources = term_sources
+        self._term_natives = term_natives
+        self._term_names = term_names
+        self._term_indptr = term_indptr
+        self._term_indices = term_indices
+        self._gene_indptr = gene_indptr
+        self._gene_indices = gene_indices
+        self._gene_index = None
+        self._term_source_ids = None
+
+    @property
+    def genes(self):
+        """
+        Gets gene vocabulary
+        """
+        return self._genes
+
+    @property
+    def term_sources(self):
+        """
+        Gets source database of each term
+        """
+        return self._term_sources
+
+    @property
+    def term_natives(self):
+        """
+        Gets identifier of each term
+        """
+        return self._term_natives
+
+    @property
+    def term_names(self):
+        """
+        Gets name of each term
+        """
+        return self._term_names
+
+    @property
+    def term_indptr(self):
+        """
+        Gets CSR offsets of term genes
+        """
+        return self._term_indptr
+
+    @property
+    def term_indices(self):
+        """
+        Gets CSR gene indices of term genes
+        """
+        return self._term_indices
+
+    def get_number_of_genes(self):
+        """
+        Gets number of genes in vocabulary which is the number
+        of annotated genes used as domain size when scoring
+
+        :rtype: int
+        """
+        return len(self._genes)
+
+    def get_number_of_terms(self):
+        """
+        Gets number of terms
+
+        :rtype: int
+        """
+        return len(self._term_indptr) - 1
+
+    def get_gene_index(self):
+        """
+        Gets mapping of gene to its position in vocabulary,
+        built on first call
+
+        :return: gene => index
+        :rtype: dict
+        """
+        if self._gene_index is None:
+            self._gene_index = {gene: index for index, gene
+                                in enumerate(self._genes)}
+        return self._gene_index
+
+    def get_gene_indices(self, genes):
+        """
+        Gets position in vocabulary of each gene in **genes**
+
+        :param genes: genes
+        :type genes: list
+        :return: index of each gene or -1 if gene is not in library
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        gene_index = self.get_gene_index()
+        return numpy.array([gene_index.get(gene, -1) for gene in genes],
+                           dtype=numpy.int64)
+
+    def get_term_source_ids(self):
+        """
+        Gets distinct sources and position of source of each term
+        in them, built on first call
+
+        :return: (list of sources, :py:class:`numpy.ndarray` with
+                 index into sources for each term)
+        :rtype: tuple
+        """
+        if self._term_source_ids is None:
+            sources, ids = numpy.unique(numpy.array(self._term_sources,
+                                                    dtype=str),
+                                        return_inverse=True)
+            self._term_source_ids = (sources.tolist(),
+                                     ids.astype(numpy.int32))
+        return self._term_source_ids
+
+    def get_inverted_index(self):
+        """
+        Gets terms of each gene in compressed sparse row format,
+        built from the term arrays on first call if not passed
+        to constructor
+
+        :return: (gene_indptr, gene_indices) where gene ``i`` is in
+                 terms ``gene_indices[gene_indptr[i]:gene_indptr[i+1]]``
+        :rtype: tuple
+        """
+        if self._gene_indptr is None:
+            term_ids = numpy.repeat(numpy.arange(self.get_number_of_terms(),
+                                                 dtype=numpy.int32),
+                                    self.get_term_sizes())
+            order = numpy.argsort(self._term_indices, kind='stable')
+            counts = numpy.bincount(self._term_indices,
+                                    minlength=self.get_number_of_genes())
+            gene_indptr = numpy.zeros(self.get_number_of_genes() + 1,
+                                      dtype=numpy.int64)
+            numpy.cumsum(counts, out=gene_indptr[1:])
+            self._gene_indices = term_ids[order]
+            self._gene_indptr = gene_indptr
+        return self._gene_indptr, self._gene_indices
+
+    def get_term_sizes(self):
+        """
+        Gets number of genes in each term
+
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        return numpy.diff(self._term_indptr)
+
+    def get_term_genes(self, term):
+        """
+        Gets genes of **term**
+
+        :param term: index of term
+        :type term: int
+        :return: genes
+        :rtype: list
+        """
+        start = self._term_indptr[term]
+        end = self._term_indptr[term + 1]
+        return [self._genes[index] for index
+                in self._term_indices[start:end]]
+
+    def get_gene_term_matrix(self):
+        """
+        Gets genes by terms sparse matrix with 1 where gene is
+        a member of term
+
+        :rtype: :py:class:`scipy.sparse.csc_matrix`
+        """
+        from scipy import sparse
+        data = numpy.ones(len(self._term_indices), dtype=numpy.int32)
+        return sparse.csc_matrix((data, self._term_indices,
+                                  self._term_indptr),
+                                 shape=(self.get_number_of_genes(),
+                                        self.get_number_of_terms()))
+
+    def get_gene_term_csr_matrix(self):
+        """
+        Same as :py:meth:`get_gene_term_matrix` but in compressed
+        sparse row format built from :py:meth:`get_inverted_index`
+        which is what multiplying by a gene lists by genes
+        matrix needs
+
+        :rtype: :py:class:`scipy.sparse.csr_matrix`
+        """
+        from scipy import sparse
+        gene_indptr, gene_indices = self.get_inverted_index()
+        data = numpy.ones(len(gene_indices), dtype=numpy.int32)
+        return sparse.csr_matrix((data, gene_indices, gene_indptr),
+                                 shape=(self.get_number_of_genes(),
+                                        self.get_number_of_terms()))
+
+
+def get_source_and_path(gmtarg):
+    """
+    Splits **gmtarg** of form ``[SOURCE=]PATH`` into source and
+    path. If no source is given, the file name without
+    :py:const:`GMT_EXTENSION` is used
+
+    :param gmtarg: value passed to --gmt
+    :type gmtarg: str
+    :return: (source, path)
+    :rtype: tuple
+    """
+    if '=' in gmtarg:
+        source, path = gmtarg.split('=', 1)
+        return source, path
+    source = os.path.basename(gmtarg)
+    if source.lower().endswith(GMT_EXTENSION):
+        source = source[:-len(GMT_EXTENSION)]
+    return source, gmtarg
+
+
+def read_gmt_files(gmtargs):
+    """
+    Reads gene sets from GMT files. Each line of a GMT file is a term
+    with tab delimited identifier, description and genes. The
+    description is used as the term name unless it is empty or
+    a URL in which case the identifier is used
+
+    :param gmtargs: values passed to --gmt of form ``[SOURCE=]PATH``
+    :type gmtargs: list
+    :return: library with terms from all files
+    :rtype: :py:class:`GeneSetLibrary`
+    """
+    gene_index = {}
+    genes = []
+    term_sources = []
+    term_natives = []
+    term_names = []
+    term_indptr = [0]
+    term_indices = []
+    for gmtarg in gmtargs:
+        source, path = get_source_and_path(gmtarg)
+        with open(path, 'r') as f:
+            for line in f:
+                split_line = line.rstrip('\r\n').split('\t')
+                if len(split_line) < 3:
+                    if len(line.strip()) > 0:
+                        sys.stderr.write('Skipping malformed line in ' +
+                                         path + ': ' + line + '\n')
+                    continue
+                term_genes = set()
+                for gene in split_line[2:]:
+                    gene = gene.strip()
+                    if len(gene) == 0 or gene in term_genes:
+                        continue
+                    term_genes.add(gene)
+                    if gene not in gene_index:
+                        gene_index[gene] = len(genes)
+                        genes.append(gene)
+                    term_indices.append(gene_index[gene])
+                if len(term_genes) == 0:
+                    continue
+                native = split_line[0].strip()
+                name = split_line[1].strip()
+                if len(name) == 0 or name.lower().startswith('http'):
+                    name = native
+                term_sources.append(source)
+                term_natives.append(native)
+                term_names.append(name)
+                term_indptr.append(len(term_indices))
+
+    return GeneSetLibrary(genes, term_sources, term_natives, term_names,
+                          numpy.array(term_indptr, dtype=numpy.int64),
+                          numpy.array(term_indices, dtype=numpy.int32))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared HTTP session used for calls to remote services
+"""
+
+import threading
+
+import enrichment_service
+
+
+DEFAULT_POOL_SIZE = 20
+
+DEFAULT_RETRIES = 3
+
+DEFAULT_BACKOFF_FACTOR = 0.5
+
+# status codes retried by the adapter for idempotent requests
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# bytes read from the connection at a time by ResponseReader
+DEFAULT_CHUNK_SIZE = 65536
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES,
+                   backoff_factor=DEFAULT_BACKOFF_FACTOR):
+    """
+    Creates session that keeps up to **pool_size** connections per
+    host alive, asks for gzip compressed responses and retries
+    idempotent requests that fail to connect or get a status in
+    :py:const:`RETRY_STATUS_CODES`, honoring ``Retry-After``
+
+    :param pool_size: connections to keep per host
+    :type pool_size: int
+    :param retries: times to retry a failed request
+    :type retries: int
+    :param backoff_factor: see :py:class:`urllib3.util.retry.Retry`
+    :type backoff_factor: float
+    :return: session
+    :rtype: :py:class:`requests.Session`
+    """
+    # imported here so importing this module stays cheap
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUS_CODES,
+                  allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                            'User-Agent': 'enrichment-service/' +
+                                          enrichment_service.__version__})
+    return session
+
+
+def get_session():
+    """
+    Gets process wide session, created with default settings
+    on first call unless one was set with :py:func:`set_session`
+
+    :rtype: :py:class:`requests.Session`
+    """
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = create_session()
+        return _default_session
+
+
+def set_session(session):
+    """
+    Sets process wide session returned by :py:func:`get_session`.
+    Lets callers configure the pool or pass in a stand in
+    transport for tests and benchmarks
+
+    :param session: session or ``None`` to go back to default
+    :type session: :py:class:`requests.Session`
+    """
+    global _default_session
+    with _default_session_lock:
+        _default_session = session
+
+
+class ResponseReader(object):
+    """
+    Read only binary file object over the body of a response
+    requested with ``stream=True``, so a parser can consume the
+    body as it arrives. The body is decompressed if the service
+    compressed it and errors reading it are raised as
+    :py:class:`requests.exceptions.RequestException`
+    """
+
+    def __init__(self, response, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Constructor
+
+        :param response: response to read body of
+        :type response: :py:class:`requests.Response`
+        :param chunk_size: bytes to read from connection at a time
+        :type chunk_size: int
+        """
+        self._chunks = iter(response.iter_content(chunk_size=chunk_size))
+        self._buffer = b''
+
+    def read(self, size=-1):
+        """
+        Reads up to **size** bytes, or the rest of the body if
+        **size** is negative
+
+        :return: bytes, empty at end of body
+        :rtype: bytes
+        """
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data = self._buffer
+        else:
+            data = self._buffer[:size]
+        self._buffer = self._buffer[len(data):]
+        return data
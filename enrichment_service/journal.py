@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+Append only journal of enrichment results so a run that dies
+partway through can be resumed without losing finished rows
+"""
+
+import os
+import sys
+import json
+import threading
+
+
+def read_journal(path):
+    """
+    Reads entries of journal at **path**. A line left incomplete
+    by a crash while it was written is skipped
+
+    :param path: path to journal
+    :type path: str
+    :return: key => result, if a key was written more than once
+             the last result is used. Empty if **path** does
+             not exist
+    :rtype: dict
+    """
+    results = {}
+    if not os.path.isfile(path):
+        return results
+    skipped = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                entry = json.loads(line)
+                results[entry['key']] = entry['result']
+            except (ValueError, KeyError, TypeError):
+                skipped += 1
+    if skipped > 0:
+        sys.stderr.write('Skipped ' + str(skipped) +
+                         ' incomplete entries of journal ' + path + '\n')
+    return results
+
+
+class ResultJournal(object):
+    """
+    Journal of results, one JSON object per line holding the
+    ``key`` and ``result`` of a gene list. Every write is flushed
+    and synced to disk before returning so results recorded before
+    a crash can be read back with :py:func:`read_journal`.
+
+    The file is only ever appended to and each write is a whole
+    number of lines, so threads and processes can share a journal
+    """
+
+    def __init__(self, path):
+        """
+        Constructor, if the last line of an existing journal at
+        **path** is incomplete it is ended so new entries start on
+        a line of their own
+
+        :param path: path to journal, created if it does not exist
+        :type path: str
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        with open(path, 'ab+') as f:
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+
+    def get_path(self):
+        """
+        Gets path to journal
+
+        :rtype: str
+        """
+        return self._path
+
+    def record(self, key, result):
+        """
+        Appends **result** of gene list with **key**
+
+        :param key: key of gene list and parameters
+        :type key: str
+        :param result: result or ``None`` if there was none
+        :type result: dict
+        """
+        self.record_results([(key, result)])
+
+    def record_results(self, results):
+        """
+        Appends every (key, result) tuple in **results** with a
+        single write and sync
+
+        :param results: list of (key, result) tuples
+        :type results: list
+        """
+        if len(results) == 0:
+            return
+        data = ''.join([json.dumps({'key': key, 'result': result}) + '\n'
+                        for key, result in results]).encode('utf-8')
+        with self._lock:
+            with open(self._path, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
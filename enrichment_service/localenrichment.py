@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline enrichment of many gene lists at once against a
+:py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+"""
+
+import numpy
+
+
+ALGORITHM_NAME = 'Local'
+
+# number of gene lists multiplied at once with their candidate terms
+CANDIDATE_BLOCK_SIZE = 64
+
+
+def get_query_gene_indices(gene_lists, library):
+    """
+    Gets position in vocabulary of **library** of the genes of
+    each gene list, dropping genes not in **library** and genes
+    repeated within a gene list
+
+    :param gene_lists: list of gene lists
+    :type gene_lists: list
+    :param library: gene sets
+    :type library: :py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+    :return: (index of gene list, index of gene) arrays sorted by
+             gene list and then by gene
+    :rtype: tuple
+    """
+    number_of_genes = library.get_number_of_genes()
+    lengths = numpy.array([len(genes) for genes in gene_lists],
+                          dtype=numpy.int64)
+    rows = numpy.repeat(numpy.arange(len(gene_lists), dtype=numpy.int64),
+                        lengths)
+    cols = library.get_gene_indices([gene for genes in gene_lists
+                                     for gene in genes])
+    known = cols >= 0
+    keys = numpy.unique(rows[known] * number_of_genes + cols[known])
+    return keys // number_of_genes, keys % number_of_genes
+
+
+def get_overlap_matrix(gene_lists, library, term_mask=None,
+                       candidates=None):
+    """
+    Builds a sparse gene lists by genes matrix and multiplies it
+    with the genes by terms matrix of **library** to get the number
+    of genes each gene list shares with each term. If **candidates**
+    is set, only those gene list and term pairs are counted
+
+    :param gene_lists: list of gene lists
+    :type gene_lists: list
+    :param library: gene sets
+    :type library: :py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+    :param term_mask: if set, only terms where mask is True are scored
+    :type term_mask: :py:class:`numpy.ndarray`
+    :param candidates: sorted keys of gene list index times number
+                       of terms plus term index
+    :type candidates: :py:class:`numpy.ndarray`
+    :return: (overlap as :py:class:`scipy.sparse.coo_matrix` of gene
+             lists by terms, number of genes of each gene list found
+             in **library**)
+    :rtype: tuple
+    """
+    from scipy import sparse
+    number_of_genes = library.get_number_of_genes()
+    number_of_terms = library.get_number_of_terms()
+    rows, cols = get_query_gene_indices(gene_lists, library)
+    query_sizes = numpy.bincount(rows, minlength=len(gene_lists))
+    query_matrix = sparse.csr_matrix((numpy.ones(len(rows),
+                                                 dtype=numpy.int32),
+                                      (rows, cols)),
+                                     shape=(len(gene_lists),
+                                            number_of_genes))
+    if candidates is not None:
+        if term_mask is not None:
+            candidates = candidates[term_mask[candidates % number_of_terms]]
+        return (get_candidate_overlap_matrix(query_matrix, library,
+                                             candidates),
+                query_sizes)
+
+    overlap = (query_matrix @ library.get_gene_term_csr_matrix()).tocoo()
+    if term_mask is None:
+        return overlap, query_sizes
+
+    keep = term_mask[overlap.col]
+    overlap = sparse.coo_matrix((overlap.data[keep],
+                                 (overlap.row[keep], overlap.col[keep])),
+                                shape=(len(gene_lists), number_of_terms))
+    return overlap, query_sizes
+
+
+def get_candidate_overlap_matrix(query_matrix, library, candidates):
+    """
+    Gets number of genes shared by the gene list and term of each
+    of **candidates**. Gene lists are multiplied in blocks of
+    :py:const:`CANDIDATE_BLOCK_SIZE` with only the terms that are
+    candidates of a gene list in the block
+
+    :param query_matrix: gene lists by genes matrix
+    :type query_matrix: :py:class:`scipy.sparse.csr_matrix`
+    :param library: gene sets
+    :type library: :py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+    :param candidates: sorted keys of gene list index times number
+                       of terms plus term index
+    :type candidates: :py:class:`numpy.ndarray`
+    :return: gene lists by terms overlap
+    :rtype: :py:class:`scipy.sparse.coo_matrix`
+    """
+    from scipy import sparse
+    number_of_queries = query_matrix.shape[0]
+    number_of_terms = library.get_number_of_terms()
+    gene_term_matrix = library.get_gene_term_matrix()
+    rows = []
+    cols = []
+    data = []
+    for start in range(0, number_of_queries, CANDIDATE_BLOCK_SIZE):
+        end = min(start + CANDIDATE_BLOCK_SIZE, number_of_queries)
+        first, last = numpy.searchsorted(candidates,
+                                         [start * number_of_terms,
+                                          end * number_of_terms])
+        if first == last:
+            continue
+        block_candidates = candidates[first:last]
+        terms = numpy.unique(block_candidates % number_of_terms)
+        overlap = (query_matrix[start:end] @ gene_term_matrix[:, terms]).tocoo()
+        block_rows = overlap.row.astype(numpy.int64) + start
+        block_cols = terms[overlap.col]
+        keep = numpy.isin(block_rows * number_of_terms + block_cols,
+                          block_candidates)
+        rows.append(block_rows[keep])
+        cols.append(block_cols[keep])
+        data.append(overlap.data[keep])
+    if len(rows) == 0:
+        return sparse.coo_matrix((number_of_queries, number_of_terms),
+                                 dtype=numpy.int32)
+    return sparse.coo_matrix((numpy.concatenate(data),
+                              (numpy.concatenate(rows),
+                               numpy.concatenate(cols))),
+                             shape=(number_of_queries, number_of_terms))
+
+
+def get_hypergeometric_pvalues(overlaps, query_sizes, term_sizes,
+                               domain_size):
+    """
+    Vectorized probability of seeing **overlaps** or more genes
+    shared between gene lists and terms by chance
+
+    :param overlaps: number of shared genes
+    :type overlaps: :py:class:`numpy.ndarray`
+    :param query_sizes: number of genes in gene list
+    :type query_sizes: :py:class:`numpy.ndarray`
+    :param term_sizes: number of genes in term
+    :type term_sizes: :py:class:`numpy.ndarray`
+    :param domain_size: total number of genes
+    :type domain_size: int
+    :return: p values
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    from scipy.stats import hypergeom
+    return hypergeom.sf(overlaps - 1, domain_size, term_sizes, query_sizes)
+
+
+def get_source_term_counts(library, term_mask=None):
+    """
+    Gets for each term the number of terms in **library** from
+    the same source, used to adjust p values for multiple testing
+    the way g:Profiler does per source
+
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    unique_sources, inverse = library.get_term_source_ids()
+    if term_mask is None:
+        term_mask = numpy.ones(len(inverse), dtype=bool)
+    counts = numpy.bincount(inverse[term_mask],
+                            minlength=len(unique_sources))
+    return counts[inverse]
+
+
+def get_term_mask(library, excludesource):
+    """
+    Gets mask that is False for terms whose source is in
+    comma delimited **excludesource**
+
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    if excludesource is None:
+        return numpy.ones(library.get_number_of_terms(), dtype=bool)
+    sources, source_ids = library.get_term_source_ids()
+    excluded = set(excludesource.split(','))
+    return ~numpy.isin(source_ids, [index for index, source in enumerate(sources)
+                                    if source in excluded])
+
+
+def get_best_terms(overlap, query_sizes, library, maxpval, minoverlap,
+                   term_mask):
+    """
+    Scores every non zero entry of **overlap**, drops terms whose
+    adjusted p value exceeds **maxpval** or whose Jaccard is below
+    **minoverlap** and picks the best term of each gene list sorting
+    by Jaccard and then by p value
+
+    :return: gene list index => (term index, adjusted p value)
+    :rtype: dict
+    """
+    if overlap.nnz == 0:
+        return {}
+    query_ids = overlap.row
+    term_ids = overlap.col
+    overlaps = overlap.data.astype(numpy.int64)
+    q_sizes = query_sizes[query_ids]
+    t_sizes = library.get_term_sizes()[term_ids]
+
+    # Jaccard is cheap so drop terms below minoverlap before
+    # computing p values which are not
+    jaccard = overlaps / (q_sizes + t_sizes - overlaps)
+    keep = jaccard >= minoverlap
+    query_ids = query_ids[keep]
+    term_ids = term_ids[keep]
+    jaccard = jaccard[keep]
+    pvalues = get_hypergeometric_pvalues(overlaps[keep], q_sizes[keep],
+                                         t_sizes[keep],
+                                         library.get_number_of_genes())
+    pvalues = numpy.minimum(pvalues * get_source_term_counts(library,
+                                                             term_mask)[term_ids],
+                            1.0)
+
+    keep = pvalues <= maxpval
+    if not numpy.any(keep):
+        return {}
+    query_ids = query_ids[keep]
+    term_ids = term_ids[keep]
+    jaccard = jaccard[keep]
+    pvalues = pvalues[keep]
+
+    # lexsort uses last key as primary key
+    order = numpy.lexsort((pvalues, -jaccard, query_ids))
+    sorted_queries = query_ids[order]
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = sorted_queries[1:] != sorted_queries[:-1]
+    best = order[first]
+    return {int(query_ids[i]): (int(term_ids[i]), float(pvalues[i]))
+            for i in best}
+
+
+def run_local_enrichment(gene_lists, library, maxpval, minoverlap,
+                         excludesource, index=None):
+    """
+    Runs enrichment of all **gene_lists** against all terms of
+    **library** at once using hypergeometric p values adjusted by
+    the number of terms per source. If **index** is set, only
+    terms it finds as candidates for a gene list are scored.
+    P values are still adjusted by the number of all terms
+
+    :param gene_lists: list of gene lists
+    :type gene_lists: list
+    :param library: gene sets
+    :type library: :py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+    :param maxpval: max adjusted p value
+    :type maxpval: float
+    :param minoverlap: minimum Jaccard
+    :type minoverlap: float
+    :param excludesource: comma delimited list of sources to exclude
+    :type excludesource: str
+    :param index: index of terms of **library** used to skip terms
+                  that cannot reach **minoverlap**
+    :type index: :py:class:`~enrichment_service.minhash.MinHashIndex`
+    :return: result in CD_* format or ``None`` for each gene list
+    :rtype: list
+    """
+    term_mask = get_term_mask(library, excludesource)
+    candidates = None
+    if index is not None:
+        candidates = index.get_candidates(gene_lists)
+    overlap, query_sizes = get_overlap_matrix(gene_lists, library,
+                                              term_mask=term_mask,
+                                              candidates=candidates)
+    best_terms = get_best_terms(overlap, query_sizes, library, maxpval,
+                                minoverlap, term_mask)
+    results = []
+    for query_index, genes in enumerate(gene_lists):
+        if query_index not in best_terms:
+            results.append(None)
+            continue
+        term, pvalue = best_terms[query_index]
+        results.append(get_result_in_mapped_term_json(genes, library,
+                                                      term, pvalue))
+    return results
+
+
+def get_result_in_mapped_term_json(genes, library, term, pvalue):
+    """
+    Gets result for **term** in the same CD_* format as the
+    g:Profiler and iQuery modes
+
+    :rtype: dict
+    """
+    term_genes = set(library.get_term_genes(term))
+    annotated_members = [gene for gene in dict.fromkeys(genes)
+                         if gene in term_genes]
+    name = library.term_names[term]
+    return {'CD_CommunityName': name,
+            'CD_AnnotatedMembers': ' '.join(annotated_members),
+            'CD_AnnotatedMembers_Size': len(annotated_members),
+            'CD_AnnotatedMembers_Overlap': len(annotated_members) / len(genes),
+            'CD_AnnotatedMembers_Pvalue': pvalue,
+            'CD_Labeled': len(name) > 0,
+            'CD_AnnotatedAlgorithm': ALGORITHM_NAME,
+            'CD_NonAnnotatedMembers': ' '.join(list(set(genes) - set(annotated_members))),
+            'CD_AnnotatedMembers_SourceDB': library.term_sources[term],
+            'CD_AnnotatedMembers_SourceTerm': library.term_natives[term]
+            }
@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+
+"""
+Timings and counts collected during a run and written out as a
+JSON report or Prometheus text format file
+"""
+
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+
+import enrichment_service
+
+
+PROMETHEUS_PREFIX = 'enrichment_service_'
+
+# time spent on each row, or on the g:Profiler batch holding it
+ROW_SECONDS = 'row_seconds'
+
+# time spent in a phase of a run, labeled by phase
+PHASE_SECONDS = 'phase_seconds'
+
+# requests made to remote services, labeled by operation and status
+HTTP_REQUESTS = 'http_requests'
+
+# latency of requests to remote services, labeled by operation
+HTTP_REQUEST_SECONDS = 'http_request_seconds'
+
+# status checks made for each iQuery task
+POLLS_PER_TASK = 'iquery_polls_per_task'
+
+# requests retried by a scheduler, labeled by backend and outcome
+RETRIES = 'http_retries'
+
+# iQuery tasks, labeled by endpoint and outcome, one of
+# completed, failed or abandoned when another submission of
+# the same genes finished first
+IQUERY_TASKS = 'iquery_tasks'
+
+# duplicate iQuery submissions of slow tasks, labeled by
+# outcome, won if the duplicate finished first otherwise lost
+HEDGES = 'iquery_hedges'
+
+# gene lists sent to --fallback_mode because the circuit of their
+# backend was open, labeled by backend and fallback
+FALLBACKS = 'fallbacks'
+
+CACHE_HITS = 'cache_hits'
+
+CACHE_MISSES = 'cache_misses'
+
+# gene lists without a result, labeled by reason
+SKIPPED = 'skipped'
+
+# percentiles included in summaries
+SUMMARY_PERCENTILES = [50, 90, 99]
+
+# status label of requests that raised an exception
+ERROR_STATUS = 'error'
+
+# observed values kept per metric and labels, percentiles of
+# metrics observed more often are taken from a uniform random
+# sample of this many values so memory use stays constant
+RESERVOIR_SIZE = 1024
+
+_default_metrics = None
+_default_metrics_lock = threading.Lock()
+
+_thread_metrics = threading.local()
+
+
+def _get_key(name, labels):
+    """
+    Gets key for metric **name** with **labels** where labels
+    are sorted so order they are passed in does not matter
+
+    :rtype: tuple
+    """
+    if labels is None:
+        return name, ()
+    return name, tuple(sorted(labels.items()))
+
+
+def get_summary(values):
+    """
+    Summarizes **values** with count, sum, mean, max and
+    percentiles in :py:const:`SUMMARY_PERCENTILES` using
+    nearest rank
+
+    :param values: observed values
+    :type values: list
+    :rtype: dict
+    """
+    values = sorted(values)
+    summary = {'count': len(values),
+               'sum': sum(values)}
+    if len(values) == 0:
+        return summary
+    summary['mean'] = summary['sum'] / len(values)
+    summary['max'] = values[-1]
+    for percentile in SUMMARY_PERCENTILES:
+        index = int(round((len(values) - 1) * percentile / 100.0))
+        summary['p' + str(percentile)] = values[index]
+    return summary
+
+
+class Reservoir(object):
+    """
+    Count, sum and max of every value added and a uniform random
+    sample of at most **size** of them, so percentiles are exact
+    until more than **size** values are added and estimated after.
+    Not thread safe, :py:class:`RunMetrics` guards access to it
+    """
+
+    def __init__(self, size=RESERVOIR_SIZE, seed=None):
+        """
+        Constructor
+
+        :param size: maximum number of values kept
+        :type size: int
+        :param seed: seed of random choice of values kept
+        :type seed: int
+        """
+        self._size = max(1, size)
+        self._random = random.Random(seed)
+        self._values = []
+        self._count = 0
+        self._sum = 0
+        self._max = None
+
+    def add(self, value):
+        """
+        Adds **value**, replacing a random kept value once
+        **size** values are kept
+        """
+        self._count += 1
+        self._sum += value
+        if self._max is None or value > self._max:
+            self._max = value
+        if len(self._values) < self._size:
+            self._values.append(value)
+            return
+        index = self._random.randrange(self._count)
+        if index < self._size:
+            self._values[index] = value
+
+    def get_values(self):
+        """
+        Gets copy of values kept
+
+        :rtype: list
+        """
+        return list(self._values)
+
+    def get_summary(self):
+        """
+        Same as :py:func:`get_summary` of values kept except
+        count, sum, mean and max cover every value added
+
+        :rtype: dict
+        """
+        summary = get_summary(self._values)
+        summary['count'] = self._count
+        summary['sum'] = self._sum
+        if self._count > 0:
+            summary['mean'] = self._sum / self._count
+            summary['max'] = self._max
+        return summary
+
+
+class RunMetrics(object):
+    """
+    Thread safe store of counters and observed values, each
+    identified by a name and optional labels
+    """
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._observations = {}
+        self._start_time = time.time()
+        self._start = time.monotonic()
+
+    def increment(self, name, labels=None, value=1):
+        """
+        Adds **value** to counter **name**
+
+        :param name: name of counter
+        :type name: str
+        :param labels: label name => value
+        :type labels: dict
+        :param value: amount to add
+        :type value: int
+        """
+        key = _get_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        """
+        Records **value** for **name**
+
+        :param name: name of metric
+        :type name: str
+        :param value: observed value ie seconds
+        :type value: float
+        :param labels: label name => value
+        :type labels: dict
+        """
+        key = _get_key(name, labels)
+        with self._lock:
+            if key not in self._observations:
+                self._observations[key] = Reservoir()
+            self._observations[key].add(value)
+
+    @contextmanager
+    def time(self, name, labels=None):
+        """
+        Context manager that records seconds spent in its
+        block for **name**, even if the block raises
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, labels=labels)
+
+    @contextmanager
+    def time_phase(self, phase):
+        """
+        Shortcut for timing **phase** under :py:const:`PHASE_SECONDS`
+        """
+        with self.time(PHASE_SECONDS, labels={'phase': phase}):
+            yield
+
+    @contextmanager
+    def time_request(self, operation):
+        """
+        Context manager that records request to a remote service
+        made in its block via :py:meth:`record_http`. The block
+        should set ``status`` key of the yielded dict, if it does
+        not or raises, :py:const:`ERROR_STATUS` is recorded
+
+        :param operation: what request does ie iquery_status
+        :type operation: str
+        """
+        request = {'status': ERROR_STATUS}
+        start = time.monotonic()
+        try:
+            yield request
+        finally:
+            self.record_http(operation, request['status'],
+                             time.monotonic() - start)
+
+    def record_http(self, operation, status, seconds):
+        """
+        Records request to a remote service
+
+        :param operation: what request did ie iquery_status
+        :type operation: str
+        :param status: HTTP status code or :py:const:`ERROR_STATUS`
+        :param seconds: time request took
+        :type seconds: float
+        """
+        self.increment(HTTP_REQUESTS, labels={'operation': operation,
+                                              'status': str(status)})
+        self.observe(HTTP_REQUEST_SECONDS, seconds,
+                     labels={'operation': operation})
+
+    def skip(self, reason, value=1):
+        """
+        Counts gene lists that got no result due to **reason**
+
+        :param reason: why there is no result ie too_many_genes
+        :type reason: str
+        """
+        self.increment(SKIPPED, labels={'reason': reason}, value=value)
+
+    def get_counter(self, name, labels=None):
+        """
+        Gets value of counter **name**
+
+        :rtype: int
+        """
+        with self._lock:
+            return self._counters.get(_get_key(name, labels), 0)
+
+    def get_observations(self, name, labels=None):
+        """
+        Gets copy of values kept for **name**, at most
+        :py:const:`RESERVOIR_SIZE` of them
+
+        :rtype: list
+        """
+        with self._lock:
+            if _get_key(name, labels) not in self._observations:
+                return []
+            return self._observations[_get_key(name, labels)].get_values()
+
+    def get_observation_summary(self, name, labels=None):
+        """
+        Gets summary of values recorded for **name**, see
+        :py:meth:`Reservoir.get_summary`
+
+        :rtype: dict
+        """
+        with self._lock:
+            if _get_key(name, labels) not in self._observations:
+                return get_summary([])
+            return self._observations[_get_key(name, labels)].get_summary()
+
+    def _get_by_name(self, store, name):
+        """
+        Gets list of (labels dict, value) for **name** in **store**
+        sorted by labels. Observed values are summarized
+        """
+        with self._lock:
+            items = [(labels, value.get_summary() if isinstance(value, Reservoir)
+                      else value)
+                     for (metric_name, labels), value in store.items()
+                     if metric_name == name]
+        items.sort(key=lambda item: item[0])
+        return [(dict(labels), value) for labels, value in items]
+
+    def get_report(self, stats=None):
+        """
+        Gets report of all metrics
+
+        :param stats: run statistics to include, see
+                      :py:func:`~enrichment_service.enrichment_servicecmd.run_enrichment`
+        :type stats: dict
+        :return: report that can be serialized to JSON
+        :rtype: dict
+        """
+        http = {}
+        for labels, value in self._get_by_name(self._counters, HTTP_REQUESTS):
+            operation = http.setdefault(labels['operation'],
+                                        {'requests': 0, 'status': {}})
+            operation['requests'] += value
+            operation['status'][labels['status']] = value
+        for labels, summary in self._get_by_name(self._observations,
+                                                 HTTP_REQUEST_SECONDS):
+            http.setdefault(labels['operation'],
+                            {'requests': 0,
+                             'status': {}})['seconds'] = summary
+
+        retries = {}
+        for labels, value in self._get_by_name(self._counters, RETRIES):
+            retries.setdefault(labels['backend'], {})[labels['outcome']] = value
+
+        iquery_tasks = {}
+        for labels, value in self._get_by_name(self._counters, IQUERY_TASKS):
+            iquery_tasks.setdefault(labels['endpoint'], {})[labels['outcome']] = value
+
+        fallbacks = {}
+        for labels, value in self._get_by_name(self._counters, FALLBACKS):
+            fallbacks.setdefault(labels['backend'], {})[labels['fallback']] = value
+
+        return {'version': enrichment_service.__version__,
+                'start_time': self._start_time,
+                'wall_seconds': time.monotonic() - self._start,
+                'stats': stats if stats is not None else {},
+                'phases': {labels['phase']: summary
+                           for labels, summary in
+                           self._get_by_name(self._observations, PHASE_SECONDS)},
+                'rows': self.get_observation_summary(ROW_SECONDS),
+                'http': http,
+                'retries': retries,
+                'iquery_polls_per_task': self.get_observation_summary(POLLS_PER_TASK),
+                'iquery_tasks': iquery_tasks,
+                'iquery_hedges': {labels['outcome']: value
+                                  for labels, value in
+                                  self._get_by_name(self._counters, HEDGES)},
+                'fallbacks': fallbacks,
+                'cache': {'hits': self.get_counter(CACHE_HITS),
+                          'misses': self.get_counter(CACHE_MISSES)},
+                'skipped': {labels['reason']: value
+                            for labels, value in
+                            self._get_by_name(self._counters, SKIPPED)}}
+
+    def get_prometheus_text(self):
+        """
+        Gets all metrics in Prometheus text exposition format.
+        Counters get a ``_total`` suffix and observed values are
+        written as summaries
+
+        :rtype: str
+        """
+        lines = []
+        with self._lock:
+            counter_names = sorted({name for name, labels in self._counters})
+            summary_names = sorted({name for name, labels in self._observations})
+        for name in counter_names:
+            metric = PROMETHEUS_PREFIX + name + '_total'
+            lines.append('# TYPE ' + metric + ' counter')
+            for labels, value in self._get_by_name(self._counters, name):
+                lines.append(metric + _format_labels(labels) + ' ' + str(value))
+        for name in summary_names:
+            metric = PROMETHEUS_PREFIX + name
+            lines.append('# TYPE ' + metric + ' summary')
+            for labels, summary in self._get_by_name(self._observations, name):
+                for percentile in SUMMARY_PERCENTILES:
+                    quantile_labels = dict(labels)
+                    quantile_labels['quantile'] = str(percentile / 100.0)
+                    lines.append(metric + _format_labels(quantile_labels) +
+                                 ' ' + repr(float(summary['p' + str(percentile)])))
+                lines.append(metric + '_sum' + _format_labels(labels) +
+                             ' ' + repr(float(summary['sum'])))
+                lines.append(metric + '_count' + _format_labels(labels) +
+                             ' ' + str(summary['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, path, stats=None):
+        """
+        Writes :py:meth:`get_report` as JSON to **path**
+        """
+        with open(path, 'w') as f:
+            json.dump(self.get_report(stats=stats), f, indent=2)
+
+    def write_prometheus(self, path):
+        """
+        Writes :py:meth:`get_prometheus_text` to **path**
+        """
+        with open(path, 'w') as f:
+            f.write(self.get_prometheus_text())
+
+
+def _format_labels(labels):
+    """
+    Formats **labels** as Prometheus label set
+
+    :rtype: str
+    """
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                          for key, value in sorted(labels.items())) + '}'
+
+
+def get_metrics():
+    """
+    Gets metrics set for the calling thread with
+    :py:func:`set_thread_metrics` or the process wide metrics,
+    created on first call unless set with :py:func:`set_metrics`
+
+    :rtype: :py:class:`RunMetrics`
+    """
+    run_metrics = getattr(_thread_metrics, 'run_metrics', None)
+    if run_metrics is not None:
+        return run_metrics
+    global _default_metrics
+    with _default_metrics_lock:
+        if _default_metrics is None:
+            _default_metrics = RunMetrics()
+        return _default_metrics
+
+
+def set_metrics(run_metrics):
+    """
+    Sets process wide metrics returned by :py:func:`get_metrics`
+
+    :param run_metrics: metrics or ``None`` to create new
+                        ones on next call of :py:func:`get_metrics`
+    :type run_metrics: :py:class:`RunMetrics`
+    """
+    global _default_metrics
+    with _default_metrics_lock:
+        _default_metrics = run_metrics
+
+
+def set_thread_metrics(run_metrics):
+    """
+    Sets metrics returned by :py:func:`get_metrics` on the calling
+    thread only, so concurrent runs in one process such as requests
+    to the service each get their own. Also used as initializer of
+    thread pools so their threads record into the metrics of the
+    thread that created the pool
+
+    :param run_metrics: metrics or ``None`` to use the process
+                        wide metrics again
+    :type run_metrics: :py:class:`RunMetrics`
+    """
+    _thread_metrics.run_metrics = run_metrics
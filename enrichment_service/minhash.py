@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+"""
+MinHash signatures of the terms of a
+:py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+banded into a locality sensitive hashing index that finds the
+terms whose Jaccard with a gene list could reach a threshold
+"""
+
+import numpy
+
+
+# Mersenne prime used as modulus of the hash functions
+PRIME = 2 ** 31 - 1
+
+# signature value of a term or gene list without genes, above
+# any hash value so it never matches a real signature
+EMPTY_SIGNATURE = numpy.iinfo(numpy.uint32).max
+
+# limit on hash values computed at once when building signatures
+MAX_BLOCK_SIZE = 2 ** 24
+
+DEFAULT_SEED = 1
+
+
+def get_candidate_probability(jaccard, bands, rows):
+    """
+    Gets probability that a term with **jaccard** similarity to a
+    gene list shares the signature of the gene list in at least
+    one of **bands** bands of **rows** rows
+
+    :rtype: float
+    """
+    return 1.0 - (1.0 - jaccard ** rows) ** bands
+
+
+def get_bands_and_rows(num_perm, threshold, recall):
+    """
+    Gets how to split a signature of **num_perm** values into bands
+    so a term with Jaccard of **threshold** is found with probability
+    of at least **recall**. Of the splits that do, the one with the
+    most rows per band is picked since it finds the fewest terms
+    below **threshold**
+
+    :param num_perm: number of values in signature
+    :type num_perm: int
+    :param threshold: Jaccard terms must reach
+    :type threshold: float
+    :param recall: probability of finding a term at **threshold**
+    :type recall: float
+    :return: (bands, rows) falling back to bands of one row if no
+             split reaches **recall**
+    :rtype: tuple
+    """
+    for rows in range(num_perm, 0, -1):
+        bands = num_perm // rows
+        if get_candidate_probability(threshold, bands, rows) >= recall:
+            return bands, rows
+    return num_perm, 1
+
+
+def _get_band_keys(signatures, bands, rows):
+    """
+    Combines each band of **signatures** into one value
+
+    :param signatures: signatures, one per row
+    :type signatures: :py:class:`numpy.ndarray`
+    :return: bands by signatures keys
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    keys = numpy.zeros((bands, signatures.shape[0]), dtype=numpy.uint64)
+    for band in range(bands):
+        for column in range(band * rows, (band + 1) * rows):
+            # collisions only add candidates which are then scored
+            keys[band] = (keys[band] * numpy.uint64(1000003)) ^ signatures[:, column]
+    return keys
+
+
+class MinHashIndex(object):
+    """
+    Locality sensitive hashing index of the terms of a library.
+    Each term gets a signature of the smallest hash of its genes
+    under **num_perm** hash functions. The chance two gene sets
+    have the same smallest hash equals their Jaccard, so splitting
+    signatures into **bands** bands of **rows** rows and looking up
+    the bands of a gene list finds the terms most similar to it
+    while skipping terms that only share a few genes with it.
+
+    More bands find more of the terms near the threshold, raising
+    recall, at the cost of more candidates to score. Use
+    :py:func:`get_bands_and_rows` to pick them for a threshold
+    """
+
+    def __init__(self, library, num_perm=128, bands=None, rows=1,
+                 seed=DEFAULT_SEED):
+        """
+        Constructor, builds signatures of all terms of **library**
+
+        :param library: gene sets
+        :type library: :py:class:`~enrichment_service.genesetlibrary.GeneSetLibrary`
+        :param num_perm: number of hash functions
+        :type num_perm: int
+        :param bands: number of bands, if ``None`` as many as fit
+        :type bands: int
+        :param rows: number of signature values per band
+        :type rows: int
+        :param seed: seed of random hash functions
+        :type seed: int
+        :raises ValueError: if bands of rows do not fit in **num_perm**
+        """
+        if bands is None:
+            bands = num_perm // rows
+        if bands < 1 or rows < 1 or bands * rows > num_perm:
+            raise ValueError(str(bands) + ' bands of ' + str(rows) +
+                             ' rows do not fit in ' + str(num_perm) +
+                             ' hash functions')
+        self._library = library
+        self._num_perm = num_perm
+        self._bands = bands
+        self._rows = rows
+        random_state = numpy.random.RandomState(seed)
+        self._a = random_state.randint(1, PRIME, size=num_perm,
+                                       dtype=numpy.int64)
+        self._b = random_state.randint(0, PRIME, size=num_perm,
+                                       dtype=numpy.int64)
+        signatures = self.get_signatures(library.term_indptr,
+                                         library.term_indices)
+        self._band_order = []
+        self._band_keys = []
+        for keys in _get_band_keys(signatures, bands, rows):
+            order = numpy.argsort(keys, kind='stable')
+            self._band_order.append(order)
+            self._band_keys.append(keys[order])
+
+    def get_bands(self):
+        """
+        Gets number of bands
+
+        :rtype: int
+        """
+        return self._bands
+
+    def get_rows(self):
+        """
+        Gets number of signature values per band
+
+        :rtype: int
+        """
+        return self._rows
+
+    def get_signatures(self, indptr, indices):
+        """
+        Gets signatures of gene sets in compressed sparse row format
+        where set ``i`` has genes ``indices[indptr[i]:indptr[i+1]]``
+
+        :param indptr: offsets into **indices**
+        :type indptr: :py:class:`numpy.ndarray`
+        :param indices: positions of genes in vocabulary of library
+        :type indices: :py:class:`numpy.ndarray`
+        :return: gene sets by **num_perm** signatures
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        number_of_sets = len(indptr) - 1
+        signatures = numpy.full((number_of_sets, self._num_perm),
+                                EMPTY_SIGNATURE, dtype=numpy.uint32)
+        non_empty = numpy.diff(indptr) > 0
+        if not numpy.any(non_empty):
+            return signatures
+        starts = numpy.asarray(indptr[:-1])[non_empty]
+        genes = numpy.asarray(indices, dtype=numpy.int64) + 1
+        block_size = max(1, MAX_BLOCK_SIZE // max(1, len(genes)))
+        for start in range(0, self._num_perm, block_size):
+            end = min(start + block_size, self._num_perm)
+            hashes = (numpy.outer(self._a[start:end], genes) +
+                      self._b[start:end, None]) % PRIME
+            signatures[non_empty, start:end] = numpy.minimum.reduceat(hashes,
+                                                                      starts,
+                                                                      axis=1).T
+        return signatures
+
+    def get_candidates(self, gene_lists):
+        """
+        Gets terms sharing at least one band of signature with
+        each of **gene_lists**
+
+        :param gene_lists: list of gene lists
+        :type gene_lists: list
+        :return: sorted keys of gene list index times number of
+                 terms plus term index
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        from enrichment_service import localenrichment
+        rows, cols = localenrichment.get_query_gene_indices(gene_lists,
+                                                            self._library)
+        indptr = numpy.zeros(len(gene_lists) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(rows, minlength=len(gene_lists)),
+                     out=indptr[1:])
+        signatures = self.get_signatures(indptr, cols)
+        number_of_terms = self._library.get_number_of_terms()
+        candidates = []
+        for band, keys in enumerate(_get_band_keys(signatures, self._bands,
+                                                   self._rows)):
+            band_keys = self._band_keys[band]
+            left = numpy.searchsorted(band_keys, keys, side='left')
+            counts = numpy.searchsorted(band_keys, keys, side='right') - left
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            queries = numpy.repeat(numpy.arange(len(gene_lists),
+                                                dtype=numpy.int64), counts)
+            offsets = numpy.repeat(left - numpy.cumsum(counts) + counts,
+                                   counts)
+            terms = self._band_order[band][numpy.arange(total) + offsets]
+            candidates.append(queries * number_of_terms + terms)
+        if len(candidates) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.unique(numpy.concatenate(candidates))
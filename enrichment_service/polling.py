@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""
+Adaptive schedule for polling remote tasks for completion
+"""
+
+import time
+import random
+import threading
+from collections import deque
+
+
+class PollSchedule(object):
+    """
+    Gets delays between checks on a remote task. The first
+    check happens after **initial_interval** seconds or, once
+    completion times of earlier tasks are known, around the time
+    the fastest of them finished. Later checks back off
+    exponentially by **multiplier** with +/- **jitter** fraction
+    of randomness up to **max_interval** seconds.
+
+    Instances are thread safe and meant to be shared by all tasks
+    sent to the same service so the schedule tunes itself from
+    their completion times
+    """
+
+    def __init__(self, initial_interval=0.25, max_interval=5.0,
+                 multiplier=2.0, jitter=0.2, history=100,
+                 first_poll_percentile=10):
+        """
+        Constructor
+
+        :param initial_interval: shortest delay in seconds
+        :type initial_interval: float
+        :param max_interval: longest delay in seconds
+        :type max_interval: float
+        :param multiplier: factor delay grows by after each check
+        :type multiplier: float
+        :param jitter: fraction of delay to randomly add or subtract
+        :type jitter: float
+        :param history: number of recent completion times to keep
+        :type history: int
+        :param first_poll_percentile: percentile of recent completion
+                                      times used as first delay
+        :type first_poll_percentile: float
+        """
+        self._initial_interval = initial_interval
+        self._max_interval = max(initial_interval, max_interval)
+        self._multiplier = multiplier
+        self._jitter = jitter
+        self._first_poll_percentile = first_poll_percentile
+        self._completion_times = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def record_completion(self, seconds):
+        """
+        Records that a task took **seconds** to complete
+
+        :param seconds: time from submission to completion
+        :type seconds: float
+        """
+        with self._lock:
+            self._completion_times.append(seconds)
+
+    def get_completion_count(self):
+        """
+        Gets number of recent completion times kept
+
+        :rtype: int
+        """
+        with self._lock:
+            return len(self._completion_times)
+
+    def get_completion_time_percentile(self, percentile):
+        """
+        Gets **percentile** of recent completion times
+
+        :param percentile: value from 0 to 100
+        :type percentile: float
+        :return: seconds or ``None`` if no tasks have completed
+        :rtype: float
+        """
+        with self._lock:
+            times = sorted(self._completion_times)
+        if len(times) == 0:
+            return None
+        index = int(round((len(times) - 1) * percentile / 100.0))
+        return times[index]
+
+    def get_first_delay(self):
+        """
+        Gets delay before first check on a new task
+
+        :return: seconds
+        :rtype: float
+        """
+        first = self.get_completion_time_percentile(self._first_poll_percentile)
+        if first is None:
+            return self._initial_interval
+        return min(max(first, self._initial_interval), self._max_interval)
+
+    def _add_jitter(self, delay):
+        """
+        Randomly adds or subtracts up to jitter fraction of **delay**
+        """
+        return delay * random.uniform(1.0 - self._jitter,
+                                      1.0 + self._jitter)
+
+    def get_delays(self):
+        """
+        Generator of delays between checks on a task, infinite
+        so caller must enforce a deadline
+
+        :return: seconds to wait before each check
+        :rtype: float
+        """
+        yield self._add_jitter(self.get_first_delay())
+        delay = self._initial_interval
+        while True:
+            yield self._add_jitter(delay)
+            delay = min(delay * self._multiplier, self._max_interval)
+
+
+class TaskPoller(object):
+    """
+    State of polling one remote task. :py:meth:`get_delays` yields
+    the delays from **schedule**, stretched to any ``Retry-After``
+    the service sent and cut short by the deadline. The caller
+    waits each delay, checks the task and passes the outcome to
+    :py:meth:`record_status`. The generator stops once the task
+    is done or **deadline** seconds after **start** have passed,
+    which lets the same loop be driven by threads or by an event
+    loop
+    """
+
+    def __init__(self, schedule, deadline, start=None,
+                 clock=time.monotonic):
+        """
+        Constructor
+
+        :param schedule: delays between checks, completion time of
+                         the task is recorded in it if it succeeds
+        :type schedule: :py:class:`PollSchedule`
+        :param deadline: seconds after **start** to give up
+        :type deadline: float
+        :param start: time task was submitted as returned by
+                      **clock**, if ``None`` the current time
+        :type start: float
+        :param clock: gets current time in seconds
+        :type clock: callable
+        """
+        self._schedule = schedule
+        self._deadline = deadline
+        self._clock = clock
+        if start is None:
+            start = clock()
+        self._start = start
+        self._status = None
+        self._retry_after = None
+        self._polls = 0
+
+    def get_delays(self):
+        """
+        Generator of seconds to wait before each check of the task
+
+        :return: seconds to wait
+        :rtype: float
+        """
+        for delay in self._schedule.get_delays():
+            if self._status is not None:
+                return
+            if self._retry_after is not None:
+                delay = max(delay, self._retry_after)
+            remaining = self._start + self._deadline - self._clock()
+            if remaining <= 0:
+                return
+            yield min(delay, remaining)
+
+    def record_status(self, status, retry_after=None):
+        """
+        Records outcome of a check of the task
+
+        :param status: ``None`` if task is still running or the
+                       check failed, True if task completed
+                       successfully, False if it failed
+        :type status: bool
+        :param retry_after: seconds the service asked to wait
+                            before the next check or ``None``
+        :type retry_after: float
+        """
+        self._polls += 1
+        self._status = status
+        self._retry_after = retry_after
+        if status is True:
+            self._schedule.record_completion(self._clock() - self._start)
+
+    def get_status(self):
+        """
+        Gets outcome of last check, see :py:meth:`record_status`
+
+        :rtype: bool
+        """
+        return self._status
+
+    def get_polls(self):
+        """
+        Gets number of checks made
+
+        :rtype: int
+        """
+        return self._polls
+
+    def get_deadline(self):
+        """
+        Gets seconds after start to give up
+
+        :rtype: float
+        """
+        return self._deadline
+
+    def get_failure_reason(self):
+        """
+        Gets why the task has no result
+
+        :return: ``None`` if task completed successfully,
+                 ``task_failed`` if it failed otherwise
+                 ``task_timeout``
+        :rtype: str
+        """
+        if self._status is True:
+            return None
+        if self._status is False:
+            return 'task_failed'
+        return 'task_timeout'
+
+
+def get_retry_after(response):
+    """
+    Gets seconds from ``Retry-After`` header of **response**. Only
+    the delay in seconds form of the header is supported
+
+    :param response: response from service
+    :type response: :py:class:`requests.Response`
+    :return: seconds or ``None`` if header is not set or not a number
+    :rtype: float
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
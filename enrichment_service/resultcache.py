@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent cache of enrichment results
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+CACHE_FILENAME = 'results.sqlite'
+
+# number of puts between checks of the cache size
+EVICTION_CHECK_INTERVAL = 100
+
+
+def get_cache_key(genes, params):
+    """
+    Gets key for **genes** and **params**. The genes are
+    stripped, de-duplicated and sorted so the key does not
+    depend on their order
+
+    :param genes: genes
+    :type genes: list
+    :param params: every parameter that affects the result
+    :type params: dict
+    :return: hex digest
+    :rtype: str
+    """
+    normalized = sorted({gene.strip() for gene in genes})
+    keystr = json.dumps({'genes': normalized, 'params': params},
+                        sort_keys=True)
+    return hashlib.sha256(keystr.encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Cache of results stored in a single SQLite file so
+    it can be shared by threads and processes. Entries expire
+    after **ttl** seconds or **negative_ttl** seconds if the
+    result is ``None`` and the least recently used entries are
+    removed once the file exceeds **maxsize** bytes
+    """
+
+    def __init__(self, cachedir, ttl=604800, negative_ttl=3600,
+                 maxsize=1073741824):
+        """
+        Constructor
+
+        :param cachedir: directory to put cache file in, created
+                         if it does not exist
+        :type cachedir: str
+        :param ttl: seconds a result is valid
+        :type ttl: float
+        :param negative_ttl: seconds a ``None`` result is valid
+        :type negative_ttl: float
+        :param maxsize: maximum size of cache in bytes
+        :type maxsize: int
+        """
+        os.makedirs(cachedir, exist_ok=True)
+        self._path = os.path.join(cachedir, CACHE_FILENAME)
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._maxsize = maxsize
+        self._local = threading.local()
+        self._put_count = 0
+        self._put_count_lock = threading.Lock()
+        conn = self._get_connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                     'key TEXT PRIMARY KEY, '
+                     'value TEXT, '
+                     'negative INTEGER, '
+                     'created REAL, '
+                     'accessed REAL, '
+                     'size INTEGER)')
+        conn.execute('CREATE INDEX IF NOT EXISTS results_accessed '
+                     'ON results (accessed)')
+
+    def get_path(self):
+        """
+        Gets path to cache file
+
+        :rtype: str
+        """
+        return self._path
+
+    def _get_connection(self):
+        """
+        Gets connection for the calling thread since SQLite
+        connections cannot be shared across threads
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, timeout=30,
+                                   isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        """
+        Gets result for **key**
+
+        :param key: key from :py:func:`get_cache_key`
+        :type key: str
+        :return: (True, result) if found otherwise (False, None).
+                 result can be ``None`` for cached negative results
+        :rtype: tuple
+        """
+        conn = self._get_connection()
+        row = conn.execute('SELECT value, negative, created FROM results '
+                           'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False, None
+        value, negative, created = row
+        now = time.time()
+        ttl = self._negative_ttl if negative else self._ttl
+        if now - created > ttl:
+            conn.execute('DELETE FROM results WHERE key = ?', (key,))
+            return False, None
+        conn.execute('UPDATE results SET accessed = ? WHERE key = ?',
+                     (now, key))
+        return True, json.loads(value)
+
+    def put(self, key, result):
+        """
+        Stores **result** for **key**
+
+        :param key: key from :py:func:`get_cache_key`
+        :type key: str
+        :param result: result which can be ``None``
+        :type result: dict
+        """
+        value = json.dumps(result)
+        now = time.time()
+        conn = self._get_connection()
+        conn.execute('INSERT OR REPLACE INTO results (key, value, negative, '
+                     'created, accessed, size) VALUES (?, ?, ?, ?, ?, ?)',
+                     (key, value, 1 if result is None else 0, now, now,
+                      len(key) + len(value)))
+        with self._put_count_lock:
+            self._put_count += 1
+            check_size = self._put_count % EVICTION_CHECK_INTERVAL == 0
+        if check_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes expired entries and then least recently used entries
+        until the total size of the cache is below **maxsize**
+        """
+        conn = self._get_connection()
+        now = time.time()
+        conn.execute('DELETE FROM results WHERE '
+                     '(negative = 0 AND created < ?) OR '
+                     '(negative = 1 AND created < ?)',
+                     (now - self._ttl, now - self._negative_ttl))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) '
+                             'FROM results').fetchone()[0]
+        if total <= self._maxsize:
+            return
+        sys.stderr.write('Result cache size of ' + str(total) +
+                         ' bytes exceeds ' + str(self._maxsize) +
+                         ', removing least recently used entries\n')
+        excess = total - self._maxsize
+        removed = 0
+        keys = []
+        for key, size in conn.execute('SELECT key, size FROM results '
+                                      'ORDER BY accessed'):
+            keys.append((key,))
+            removed += size
+            if removed >= excess:
+                break
+        conn.executemany('DELETE FROM results WHERE key = ?', keys)
+
+    def close(self):
+        """
+        Closes connection of calling thread
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
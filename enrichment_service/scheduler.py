@@ -0,0 +1,523 @@
+# -*- coding: utf-8 -*-
+
+"""
+Rate limiting, adaptive concurrency and retries for requests
+to remote services
+"""
+
+import copy
+import time
+import random
+import threading
+
+from enrichment_service import metrics
+
+
+# outcomes of a request used to adjust concurrency and
+# decide whether to retry
+SUCCESS = 'success'
+
+# service asked us to slow down ie 429
+THROTTLED = 'throttled'
+
+# request failed in a way that may succeed if retried ie
+# 5xx status, timeout or connection error
+ERROR = 'error'
+
+# request failed in a way retrying will not fix
+FAILED = 'failed'
+
+# status codes where the service refused the request because
+# it is overloaded, the request had no effect so it is safe to
+# retry even if it is not idempotent
+THROTTLE_STATUS_CODES = (429, 503)
+
+# status codes of transient server errors
+ERROR_STATUS_CODES = (500, 502, 504)
+
+# outcomes retried for requests that can safely be repeated
+RETRY_IDEMPOTENT = (THROTTLED, ERROR)
+
+# outcomes retried for requests that may have taken effect even
+# if they failed ie submitting a task
+RETRY_NON_IDEMPOTENT = (THROTTLED,)
+
+DEFAULT_RETRIES = 3
+
+DEFAULT_BACKOFF = 0.5
+
+DEFAULT_MAX_BACKOFF = 30.0
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a request cannot be made or retried before
+    the deadline of the run
+    """
+    pass
+
+
+class Deadline(object):
+    """
+    Point in time work must be done by
+    """
+
+    def __init__(self, seconds=None):
+        """
+        Constructor
+
+        :param seconds: seconds from now or ``None`` for no deadline
+        :type seconds: float
+        """
+        self._seconds = seconds
+        self._end = None
+        if seconds is not None:
+            self._end = time.monotonic() + seconds
+
+    def get_seconds(self):
+        """
+        Gets seconds deadline was set to
+
+        :return: seconds or ``None`` if there is no deadline
+        :rtype: float
+        """
+        return self._seconds
+
+    def remaining(self):
+        """
+        Gets seconds left
+
+        :return: seconds, 0 once passed, or ``None`` if there
+                 is no deadline
+        :rtype: float
+        """
+        if self._end is None:
+            return None
+        return max(0.0, self._end - time.monotonic())
+
+    def expired(self):
+        """
+        Checks if deadline has passed
+
+        :rtype: bool
+        """
+        return self._end is not None and time.monotonic() >= self._end
+
+    def cap(self, seconds):
+        """
+        Gets the smaller of **seconds** and seconds left
+
+        :param seconds: seconds or ``None`` for no limit
+        :type seconds: float
+        :return: seconds or ``None`` if both are unlimited
+        :rtype: float
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return seconds
+        if seconds is None:
+            return remaining
+        return min(seconds, remaining)
+
+
+def get_status_outcome(status_code):
+    """
+    Gets outcome of a response with **status_code**
+
+    :param status_code: HTTP status code
+    :type status_code: int
+    :return: :py:const:`THROTTLED`, :py:const:`ERROR` or
+             :py:const:`SUCCESS` for any other status since the
+             service handled the request
+    :rtype: str
+    """
+    if status_code in THROTTLE_STATUS_CODES:
+        return THROTTLED
+    if status_code in ERROR_STATUS_CODES:
+        return ERROR
+    return SUCCESS
+
+
+def classify_response(response, error):
+    """
+    Gets outcome of a request made with :py:mod:`requests`
+
+    :param response: response or ``None`` if request raised **error**
+    :type response: :py:class:`requests.Response`
+    :param error: exception raised by request or ``None``
+    :type error: Exception
+    :return: (outcome, seconds from ``Retry-After`` or ``None``)
+    :rtype: tuple
+    """
+    if error is not None:
+        import requests
+        if isinstance(error, (requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout)):
+            return ERROR, None
+        return FAILED, None
+    outcome = get_status_outcome(response.status_code)
+    if outcome == THROTTLED:
+        from enrichment_service import polling
+        return outcome, polling.get_retry_after(response)
+    return outcome, None
+
+
+class TokenBucket(object):
+    """
+    Limits requests to **rate** per second on average while
+    allowing bursts of up to **burst** requests. Can also be
+    paused, ie when a service sends ``Retry-After``, which holds
+    every request until the pause ends. Thread safe
+    """
+
+    def __init__(self, rate=None, burst=None):
+        """
+        Constructor
+
+        :param rate: requests per second or ``None`` for no limit
+        :type rate: float
+        :param burst: most requests that can be made at once,
+                      if ``None`` rate rounded up is used
+        :type burst: int
+        """
+        self._rate = rate
+        if burst is None:
+            burst = 1 if rate is None else max(1, int(rate + 0.999999))
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        """
+        Holds all requests for **seconds** unless already paused
+        for longer
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until,
+                                     time.monotonic() + seconds)
+
+    def _get_wait(self):
+        """
+        Takes a token if one is available
+
+        :return: 0 if a token was taken otherwise seconds to
+                 wait before trying again
+        :rtype: float
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self._rate is None:
+                return 0
+            self._tokens = min(float(self._burst),
+                               self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0
+            return (1.0 - self._tokens) / self._rate
+
+    def acquire(self, deadline=None):
+        """
+        Blocks until a request can be made
+
+        :param deadline: when to give up waiting
+        :type deadline: :py:class:`Deadline`
+        :raises DeadlineExceeded: if **deadline** passes first
+        :return: seconds spent waiting
+        :rtype: float
+        """
+        waited = 0.0
+        wait = self._get_wait()
+        while wait > 0:
+            if deadline is not None and deadline.cap(wait) < wait:
+                raise DeadlineExceeded('Deadline passed waiting for rate limit')
+            time.sleep(wait)
+            waited += wait
+            wait = self._get_wait()
+        return waited
+
+
+class AdaptiveConcurrencyLimit(object):
+    """
+    Limits number of simultaneous requests using additive increase
+    multiplicative decrease. Each successful request raises the
+    limit by **increase** divided by the limit, so about
+    **increase** per round of requests, up to **max_limit**. A
+    throttled or failed request, or smoothed latency rising above
+    **latency_tolerance** times its baseline, multiplies the
+    limit by **decrease_factor** down to **min_limit**. The limit
+    is lowered at most once per smoothed latency so a burst of
+    errors from one round only counts once. Thread safe
+    """
+
+    # fraction baseline latency may rise per successful request
+    # so a service that stays slower becomes the new normal
+    BASELINE_DRIFT = 0.01
+
+    def __init__(self, max_limit, min_limit=1, initial_limit=None,
+                 increase=1.0, decrease_factor=0.5,
+                 latency_tolerance=3.0, smoothing=0.2):
+        """
+        Constructor
+
+        :param max_limit: most simultaneous requests
+        :type max_limit: int
+        :param min_limit: fewest simultaneous requests
+        :type min_limit: int
+        :param initial_limit: starting limit, **max_limit** if ``None``
+        :type initial_limit: float
+        :param increase: amount limit grows per round of requests
+        :type increase: float
+        :param decrease_factor: factor limit is multiplied by
+                                upon congestion
+        :type decrease_factor: float
+        :param latency_tolerance: ratio of smoothed latency to its
+                                  baseline treated as congestion
+        :type latency_tolerance: float
+        :param smoothing: weight of newest latency in smoothed latency
+        :type smoothing: float
+        """
+        self._max_limit = max(1, max_limit)
+        self._min_limit = max(1, min(min_limit, self._max_limit))
+        if initial_limit is None:
+            initial_limit = self._max_limit
+        self._limit = float(min(max(initial_limit, self._min_limit),
+                                self._max_limit))
+        self._increase = increase
+        self._decrease_factor = decrease_factor
+        self._latency_tolerance = latency_tolerance
+        self._smoothing = smoothing
+        self._latency = None
+        self._baseline = None
+        self._next_decrease = 0.0
+        self._inflight = 0
+        self._condition = threading.Condition()
+
+    def get_limit(self):
+        """
+        Gets current number of simultaneous requests allowed
+
+        :rtype: int
+        """
+        with self._condition:
+            return int(self._limit)
+
+    def acquire(self, deadline=None):
+        """
+        Blocks until fewer than the limit of requests are running
+
+        :param deadline: when to give up waiting
+        :type deadline: :py:class:`Deadline`
+        :raises DeadlineExceeded: if **deadline** passes first
+        """
+        with self._condition:
+            while self._inflight >= int(self._limit):
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceeded('Deadline passed waiting for '
+                                           'concurrency limit')
+                self._condition.wait(None if deadline is None
+                                     else deadline.remaining())
+            self._inflight += 1
+
+    def release(self, outcome, latency):
+        """
+        Marks a request done and adjusts the limit
+
+        :param outcome: outcome of request ie :py:const:`SUCCESS`
+        :type outcome: str
+        :param latency: seconds request took
+        :type latency: float
+        """
+        with self._condition:
+            self._inflight -= 1
+            congested = outcome in (THROTTLED, ERROR)
+            if outcome == SUCCESS:
+                if self._latency is None:
+                    self._latency = latency
+                else:
+                    self._latency += self._smoothing * (latency - self._latency)
+                if self._baseline is None:
+                    self._baseline = self._latency
+                else:
+                    self._baseline = min(self._latency,
+                                         self._baseline * (1.0 + self.BASELINE_DRIFT))
+                if self._latency > self._latency_tolerance * self._baseline:
+                    congested = True
+                else:
+                    self._limit = min(float(self._max_limit),
+                                      self._limit + self._increase / self._limit)
+            if congested:
+                now = time.monotonic()
+                if now >= self._next_decrease:
+                    self._limit = max(float(self._min_limit),
+                                      self._limit * self._decrease_factor)
+                    self._next_decrease = now + (latency if self._latency is None
+                                                 else self._latency)
+            self._condition.notify_all()
+
+
+class BackendScheduler(object):
+    """
+    Runs requests to one remote service through a
+    :py:class:`TokenBucket` and an :py:class:`AdaptiveConcurrencyLimit`,
+    retrying throttled and failed requests after an exponential
+    backoff with full jitter, or the delay in ``Retry-After`` if
+    longer. ``Retry-After`` also pauses every other request to
+    the service. Meant to be shared by all threads talking to
+    the same service
+    """
+
+    def __init__(self, name, max_concurrency, rate=None, burst=None,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF):
+        """
+        Constructor
+
+        :param name: name of service used in metrics ie iquery
+        :type name: str
+        :param max_concurrency: most simultaneous requests
+        :type max_concurrency: int
+        :param rate: see :py:class:`TokenBucket`
+        :type rate: float
+        :param burst: see :py:class:`TokenBucket`
+        :type burst: int
+        :param retries: times to retry a request
+        :type retries: int
+        :param backoff: upper bound in seconds of delay before
+                        first retry, doubled for each later retry
+        :type backoff: float
+        :param max_backoff: upper bound of delay before any retry
+        :type max_backoff: float
+        """
+        self._name = name
+        self._bucket = TokenBucket(rate=rate, burst=burst)
+        self._limit = AdaptiveConcurrencyLimit(max_concurrency)
+        self._retries = max(0, retries)
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._deadline = None
+
+    def with_deadline(self, deadline):
+        """
+        Gets scheduler sharing the limits of this one that raises
+        :py:class:`DeadlineExceeded` instead of waiting for, making
+        or retrying a request after **deadline**
+
+        :param deadline: deadline of the run
+        :type deadline: :py:class:`Deadline`
+        :rtype: :py:class:`BackendScheduler`
+        """
+        bound = copy.copy(self)
+        bound._deadline = deadline
+        return bound
+
+    def get_deadline(self):
+        """
+        Gets deadline set by :py:meth:`with_deadline`
+
+        :rtype: :py:class:`Deadline`
+        """
+        return self._deadline
+
+    def get_concurrency_limit(self):
+        """
+        Gets current number of simultaneous requests allowed
+
+        :rtype: int
+        """
+        return self._limit.get_limit()
+
+    def get_backoff(self, attempt, retry_after=None):
+        """
+        Gets seconds to wait before retry **attempt**, chosen at
+        random up to :py:attr:`backoff` times 2 to the **attempt**
+        so clients that failed together do not retry together
+
+        :param attempt: number of retries already made
+        :type attempt: int
+        :param retry_after: seconds service asked to wait
+        :type retry_after: float
+        :rtype: float
+        """
+        delay = random.uniform(0, min(self._max_backoff,
+                                      self._backoff * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, func, classify=classify_response,
+             retry_on=RETRY_IDEMPOTENT):
+        """
+        Calls **func** when the rate and concurrency limits allow,
+        retrying if its outcome is in **retry_on**
+
+        :param func: makes the request, called with no arguments
+        :type func: callable
+        :param classify: given (value returned by **func** or ``None``,
+                         exception raised by **func** or ``None``)
+                         returns (outcome, seconds to wait or ``None``)
+        :type classify: callable
+        :param retry_on: outcomes to retry
+        :type retry_on: tuple
+        :raises DeadlineExceeded: if the deadline set by
+                                  :py:meth:`with_deadline` passes
+                                  before **func** can be called or
+                                  retried
+        :raises Exception: what **func** raised on its last attempt
+        :return: what **func** returned on its last attempt
+        """
+        run_metrics = metrics.get_metrics()
+        attempt = 0
+        while True:
+            if self._deadline is not None and self._deadline.expired():
+                raise DeadlineExceeded('Deadline passed before request '
+                                       'to ' + self._name)
+            with run_metrics.time_phase(self._name + '_throttle'):
+                self._limit.acquire(deadline=self._deadline)
+                try:
+                    self._bucket.acquire(deadline=self._deadline)
+                except BaseException:
+                    self._limit.release(FAILED, 0)
+                    raise
+            start = time.monotonic()
+            result = None
+            error = None
+            try:
+                result = func()
+            except Exception as e:
+                error = e
+            outcome, retry_after = classify(result, error)
+            self._limit.release(outcome, time.monotonic() - start)
+            if retry_after is not None:
+                self._bucket.pause(retry_after)
+
+            if outcome in retry_on and attempt < self._retries:
+                backoff = self.get_backoff(attempt, retry_after=retry_after)
+                if self._deadline is not None and \
+                        self._deadline.cap(backoff) < backoff:
+                    raise DeadlineExceeded('Deadline passes before retry '
+                                           'of request to ' + self._name)
+                run_metrics.increment(metrics.RETRIES,
+                                      labels={'backend': self._name,
+                                              'outcome': outcome})
+                time.sleep(backoff)
+                attempt += 1
+                continue
+            if error is not None:
+                raise error
+            return result
+
+
+def call(scheduler, func, classify=classify_response,
+         retry_on=RETRY_IDEMPOTENT):
+    """
+    Calls **func** via **scheduler** or directly if **scheduler**
+    is ``None``, see :py:meth:`BackendScheduler.call`
+    """
+    if scheduler is None:
+        return func()
+    return scheduler.call(func, classify=classify, retry_on=retry_on)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""
+Long running HTTP service that runs enrichment on node tables
+"""
+
+import sys
+import json
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+import enrichment_service
+from enrichment_service import httpclient
+from enrichment_service import metrics
+from enrichment_service import enrichment_servicecmd
+
+
+ENRICHMENT_PATHS = ['/', '/enrichment']
+
+HEALTH_PATH = '/health'
+
+# placeholder for input positional argument of enrichment arguments
+INPUT_PLACEHOLDER = '-'
+
+# enrichment options a request can set in its query string, the
+# rest name files, services or resources of the process and can
+# only be set when the service is started
+REQUEST_PARAMETERS = ['mode', 'maxpval', 'minoverlap', 'omit_intersections',
+                      'excludesource', 'maxgenelistsize', 'precision',
+                      'top-k', 'organism', 'fingerprint']
+
+
+def _parse_arguments(desc, args):
+    """
+    Parses command line arguments. Arguments not known to
+    this parser are returned and used as default enrichment
+    arguments for every request
+
+    :param desc:
+    :param args:
+    :return: (parsed arguments, remaining arguments)
+    :rtype: tuple
+    """
+    help_fm = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', default=8080, type=int,
+                        help='Port to listen on')
+    return parser.parse_known_args(args)
+
+
+def get_enrichment_arguments(default_args, query):
+    """
+    Gets enrichment arguments for a request by adding query
+    string parameters of **query** as ``--name value`` after
+    **default_args**. A parameter without a value is passed as
+    a flag ie ``?omit_intersections`` becomes
+    ``--omit_intersections``. Only parameters in
+    :py:const:`REQUEST_PARAMETERS` are allowed
+
+    :param default_args: enrichment arguments passed to serve
+    :type default_args: list
+    :param query: query string of request
+    :type query: str
+    :raises ValueError: if arguments are invalid or a parameter
+                        is not allowed
+    :return: parsed arguments
+    """
+    request_args = []
+    for name, value in parse_qsl(query, keep_blank_values=True):
+        if name not in REQUEST_PARAMETERS:
+            raise ValueError('Parameter ' + name + ' cannot be set per '
+                             'request, allowed parameters: ' +
+                             ', '.join(REQUEST_PARAMETERS))
+        request_args.append('--' + name)
+        if len(value) > 0:
+            request_args.append(value)
+    try:
+        return enrichment_servicecmd._parse_arguments('enrichment',
+                                                      [INPUT_PLACEHOLDER] +
+                                                      default_args +
+                                                      request_args)
+    except SystemExit:
+        raise ValueError('Invalid parameters: ' + ' '.join(request_args))
+
+
+class EnrichmentRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles ``POST`` of node table JSON to one of
+    :py:const:`ENRICHMENT_PATHS`, returning the same updateTables
+    action list written by the command line tool, and ``GET`` of
+    :py:const:`HEALTH_PATH`
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, data):
+        """
+        Sends **data** as JSON with **status**
+        """
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """
+        Reports service is up
+        """
+        if urlparse(self.path).path != HEALTH_PATH:
+            self._send_json(404, {'message': 'Not found'})
+            return
+        self._send_json(200, {'status': 'ok',
+                              'version': enrichment_service.__version__})
+
+    def do_POST(self):
+        """
+        Runs enrichment on node table in request body, recording
+        metrics of the request in their own
+        :py:class:`~enrichment_service.metrics.RunMetrics` which
+        are dropped once it is done
+        """
+        url = urlparse(self.path)
+        if url.path not in ENRICHMENT_PATHS:
+            self._send_json(404, {'message': 'Not found'})
+            return
+        try:
+            theargs = get_enrichment_arguments(self.server.default_args,
+                                               url.query)
+            length = int(self.headers.get('Content-Length', 0))
+            node_table = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError as e:
+            self._send_json(400, {'message': str(e)})
+            return
+
+        metrics.set_thread_metrics(metrics.RunMetrics())
+        try:
+            stats = {}
+            theres = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                          theargs.mode,
+                                                          stats=stats)
+        except Exception as e:
+            sys.stderr.write('Caught exception: ' + str(e) + '\n')
+            self._send_json(500, {'message': str(e)})
+            return
+        finally:
+            metrics.set_thread_metrics(None)
+        if theres is None:
+            self._send_json(400, {'message': 'No results'})
+            return
+        self._send_json(200, theres)
+
+    def log_message(self, format, *args):
+        """
+        Writes request log to standard error
+        """
+        sys.stderr.write(self.address_string() + ' - ' +
+                         (format % args) + '\n')
+
+
+def create_server(host, port, default_args):
+    """
+    Creates server that handles each request on its own thread
+
+    :param host: address to listen on
+    :type host: str
+    :param port: port to listen on, 0 picks a free port
+    :type port: int
+    :param default_args: enrichment arguments used for every
+                         request, see :py:func:`get_enrichment_arguments`
+    :type default_args: list
+    :raises ValueError: if **default_args** are invalid
+    :rtype: :py:class:`http.server.ThreadingHTTPServer`
+    """
+    theargs = get_enrichment_arguments(default_args, '')
+    httpclient.set_session(enrichment_servicecmd.create_http_session(theargs))
+    # the command line tool defers these imports, pay for them
+    # once at start up instead of on the first request
+    import pandas  # noqa: F401 imported only so first request does not pay for it
+    enrichment_servicecmd.get_gprofiler()
+    server = ThreadingHTTPServer((host, port), EnrichmentRequestHandler)
+    server.daemon_threads = True
+    server.default_args = default_args
+    return server
+
+
+def main(args):
+    """
+    Main entry point for serve command
+
+    :param args: arguments after serve
+    :type args: list
+    :return: 0 for success otherwise failure
+    :rtype: int
+    """
+    desc = """
+    Runs HTTP service that accepts POST of node table JSON
+    to / or /enrichment and returns updateTables result. Any
+    enrichment option other than input can be passed after
+    the options below and is used as default for every request.
+    Requests can override """ + ', '.join(REQUEST_PARAMETERS) + """
+    via query string parameters ie /enrichment?mode=iquery&maxpval=0.001
+    Service status is returned by GET of /health
+    """
+    theargs, default_args = _parse_arguments(desc, args)
+    try:
+        server = create_server(theargs.host, theargs.port, default_args)
+    except ValueError as e:
+        sys.stderr.write(str(e) + '\n')
+        return 2
+    sys.stderr.write('Listening on ' + theargs.host + ':' +
+                     str(server.server_address[1]) + '\n')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
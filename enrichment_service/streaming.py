@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+Incremental reading of node tables and iQuery results and
+writing of updateTables results
+"""
+
+import gzip
+import json
+import heapq
+
+
+GZIP_EXTENSION = '.gz'
+
+# ijson prefix of the results of each source in an iQuery
+# integratedsearch result
+IQUERY_RESULTS_PREFIX = 'sources.item.results'
+
+
+def open_inputfile(inputfile, mode='r'):
+    """
+    Opens **inputfile**, decompressing it if name ends
+    with :py:const:`GZIP_EXTENSION`
+
+    :param inputfile: path to file
+    :type inputfile: str
+    :param mode: 'r' for text or 'rb' for binary
+    :type mode: str
+    :return: file object
+    """
+    if inputfile.endswith(GZIP_EXTENSION):
+        if mode == 'r':
+            return gzip.open(inputfile, 'rt')
+        return gzip.open(inputfile, mode)
+    return open(inputfile, mode)
+
+
+def get_node_table_columns(inputfile):
+    """
+    Gets ``columns`` of node table in **inputfile** without
+    loading the ``rows``. Parsing stops once the ``columns``
+    array ends so ``rows`` that come after it are never read
+
+    :param inputfile: path to node table in JSON format
+    :type inputfile: str
+    :return: columns
+    :rtype: list
+    """
+    import ijson
+    builder = None
+    with open_inputfile(inputfile, 'rb') as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if builder is None:
+                if prefix == 'columns' and event == 'start_array':
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                continue
+            builder.event(event, value)
+            if prefix == 'columns' and event == 'end_array':
+                return builder.value
+    return []
+
+
+def iter_node_table_rows(inputfile):
+    """
+    Generator of ``rows`` of node table in **inputfile** parsed
+    one at a time so memory use does not depend on number of rows
+
+    :param inputfile: path to node table in JSON format
+    :type inputfile: str
+    :return: (node id, row) tuples
+    :rtype: tuple
+    """
+    import ijson
+    with open_inputfile(inputfile, 'rb') as f:
+        for node_id, node_val in ijson.kvitems(f, 'rows', use_float=True):
+            yield node_id, node_val
+
+
+def _get_similarity(result):
+    """
+    Gets cosine similarity of iQuery **result**
+
+    :rtype: float
+    """
+    return result['details']['similarity']
+
+
+def read_iquery_result(f, topk=1):
+    """
+    Parses iQuery integratedsearch result in file object **f**
+    as it is read, keeping only the **topk** results with the
+    highest ``similarity``, earliest first upon ties, so memory use
+    does not depend on the number of results. Results are pooled
+    into one source, which is all there is since tasks are only
+    submitted for the enrichment source
+
+    :param f: binary file object holding result in JSON format
+    :param topk: number of results to keep
+    :type topk: int
+    :return: result with one source holding the kept results
+             sorted best first
+    :rtype: dict
+    """
+    import ijson
+    topk = max(1, topk)
+    top_results = []
+    for index, result in enumerate(ijson.items(f, IQUERY_RESULTS_PREFIX + '.item',
+                                               use_float=True)):
+        entry = (_get_similarity(result), -index, result)
+        if len(top_results) < topk:
+            heapq.heappush(top_results, entry)
+        else:
+            heapq.heappushpop(top_results, entry)
+    return {'sources': [{'results': [entry[2] for entry in
+                                     sorted(top_results, reverse=True,
+                                            key=lambda entry: entry[:2])]}]}
+
+
+class UpdateTablesStreamWriter(object):
+    """
+    Writes updateTables action to a file object one row at
+    a time. Output is the same JSON as dumping the full
+    action, just with rows in the order they were written
+    """
+
+    def __init__(self, out, columns, table_id='node'):
+        """
+        Constructor
+
+        :param out: file object to write to
+        :param columns: columns of updateTables action
+        :type columns: list
+        :param table_id: id of table to update
+        :type table_id: str
+        """
+        self._out = out
+        self._columns = columns
+        self._table_id = table_id
+        self._row_count = 0
+        self._started = False
+
+    def get_row_count(self):
+        """
+        Gets number of rows written
+
+        :rtype: int
+        """
+        return self._row_count
+
+    def start(self):
+        """
+        Writes start of updateTables action up to the rows
+        """
+        self._out.write('[{"action": "updateTables", "data": {"id": ' +
+                        json.dumps(self._table_id) + ', "columns": ' +
+                        json.dumps(self._columns) + ', "rows": {')
+        self._started = True
+
+    def write_row(self, node_id, result):
+        """
+        Writes **result** for **node_id** and flushes output
+
+        :param node_id: id of row
+        :type node_id: str
+        :param result: CD_* values of row
+        :type result: dict
+        """
+        if not self._started:
+            self.start()
+        if self._row_count > 0:
+            self._out.write(',')
+        self._out.write('\n' + json.dumps(str(node_id)) + ': ' +
+                        json.dumps(result))
+        self._row_count += 1
+        self._out.flush()
+
+    def end(self):
+        """
+        Writes end of updateTables action
+        """
+        if not self._started:
+            self.start()
+        self._out.write('\n}}}]\n')
+        self._out.flush()
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+"""
+Runs g:Profiler enrichment on a node table once and labels its rows
+with every combination of a set of filter thresholds
+"""
+
+import os
+import sys
+import copy
+import json
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from enrichment_service import httpclient
+from enrichment_service import metrics
+from enrichment_service import enrichment_servicecmd
+
+
+SUMMARY_FILENAME = 'sweep.json'
+
+COMPARISON_FILENAME = 'comparison.tsv'
+
+# output of each combination is named this prefix followed by
+# the number of the combination and OUTPUT_EXTENSION
+OUTPUT_PREFIX = 'combination_'
+
+OUTPUT_EXTENSION = '.json'
+
+# parameters varied by a sweep, in the order their
+# combinations are enumerated
+SWEEP_PARAMETERS = ['maxpval', 'minoverlap', 'excludesource']
+
+
+def _parse_arguments(desc, args):
+    """
+    Parses command line arguments. Arguments not known to this
+    parser are returned and used as enrichment arguments
+
+    :param desc:
+    :param args:
+    :return: (parsed arguments, remaining arguments)
+    :rtype: tuple
+    """
+    help_fm = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('input',
+                        help='Node table file in JSON format, can be '
+                             'gzip compressed')
+    parser.add_argument('--outdir', required=True,
+                        help='Directory to write output of each '
+                             'combination, ' + COMPARISON_FILENAME +
+                             ' and ' + SUMMARY_FILENAME + ' to')
+    parser.add_argument('--maxpval', nargs='+', type=float,
+                        help='Maximum p values to sweep. If unset, '
+                             'the enrichment default is used')
+    parser.add_argument('--minoverlap', nargs='+', type=float,
+                        help='Minimum Jaccard values to sweep. If '
+                             'unset, the enrichment default is used')
+    parser.add_argument('--excludesource', nargs='+',
+                        help='Comma delimited lists of sources to '
+                             'exclude to sweep, an empty string '
+                             'excludes none. If unset, the enrichment '
+                             'default is used')
+    return parser.parse_known_args(args)
+
+
+def get_combinations(theargs, enrichment_theargs):
+    """
+    Gets every combination of the values of
+    :py:const:`SWEEP_PARAMETERS` in **theargs**, using the value
+    in **enrichment_theargs** for parameters not swept
+
+    :param theargs: parsed sweep arguments
+    :param enrichment_theargs: parsed enrichment arguments
+    :return: list of dicts of parameter name => value
+    :rtype: list
+    """
+    values = []
+    for name in SWEEP_PARAMETERS:
+        swept = getattr(theargs, name)
+        if swept is None:
+            swept = [getattr(enrichment_theargs, name)]
+        values.append(swept)
+    return [dict(zip(SWEEP_PARAMETERS, combination))
+            for combination in itertools.product(*values)]
+
+
+def fetch_terms(unique_genes, theargs, maxpval):
+    """
+    Queries g:Profiler once for each gene list in **unique_genes**
+    at **maxpval**, in batches of `--gprofiler_batchsize` run
+    `--workers` at a time
+
+    :param unique_genes: list of (node id, list of genes) tuples
+    :type unique_genes: list
+    :param theargs: parsed enrichment arguments
+    :param maxpval: loosest maximum p value of the sweep
+    :type maxpval: float
+    :return: node id => terms of its query as
+             :py:class:`pandas.DataFrame` or ``None`` if it has no
+             terms or its gene list is not valid. Node ids whose
+             query failed are omitted
+    :rtype: dict
+    """
+    valid_genes = [(node_id, genes) for node_id, genes in unique_genes
+                   if enrichment_servicecmd._is_valid_genelist(genes,
+                                                               theargs.maxgenelistsize)]
+    genes_by_query, node_id_by_query = enrichment_servicecmd.get_gprofiler_queries(valid_genes)
+    batches = enrichment_servicecmd.get_gprofiler_batches(genes_by_query,
+                                                          max(1, theargs.gprofiler_batchsize),
+                                                          theargs.gprofiler_batchmaxgenes)
+    thescheduler = enrichment_servicecmd.get_scheduler(theargs, 'gprofiler')
+    valid_node_ids = set(node_id_by_query.values())
+    terms_by_node_id = {node_id: None for node_id, genes in unique_genes
+                        if node_id not in valid_node_ids}
+    with ThreadPoolExecutor(max_workers=max(1, theargs.workers)) as executor:
+        futures = [executor.submit(enrichment_servicecmd.profile_gprofiler_batch,
+                                   batch, theargs.organism, maxpval,
+                                   theargs.omit_intersections,
+                                   thescheduler=thescheduler)
+                   for batch in batches]
+        for batch, future in zip(batches, futures):
+            try:
+                terms_by_query = future.result()
+            except Exception as e:
+                sys.stderr.write('Query ' + str(node_id_by_query[list(batch.keys())[0]]) +
+                                 ' failed: ' + str(e) + '\n')
+                metrics.get_metrics().skip('exception')
+                continue
+            for query_name, df_terms in terms_by_query.items():
+                terms_by_node_id[node_id_by_query[query_name]] = df_terms
+    return terms_by_node_id
+
+
+def select_terms(terms_by_node_id, combination, topk=1):
+    """
+    Applies the thresholds of **combination** to the terms of each
+    query in **terms_by_node_id** and selects the **topk** best with
+    :py:func:`~enrichment_service.enrichment_servicecmd.get_top_gprofiler_terms`
+    so they match those of a run at those thresholds
+
+    :param terms_by_node_id: terms from :py:func:`fetch_terms`
+    :type terms_by_node_id: dict
+    :param combination: see :py:func:`get_combinations`
+    :type combination: dict
+    :param topk: number of terms per query
+    :type topk: int
+    :return: node id => terms passing the thresholds, best first,
+             queries without any are omitted
+    :rtype: dict
+    """
+    top_terms_by_node_id = {}
+    for node_id, df_terms in terms_by_node_id.items():
+        if df_terms is None:
+            continue
+        # done by g:Profiler when queried at this maxpval
+        df_terms = df_terms.loc[df_terms['p_value'].to_numpy() <= combination['maxpval']]
+        top_terms = enrichment_servicecmd.get_top_gprofiler_terms(df_terms,
+                                                                  combination['minoverlap'],
+                                                                  combination['excludesource'],
+                                                                  topk=topk)
+        if top_terms is not None:
+            top_terms_by_node_id[node_id] = top_terms
+    return top_terms_by_node_id
+
+
+def run_sweep(inputfile, outdir, enrichment_args, sweep_theargs):
+    """
+    Fetches g:Profiler terms for every unique gene list of the node
+    table in **inputfile** once, at the loosest maximum p value of
+    the sweep, and writes an updateTables action for each combination
+    from :py:func:`get_combinations` to **outdir**. Results of each
+    combination are also stored in the result cache so a later run
+    with the chosen thresholds does not query g:Profiler again
+
+    :param inputfile: node table file
+    :type inputfile: str
+    :param outdir: directory to write output to
+    :type outdir: str
+    :param enrichment_args: enrichment arguments other than input
+    :type enrichment_args: list
+    :param sweep_theargs: parsed sweep arguments
+    :raises ValueError: if **enrichment_args** or node table
+                        are invalid
+    :return: summary of sweep written to :py:const:`SUMMARY_FILENAME`
+    :rtype: dict
+    """
+    try:
+        theargs = enrichment_servicecmd._parse_arguments('sweep',
+                                                         [inputfile] +
+                                                         enrichment_args)
+    except SystemExit:
+        raise ValueError('Invalid enrichment arguments: ' +
+                         ' '.join(enrichment_args))
+    httpclient.set_session(enrichment_servicecmd.create_http_session(theargs))
+    node_table = enrichment_servicecmd.read_inputfile(inputfile)
+    column_name = enrichment_servicecmd._get_gene_column_name(node_table['columns'],
+                                                              theargs, 'gprofiler')
+    if column_name is None:
+        raise ValueError('Invalid node table: ' + inputfile)
+
+    row_genes = [(node_id, enrichment_servicecmd.get_genes_from_data(node_val[column_name]))
+                 for node_id, node_val in node_table['rows'].items()]
+    unique_genes, representatives = enrichment_servicecmd.get_unique_genes(row_genes)
+    combinations = get_combinations(sweep_theargs, theargs)
+    maxpval = max(combination['maxpval'] for combination in combinations)
+    terms_by_node_id = fetch_terms(unique_genes, theargs, maxpval)
+
+    os.makedirs(outdir, exist_ok=True)
+    topk = enrichment_servicecmd._get_topk(theargs, 'gprofiler')
+    fingerprint = enrichment_servicecmd._is_fingerprint_enabled(theargs)
+    thecache = enrichment_servicecmd.get_result_cache(theargs)
+    summary = {'input': inputfile,
+               'rows': len(row_genes),
+               'unique_genelists': len(unique_genes),
+               'fetch_maxpval': maxpval,
+               'combinations': []}
+    names_by_combination = []
+    for number, combination in enumerate(combinations, start=1):
+        combination_args = copy.copy(theargs)
+        for name, value in combination.items():
+            setattr(combination_args, name, value)
+        top_terms_by_node_id = select_terms(terms_by_node_id, combination,
+                                            topk=topk)
+
+        unique_results = {}
+        for node_id, genes in unique_genes:
+            if node_id not in terms_by_node_id:
+                continue
+            res = None
+            if node_id in top_terms_by_node_id:
+                res = enrichment_servicecmd.get_gprofiler_terms_result(top_terms_by_node_id[node_id],
+                                                                       genes)
+            if thecache is not None:
+                thecache.put(enrichment_servicecmd.get_cache_key(genes, combination_args,
+                                                                 'gprofiler'), res)
+            if res is not None and fingerprint:
+                res[enrichment_servicecmd.FINGERPRINT_COLUMN] = \
+                    enrichment_servicecmd.get_row_fingerprint(genes, combination_args,
+                                                              'gprofiler')
+            unique_results[node_id] = res
+        results, dropped = enrichment_servicecmd._get_row_results(row_genes,
+                                                                  representatives,
+                                                                  unique_results)
+        results_for_rows = dict(results)
+
+        output = os.path.join(outdir, OUTPUT_PREFIX + str(number) +
+                              OUTPUT_EXTENSION)
+        with open(output, 'w') as f:
+            json.dump(enrichment_servicecmd.get_update_tables_action(results_for_rows,
+                                                                     topk=topk,
+                                                                     fingerprint=fingerprint),
+                      f)
+        entry = dict(combination)
+        entry.update({'combination': number,
+                      'output': output,
+                      'labeled_rows': len(results_for_rows)})
+        summary['combinations'].append(entry)
+        names_by_combination.append({node_id: res['CD_CommunityName']
+                                     for node_id, res in results_for_rows.items()})
+
+    write_comparison(os.path.join(outdir, COMPARISON_FILENAME), row_genes,
+                     names_by_combination)
+    with open(os.path.join(outdir, SUMMARY_FILENAME), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def write_comparison(path, row_genes, names_by_combination):
+    """
+    Writes tab delimited table with a row for each node holding
+    the name of its best term under each combination, empty if
+    it has none
+
+    :param path: where to write table
+    :type path: str
+    :param row_genes: list of (node id, list of genes) tuples
+    :type row_genes: list
+    :param names_by_combination: node id => name for each combination
+    :type names_by_combination: list
+    """
+    with open(path, 'w') as f:
+        f.write('node_id\t' + '\t'.join(OUTPUT_PREFIX + str(number)
+                                        for number in range(1, len(names_by_combination) + 1)) +
+                '\n')
+        for node_id, genes in row_genes:
+            f.write(str(node_id) + '\t' +
+                    '\t'.join(names.get(node_id, '') for names in names_by_combination) +
+                    '\n')
+
+
+def main(args):
+    """
+    Main entry point for sweep command
+
+    :param args: arguments after sweep
+    :type args: list
+    :return: 0 upon success otherwise failure
+    :rtype: int
+    """
+    desc = """
+    Runs g:Profiler enrichment on a node table for every combination
+    of the --maxpval, --minoverlap and --excludesource values given.
+    Each unique gene list is only queried once, at the largest
+    --maxpval, and the thresholds are applied locally. Any enrichment
+    option other than input can be passed after the options below.
+    The updateTables action of each combination is written to
+    --outdir as """ + OUTPUT_PREFIX + """<number>""" + OUTPUT_EXTENSION + """,
+    the best term of each node under every combination to
+    """ + COMPARISON_FILENAME + """ and the combinations to """ + SUMMARY_FILENAME + """
+    """
+    theargs, enrichment_args = _parse_arguments(desc, args)
+    try:
+        summary = run_sweep(theargs.input, theargs.outdir, enrichment_args,
+                            theargs)
+    except ValueError as e:
+        sys.stderr.write(str(e) + '\n')
+        return 2
+    sys.stderr.write('Wrote ' + str(len(summary['combinations'])) +
+                     ' combinations to ' + theargs.outdir + '\n')
+    return 0
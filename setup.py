@@ -21,7 +21,10 @@ with open(os.path.join('enrichment_service', '__init__.py')) as ver_file:
 requirements = [
     'ndex2',
     'gprofiler-official',
-    'requests'
+    'requests',
+    'numpy',
+    'scipy',
+    'ijson'
 ]
 
 test_requirements = [
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `batch` module."""
+
+import os
+import json
+import shutil
+import tempfile
+
+import unittest
+
+from enrichment_service import batch
+from enrichment_service import enrichment_servicecmd
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def test_get_input_files_directory_and_manifest(self):
+        inputdir = os.path.join(self._temp_dir, 'in')
+        os.makedirs(inputdir)
+        for name in ['b.json', 'a.json.gz', 'notes.txt']:
+            open(os.path.join(inputdir, name), 'w').close()
+        self.assertEqual([os.path.join(inputdir, 'a.json.gz'),
+                          os.path.join(inputdir, 'b.json')],
+                         batch.get_input_files(inputdir))
+
+        manifest = os.path.join(self._temp_dir, 'manifest.txt')
+        with open(manifest, 'w') as f:
+            f.write('# comment\nin/b.json\n\n/abs/c.json\n')
+        self.assertEqual([os.path.join(self._temp_dir, 'in', 'b.json'),
+                          '/abs/c.json'],
+                         batch.get_input_files(manifest))
+
+        with self.assertRaises(ValueError):
+            batch.get_input_files(os.path.join(self._temp_dir, 'nope'))
+
+    def test_get_output_names(self):
+        self.assertEqual(['a', 'b', 'a_1', 'a_2', '.json'],
+                         batch.get_output_names(['/x/a.json', 'b.json.gz',
+                                                 '/y/a.json', '/z/a',
+                                                 '.json']))
+
+    def test_main_local_mode(self):
+        gmtfile = os.path.join(self._temp_dir, 'GO.gmt')
+        with open(gmtfile, 'w') as f:
+            f.write('GO:1\tterm one\ta\tb\tc\n')
+        inputdir = os.path.join(self._temp_dir, 'in')
+        os.makedirs(inputdir)
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a b'}}}
+        with open(os.path.join(inputdir, 'good.json'), 'w') as f:
+            json.dump(node_table, f)
+        with open(os.path.join(inputdir, 'twocolumns.json'), 'w') as f:
+            json.dump({'columns': [{'id': 'name'}, {'id': 'genes'}],
+                       'rows': {}}, f)
+        with open(os.path.join(inputdir, 'broken.json'), 'w') as f:
+            f.write('{not json')
+        outdir = os.path.join(self._temp_dir, 'out')
+
+        self.assertEqual(1, enrichment_servicecmd.main(['prog', 'batch',
+                                                        inputdir, '--outdir',
+                                                        outdir,
+                                                        '--processes', '2',
+                                                        '--mode', 'local',
+                                                        '--gmt', gmtfile,
+                                                        '--maxpval', '1.0']))
+        with open(os.path.join(outdir, batch.STATUS_FILENAME), 'r') as f:
+            status = json.load(f)
+        self.assertEqual(1, status['succeeded'])
+        self.assertEqual(2, status['failed'])
+        exit_codes = {os.path.basename(res['input']): res['exit_code']
+                      for res in status['inputs']}
+        self.assertEqual({'broken.json': batch.EXCEPTION_EXIT_CODE,
+                          'good.json': 0,
+                          'twocolumns.json': batch.NO_RESULTS_EXIT_CODE},
+                         exit_codes)
+        self.assertEqual([batch.STATUS_FILENAME, 'broken.log', 'good.json',
+                          'good.log', 'twocolumns.log'],
+                         sorted(os.listdir(outdir)))
+
+        with open(os.path.join(outdir, 'good.json'), 'r') as f:
+            res = json.load(f)
+        self.assertEqual('GO:1',
+                         res[0]['data']['rows']['1']['CD_AnnotatedMembers_SourceTerm'])
+
+    def test_run_batch_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            batch.run_batch([], os.path.join(self._temp_dir, 'out'),
+                            ['--mode', 'nope'])
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `circuitbreaker` module."""
+
+import unittest
+
+from enrichment_service import circuitbreaker
+
+
+class FakeClock(object):
+    """
+    Clock that only moves when told to
+    """
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = circuitbreaker.CircuitBreaker('svc', failure_threshold=3,
+                                                clock=FakeClock())
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertEqual(circuitbreaker.CLOSED, breaker.get_state())
+        self.assertTrue(breaker.allow_request())
+
+        breaker.record_failure()
+        self.assertEqual(circuitbreaker.OPEN, breaker.get_state())
+        self.assertFalse(breaker.allow_request())
+        with self.assertRaises(circuitbreaker.CircuitOpenError):
+            breaker.check()
+        self.assertEqual({'state': circuitbreaker.OPEN, 'failures': 3,
+                          'opened': 1, 'refused': 2},
+                         breaker.get_report())
+
+    def test_half_open_probe(self):
+        clock = FakeClock()
+        breaker = circuitbreaker.CircuitBreaker('svc', failure_threshold=1,
+                                                reset_timeout=10.0,
+                                                clock=clock)
+        breaker.record_failure()
+        clock.now += 9.9
+        self.assertFalse(breaker.allow_request())
+
+        # a single probe per reset timeout
+        clock.now += 0.1
+        self.assertTrue(breaker.allow_request())
+        self.assertEqual(circuitbreaker.HALF_OPEN, breaker.get_state())
+        self.assertFalse(breaker.allow_request())
+
+        # failed probe opens circuit again
+        breaker.record_failure()
+        self.assertEqual(circuitbreaker.OPEN, breaker.get_state())
+        self.assertFalse(breaker.allow_request())
+        self.assertEqual(2, breaker.get_report()['opened'])
+
+        # probe that never reports lets another through later
+        clock.now += 10.0
+        self.assertTrue(breaker.allow_request())
+        clock.now += 10.0
+        self.assertTrue(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(circuitbreaker.CLOSED, breaker.get_state())
+        self.assertEqual(0, breaker.get_report()['failures'])
+        self.assertTrue(breaker.allow_request())
+        self.assertTrue(breaker.allow_request())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `compiledlibrary` module."""
+
+import os
+import tempfile
+import shutil
+
+import unittest
+
+import numpy
+
+from enrichment_service import genesetlibrary
+from enrichment_service import compiledlibrary
+from enrichment_service import localenrichment
+from enrichment_service import enrichment_servicecmd
+
+
+class TestCompiledLibrary(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def _write_gmt_files(self):
+        gofile = os.path.join(self._temp_dir, 'GO.gmt')
+        with open(gofile, 'w') as f:
+            f.write('GO:1\tterm one\tzeta\tb\tc\n')
+            f.write('GO:2\thttp://foo\tc\td\td\n')
+        kegg = os.path.join(self._temp_dir, 'k.gmt')
+        with open(kegg, 'w') as f:
+            f.write('K1\tkégg one\tépsilon\tzeta\n')
+        return [gofile, 'KEGG=' + kegg]
+
+    def test_sorted_strings_get_indices(self):
+        strings = compiledlibrary.SortedStrings(numpy.array([b'a', b'bb', b'c'],
+                                                            dtype='S2'))
+        self.assertEqual(['a', 'bb', 'c'], list(strings))
+        self.assertEqual([1, -1, 0, -1, 2, -1],
+                         strings.get_indices(['bb', 'bbb', 'a', 'b', 'c',
+                                              '']).tolist())
+        self.assertEqual([], strings.get_indices([]).tolist())
+
+    def test_packed_strings(self):
+        data, offsets = compiledlibrary._pack_strings(['ab', '', 'é'])
+        strings = compiledlibrary.PackedStrings(data, offsets)
+        self.assertEqual(3, len(strings))
+        self.assertEqual(['ab', '', 'é'], list(strings))
+        self.assertEqual('é', strings[-1])
+        with self.assertRaises(IndexError):
+            strings[3]
+
+    def test_write_and_load_compiled_library(self):
+        gmtargs = self._write_gmt_files()
+        lib = genesetlibrary.read_gmt_files(gmtargs)
+        path = os.path.join(self._temp_dir, 'lib.gslib')
+        compiledlibrary.write_compiled_library(lib, path)
+        self.assertTrue(compiledlibrary.is_compiled_library(path))
+        self.assertFalse(compiledlibrary.is_compiled_library(gmtargs[0]))
+        self.assertFalse(compiledlibrary.is_compiled_library(path + 'x'))
+
+        compiled = compiledlibrary.load_compiled_library(path)
+        self.assertTrue(isinstance(compiled.term_indices, numpy.memmap) or
+                        isinstance(compiled.term_indices.base, numpy.memmap))
+        self.assertEqual(sorted(lib.genes), list(compiled.genes))
+        self.assertEqual(lib.get_number_of_genes(),
+                         compiled.get_number_of_genes())
+        self.assertEqual(3, compiled.get_number_of_terms())
+        self.assertEqual(['GO', 'GO', 'KEGG'], list(compiled.term_sources))
+        self.assertEqual(['GO:1', 'GO:2', 'K1'], list(compiled.term_natives))
+        self.assertEqual(['term one', 'GO:2', 'kégg one'],
+                         list(compiled.term_names))
+        for term in range(3):
+            self.assertEqual(lib.get_term_genes(term),
+                             compiled.get_term_genes(term))
+        self.assertEqual([compiled.genes.index('c'), -1],
+                         compiled.get_gene_indices(['c', 'x']).tolist())
+
+        # inverted index agrees with the term arrays
+        gene_indptr, gene_indices = compiled.get_inverted_index()
+        zeta = compiled.genes.index('zeta')
+        self.assertEqual([0, 2],
+                         gene_indices[gene_indptr[zeta]:gene_indptr[zeta + 1]].tolist())
+        self.assertEqual(compiled.get_gene_term_matrix().toarray().tolist(),
+                         compiled.get_gene_term_csr_matrix().toarray().tolist())
+
+        gene_lists = [['zeta', 'b', 'c'], ['épsilon', 'zeta'], ['x']]
+        self.assertEqual(localenrichment.run_local_enrichment(gene_lists,
+                                                              lib, 1.0, 0.0,
+                                                              None),
+                         localenrichment.run_local_enrichment(gene_lists,
+                                                              compiled, 1.0,
+                                                              0.0, None))
+
+    def test_read_header_invalid(self):
+        with self.assertRaises(ValueError):
+            compiledlibrary.read_header(self._write_gmt_files()[0])
+        emptyfile = os.path.join(self._temp_dir, 'empty')
+        open(emptyfile, 'w').close()
+        with self.assertRaises(ValueError):
+            compiledlibrary.read_header(emptyfile)
+
+    def test_compile_library_command_and_local_mode(self):
+        gmtargs = self._write_gmt_files()
+        path = os.path.join(self._temp_dir, 'lib.gslib')
+        self.assertEqual(0, enrichment_servicecmd.main(['prog',
+                                                        'compile-library',
+                                                        path, '--gmt',
+                                                        gmtargs[0], '--gmt',
+                                                        gmtargs[1]]))
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'zeta b c'},
+                               '2': {'genes': 'épsilon zeta'}}}
+        results = []
+        for gmt in [gmtargs, [path]]:
+            args = ['foo', '--maxpval', '1.0']
+            for gmtarg in gmt:
+                args.extend(['--gmt', gmtarg])
+            theargs = enrichment_servicecmd._parse_arguments('desc', args)
+            results.append(enrichment_servicecmd.run_enrichment(node_table,
+                                                                theargs,
+                                                                'local'))
+        self.assertEqual(results[0], results[1])
+        rows = results[1][0]['data']['rows']
+        self.assertEqual('KEGG', rows['2']['CD_AnnotatedMembers_SourceDB'])
+        self.assertEqual('K1', rows['2']['CD_AnnotatedMembers_SourceTerm'])
+
+        with self.assertRaises(ValueError):
+            enrichment_servicecmd.get_local_library([path, gmtargs[0]])
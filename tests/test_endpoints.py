@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `endpoints` module."""
+
+import unittest
+
+from enrichment_service import endpoints
+
+
+class TestEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+
+    def test_constructor_requires_endpoint(self):
+        with self.assertRaises(ValueError):
+            endpoints.EndpointPool([])
+
+    def test_acquire_spreads_tasks_and_favors_fast_endpoint(self):
+        pool = endpoints.EndpointPool(['a', 'b'])
+        self.assertEqual('a', pool.acquire())
+        self.assertEqual('b', pool.acquire())
+        pool.release('a', seconds=10.0)
+        pool.release('b', seconds=1.0)
+
+        # b is ten times faster so it gets new tasks until
+        # nine are outstanding on it
+        self.assertEqual(['b'] * 9, [pool.acquire() for x in range(9)])
+        self.assertEqual('a', pool.acquire())
+        self.assertEqual('b', pool.acquire(exclude=['a']))
+        self.assertIsNone(pool.acquire(exclude=['a', 'b']))
+
+    def test_abandoned_task_only_raises_completion_time(self):
+        pool = endpoints.EndpointPool(['a'], smoothing=1.0)
+        pool.acquire()
+        pool.release('a', seconds=2.0)
+        pool.acquire()
+        pool.release('a', seconds=1.0, abandoned=True)
+        self.assertEqual(2.0, pool.get_report()['a']['seconds'])
+        pool.acquire()
+        pool.release('a', seconds=5.0, abandoned=True)
+        self.assertEqual(5.0, pool.get_report()['a']['seconds'])
+        self.assertEqual(1, pool.get_report()['a']['completed'])
+
+    def test_failing_endpoint_avoided(self):
+        pool = endpoints.EndpointPool(['a', 'b'], failure_threshold=2,
+                                      cooldown=60.0)
+        for x in range(2):
+            pool.acquire(exclude=['b'])
+            pool.release('a', failed=True)
+        report = pool.get_report()
+        self.assertFalse(report['a']['healthy'])
+        self.assertEqual(2, report['a']['failures'])
+        self.assertEqual(['b', 'b', 'b'], [pool.acquire() for x in range(3)])
+
+        # picked when it is the only choice and healthy again
+        # once a task completes
+        self.assertEqual('a', pool.acquire(exclude=['b']))
+        pool.release('a', seconds=1.0)
+        self.assertTrue(pool.get_report()['a']['healthy'])
+        self.assertEqual(0, pool.get_report()['a']['failures'])
+
+    def test_hedge_budget(self):
+        self.assertFalse(endpoints.EndpointPool(['a']).try_start_hedge())
+
+        pool = endpoints.EndpointPool(['a', 'b'], hedge_fraction=0.1)
+        self.assertTrue(pool.try_start_hedge())
+        self.assertFalse(pool.try_start_hedge())
+        for x in range(20):
+            pool.acquire()
+        self.assertTrue(pool.try_start_hedge())
+        self.assertFalse(pool.try_start_hedge())
+        pool.finish_hedge()
+        self.assertTrue(pool.try_start_hedge())
@@ -4,11 +4,42 @@
 """Tests for `enrichment_servicecmd` package."""
 
 import os
+import json
 import tempfile
 import shutil
+import time
+import threading
 
 import unittest
+from unittest.mock import MagicMock, patch
+
+import pandas
+import requests_mock
 from enrichment_service import enrichment_servicecmd
+from enrichment_service import metrics
+
+
+def get_gprofiler_dataframe(rows):
+    """
+    Builds a DataFrame like the one returned by
+    GProfiler.profile() from a list of
+    (query, source, native, name, p_value, precision,
+    recall, intersections) tuples
+    """
+    return pandas.DataFrame(rows, columns=['query', 'source', 'native',
+                                           'name', 'p_value',
+                                           'precision', 'recall',
+                                           'intersections'])
+
+
+def get_iquery_result(description, hitgenes, similarity, pvalue=0.001):
+    """
+    Builds iQuery integratedsearch result with one hit
+    """
+    return {'sources': [{'results': [{'description': description,
+                                      'hitGenes': hitgenes,
+                                      'details': {'similarity': similarity,
+                                                  'PValue': pvalue}}]}]}
 
 
 class TestEnrichmentServiceCommand(unittest.TestCase):
@@ -28,3 +59,964 @@ class TestEnrichmentServiceCommand(unittest.TestCase):
         self.assertEqual([], enrichment_servicecmd.get_genes_from_data(''))
         self.assertEqual(['a', 'b', 'c', 'dss'],
                          enrichment_servicecmd.get_genes_from_data(' a b,c , dss  '))
+
+    def test_run_enrichment_with_workers_keeps_row_order(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo',
+                                                          '--workers',
+                                                          '4'])
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {str(x): {'genes': 'g' + str(x)}
+                               for x in range(20, 0, -1)}}
+
+        def fake_gprofiler(genes, *args, **kwargs):
+            if genes == ['g5']:
+                raise Exception('some error')
+            return {'CD_CommunityName': genes[0]}
+
+        with patch.object(enrichment_servicecmd, 'run_gprofiler',
+                          side_effect=fake_gprofiler):
+            res = enrichment_servicecmd.run_enrichment(node_table,
+                                                       theargs,
+                                                       'gprofiler')
+        rows = res[0]['data']['rows']
+        expected = [str(x) for x in range(20, 0, -1) if x != 5]
+        self.assertEqual(expected, list(rows.keys()))
+        self.assertEqual({'CD_CommunityName': 'g7'}, rows['7'])
+
+    def test_run_enrichment_invalid_mode(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc', ['foo'])
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a'}}}
+        self.assertIsNone(enrichment_servicecmd.run_enrichment(node_table,
+                                                               theargs,
+                                                               'foo'))
+
+    def test_get_gprofiler_batches(self):
+        genes_by_query = {'q0': ['a', 'b'], 'q1': ['c'],
+                          'q2': ['d', 'e', 'f'], 'q3': ['g']}
+        self.assertEqual([{'q0': ['a', 'b'], 'q1': ['c']},
+                          {'q2': ['d', 'e', 'f'], 'q3': ['g']}],
+                         enrichment_servicecmd.get_gprofiler_batches(genes_by_query,
+                                                                     2, 100))
+        self.assertEqual([{'q0': ['a', 'b'], 'q1': ['c']},
+                          {'q2': ['d', 'e', 'f']},
+                          {'q3': ['g']}],
+                         enrichment_servicecmd.get_gprofiler_batches(genes_by_query,
+                                                                     10, 3))
+
+    def test_get_gprofiler_uses_url_from_environment(self):
+        with patch.object(enrichment_servicecmd, '_gprofiler', None), \
+                patch.dict(os.environ,
+                           {enrichment_servicecmd.GPROFILER_URL_ENV: 'http://foo'}):
+            gprof = enrichment_servicecmd.get_gprofiler()
+            self.assertEqual('http://foo', gprof.base_url)
+            self.assertTrue(gprof is enrichment_servicecmd.get_gprofiler())
+
+    def test_get_cache_key_includes_service_url(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc', ['foo'])
+        other_url = enrichment_servicecmd._parse_arguments('desc',
+                                                           ['foo', '--url',
+                                                            'http://other'])
+        with patch.dict(os.environ, {}):
+            os.environ.pop(enrichment_servicecmd.GPROFILER_URL_ENV, None)
+            gprofiler_key = enrichment_servicecmd.get_cache_key(['a'], theargs,
+                                                                'gprofiler')
+            iquery_key = enrichment_servicecmd.get_cache_key(['a'], theargs,
+                                                             'iquery')
+            # --url only affects iQuery
+            self.assertEqual(gprofiler_key,
+                             enrichment_servicecmd.get_cache_key(['a'], other_url,
+                                                                 'gprofiler'))
+            self.assertNotEqual(iquery_key,
+                                enrichment_servicecmd.get_cache_key(['a'], other_url,
+                                                                    'iquery'))
+            os.environ[enrichment_servicecmd.GPROFILER_URL_ENV] = 'http://mock'
+            self.assertNotEqual(gprofiler_key,
+                                enrichment_servicecmd.get_cache_key(['a'], theargs,
+                                                                    'gprofiler'))
+            self.assertNotEqual(gprofiler_key,
+                                enrichment_servicecmd.get_row_fingerprint(['a'], theargs,
+                                                                          'gprofiler'))
+            self.assertEqual(iquery_key,
+                             enrichment_servicecmd.get_cache_key(['a'], theargs,
+                                                                 'iquery'))
+
+        # --precision does not change the result
+        other_precision = enrichment_servicecmd._parse_arguments('desc',
+                                                                 ['foo', '--precision',
+                                                                  '5'])
+        self.assertEqual(enrichment_servicecmd.get_cache_key(['a'], theargs,
+                                                             'gprofiler'),
+                         enrichment_servicecmd.get_cache_key(['a'], other_precision,
+                                                             'gprofiler'))
+
+    def test_run_gprofiler_batch(self):
+        gprof = MagicMock()
+        gprof.profile.return_value = get_gprofiler_dataframe([
+            ('q0', 'GO:BP', 'GO:1', 'term1', 0.001, 0.5, 0.5, ['a']),
+            ('q0', 'GO:BP', 'GO:2', 'term2', 0.0001, 1.0, 0.5, ['a', 'b']),
+            ('q1', 'HP', 'HP:1', 'hp1', 0.001, 1.0, 1.0, ['c']),
+            ('q2', 'GO:CC', 'GO:3', 'term3', 0.001, 1.0, 0.01, ['d'])])
+        res = enrichment_servicecmd.run_gprofiler_batch({'q0': ['a', 'b'],
+                                                         'q1': ['c'],
+                                                         'q2': ['d'],
+                                                         'q3': []},
+                                                        500, 'hsapiens',
+                                                        0.001, False, 0.05,
+                                                        'HP,MIRNA,TF', 3,
+                                                        gprofwrapper=gprof)
+        self.assertEqual(1, gprof.profile.call_count)
+        self.assertEqual({'q0': ['a', 'b'], 'q1': ['c'], 'q2': ['d']},
+                         gprof.profile.call_args[1]['query'])
+        self.assertEqual('term2', res['q0']['CD_CommunityName'])
+        self.assertEqual('GO:2', res['q0']['CD_AnnotatedMembers_SourceTerm'])
+        self.assertEqual(1.0, res['q0']['CD_AnnotatedMembers_Overlap'])
+        self.assertIsNone(res['q1'])
+        self.assertIsNone(res['q2'])
+        self.assertIsNone(res['q3'])
+
+    def test_run_gprofiler_batch_splits_failed_batch(self):
+        def fake_profile(query=None, **kwargs):
+            if 'bad' in query:
+                raise AssertionError('query failed')
+            return get_gprofiler_dataframe([(name, 'GO:BP', 'GO:1',
+                                             'term1', 0.001, 1.0, 1.0,
+                                             genes)
+                                            for name, genes in query.items()])
+        gprof = MagicMock()
+        gprof.profile.side_effect = fake_profile
+        queries = {'q' + str(x): ['g' + str(x)] for x in range(3)}
+        queries['bad'] = ['x']
+        res = enrichment_servicecmd.run_gprofiler_batch(queries, 500,
+                                                        'hsapiens', 0.001,
+                                                        False, 0.05, None, 3,
+                                                        gprofwrapper=gprof)
+        self.assertNotIn('bad', res)
+        for x in range(3):
+            self.assertEqual('g' + str(x),
+                             res['q' + str(x)]['CD_AnnotatedMembers'])
+        # 1 failed batch of 4, 2 halves, 1 failed half split again
+        self.assertEqual(5, gprof.profile.call_count)
+
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo',
+                                                          '--gprofiler_batchsize',
+                                                          '10'])
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a'}, '2': {'genes': 'b'},
+                               '3': {'genes': 'c'}}}
+        gprof.reset_mock()
+        with patch.object(enrichment_servicecmd, 'get_gprofiler',
+                          return_value=gprof):
+            res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                       'gprofiler')
+            self.assertEqual(1, gprof.profile.call_count)
+        rows = res[0]['data']['rows']
+        self.assertEqual(['1', '2', '3'], list(rows.keys()))
+        self.assertEqual('b', rows['2']['CD_AnnotatedMembers'])
+
+    def test_get_best_gprofiler_result_top_k(self):
+        df_result = get_gprofiler_dataframe([
+            ('q0', 'GO:BP', 'GO:1', 'term1', 0.001, 0.5, 0.5, ['a']),
+            ('q0', 'GO:BP', 'GO:2', 'term2', 0.0001, 1.0, 0.5, ['a', 'b']),
+            ('q0', 'GO:CC', 'GO:3', 'term3', 0.01, 0.5, 0.5, ['b']),
+            ('q0', 'HP', 'HP:1', 'hp1', 0.00001, 1.0, 1.0, ['a', 'b']),
+            ('q0', 'GO:MF', 'GO:4', 'term4', 0.001, 1.0, 0.01, ['c'])])
+        res = enrichment_servicecmd.get_best_gprofiler_result(df_result,
+                                                              ['a', 'b', 'c'],
+                                                              0.05,
+                                                              'HP,MIRNA,TF',
+                                                              3, topk=1)
+        self.assertEqual('term2', res['CD_CommunityName'])
+        self.assertEqual('c', res['CD_NonAnnotatedMembers'])
+        self.assertFalse('CD_CommunityName_2' in res)
+
+        res = enrichment_servicecmd.get_best_gprofiler_result(df_result,
+                                                              ['a', 'b', 'c'],
+                                                              0.05,
+                                                              'HP,MIRNA,TF',
+                                                              3, topk=5)
+        self.assertEqual('term2', res['CD_CommunityName'])
+        # tie on Jaccard is broken by p value
+        self.assertEqual('term1', res['CD_CommunityName_2'])
+        self.assertEqual('GO:1', res['CD_AnnotatedMembers_SourceTerm_2'])
+        self.assertEqual('term3', res['CD_CommunityName_3'])
+        self.assertEqual(1, res['CD_AnnotatedMembers_Size_3'])
+        self.assertEqual('GO:CC', res['CD_AnnotatedMembers_SourceDB_3'])
+        self.assertFalse('CD_CommunityName_4' in res)
+        self.assertFalse('CD_Labeled_2' in res)
+
+    def test_get_best_gprofiler_result_none_pass_filters(self):
+        df_result = get_gprofiler_dataframe([
+            ('q0', 'HP', 'HP:1', 'hp1', 0.001, 1.0, 1.0, ['a']),
+            ('q0', 'GO:MF', 'GO:4', 'term4', 0.001, 1.0, 0.01, ['c'])])
+        self.assertIsNone(enrichment_servicecmd.get_best_gprofiler_result(df_result,
+                                                                          ['a'],
+                                                                          0.05,
+                                                                          'HP',
+                                                                          3))
+
+    def test_get_update_tables_columns_top_k(self):
+        columns = enrichment_servicecmd.get_update_tables_columns()
+        self.assertEqual(10, len(columns))
+        columns = enrichment_servicecmd.get_update_tables_columns(topk=3)
+        self.assertEqual(24, len(columns))
+        self.assertEqual({'id': 'CD_AnnotatedMembers_Size_2',
+                          'type': 'integer'}, columns[12])
+        self.assertEqual({'id': 'CD_AnnotatedMembers_SourceTerm_3',
+                          'type': 'string'}, columns[-1])
+
+    def test_run_enrichment_reuses_previous_output(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            calls = []
+
+            def fake_gprofiler(genes, *args, **kwargs):
+                calls.append(genes)
+                if genes == ['z']:
+                    return None
+                return {'CD_CommunityName': ' '.join(genes)}
+
+            node_table = {'columns': [{'id': 'genes'}],
+                          'rows': {'1': {'genes': 'a b'},
+                                   '2': {'genes': 'c'},
+                                   '3': {'genes': 'z'}}}
+            theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                             ['foo',
+                                                              '--fingerprint'])
+            with patch.object(enrichment_servicecmd, 'run_gprofiler',
+                              side_effect=fake_gprofiler):
+                first = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                             'gprofiler')
+            self.assertEqual('CD_EnrichmentFingerprint',
+                             first[0]['data']['columns'][-1]['id'])
+            rows = first[0]['data']['rows']
+            self.assertEqual(enrichment_servicecmd.get_row_fingerprint(['a', 'b'],
+                                                                       theargs,
+                                                                       'gprofiler'),
+                             rows['1']['CD_EnrichmentFingerprint'])
+            previous_output = os.path.join(temp_dir, 'previous.json')
+            with open(previous_output, 'w') as f:
+                json.dump(first, f)
+
+            # communities renumbered, one changed and one added
+            node_table = {'columns': [{'id': 'genes'}],
+                          'rows': {'10': {'genes': 'b a'},
+                                   '11': {'genes': 'c d'},
+                                   '12': {'genes': 'z'},
+                                   '13': {'genes': 'a b'}}}
+            theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                             ['foo',
+                                                              '--previous-output',
+                                                              previous_output])
+            del calls[:]
+            stats = {}
+            with patch.object(enrichment_servicecmd, 'run_gprofiler',
+                              side_effect=fake_gprofiler):
+                second = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                              'gprofiler',
+                                                              stats=stats)
+            self.assertEqual([['c', 'd'], ['z']], calls)
+            self.assertEqual(2, stats['reused_rows'])
+            self.assertEqual(2, stats['recomputed_rows'])
+            rows = second[0]['data']['rows']
+            self.assertEqual(['10', '11', '13'], list(rows.keys()))
+            self.assertEqual(rows['10'], first[0]['data']['rows']['1'])
+            self.assertEqual('c d', rows['11']['CD_CommunityName'])
+            self.assertTrue('CD_EnrichmentFingerprint' in rows['11'])
+
+            # different parameters do not match earlier fingerprints
+            theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                             ['foo',
+                                                              '--maxpval',
+                                                              '0.5',
+                                                              '--previous-output',
+                                                              previous_output])
+            del calls[:]
+            with patch.object(enrichment_servicecmd, 'run_gprofiler',
+                              side_effect=fake_gprofiler):
+                enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                     'gprofiler')
+            self.assertEqual(3, len(calls))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_enrichment_resume_from_journal(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            calls = []
+
+            def fake_gprofiler(genes, *args, **kwargs):
+                calls.append(genes)
+                if genes == ['c']:
+                    # process killed while querying third gene list
+                    raise SystemExit(1)
+                if genes == ['z']:
+                    return None
+                return {'CD_CommunityName': ' '.join(genes),
+                        'CD_AnnotatedMembers_Pvalue': 0.1}
+
+            node_table = {'columns': [{'id': 'genes'}],
+                          'rows': {'1': {'genes': 'a b'},
+                                   '2': {'genes': 'z'},
+                                   '3': {'genes': 'c'},
+                                   '4': {'genes': 'b a'},
+                                   '5': {'genes': 'd'}}}
+            journal_path = os.path.join(temp_dir, 'journal.jsonl')
+            theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                             ['foo',
+                                                              '--journal',
+                                                              journal_path])
+            with patch.dict(enrichment_servicecmd._journals, clear=True), \
+                    patch.object(enrichment_servicecmd, 'run_gprofiler',
+                                 side_effect=fake_gprofiler):
+                with self.assertRaises(SystemExit):
+                    enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                         'gprofiler')
+            self.assertEqual([['a', 'b'], ['z'], ['c']], calls)
+
+            def fake_gprofiler_recovered(genes, *args, **kwargs):
+                calls.append(genes)
+                if genes == ['z']:
+                    return None
+                return {'CD_CommunityName': ' '.join(genes),
+                        'CD_AnnotatedMembers_Pvalue': 0.1}
+
+            expected_args = enrichment_servicecmd._parse_arguments('desc',
+                                                                   ['foo'])
+            with patch.object(enrichment_servicecmd, 'run_gprofiler',
+                              side_effect=fake_gprofiler_recovered):
+                expected = enrichment_servicecmd.run_enrichment(node_table,
+                                                                expected_args,
+                                                                'gprofiler')
+
+            theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                             ['foo',
+                                                              '--journal',
+                                                              journal_path,
+                                                              '--resume'])
+            del calls[:]
+            stats = {}
+            with patch.dict(enrichment_servicecmd._journals, clear=True), \
+                    patch.dict(enrichment_servicecmd._journaled_results,
+                               clear=True), \
+                    patch.object(enrichment_servicecmd, 'run_gprofiler',
+                                 side_effect=fake_gprofiler_recovered):
+                resumed = enrichment_servicecmd.run_enrichment(node_table,
+                                                               theargs,
+                                                               'gprofiler',
+                                                               stats=stats)
+            self.assertEqual([['c'], ['d']], calls)
+            self.assertEqual(3, stats['resumed_rows'])
+            self.assertEqual(json.dumps(expected), json.dumps(resumed))
+
+            # the finished run left a complete journal behind
+            del calls[:]
+            with patch.dict(enrichment_servicecmd._journals, clear=True), \
+                    patch.dict(enrichment_servicecmd._journaled_results,
+                               clear=True), \
+                    patch.object(enrichment_servicecmd, 'run_gprofiler',
+                                 side_effect=fake_gprofiler_recovered):
+                again = enrichment_servicecmd.run_enrichment(node_table,
+                                                             theargs,
+                                                             'gprofiler')
+            self.assertEqual([], calls)
+            self.assertEqual(json.dumps(expected), json.dumps(again))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_enrichment_resume_retries_failed_rows(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            journal_path = os.path.join(temp_dir, 'journal.jsonl')
+            args = ['foo', '--mode', 'iquery', '--url', 'http://foo',
+                    '--polling_interval', '0.01', '--http_retries', '0',
+                    '--journal', journal_path]
+            node_table = {'columns': [{'id': 'genes'}],
+                          'rows': {'1': {'genes': 'a b'}, '2': {'genes': 'c'},
+                                   '3': {'genes': 'd'}}}
+            submitted = []
+            failing = [['a', 'b']]
+
+            def submit_callback(request, context):
+                submitted.append(request.json()['geneList'])
+                if request.json()['geneList'] in failing:
+                    context.status_code = 500
+                    return {}
+                context.status_code = 202
+                return {'id': 'task_' + '_'.join(request.json()['geneList'])}
+
+            def run(theargs):
+                with patch.dict(enrichment_servicecmd._journals, clear=True), \
+                        patch.dict(enrichment_servicecmd._journaled_results,
+                                   clear=True), \
+                        patch.dict(enrichment_servicecmd._circuit_breakers,
+                                   clear=True), \
+                        requests_mock.Mocker() as m:
+                    m.post('http://foo/integratedsearch/v1/', json=submit_callback)
+                    for task in ['a_b', 'c', 'd']:
+                        m.get('http://foo/integratedsearch/v1/task_' + task +
+                              '/status', json={'progress': 100,
+                                               'status': 'complete'})
+                    m.get('http://foo/integratedsearch/v1/task_a_b',
+                          json=get_iquery_result('GO: some term', ['a'], 0.5))
+                    m.get('http://foo/integratedsearch/v1/task_c',
+                          json={'sources': []})
+                    m.get('http://foo/integratedsearch/v1/task_d',
+                          json=get_iquery_result('GO: other term', ['d'], 0.5))
+                    return enrichment_servicecmd.run_enrichment(node_table,
+                                                                theargs,
+                                                                'iquery')
+
+            first = run(enrichment_servicecmd._parse_arguments('desc', args))
+            self.assertEqual(['3'], list(first[0]['data']['rows'].keys()))
+
+            # service recovered, only the failed row is queried again
+            del failing[:]
+            del submitted[:]
+            resumed = run(enrichment_servicecmd._parse_arguments('desc', args +
+                                                                 ['--resume']))
+            self.assertEqual([['a', 'b']], submitted)
+            rows = resumed[0]['data']['rows']
+            self.assertEqual(['1', '3'], list(rows.keys()))
+            self.assertEqual('some term', rows['1']['CD_CommunityName'])
+            self.assertEqual(first[0]['data']['rows']['3'], rows['3'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_enrichment_resume_requires_journal(self):
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a b'}}}
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--resume'])
+        self.assertIsNone(enrichment_servicecmd.run_enrichment(node_table,
+                                                               theargs,
+                                                               'gprofiler'))
+
+    def test_get_canonical_genes(self):
+        self.assertEqual([], enrichment_servicecmd.get_canonical_genes([' ']))
+        self.assertEqual(['a', 'b'],
+                         enrichment_servicecmd.get_canonical_genes(['b', ' a',
+                                                                    'b ', '']))
+
+    def test_run_enrichment_queries_identical_genelists_once(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc', ['foo'])
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'b,a'},
+                               '2': {'genes': 'c'},
+                               '3': {'genes': ' a b a'},
+                               '4': {'genes': 'a b'}}}
+
+        def fake_gprofiler(genes, *args, **kwargs):
+            return {'CD_CommunityName': ','.join(genes)}
+
+        stats = {}
+        with patch.object(enrichment_servicecmd, 'run_gprofiler',
+                          side_effect=fake_gprofiler) as mock_gprof:
+            res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                       'gprofiler',
+                                                       stats=stats)
+            self.assertEqual(2, mock_gprof.call_count)
+        rows = res[0]['data']['rows']
+        self.assertEqual(['1', '2', '3', '4'], list(rows.keys()))
+        for node_id in ['1', '3', '4']:
+            self.assertEqual({'CD_CommunityName': 'a,b'}, rows[node_id])
+        self.assertEqual({'rows': 4, 'unique_genelists': 2,
+                          'dedup_ratio': 0.5}, stats)
+
+    def test_run_enrichment_iquery_submits_all_then_polls(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--mode',
+                                                          'iquery',
+                                                          '--url',
+                                                          'http://foo',
+                                                          '--polling_interval',
+                                                          '0.01'])
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a b'}, '2': {'genes': 'c'},
+                               '3': {'genes': 'd'}}}
+        submitted = []
+
+        def submit_callback(request, context):
+            context.status_code = 202
+            submitted.append(request.json()['geneList'])
+            return {'id': 'task_' + '_'.join(request.json()['geneList'])}
+
+        with requests_mock.Mocker() as m:
+            m.post('http://foo/integratedsearch/v1/', json=submit_callback)
+            m.get('http://foo/integratedsearch/v1/task_a_b/status',
+                  [{'json': {'progress': 50, 'status': 'processing'}},
+                   {'json': {'progress': 100, 'status': 'complete'}}])
+            m.get('http://foo/integratedsearch/v1/task_c/status',
+                  json={'progress': 100, 'status': 'complete'})
+            m.get('http://foo/integratedsearch/v1/task_d/status',
+                  json={'progress': 100, 'status': 'failed'})
+            m.get('http://foo/integratedsearch/v1/task_a_b',
+                  json=get_iquery_result('GO: some term', ['a'], 0.5))
+            m.get('http://foo/integratedsearch/v1/task_c',
+                  json={'sources': []})
+            res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                       'iquery')
+        self.assertEqual([['a', 'b'], ['c'], ['d']], sorted(submitted))
+        rows = res[0]['data']['rows']
+        self.assertEqual(['1'], list(rows.keys()))
+        self.assertEqual('some term', rows['1']['CD_CommunityName'])
+        self.assertEqual('GO', rows['1']['CD_AnnotatedMembers_SourceDB'])
+        self.assertEqual('b', rows['1']['CD_NonAnnotatedMembers'])
+        self.assertEqual('iQuery', rows['1']['CD_AnnotatedAlgorithm'])
+
+    def test_run_enrichment_iquery_failures_not_cached(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                             ['foo', '--mode',
+                                                              'iquery',
+                                                              '--url',
+                                                              'http://foo',
+                                                              '--polling_interval',
+                                                              '0.01',
+                                                              '--http_retries',
+                                                              '0',
+                                                              '--cache-dir',
+                                                              temp_dir])
+            node_table = {'columns': [{'id': 'genes'}],
+                          'rows': {'1': {'genes': 'a b'}, '2': {'genes': 'c'},
+                                   '3': {'genes': 'd'}, '4': {'genes': 'e'}}}
+
+            def submit_callback(request, context):
+                if request.json()['geneList'] == ['a', 'b']:
+                    context.status_code = 500
+                    return {}
+                context.status_code = 202
+                return {'id': 'task_' + '_'.join(request.json()['geneList'])}
+
+            run_metrics = metrics.RunMetrics()
+            with patch.dict(enrichment_servicecmd._result_caches, clear=True), \
+                    patch.dict(enrichment_servicecmd._circuit_breakers, clear=True), \
+                    patch.object(metrics, '_default_metrics', run_metrics), \
+                    requests_mock.Mocker() as m:
+                m.post('http://foo/integratedsearch/v1/', json=submit_callback)
+                for task in ['c', 'e']:
+                    m.get('http://foo/integratedsearch/v1/task_' + task +
+                          '/status', json={'progress': 100, 'status': 'complete'})
+                m.get('http://foo/integratedsearch/v1/task_d/status',
+                      json={'progress': 100, 'status': 'failed'})
+                m.get('http://foo/integratedsearch/v1/task_c',
+                      json={'sources': []})
+                m.get('http://foo/integratedsearch/v1/task_e', status_code=500)
+                res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                           'iquery')
+                thecache = enrichment_servicecmd.get_result_cache(theargs)
+                self.assertEqual({}, res[0]['data']['rows'])
+                # only gene list without a term is cached
+                self.assertEqual((True, None),
+                                 thecache.get(enrichment_servicecmd.get_cache_key(['c'],
+                                                                                  theargs,
+                                                                                  'iquery')))
+                for genes in [['a', 'b'], ['d'], ['e']]:
+                    self.assertEqual((False, None),
+                                     thecache.get(enrichment_servicecmd.get_cache_key(genes,
+                                                                                      theargs,
+                                                                                      'iquery')))
+            self.assertEqual({'no_result': 1, 'submit_failed': 1,
+                              'task_failed': 1, 'result_failed': 1},
+                             run_metrics.get_report()['skipped'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_iquery_returns_none_on_failure(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--url',
+                                                          'http://failed',
+                                                          '--http_retries',
+                                                          '0'])
+        run_metrics = metrics.RunMetrics()
+        with patch.object(metrics, '_default_metrics', run_metrics), \
+                requests_mock.Mocker() as m:
+            m.post('http://failed/integratedsearch/v1/', status_code=500)
+            self.assertIsNone(enrichment_servicecmd.run_iquery(['a'], theargs))
+            with self.assertRaises(enrichment_servicecmd.IQueryError) as context:
+                enrichment_servicecmd._run_iquery(['a'], theargs)
+            self.assertEqual('submit_failed', context.exception.get_reason())
+        self.assertEqual({'submit_failed': 1},
+                         run_metrics.get_report()['skipped'])
+
+    def test_run_enrichment_iquery_top_k(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--mode',
+                                                          'iquery',
+                                                          '--url',
+                                                          'http://topk',
+                                                          '--polling_interval',
+                                                          '0.01',
+                                                          '--top-k', '2'])
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a b'}}}
+        resjson = get_iquery_result('GO: second', ['a'], 0.2)
+        resjson['sources'][0]['results'] += get_iquery_result('GO: best', ['a', 'b'],
+                                                              0.9)['sources'][0]['results']
+        resjson['sources'][0]['results'] += get_iquery_result('GO: third', ['b'],
+                                                              0.1)['sources'][0]['results']
+        with requests_mock.Mocker() as m:
+            m.post('http://topk/integratedsearch/v1/', status_code=202,
+                   json={'id': 'task1'})
+            m.get('http://topk/integratedsearch/v1/task1/status',
+                  json={'progress': 100, 'status': 'complete'})
+            m.get('http://topk/integratedsearch/v1/task1', json=resjson)
+            res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                       'iquery')
+        self.assertEqual([column['id'] for column in
+                          enrichment_servicecmd.get_update_tables_columns(topk=2)],
+                         [column['id'] for column in res[0]['data']['columns']])
+        row = res[0]['data']['rows']['1']
+        self.assertEqual('best', row['CD_CommunityName'])
+        self.assertEqual('', row['CD_NonAnnotatedMembers'])
+        self.assertEqual('second', row['CD_CommunityName_2'])
+        self.assertEqual(0.5, row['CD_AnnotatedMembers_Overlap_2'])
+        self.assertNotIn('CD_CommunityName_3', row)
+        self.assertNotIn('CD_Labeled_2', row)
+
+    def test_get_iquery_urls(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc', ['foo'])
+        self.assertEqual([enrichment_servicecmd.DEFAULT_IQUERY_URL],
+                         enrichment_servicecmd.get_iquery_urls(theargs))
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--url',
+                                                          'http://a/,http://b',
+                                                          '--url', 'http://c',
+                                                          '--url', 'http://a'])
+        self.assertEqual(['http://a', 'http://b', 'http://c'],
+                         enrichment_servicecmd.get_iquery_urls(theargs))
+        self.assertIs(enrichment_servicecmd.get_endpoint_pool(theargs),
+                      enrichment_servicecmd.get_endpoint_pool(theargs))
+
+        # url set to a str rather than list by callers
+        theargs = enrichment_servicecmd._parse_arguments('desc', ['foo'])
+        theargs.url = 'http://h.org/x/'
+        self.assertEqual(['http://h.org/x'],
+                         enrichment_servicecmd.get_iquery_urls(theargs))
+        theargs.url = 'http://a,http://b'
+        self.assertEqual(['http://a', 'http://b'],
+                         enrichment_servicecmd.get_iquery_urls(theargs))
+
+    def test_run_enrichment_iquery_hedges_slow_task(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--mode',
+                                                          'iquery',
+                                                          '--url',
+                                                          'http://hedgeslow',
+                                                          '--url',
+                                                          'http://hedgefast',
+                                                          '--polling_interval',
+                                                          '0.013',
+                                                          '--max_polling_interval',
+                                                          '0.02',
+                                                          '--task_deadline', '5'])
+        schedule = enrichment_servicecmd.get_poll_schedule(theargs)
+        self.assertIsNone(enrichment_servicecmd.get_hedge_delay(theargs,
+                                                                schedule))
+        for x in range(enrichment_servicecmd.HEDGE_MIN_COMPLETIONS):
+            schedule.record_completion(0.05)
+        self.assertEqual(0.05, enrichment_servicecmd.get_hedge_delay(theargs,
+                                                                     schedule))
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a'}}}
+        run_metrics = metrics.RunMetrics()
+        metrics.set_metrics(run_metrics)
+        try:
+            with requests_mock.Mocker() as m:
+                for url in ['http://hedgeslow', 'http://hedgefast']:
+                    m.post(url + '/integratedsearch/v1/', status_code=202,
+                           json={'id': 'task_a'})
+                m.get('http://hedgeslow/integratedsearch/v1/task_a/status',
+                      json={'progress': 50, 'status': 'processing'})
+                m.get('http://hedgefast/integratedsearch/v1/task_a/status',
+                      json={'progress': 100, 'status': 'complete'})
+                m.get('http://hedgefast/integratedsearch/v1/task_a',
+                      json=get_iquery_result('GO: fast term', ['a'], 0.5))
+                start = time.monotonic()
+                res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                           'iquery')
+        finally:
+            metrics.set_metrics(None)
+        self.assertTrue(time.monotonic() - start < 2.0)
+        self.assertEqual('fast term',
+                         res[0]['data']['rows']['1']['CD_CommunityName'])
+        report = run_metrics.get_report()
+        self.assertEqual({'won': 1}, report['iquery_hedges'])
+        self.assertEqual({'http://hedgeslow': {'abandoned': 1},
+                          'http://hedgefast': {'completed': 1}},
+                         report['iquery_tasks'])
+
+        # the slow endpoint now has the longer completion time so
+        # the next task goes to the fast one
+        pool = enrichment_servicecmd.get_endpoint_pool(theargs)
+        self.assertEqual('http://hedgefast', pool.acquire())
+
+    def test_run_enrichment_circuit_breaker_falls_back_to_local(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtfile = os.path.join(temp_dir, 'GO_BP.gmt')
+            with open(gmtfile, 'w') as f:
+                f.write('GO:1\tterm 1\ta\tb\tc\n')
+            healthy = [False]
+
+            def fake_profile(query=None, **kwargs):
+                if not healthy[0]:
+                    raise ConnectionError('connection refused')
+                return get_gprofiler_dataframe([('query_1', 'GO:BP', 'GO:9',
+                                                 'remote', 0.001, 1.0, 1.0,
+                                                 query)])
+            gprof = MagicMock()
+            gprof.profile.side_effect = fake_profile
+            theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                             ['foo', '--gmt',
+                                                              gmtfile,
+                                                              '--maxpval', '1',
+                                                              '--http_retries',
+                                                              '0',
+                                                              '--breaker_threshold',
+                                                              '2',
+                                                              '--breaker_reset',
+                                                              '0.2',
+                                                              '--fallback_mode',
+                                                              'local',
+                                                              '--fingerprint'])
+            node_table = {'columns': [{'id': 'genes'}],
+                          'rows': {'1': {'genes': 'a'}, '2': {'genes': 'b'},
+                                   '3': {'genes': 'a b'},
+                                   '4': {'genes': 'b c'},
+                                   '5': {'genes': 'b a'}}}
+            stats = {}
+            with patch.dict(enrichment_servicecmd._circuit_breakers, clear=True), \
+                    patch.object(enrichment_servicecmd, 'get_gprofiler',
+                                 return_value=gprof):
+                res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                           'gprofiler',
+                                                           stats=stats)
+                # circuit opened after 2 failed rows, rest never
+                # reached g:Profiler
+                self.assertEqual(2, gprof.profile.call_count)
+                rows = res[0]['data']['rows']
+                self.assertEqual(['3', '4', '5'], list(rows.keys()))
+                for node_id in ['3', '4', '5']:
+                    self.assertEqual('Local',
+                                     rows[node_id]['CD_AnnotatedAlgorithm'])
+                    self.assertNotIn('CD_EnrichmentFingerprint', rows[node_id])
+                self.assertEqual('local', stats['fallback_mode'])
+                self.assertEqual(3, stats['fallback_rows'])
+                self.assertEqual(['3', '4', '5'], stats['fallback_node_ids'])
+                self.assertEqual('open', stats['circuit_breaker']['state'])
+
+                # after --breaker_reset a probe finds g:Profiler
+                # healthy again and closes the circuit
+                healthy[0] = True
+                time.sleep(0.25)
+                gprof.reset_mock()
+                stats = {}
+                res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                           'gprofiler',
+                                                           stats=stats)
+                self.assertEqual(4, gprof.profile.call_count)
+                rows = res[0]['data']['rows']
+                self.assertEqual('remote', rows['1']['CD_CommunityName'])
+                self.assertIn('CD_EnrichmentFingerprint', rows['1'])
+                self.assertEqual(0, stats['fallback_rows'])
+                self.assertEqual('closed', stats['circuit_breaker']['state'])
+
+            theargs.fallback_mode = 'gprofiler'
+            self.assertIsNone(enrichment_servicecmd.run_enrichment(node_table,
+                                                                   theargs,
+                                                                   'gprofiler'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_enrichment_circuit_breaker_disabled_by_default(self):
+        gprof = MagicMock()
+        gprof.profile.side_effect = ConnectionError('connection refused')
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--http_retries',
+                                                          '0'])
+        self.assertIsNone(enrichment_servicecmd.get_circuit_breaker(theargs,
+                                                                    'gprofiler'))
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {str(x): {'genes': 'g' + str(x)}
+                               for x in range(8)}}
+        stats = {}
+        with patch.dict(enrichment_servicecmd._circuit_breakers, clear=True), \
+                patch.object(enrichment_servicecmd, 'get_gprofiler',
+                             return_value=gprof):
+            res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                       'gprofiler', stats=stats)
+        # every row reached g:Profiler, none were skipped unsent
+        self.assertEqual(8, gprof.profile.call_count)
+        self.assertEqual({}, res[0]['data']['rows'])
+        self.assertNotIn('circuit_breaker', stats)
+
+    def test_run_enrichment_circuit_breaker_iquery_cache_fallback(self):
+        temp_dir = tempfile.mkdtemp()
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--mode',
+                                                          'iquery',
+                                                          '--url',
+                                                          'http://breakerdown',
+                                                          '--maxinflight', '1',
+                                                          '--http_retries', '0',
+                                                          '--breaker_threshold',
+                                                          '1',
+                                                          '--fallback_mode',
+                                                          'cache',
+                                                          '--cache-dir',
+                                                          temp_dir])
+        thecache = enrichment_servicecmd.get_result_cache(theargs)
+        thecache.put(enrichment_servicecmd.get_cache_key(['b'], theargs,
+                                                         'gprofiler'),
+                     {'CD_CommunityName': 'cached'})
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a'}, '2': {'genes': 'b'},
+                               '3': {'genes': 'c'}}}
+        stats = {}
+        run_metrics = metrics.RunMetrics()
+        metrics.set_metrics(run_metrics)
+        try:
+            with patch.dict(enrichment_servicecmd._circuit_breakers, clear=True), \
+                    requests_mock.Mocker() as m:
+                m.post('http://breakerdown/integratedsearch/v1/',
+                       status_code=500)
+                res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                           'iquery',
+                                                           stats=stats)
+                self.assertEqual(1, m.call_count)
+        finally:
+            metrics.set_metrics(None)
+            shutil.rmtree(temp_dir)
+        self.assertEqual({'2': {'CD_CommunityName': 'cached'}},
+                         res[0]['data']['rows'])
+        self.assertEqual(['2', '3'], sorted(stats['fallback_node_ids']))
+        report = run_metrics.get_report()
+        self.assertEqual({'iquery': {'cache': 2}}, report['fallbacks'])
+        self.assertEqual(1, report['skipped']['circuit_open'])
+
+    def test_run_enrichment_deadline_drops_unfinished_rows(self):
+        release = threading.Event()
+
+        def fake_gprofiler(genes, *args, **kwargs):
+            if genes == ['slow']:
+                release.wait(5)
+            return {'CD_CommunityName': ' '.join(genes)}
+
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--deadline',
+                                                          '0.3'])
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a'}, '2': {'genes': 'slow'},
+                               '3': {'genes': 'slow'}, '4': {'genes': 'b'}}}
+        stats = {}
+        start = time.monotonic()
+        try:
+            with patch.object(enrichment_servicecmd, 'run_gprofiler',
+                              side_effect=fake_gprofiler):
+                res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                           'gprofiler',
+                                                           stats=stats)
+        finally:
+            release.set()
+        self.assertTrue(time.monotonic() - start < 2.0)
+        rows = res[0]['data']['rows']
+        # rows after the slow one never started since --workers is 1
+        self.assertEqual(['1'], list(rows.keys()))
+        self.assertTrue(stats['deadline_exceeded'])
+        self.assertEqual(3, stats['deadline_dropped_rows'])
+        self.assertEqual(['2', '3', '4'], stats['deadline_dropped_node_ids'])
+
+    def test_run_enrichment_deadline_gprofiler_batches(self):
+        release = threading.Event()
+
+        def fake_profile(query=None, **kwargs):
+            if 'slow' in [genes[0] for genes in query.values()]:
+                release.wait(5)
+            return get_gprofiler_dataframe([(name, 'GO:BP', 'GO:1',
+                                             'term1', 0.001, 1.0, 1.0,
+                                             genes)
+                                            for name, genes in query.items()])
+        gprof = MagicMock()
+        gprof.profile.side_effect = fake_profile
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--deadline',
+                                                          '0.3', '--workers',
+                                                          '2',
+                                                          '--gprofiler_batchsize',
+                                                          '2'])
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a'}, '2': {'genes': 'b'},
+                               '3': {'genes': 'slow'}, '4': {'genes': 'c'}}}
+        stats = {}
+        try:
+            with patch.object(enrichment_servicecmd, 'get_gprofiler',
+                              return_value=gprof):
+                res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                           'gprofiler',
+                                                           stats=stats)
+        finally:
+            release.set()
+        self.assertEqual(['1', '2'], list(res[0]['data']['rows'].keys()))
+        self.assertEqual(['3', '4'], stats['deadline_dropped_node_ids'])
+
+    def test_run_enrichment_deadline_iquery(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--mode',
+                                                          'iquery',
+                                                          '--url',
+                                                          'http://foo',
+                                                          '--polling_interval',
+                                                          '0.01',
+                                                          '--deadline', '0.5'])
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a'}, '2': {'genes': 'b'}}}
+
+        def submit_callback(request, context):
+            context.status_code = 202
+            return {'id': 'task_' + request.json()['geneList'][0]}
+
+        stats = {}
+        start = time.monotonic()
+        with requests_mock.Mocker() as m:
+            m.post('http://foo/integratedsearch/v1/', json=submit_callback)
+            m.get('http://foo/integratedsearch/v1/task_a/status',
+                  json={'progress': 100, 'status': 'complete'})
+            m.get('http://foo/integratedsearch/v1/task_b/status',
+                  json={'progress': 50, 'status': 'processing'})
+            m.get('http://foo/integratedsearch/v1/task_a',
+                  json=get_iquery_result('GO: some term', ['a'], 0.5))
+            res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                       'iquery', stats=stats)
+        self.assertTrue(time.monotonic() - start < 2.0)
+        self.assertEqual(['1'], list(res[0]['data']['rows'].keys()))
+        self.assertEqual(['2'], stats['deadline_dropped_node_ids'])
+
+    def test_run_iquery_task_async_stops_polling_at_run_deadline(self):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--url',
+                                                          'http://slowtask',
+                                                          '--polling_interval',
+                                                          '0.01',
+                                                          '--task_deadline',
+                                                          '60',
+                                                          '--deadline', '0.3'])
+        pool = enrichment_servicecmd.get_endpoint_pool(theargs)
+        start = time.monotonic()
+        with requests_mock.Mocker() as m, \
+                ThreadPoolExecutor(max_workers=1) as executor:
+            m.post('http://slowtask/integratedsearch/v1/', status_code=202,
+                   json={'id': 'task_a'})
+            m.get('http://slowtask/integratedsearch/v1/task_a/status',
+                  json={'progress': 50, 'status': 'processing'})
+            res = asyncio.run(enrichment_servicecmd._run_iquery_task_async(['a'], theargs,
+                                                                           pool,
+                                                                           pool.acquire(),
+                                                                           executor))
+        self.assertEqual((None, 'deadline'), res)
+        self.assertTrue(time.monotonic() - start < 2.0)
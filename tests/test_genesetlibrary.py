@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `genesetlibrary` module."""
+
+import os
+import tempfile
+import shutil
+
+import unittest
+from enrichment_service import genesetlibrary
+
+
+class TestGeneSetLibrary(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def test_get_source_and_path(self):
+        self.assertEqual(('GO_BP', '/x/GO_BP.gmt'),
+                         genesetlibrary.get_source_and_path('/x/GO_BP.gmt'))
+        self.assertEqual(('REAC', '/x/r.gmt'),
+                         genesetlibrary.get_source_and_path('REAC=/x/r.gmt'))
+
+    def test_read_gmt_files(self):
+        gofile = os.path.join(self._temp_dir, 'GO.gmt')
+        with open(gofile, 'w') as f:
+            f.write('GO:1\tterm one\ta\tb\tc\n')
+            f.write('GO:2\thttp://foo\tc\td\td\n')
+            f.write('bad line\n')
+            f.write('GO:3\t\t\n')
+        kegg = os.path.join(self._temp_dir, 'k.gmt')
+        with open(kegg, 'w') as f:
+            f.write('K1\tkegg one\te\ta\n')
+
+        lib = genesetlibrary.read_gmt_files([gofile, 'KEGG=' + kegg])
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'], lib.genes)
+        self.assertEqual(3, lib.get_number_of_terms())
+        self.assertEqual(['GO', 'GO', 'KEGG'], lib.term_sources)
+        self.assertEqual(['GO:1', 'GO:2', 'K1'], lib.term_natives)
+        self.assertEqual(['term one', 'GO:2', 'kegg one'], lib.term_names)
+        self.assertEqual([3, 2, 2], lib.get_term_sizes().tolist())
+        self.assertEqual(['c', 'd'], lib.get_term_genes(1))
+        self.assertEqual(['e', 'a'], lib.get_term_genes(2))
+
+        matrix = lib.get_gene_term_matrix().toarray()
+        self.assertEqual((5, 3), matrix.shape)
+        self.assertEqual([1, 0, 1], matrix[0].tolist())
+        self.assertEqual([0, 0, 1], matrix[4].tolist())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `httpclient` module."""
+
+import unittest
+from unittest.mock import MagicMock
+
+from enrichment_service import httpclient
+from enrichment_service import enrichment_servicecmd
+
+
+class TestHttpClient(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        httpclient.set_session(None)
+
+    def test_create_session(self):
+        session = httpclient.create_session(pool_size=7, retries=2)
+        adapter = session.get_adapter('https://www.ndexbio.org')
+        self.assertEqual(7, adapter._pool_maxsize)
+        self.assertEqual(2, adapter.max_retries.total)
+        self.assertIn(503, adapter.max_retries.status_forcelist)
+        self.assertNotIn('POST', adapter.max_retries.allowed_methods)
+        self.assertIn('gzip', session.headers['Accept-Encoding'])
+        self.assertIs(adapter, session.get_adapter('http://foo'))
+
+    def test_get_and_set_session(self):
+        session = httpclient.get_session()
+        self.assertIs(session, httpclient.get_session())
+        other = MagicMock()
+        httpclient.set_session(other)
+        self.assertIs(other, httpclient.get_session())
+        httpclient.set_session(None)
+        self.assertIsNot(other, httpclient.get_session())
+
+    def test_iquery_calls_use_injected_session(self):
+        session = MagicMock()
+        submit_res = MagicMock(status_code=202)
+        submit_res.json.return_value = {'id': 'task1'}
+        session.post.return_value = submit_res
+        status_res = MagicMock(status_code=200, headers={})
+        status_res.json.return_value = {'progress': 100,
+                                        'status': 'complete'}
+        result_res = MagicMock(status_code=200)
+        result_res.iter_content.return_value = iter([b'{"sources": []}'])
+        session.get.side_effect = [status_res, result_res]
+
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--url',
+                                                          'http://foo',
+                                                          '--polling_interval',
+                                                          '0.01'])
+        self.assertIsNone(enrichment_servicecmd.run_iquery(['a'], theargs,
+                                                           session=session))
+        self.assertEqual('http://foo/integratedsearch/v1/',
+                         session.post.call_args[0][0])
+        self.assertEqual(['http://foo/integratedsearch/v1/task1/status',
+                          'http://foo/integratedsearch/v1/task1'],
+                         [c[0][0] for c in session.get.call_args_list])
+
+    def test_response_reader(self):
+        response = MagicMock()
+        response.iter_content.return_value = iter([b'abc', b'de', b'f'])
+        reader = httpclient.ResponseReader(response, chunk_size=2)
+        self.assertEqual(b'ab', reader.read(2))
+        self.assertEqual(b'cde', reader.read(3))
+        self.assertEqual(b'f', reader.read())
+        self.assertEqual(b'', reader.read(10))
+        response.iter_content.assert_called_once_with(chunk_size=2)
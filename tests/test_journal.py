@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `journal` module."""
+
+import os
+import tempfile
+import shutil
+
+import unittest
+
+from enrichment_service import journal
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+
+    def test_read_journal_missing_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self.assertEqual({}, journal.read_journal(os.path.join(temp_dir,
+                                                                   'journal')))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_record_and_read_after_incomplete_write(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'journal')
+            thejournal = journal.ResultJournal(path)
+            self.assertEqual(path, thejournal.get_path())
+            thejournal.record('a', {'CD_CommunityName': 'x', 'p': 0.1})
+            thejournal.record_results([('b', None), ('c', {'n': 1})])
+            thejournal.record_results([])
+
+            # crash in the middle of a write
+            with open(path, 'a') as f:
+                f.write('{"key": "d", "res')
+            self.assertEqual({'a': {'CD_CommunityName': 'x', 'p': 0.1},
+                              'b': None, 'c': {'n': 1}},
+                             journal.read_journal(path))
+
+            # entries of resumed run start on a line of their own
+            thejournal = journal.ResultJournal(path)
+            thejournal.record('d', {'n': 2})
+            thejournal.record('c', {'n': 3})
+            self.assertEqual({'a': {'CD_CommunityName': 'x', 'p': 0.1},
+                              'b': None, 'c': {'n': 3}, 'd': {'n': 2}},
+                             journal.read_journal(path))
+        finally:
+            shutil.rmtree(temp_dir)
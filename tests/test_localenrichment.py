@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `localenrichment` module."""
+
+import os
+import tempfile
+import shutil
+
+import unittest
+
+import numpy
+from scipy.stats import hypergeom
+
+from enrichment_service import genesetlibrary
+from enrichment_service import localenrichment
+from enrichment_service import enrichment_servicecmd
+
+
+def get_library():
+    genes = ['g' + str(x) for x in range(100)]
+    # term 0: g0-g9, term 1: g0-g4, term 2: g50-g99, term 3: g0-g9
+    term_genes = [range(0, 10), range(0, 5), range(50, 100), range(0, 10)]
+    indptr = [0]
+    indices = []
+    for a_term in term_genes:
+        indices.extend(a_term)
+        indptr.append(len(indices))
+    return genesetlibrary.GeneSetLibrary(genes,
+                                         ['GO:BP', 'GO:BP', 'GO:CC', 'HP'],
+                                         ['GO:0', 'GO:1', 'GO:2', 'HP:3'],
+                                         ['zero', 'one', 'two', 'three'],
+                                         numpy.array(indptr),
+                                         numpy.array(indices))
+
+
+class TestLocalEnrichment(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def test_get_overlap_matrix(self):
+        lib = get_library()
+        overlap, query_sizes = localenrichment.get_overlap_matrix([['g0', 'g1', 'g1', 'x'],
+                                                                   ['g60']],
+                                                                  lib)
+        self.assertEqual([2, 1], query_sizes.tolist())
+        self.assertEqual([[2, 2, 0, 2], [0, 0, 1, 0]],
+                         overlap.toarray().tolist())
+
+        mask = numpy.array([True, False, True, False])
+        overlap, query_sizes = localenrichment.get_overlap_matrix([['g0', 'g1']],
+                                                                  lib,
+                                                                  term_mask=mask)
+        self.assertEqual([[2, 0, 0, 0]], overlap.toarray().tolist())
+
+        # only candidates are counted, pair of gene list 1 and
+        # term 1 has no genes in common
+        overlap, query_sizes = localenrichment.get_overlap_matrix([['g0', 'g1'],
+                                                                   ['g60']],
+                                                                  lib,
+                                                                  term_mask=mask,
+                                                                  candidates=numpy.array([0, 1, 2, 5]))
+        self.assertEqual([2, 1], query_sizes.tolist())
+        self.assertEqual([[2, 0, 0, 0], [0, 0, 0, 0]],
+                         overlap.toarray().tolist())
+        overlap, query_sizes = localenrichment.get_overlap_matrix([['g0', 'g1']],
+                                                                  lib,
+                                                                  candidates=numpy.array([], dtype=numpy.int64))
+        self.assertEqual(0, overlap.nnz)
+
+    def test_run_local_enrichment(self):
+        lib = get_library()
+        genes = ['g' + str(x) for x in range(6)] + ['unknown']
+        res = localenrichment.run_local_enrichment([genes, ['g60'], []],
+                                                   lib, 1.0, 0.05,
+                                                   'HP')
+        # term 0 has Jaccard 6/10, term 1 has 5/6
+        self.assertEqual('one', res[0]['CD_CommunityName'])
+        self.assertEqual('GO:1', res[0]['CD_AnnotatedMembers_SourceTerm'])
+        self.assertEqual('GO:BP', res[0]['CD_AnnotatedMembers_SourceDB'])
+        self.assertEqual('g0 g1 g2 g3 g4', res[0]['CD_AnnotatedMembers'])
+        self.assertEqual(5, res[0]['CD_AnnotatedMembers_Size'])
+        self.assertAlmostEqual(5 / 7, res[0]['CD_AnnotatedMembers_Overlap'])
+        self.assertEqual(['g5', 'unknown'],
+                         sorted(res[0]['CD_NonAnnotatedMembers'].split(' ')))
+        self.assertEqual('Local', res[0]['CD_AnnotatedAlgorithm'])
+        # p value adjusted by the 2 GO:BP terms
+        expected = min(1.0, 2 * hypergeom.sf(4, 100, 5, 6))
+        self.assertAlmostEqual(expected,
+                               res[0]['CD_AnnotatedMembers_Pvalue'])
+        # Jaccard 1/50 is below minoverlap
+        self.assertIsNone(res[1])
+        self.assertIsNone(res[2])
+
+        # maxpval filters out both GO:BP terms
+        res = localenrichment.run_local_enrichment([genes], lib,
+                                                   expected / 10, 0.05,
+                                                   'HP')
+        self.assertIsNone(res[0])
+
+        # minoverlap filters out term 1
+        res = localenrichment.run_local_enrichment([genes], lib,
+                                                   1.0, 0.9, 'HP')
+        self.assertIsNone(res[0])
+        res = localenrichment.run_local_enrichment([genes], lib,
+                                                   1.0, 0.5, 'HP,GO:BP')
+        self.assertIsNone(res[0])
+
+        # with nothing excluded equally good HP term 3 loses tie
+        # on p value since GO:BP has 2 terms to correct for
+        res = localenrichment.run_local_enrichment([['g' + str(x)
+                                                     for x in range(10)]],
+                                                   lib, 1.0, 0.05, None)
+        self.assertEqual('three', res[0]['CD_CommunityName'])
+
+    def test_run_enrichment_local_mode(self):
+        gmtfile = os.path.join(self._temp_dir, 'GO_BP.gmt')
+        with open(gmtfile, 'w') as f:
+            for x in range(20):
+                f.write('GO:' + str(x) + '\tterm ' + str(x) + '\t' +
+                        '\t'.join(['g' + str(y)
+                                   for y in range(x * 10, x * 10 + 10)]) +
+                        '\n')
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--gmt',
+                                                          gmtfile,
+                                                          '--maxpval',
+                                                          '0.01'])
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'5': {'genes': 'g10 g11 g12 g13 g14 g15'},
+                               '3': {'genes': 'g1'},
+                               '4': {'genes': ''}}}
+        res = enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                   'local')
+        rows = res[0]['data']['rows']
+        self.assertEqual(['5'], list(rows.keys()))
+        self.assertEqual('term 1', rows['5']['CD_CommunityName'])
+        self.assertEqual('GO_BP', rows['5']['CD_AnnotatedMembers_SourceDB'])
+
+        # bands of one row at default --minoverlap score every term
+        theargs.lsh_permutations = 64
+        self.assertIsNone(enrichment_servicecmd.get_minhash_index(theargs,
+                                                                  None))
+        theargs.minoverlap = 0.5
+        self.assertEqual(res, enrichment_servicecmd.run_enrichment(node_table,
+                                                                   theargs,
+                                                                   'local'))
+        library = enrichment_servicecmd.get_local_library(theargs.gmt)
+        index = enrichment_servicecmd.get_minhash_index(theargs, library)
+        self.assertGreater(index.get_rows(), 1)
+        self.assertIs(index, enrichment_servicecmd.get_minhash_index(theargs,
+                                                                     library))
+
+        theargs.gmt = None
+        self.assertIsNone(enrichment_servicecmd.run_enrichment(node_table,
+                                                               theargs,
+                                                               'local'))
+
+    def test_get_row_fingerprint_local_mode_follows_gmt_file(self):
+        gmtfile = os.path.join(self._temp_dir, 'GO_BP.gmt')
+        with open(gmtfile, 'w') as f:
+            f.write('GO:0\tterm 0\tg0\tg1\n')
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--gmt',
+                                                          'GO=' + gmtfile])
+        fingerprint = enrichment_servicecmd.get_row_fingerprint(['g0'], theargs,
+                                                                'local')
+        self.assertEqual(fingerprint,
+                         enrichment_servicecmd.get_row_fingerprint(['g0'], theargs,
+                                                                   'local'))
+
+        # same size, only modification time changed
+        os.utime(gmtfile, ns=(0, 10 ** 9))
+        touched = enrichment_servicecmd.get_row_fingerprint(['g0'], theargs,
+                                                            'local')
+        self.assertNotEqual(fingerprint, touched)
+
+        with open(gmtfile, 'w') as f:
+            f.write('GO:0\tterm 0\tg0\tg1\tg2\n')
+        os.utime(gmtfile, ns=(0, 10 ** 9))
+        self.assertNotEqual(touched,
+                            enrichment_servicecmd.get_row_fingerprint(['g0'], theargs,
+                                                                      'local'))
+        self.assertEqual([['GO=' + gmtfile, 10 ** 9, 21]],
+                         enrichment_servicecmd.get_gmt_file_stats(theargs.gmt))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `metrics` module."""
+
+import os
+import json
+import shutil
+import tempfile
+
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pandas
+
+from enrichment_service import metrics
+from enrichment_service import enrichment_servicecmd
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        metrics.set_metrics(None)
+
+    def test_get_summary(self):
+        self.assertEqual({'count': 0, 'sum': 0}, metrics.get_summary([]))
+        summary = metrics.get_summary([float(x) for x in range(100, 0, -1)])
+        self.assertEqual(100, summary['count'])
+        self.assertEqual(5050.0, summary['sum'])
+        self.assertEqual(50.5, summary['mean'])
+        self.assertEqual(100.0, summary['max'])
+        self.assertEqual(51.0, summary['p50'])
+        self.assertEqual(99.0, summary['p99'])
+
+    def test_reservoir_is_bounded(self):
+        reservoir = metrics.Reservoir(size=100, seed=1)
+        for x in range(10):
+            reservoir.add(float(x))
+        self.assertEqual(metrics.get_summary([float(x) for x in range(10)]),
+                         reservoir.get_summary())
+
+        for x in range(10, 10000):
+            reservoir.add(float(x))
+        self.assertEqual(100, len(reservoir.get_values()))
+        summary = reservoir.get_summary()
+        self.assertEqual(10000, summary['count'])
+        self.assertEqual(49995000.0, summary['sum'])
+        self.assertEqual(4999.5, summary['mean'])
+        self.assertEqual(9999.0, summary['max'])
+        self.assertTrue(3000 < summary['p50'] < 7000)
+
+        run_metrics = metrics.RunMetrics()
+        for x in range(metrics.RESERVOIR_SIZE * 2):
+            run_metrics.observe('foo', 1.0)
+        self.assertEqual(metrics.RESERVOIR_SIZE,
+                         len(run_metrics.get_observations('foo')))
+        self.assertEqual(metrics.RESERVOIR_SIZE * 2,
+                         run_metrics.get_observation_summary('foo')['count'])
+
+    def test_thread_metrics(self):
+        process_metrics = metrics.RunMetrics()
+        metrics.set_metrics(process_metrics)
+        run_metrics = metrics.RunMetrics()
+        metrics.set_thread_metrics(run_metrics)
+        try:
+            executor = enrichment_servicecmd.create_thread_pool(2)
+            try:
+                self.assertEqual([run_metrics] * 4,
+                                 list(executor.map(lambda x: metrics.get_metrics(),
+                                                   range(4))))
+            finally:
+                executor.shutdown()
+        finally:
+            metrics.set_thread_metrics(None)
+        self.assertTrue(metrics.get_metrics() is process_metrics)
+
+    def test_counters_and_observations(self):
+        run_metrics = metrics.RunMetrics()
+        run_metrics.increment('foo')
+        run_metrics.increment('foo', value=2)
+        run_metrics.increment('foo', labels={'a': '1', 'b': '2'})
+        run_metrics.increment('foo', labels={'b': '2', 'a': '1'})
+        self.assertEqual(3, run_metrics.get_counter('foo'))
+        self.assertEqual(2, run_metrics.get_counter('foo',
+                                                    labels={'a': '1',
+                                                            'b': '2'}))
+        self.assertEqual(0, run_metrics.get_counter('bar'))
+
+        with run_metrics.time('bar'):
+            pass
+        try:
+            with run_metrics.time('bar'):
+                raise ValueError('error')
+        except ValueError:
+            pass
+        self.assertEqual(2, len(run_metrics.get_observations('bar')))
+
+    def test_time_request(self):
+        run_metrics = metrics.RunMetrics()
+        with run_metrics.time_request('op') as request:
+            request['status'] = 200
+        try:
+            with run_metrics.time_request('op'):
+                raise ValueError('error')
+        except ValueError:
+            pass
+        report = run_metrics.get_report()
+        self.assertEqual(2, report['http']['op']['requests'])
+        self.assertEqual({'200': 1, 'error': 1},
+                         report['http']['op']['status'])
+        self.assertEqual(2, report['http']['op']['seconds']['count'])
+
+    def test_get_report(self):
+        run_metrics = metrics.RunMetrics()
+        run_metrics.observe(metrics.ROW_SECONDS, 1.0)
+        run_metrics.observe(metrics.POLLS_PER_TASK, 3)
+        with run_metrics.time_phase('read_input'):
+            pass
+        run_metrics.increment(metrics.CACHE_HITS, value=2)
+        run_metrics.skip('too_many_genes')
+        run_metrics.skip('too_many_genes')
+        report = run_metrics.get_report(stats={'rows': 5})
+        self.assertEqual({'rows': 5}, report['stats'])
+        self.assertEqual(1, report['rows']['count'])
+        self.assertEqual(3, report['iquery_polls_per_task']['max'])
+        self.assertEqual(1, report['phases']['read_input']['count'])
+        self.assertEqual({'hits': 2, 'misses': 0}, report['cache'])
+        self.assertEqual({'too_many_genes': 2}, report['skipped'])
+        json.dumps(report)
+
+    def test_get_prometheus_text(self):
+        run_metrics = metrics.RunMetrics()
+        run_metrics.record_http('gprofiler_profile', 200, 0.5)
+        run_metrics.skip('a"b')
+        text = run_metrics.get_prometheus_text()
+        lines = text.splitlines()
+        self.assertTrue('# TYPE enrichment_service_http_requests_total '
+                        'counter' in lines)
+        self.assertTrue('enrichment_service_http_requests_total'
+                        '{operation="gprofiler_profile",status="200"} 1'
+                        in lines)
+        self.assertTrue('enrichment_service_skipped_total'
+                        '{reason="a\\"b"} 1' in lines)
+        self.assertTrue('enrichment_service_http_request_seconds'
+                        '{operation="gprofiler_profile",quantile="0.5"} 0.5'
+                        in lines)
+        self.assertTrue('enrichment_service_http_request_seconds_count'
+                        '{operation="gprofiler_profile"} 1' in lines)
+
+    def test_get_and_set_metrics(self):
+        metrics.set_metrics(None)
+        run_metrics = metrics.get_metrics()
+        self.assertTrue(run_metrics is metrics.get_metrics())
+        other = metrics.RunMetrics()
+        metrics.set_metrics(other)
+        self.assertTrue(other is metrics.get_metrics())
+
+    def test_main_writes_metrics(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            inputfile = os.path.join(temp_dir, 'input.json')
+            with open(inputfile, 'w') as f:
+                json.dump({'columns': [{'id': 'genes'}],
+                           'rows': {'1': {'genes': 'a b'},
+                                    '2': {'genes': ''},
+                                    '3': {'genes': 'c'}}}, f)
+            gprof = MagicMock()
+            gprof.profile.return_value = pandas.DataFrame([
+                {'source': 'GO:BP', 'native': 'GO:1', 'name': 'term1',
+                 'p_value': 0.001, 'precision': 1.0, 'recall': 0.5,
+                 'intersections': ['a', 'b']}])
+            metrics_out = os.path.join(temp_dir, 'metrics.json')
+            prom_out = os.path.join(temp_dir, 'metrics.prom')
+            with patch.object(enrichment_servicecmd, 'get_gprofiler',
+                              return_value=gprof), \
+                    patch('sys.stdout'):
+                self.assertEqual(0, enrichment_servicecmd.main(['prog', inputfile,
+                                                                '--metrics-out',
+                                                                metrics_out,
+                                                                '--metrics-prometheus',
+                                                                prom_out]))
+            with open(metrics_out, 'r') as f:
+                report = json.load(f)
+            self.assertEqual(3, report['stats']['rows'])
+            self.assertEqual(3, report['rows']['count'])
+            self.assertEqual(2, report['http']['gprofiler_profile']['requests'])
+            self.assertEqual({'empty_genelist': 1}, report['skipped'])
+            self.assertTrue('read_input' in report['phases'])
+            self.assertTrue('write_output' in report['phases'])
+            self.assertTrue('gprofiler_postprocess' in report['phases'])
+            with open(prom_out, 'r') as f:
+                self.assertTrue('enrichment_service_row_seconds_count 3'
+                                in f.read().splitlines())
+        finally:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `minhash` module."""
+
+import unittest
+
+import numpy
+
+from enrichment_service import genesetlibrary
+from enrichment_service import localenrichment
+from enrichment_service import minhash
+
+
+def get_library(term_genes):
+    genes = ['g' + str(x) for x in range(200)]
+    indptr = [0]
+    indices = []
+    for a_term in term_genes:
+        indices.extend(a_term)
+        indptr.append(len(indices))
+    names = ['t' + str(x) for x in range(len(term_genes))]
+    return genesetlibrary.GeneSetLibrary(genes, ['GO:BP'] * len(term_genes),
+                                         names, names,
+                                         numpy.array(indptr),
+                                         numpy.array(indices))
+
+
+class TestMinHash(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+
+    def test_get_bands_and_rows(self):
+        self.assertEqual((128, 1), minhash.get_bands_and_rows(128, 0.05, 0.95))
+        bands, rows = minhash.get_bands_and_rows(128, 0.5, 0.95)
+        self.assertEqual(128 // rows, bands)
+        self.assertGreaterEqual(minhash.get_candidate_probability(0.5, bands,
+                                                                  rows), 0.95)
+        self.assertLess(minhash.get_candidate_probability(0.5, 128 // (rows + 1),
+                                                          rows + 1), 0.95)
+
+        # lower recall allows longer bands that find fewer terms
+        self.assertGreater(minhash.get_bands_and_rows(128, 0.5, 0.5)[1], rows)
+
+    def test_constructor_checks_bands_fit(self):
+        library = get_library([range(0, 10)])
+        with self.assertRaises(ValueError):
+            minhash.MinHashIndex(library, num_perm=16, bands=5, rows=4)
+        index = minhash.MinHashIndex(library, num_perm=16, rows=4)
+        self.assertEqual(4, index.get_bands())
+        self.assertEqual(4, index.get_rows())
+
+    def test_get_signatures(self):
+        library = get_library([range(0, 10), [], range(5, 8)])
+        index = minhash.MinHashIndex(library, num_perm=8)
+        signatures = index.get_signatures(library.term_indptr,
+                                          library.term_indices)
+        self.assertEqual((3, 8), signatures.shape)
+        self.assertTrue(numpy.all(signatures[1] == minhash.EMPTY_SIGNATURE))
+        for term in [0, 2]:
+            start = library.term_indptr[term]
+            end = library.term_indptr[term + 1]
+            genes = library.term_indices[start:end] + 1
+            for perm in range(8):
+                self.assertEqual(min((index._a[perm] * gene + index._b[perm]) %
+                                     minhash.PRIME for gene in genes),
+                                 signatures[term][perm])
+
+    def test_get_candidates(self):
+        # term 0 matches first gene list, term 2 shares a single gene
+        # with it and term 1 nothing
+        library = get_library([range(0, 40), range(100, 140),
+                               list(range(39, 79)), range(0, 40)])
+        index = minhash.MinHashIndex(library, num_perm=64, bands=16, rows=4)
+        gene_lists = [['g' + str(x) for x in range(0, 40)],
+                      ['unknown'],
+                      ['g' + str(x) for x in range(100, 139)]]
+        candidates = index.get_candidates(gene_lists)
+        self.assertEqual([0, 3, 2 * 4 + 1], candidates.tolist())
+
+    def test_run_local_enrichment_with_index(self):
+        rand = numpy.random.RandomState(3)
+        term_genes = [rand.choice(200, size=rand.randint(5, 40),
+                                  replace=False).tolist()
+                      for x in range(100)]
+        library = get_library(term_genes)
+        gene_lists = []
+        for term in range(0, 100, 5):
+            genes = ['g' + str(x) for x in term_genes[term]
+                     if rand.random_sample() < 0.8]
+            gene_lists.append(genes + ['g' + str(rand.randint(200))])
+
+        index = minhash.MinHashIndex(library, num_perm=128, bands=32, rows=4)
+        expected = localenrichment.run_local_enrichment(gene_lists, library,
+                                                        0.05, 0.5, None)
+        self.assertEqual(20, len([res for res in expected if res is not None]))
+        self.assertEqual(expected,
+                         localenrichment.run_local_enrichment(gene_lists, library,
+                                                              0.05, 0.5, None,
+                                                              index=index))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `polling` module."""
+
+import itertools
+
+import unittest
+from unittest.mock import MagicMock, patch
+
+import requests_mock
+
+from enrichment_service import polling
+from enrichment_service import enrichment_servicecmd
+
+
+class TestPolling(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+
+    def test_get_delays_backs_off_to_max(self):
+        schedule = polling.PollSchedule(initial_interval=0.5,
+                                        max_interval=3.0, jitter=0.0)
+        self.assertEqual([0.5, 0.5, 1.0, 2.0, 3.0, 3.0],
+                         list(itertools.islice(schedule.get_delays(), 6)))
+
+    def test_get_delays_with_jitter(self):
+        schedule = polling.PollSchedule(initial_interval=1.0,
+                                        max_interval=1.0, jitter=0.2)
+        for delay in itertools.islice(schedule.get_delays(), 50):
+            self.assertTrue(0.8 <= delay <= 1.2)
+
+    def test_first_delay_tuned_from_completion_times(self):
+        schedule = polling.PollSchedule(initial_interval=0.25,
+                                        max_interval=5.0,
+                                        first_poll_percentile=10)
+        self.assertIsNone(schedule.get_completion_time_percentile(50))
+        self.assertEqual(0.25, schedule.get_first_delay())
+        for seconds in range(1, 12):
+            schedule.record_completion(float(seconds))
+        self.assertEqual(2.0, schedule.get_first_delay())
+        self.assertEqual(6.0, schedule.get_completion_time_percentile(50))
+        schedule.record_completion(0.01)
+        self.assertEqual(1.0, schedule.get_first_delay())
+
+        schedule = polling.PollSchedule(initial_interval=0.25,
+                                        max_interval=5.0)
+        schedule.record_completion(100.0)
+        self.assertEqual(5.0, schedule.get_first_delay())
+
+    def test_get_retry_after(self):
+        response = MagicMock()
+        response.headers = {}
+        self.assertIsNone(polling.get_retry_after(response))
+        response.headers = {'Retry-After': '3'}
+        self.assertEqual(3.0, polling.get_retry_after(response))
+        response.headers = {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+        self.assertIsNone(polling.get_retry_after(response))
+
+    def test_wait_for_result_honors_retry_after(self):
+        schedule = polling.PollSchedule(initial_interval=0.1,
+                                        max_interval=1.0, jitter=0.0)
+        with requests_mock.Mocker() as m:
+            m.get('http://foo/integratedsearch/v1/1/status',
+                  [{'json': {'progress': 10}, 'headers': {'Retry-After': '4'}},
+                   {'json': {'progress': 50}},
+                   {'json': {'progress': 100, 'status': 'complete'}}])
+            with patch('time.sleep') as mock_sleep:
+                self.assertTrue(enrichment_servicecmd.wait_for_result('http://foo',
+                                                                      '1', 'ua',
+                                                                      deadline=60,
+                                                                      schedule=schedule))
+        self.assertEqual([0.1, 4.0, 0.2],
+                         [c[0][0] for c in mock_sleep.call_args_list])
+        self.assertIsNotNone(schedule.get_completion_time_percentile(50))
+
+    def test_wait_for_result_deadline(self):
+        schedule = polling.PollSchedule(initial_interval=0.01,
+                                        max_interval=0.01, jitter=0.0)
+        with requests_mock.Mocker() as m:
+            m.get('http://foo/integratedsearch/v1/1/status',
+                  json={'progress': 10})
+            self.assertFalse(enrichment_servicecmd.wait_for_result('http://foo',
+                                                                   '1', 'ua',
+                                                                   deadline=0.1,
+                                                                   schedule=schedule))
+            self.assertTrue(m.call_count < 12)
+        self.assertIsNone(schedule.get_completion_time_percentile(50))
+
+    def test_task_poller(self):
+        clock = MagicMock(return_value=100.0)
+        schedule = polling.PollSchedule(initial_interval=1.0,
+                                        max_interval=4.0, jitter=0.0)
+        poller = polling.TaskPoller(schedule, 10.0, start=99.0, clock=clock)
+        delays = poller.get_delays()
+        self.assertEqual(1.0, next(delays))
+        poller.record_status(None, retry_after=3.0)
+        self.assertEqual(3.0, next(delays))
+        clock.return_value = 107.0
+        poller.record_status(None)
+        # cut short by deadline
+        self.assertEqual(2.0, next(delays))
+        clock.return_value = 108.0
+        poller.record_status(True)
+        self.assertEqual([], list(delays))
+        self.assertEqual(3, poller.get_polls())
+        self.assertIsNone(poller.get_failure_reason())
+        self.assertEqual(9.0, schedule.get_completion_time_percentile(50))
+
+        poller = polling.TaskPoller(schedule, 10.0, start=98.0, clock=clock)
+        self.assertEqual([], list(poller.get_delays()))
+        self.assertEqual('task_timeout', poller.get_failure_reason())
+        poller.record_status(False)
+        self.assertEqual('task_failed', poller.get_failure_reason())
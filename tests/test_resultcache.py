@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `resultcache` module."""
+
+import os
+import tempfile
+import shutil
+import threading
+
+import unittest
+from unittest.mock import patch
+
+from enrichment_service import resultcache
+from enrichment_service import enrichment_servicecmd
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def test_get_cache_key(self):
+        key = resultcache.get_cache_key(['b', ' a', 'b'], {'x': 1})
+        self.assertEqual(key, resultcache.get_cache_key(['a', 'b'],
+                                                        {'x': 1}))
+        self.assertNotEqual(key, resultcache.get_cache_key(['a', 'b'],
+                                                           {'x': 2}))
+        self.assertNotEqual(key, resultcache.get_cache_key(['a', 'c'],
+                                                           {'x': 1}))
+
+    def test_put_and_get(self):
+        thecache = resultcache.ResultCache(os.path.join(self._temp_dir,
+                                                        'cache'))
+        self.assertTrue(os.path.isfile(thecache.get_path()))
+        self.assertEqual((False, None), thecache.get('foo'))
+        thecache.put('foo', {'CD_CommunityName': 'x'})
+        thecache.put('none', None)
+        self.assertEqual((True, {'CD_CommunityName': 'x'}),
+                         thecache.get('foo'))
+        self.assertEqual((True, None), thecache.get('none'))
+
+        # other threads and cache objects see the same results
+        found = []
+        thread = threading.Thread(target=lambda: found.append(thecache.get('foo')))
+        thread.start()
+        thread.join()
+        self.assertEqual([(True, {'CD_CommunityName': 'x'})], found)
+        othercache = resultcache.ResultCache(os.path.join(self._temp_dir,
+                                                          'cache'))
+        self.assertEqual((True, None), othercache.get('none'))
+
+    def test_ttl(self):
+        thecache = resultcache.ResultCache(self._temp_dir, ttl=100,
+                                           negative_ttl=10)
+        with patch('time.time', return_value=1000.0):
+            thecache.put('foo', {'a': 1})
+            thecache.put('none', None)
+        with patch('time.time', return_value=1050.0):
+            self.assertEqual((True, {'a': 1}), thecache.get('foo'))
+            self.assertEqual((False, None), thecache.get('none'))
+        with patch('time.time', return_value=1101.0):
+            self.assertEqual((False, None), thecache.get('foo'))
+
+    def test_evict_removes_least_recently_used(self):
+        thecache = resultcache.ResultCache(self._temp_dir, ttl=1e12,
+                                           maxsize=100)
+        for x in range(4):
+            with patch('time.time', return_value=1000.0 + x):
+                thecache.put('key' + str(x), {'a': 'x' * 20})
+        with patch('time.time', return_value=2000.0):
+            thecache.get('key0')
+            thecache.evict()
+        self.assertTrue(thecache.get('key0')[0])
+        self.assertFalse(thecache.get('key1')[0])
+        self.assertTrue(thecache.get('key3')[0])
+
+    def test_run_enrichment_uses_cache(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo',
+                                                          '--cache-dir',
+                                                          self._temp_dir])
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a,b'}, '2': {'genes': 'c'}}}
+
+        def fake_gprofiler(genes, *args, **kwargs):
+            if genes == ['c']:
+                return None
+            return {'CD_CommunityName': 'x'}
+
+        with patch.object(enrichment_servicecmd, 'run_gprofiler',
+                          side_effect=fake_gprofiler) as mock_gprof:
+            first = enrichment_servicecmd.run_enrichment(node_table,
+                                                         theargs,
+                                                         'gprofiler')
+            self.assertEqual(2, mock_gprof.call_count)
+            node_table['rows']['1'] = {'genes': 'b a'}
+            second = enrichment_servicecmd.run_enrichment(node_table,
+                                                          theargs,
+                                                          'gprofiler')
+            self.assertEqual(2, mock_gprof.call_count)
+            theargs.no_cache = True
+            enrichment_servicecmd.run_enrichment(node_table, theargs,
+                                                 'gprofiler')
+            self.assertEqual(4, mock_gprof.call_count)
+        self.assertEqual(first, second)
+        self.assertEqual({'1': {'CD_CommunityName': 'x'}},
+                         second[0]['data']['rows'])
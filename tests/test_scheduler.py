@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `scheduler` module."""
+
+import time
+import unittest
+from unittest.mock import MagicMock
+
+import requests
+
+from enrichment_service import metrics
+from enrichment_service import scheduler
+from enrichment_service import enrichment_servicecmd
+
+
+def get_response(status_code, headers=None):
+    res = MagicMock(status_code=status_code, text='')
+    res.headers = headers if headers is not None else {}
+    return res
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        metrics.set_metrics(metrics.RunMetrics())
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        metrics.set_metrics(None)
+
+    def test_classify_response(self):
+        self.assertEqual((scheduler.SUCCESS, None),
+                         scheduler.classify_response(get_response(202), None))
+        self.assertEqual((scheduler.SUCCESS, None),
+                         scheduler.classify_response(get_response(404), None))
+        self.assertEqual((scheduler.ERROR, None),
+                         scheduler.classify_response(get_response(502), None))
+        self.assertEqual((scheduler.THROTTLED, 2.0),
+                         scheduler.classify_response(get_response(429,
+                                                                  {'Retry-After': '2'}),
+                                                     None))
+        self.assertEqual((scheduler.ERROR, None),
+                         scheduler.classify_response(None,
+                                                     requests.exceptions.ConnectTimeout()))
+        self.assertEqual((scheduler.FAILED, None),
+                         scheduler.classify_response(None, ValueError()))
+
+    def test_token_bucket(self):
+        bucket = scheduler.TokenBucket(rate=50, burst=2)
+        self.assertEqual(0, bucket.acquire())
+        self.assertEqual(0, bucket.acquire())
+        self.assertTrue(bucket.acquire() > 0)
+
+        unlimited = scheduler.TokenBucket()
+        for x in range(100):
+            self.assertEqual(0, unlimited.acquire())
+        unlimited.pause(0.05)
+        start = time.monotonic()
+        unlimited.acquire()
+        self.assertTrue(time.monotonic() - start >= 0.04)
+
+    def test_adaptive_concurrency_limit(self):
+        limit = scheduler.AdaptiveConcurrencyLimit(8, initial_limit=4)
+        self.assertEqual(4, limit.get_limit())
+        # about one more per round of successful requests
+        for x in range(6):
+            limit.acquire()
+            limit.release(scheduler.SUCCESS, 0.01)
+        self.assertEqual(5, limit.get_limit())
+
+        # errors from the same round only lower the limit once
+        limit.release(scheduler.THROTTLED, 0.01)
+        self.assertEqual(2, limit.get_limit())
+        limit.release(scheduler.ERROR, 0.01)
+        self.assertEqual(2, limit.get_limit())
+        time.sleep(0.02)
+        limit.release(scheduler.ERROR, 0.01)
+        self.assertEqual(1, limit.get_limit())
+        time.sleep(0.02)
+        limit.release(scheduler.ERROR, 0.01)
+        self.assertEqual(1, limit.get_limit())
+
+        # client errors do not change the limit
+        limit.release(scheduler.FAILED, 0.01)
+        self.assertEqual(1, limit.get_limit())
+
+    def test_adaptive_concurrency_limit_latency(self):
+        limit = scheduler.AdaptiveConcurrencyLimit(8, latency_tolerance=2.0,
+                                                   smoothing=1.0)
+        limit.release(scheduler.SUCCESS, 0.001)
+        self.assertEqual(8, limit.get_limit())
+        limit.release(scheduler.SUCCESS, 0.01)
+        self.assertEqual(4, limit.get_limit())
+
+    def test_call_retries_throttled_request(self):
+        thescheduler = scheduler.BackendScheduler('foo', 4, retries=3,
+                                                  backoff=0)
+        responses = [get_response(429, {'Retry-After': '0'}),
+                     get_response(503),
+                     get_response(200)]
+        func = MagicMock(side_effect=responses)
+        self.assertIs(responses[2], thescheduler.call(func))
+        self.assertEqual(3, func.call_count)
+        self.assertEqual(2, metrics.get_metrics().get_counter(metrics.RETRIES,
+                                                              labels={'backend': 'foo',
+                                                                      'outcome': 'throttled'}))
+
+    def test_call_gives_up_after_retries(self):
+        thescheduler = scheduler.BackendScheduler('foo', 4, retries=2,
+                                                  backoff=0)
+        func = MagicMock(return_value=get_response(502))
+        self.assertEqual(502, thescheduler.call(func).status_code)
+        self.assertEqual(3, func.call_count)
+
+        func = MagicMock(side_effect=requests.exceptions.ConnectionError('down'))
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            thescheduler.call(func)
+        self.assertEqual(3, func.call_count)
+
+    def test_call_does_not_retry_failed_or_non_idempotent_errors(self):
+        thescheduler = scheduler.BackendScheduler('foo', 4, retries=2,
+                                                  backoff=0)
+        func = MagicMock(side_effect=ValueError('bad'))
+        with self.assertRaises(ValueError):
+            thescheduler.call(func)
+        self.assertEqual(1, func.call_count)
+
+        func = MagicMock(return_value=get_response(500))
+        thescheduler.call(func, retry_on=scheduler.RETRY_NON_IDEMPOTENT)
+        self.assertEqual(1, func.call_count)
+
+    def test_call_without_scheduler(self):
+        func = MagicMock(return_value=get_response(503))
+        self.assertEqual(503, scheduler.call(None, func).status_code)
+        self.assertEqual(1, func.call_count)
+
+    def test_get_backoff(self):
+        thescheduler = scheduler.BackendScheduler('foo', 4, backoff=1.0,
+                                                  max_backoff=3.0)
+        for x in range(20):
+            self.assertTrue(0 <= thescheduler.get_backoff(0) <= 1.0)
+            self.assertTrue(0 <= thescheduler.get_backoff(5) <= 3.0)
+        self.assertEqual(10.0, thescheduler.get_backoff(0, retry_after=10.0))
+
+    def test_submit_iquery_task_retried_when_throttled(self):
+        session = MagicMock()
+        accepted = get_response(202)
+        accepted.json.return_value = {'id': 'task1'}
+        session.post.side_effect = [get_response(429), accepted]
+        thescheduler = scheduler.BackendScheduler('iquery', 4, backoff=0)
+        self.assertEqual('task1',
+                         enrichment_servicecmd.submit_iquery_task('http://foo',
+                                                                  ['a'], 'agent',
+                                                                  session=session,
+                                                                  thescheduler=thescheduler))
+        self.assertEqual(2, session.post.call_count)
+
+        # may have created a task so not retried
+        session.post.side_effect = [get_response(500), accepted]
+        session.post.reset_mock()
+        self.assertIsNone(enrichment_servicecmd.submit_iquery_task('http://foo',
+                                                                   ['a'], 'agent',
+                                                                   session=session,
+                                                                   thescheduler=thescheduler))
+        self.assertEqual(1, session.post.call_count)
+
+    def test_run_gprofiler_retries_throttled_request(self):
+        self.assertEqual((scheduler.ERROR, None),
+                         enrichment_servicecmd.classify_gprofiler_call(None,
+                                                                       AssertionError('Injected error')))
+        self.assertEqual((scheduler.FAILED, None),
+                         enrichment_servicecmd.classify_gprofiler_call(None,
+                                                                       AssertionError('query failed '
+                                                                                      'with error 400')))
+        gprof = MagicMock()
+        gprof.profile.side_effect = [AssertionError('query failed with error 429'),
+                                     None]
+        thescheduler = scheduler.BackendScheduler('gprofiler', 4, backoff=0)
+        self.assertIsNone(enrichment_servicecmd.run_gprofiler(['a'], 500,
+                                                              'hsapiens', 0.001,
+                                                              False, 0.05, None,
+                                                              3, gprofwrapper=gprof,
+                                                              thescheduler=thescheduler))
+        self.assertEqual(2, gprof.profile.call_count)
+        report = metrics.get_metrics().get_report()
+        self.assertEqual({'gprofiler': {'throttled': 1}}, report['retries'])
+        self.assertEqual(2, report['http']['gprofiler_profile']['requests'])
+
+    def test_get_scheduler(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         ['foo', '--rate_limit',
+                                                          '5'])
+        thescheduler = enrichment_servicecmd.get_scheduler(theargs, 'iquery')
+        self.assertIs(thescheduler,
+                      enrichment_servicecmd.get_scheduler(theargs, 'iquery'))
+        self.assertIsNot(thescheduler,
+                         enrichment_servicecmd.get_scheduler(theargs,
+                                                             'gprofiler'))
+        self.assertEqual(enrichment_servicecmd.DEFAULT_MAX_INFLIGHT['iquery'],
+                         thescheduler.get_concurrency_limit())
+
+    def test_get_inflight_semaphore(self):
+        semaphore = enrichment_servicecmd._get_inflight_semaphore('foo', 1)
+        self.assertIs(semaphore,
+                      enrichment_servicecmd._get_inflight_semaphore('foo', 1))
+        self.assertIs(enrichment_servicecmd._get_inflight_semaphore('foo'),
+                      enrichment_servicecmd._get_inflight_semaphore('foo', 1))
+
+        # a different --maxinflight gets a semaphore of its own
+        self.assertTrue(semaphore.acquire(blocking=False))
+        try:
+            other = enrichment_servicecmd._get_inflight_semaphore('foo', 2)
+            self.assertIsNot(semaphore, other)
+            self.assertTrue(other.acquire(blocking=False))
+            self.assertTrue(other.acquire(blocking=False))
+            self.assertFalse(other.acquire(blocking=False))
+            other.release()
+            other.release()
+        finally:
+            semaphore.release()
+
+    def test_deadline(self):
+        unlimited = scheduler.Deadline()
+        self.assertIsNone(unlimited.remaining())
+        self.assertFalse(unlimited.expired())
+        self.assertEqual(5, unlimited.cap(5))
+        self.assertIsNone(unlimited.cap(None))
+
+        deadline = scheduler.Deadline(10)
+        self.assertEqual(10, deadline.get_seconds())
+        self.assertTrue(9 < deadline.remaining() <= 10)
+        self.assertEqual(1, deadline.cap(1))
+        self.assertTrue(deadline.cap(None) <= 10)
+
+        expired = scheduler.Deadline(0)
+        self.assertTrue(expired.expired())
+        self.assertEqual(0, expired.remaining())
+
+    def test_call_with_deadline(self):
+        thescheduler = scheduler.BackendScheduler('foo', 4, retries=3,
+                                                  backoff=0)
+        func = MagicMock(return_value=get_response(200))
+        with self.assertRaises(scheduler.DeadlineExceeded):
+            thescheduler.with_deadline(scheduler.Deadline(0)).call(func)
+        func.assert_not_called()
+        self.assertIsNone(thescheduler.get_deadline())
+
+        # no time left to wait for Retry-After
+        func = MagicMock(return_value=get_response(429, {'Retry-After': '60'}))
+        bound = thescheduler.with_deadline(scheduler.Deadline(5))
+        with self.assertRaises(scheduler.DeadlineExceeded):
+            bound.call(func)
+        self.assertEqual(1, func.call_count)
+
+        # Retry-After paused the shared rate limit
+        with self.assertRaises(scheduler.DeadlineExceeded):
+            bound.call(MagicMock())
+
+    def test_token_bucket_acquire_with_deadline(self):
+        bucket = scheduler.TokenBucket(rate=0.1, burst=1)
+        bucket.acquire()
+        with self.assertRaises(scheduler.DeadlineExceeded):
+            bucket.acquire(deadline=scheduler.Deadline(1))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `server` module."""
+
+import threading
+
+import unittest
+from unittest.mock import patch
+
+import requests
+
+import enrichment_service
+from enrichment_service import metrics
+from enrichment_service import server
+from enrichment_service import enrichment_servicecmd
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        metrics.set_metrics(metrics.RunMetrics())
+        self._server = server.create_server('127.0.0.1', 0,
+                                            ['--maxpval', '0.01'])
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+        self._url = 'http://127.0.0.1:' + str(self._server.server_address[1])
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        metrics.set_metrics(None)
+
+    def test_get_enrichment_arguments(self):
+        theargs = server.get_enrichment_arguments(['--maxpval', '0.01'],
+                                                  'mode=iquery&omit_intersections')
+        self.assertEqual('iquery', theargs.mode)
+        self.assertEqual(0.01, theargs.maxpval)
+        self.assertTrue(theargs.omit_intersections)
+        with self.assertRaises(ValueError):
+            server.get_enrichment_arguments([], 'mode=foo')
+        for query in ['journal=/tmp/x', 'cache-dir=/tmp', 'gmt=/etc/passwd',
+                      'previous-output=/tmp/x', 'url=http://bar',
+                      'maxpval=0.1&workers=100']:
+            with self.assertRaises(ValueError):
+                server.get_enrichment_arguments([], query)
+
+    def test_health(self):
+        res = requests.get(self._url + '/health')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual({'status': 'ok',
+                          'version': enrichment_service.__version__},
+                         res.json())
+        self.assertEqual(404, requests.get(self._url + '/foo').status_code)
+
+    def test_enrichment(self):
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a b'}, '2': {'genes': 'c'}}}
+        calls = []
+
+        def fake_gprofiler(genes, maxgenelistsize, organism, maxpval,
+                           *args, **kwargs):
+            calls.append(maxpval)
+            return {'CD_CommunityName': ' '.join(genes)}
+
+        with patch.object(enrichment_servicecmd, 'run_gprofiler',
+                          side_effect=fake_gprofiler):
+            res = requests.post(self._url + '/enrichment', json=node_table)
+            self.assertEqual(200, res.status_code)
+            self.assertEqual({'1': {'CD_CommunityName': 'a b'},
+                              '2': {'CD_CommunityName': 'c'}},
+                             res.json()[0]['data']['rows'])
+            self.assertEqual([0.01, 0.01], calls)
+
+            res = requests.post(self._url + '/?maxpval=0.5', json=node_table)
+            self.assertEqual(200, res.status_code)
+            self.assertEqual([0.01, 0.01, 0.5, 0.5], calls)
+
+        # each request records into metrics of its own
+        self.assertEqual(0, metrics.get_metrics().get_observation_summary(metrics.ROW_SECONDS)['count'])
+
+        res = requests.post(self._url + '/?mode=foo', json=node_table)
+        self.assertEqual(400, res.status_code)
+        res = requests.post(self._url + '/?journal=/tmp/journal',
+                            json=node_table)
+        self.assertEqual(400, res.status_code)
+        self.assertTrue(res.json()['message'].startswith('Parameter journal '))
+        res = requests.post(self._url + '/', data='{bad')
+        self.assertEqual(400, res.status_code)
+        res = requests.post(self._url + '/',
+                            json={'columns': [], 'rows': {}})
+        self.assertEqual(400, res.status_code)
+        self.assertEqual({'message': 'No results'}, res.json())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Guards start up time of `enrichment_servicecmd` which is the
+entry point of the Docker image."""
+
+import os
+import sys
+import time
+import subprocess
+
+import unittest
+
+
+# modules that must only be imported by code paths that need them
+DEFERRED_MODULES = ['pandas', 'numpy', 'scipy', 'gprofiler', 'requests',
+                    'asyncio', 'sqlite3', 'ijson']
+
+# budget for importing enrichment_servicecmd as a multiple of
+# the time python takes to start, so a slow or loaded machine
+# does not fail the test
+IMPORT_BUDGET_FACTOR = 4.0
+
+CMD_MODULE = 'enrichment_service.enrichment_servicecmd'
+
+
+def run_python(code, *options):
+    """
+    Runs **code** in a fresh interpreter from root of repo
+
+    :return: completed process
+    """
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.run([sys.executable] + list(options) + ['-c', code],
+                          cwd=repo_dir, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+
+
+def get_run_time(code, repeat=3):
+    """
+    Runs **code** in a fresh interpreter **repeat** times
+
+    :return: shortest wall clock time in seconds
+    :rtype: float
+    """
+    best = None
+    for x in range(repeat):
+        start = time.monotonic()
+        run_python(code)
+        elapsed = time.monotonic() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def get_import_times():
+    """
+    Imports enrichment_servicecmd with ``python -X importtime``
+
+    :return: top level module name => cumulative import time
+             in seconds
+    :rtype: dict
+    """
+    proc = run_python('import ' + CMD_MODULE, '-X', 'importtime')
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        split_line = line.split('|')
+        try:
+            cumulative = int(split_line[1].strip()) / 1000000.0
+        except ValueError:
+            continue
+        name = split_line[2].strip()
+        times[name] = cumulative
+    return times
+
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+
+    def test_import_defers_heavy_modules(self):
+        imported = [name.split('.')[0] for name in get_import_times().keys()]
+        for module in DEFERRED_MODULES:
+            self.assertNotIn(module, imported)
+
+    def test_import_time_budget(self):
+        startup = get_run_time('pass')
+        import_time = get_run_time('import ' + CMD_MODULE) - startup
+        budget = IMPORT_BUDGET_FACTOR * startup
+        self.assertTrue(import_time < budget,
+                        'Importing ' + CMD_MODULE + ' took ' +
+                        str(import_time) + ' seconds which exceeds budget '
+                        'of ' + str(budget) + ' seconds, ' +
+                        str(IMPORT_BUDGET_FACTOR) + ' times python start up')
+
+    def test_help_and_iquery_mode_skip_gprofiler(self):
+        code = """
+import sys
+import json
+from unittest.mock import MagicMock
+from enrichment_service import enrichment_servicecmd
+try:
+    enrichment_servicecmd.main(['x', '--help'])
+except SystemExit:
+    pass
+loaded = [m for m in ['pandas', 'gprofiler', 'numpy'] if m in sys.modules]
+
+session = MagicMock()
+session.post.return_value = MagicMock(status_code=500, text='error')
+enrichment_servicecmd.httpclient.set_session(session)
+theargs = enrichment_servicecmd._parse_arguments('desc', ['x'])
+enrichment_servicecmd.run_enrichment({'columns': [{'id': 'g'}],
+                                      'rows': {'1': {'g': 'a'}}},
+                                     theargs, 'iquery')
+loaded += [m for m in ['pandas', 'gprofiler', 'numpy'] if m in sys.modules]
+sys.stderr.write(json.dumps(loaded))
+"""
+        proc = run_python(code)
+        self.assertTrue(proc.stderr.endswith('[]'), proc.stderr)
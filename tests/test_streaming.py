@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `streaming` module."""
+
+import os
+import io
+import gzip
+import json
+import tempfile
+import shutil
+
+import unittest
+from unittest.mock import patch
+
+from enrichment_service import streaming
+from enrichment_service import enrichment_servicecmd
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def _write_node_table(self, node_table, filename):
+        path = os.path.join(self._temp_dir, filename)
+        if filename.endswith('.gz'):
+            with gzip.open(path, 'wt') as f:
+                json.dump(node_table, f)
+        else:
+            with open(path, 'w') as f:
+                json.dump(node_table, f)
+        return path
+
+    def test_read_columns_and_rows(self):
+        node_table = {'rows': {'1': {'genes': 'a b'}, '2': {'genes': 'c'}},
+                      'columns': [{'id': 'genes', 'type': 'string'}]}
+        for filename in ['x.json', 'x.json.gz']:
+            path = self._write_node_table(node_table, filename)
+            self.assertEqual([{'id': 'genes', 'type': 'string'}],
+                             streaming.get_node_table_columns(path))
+            self.assertEqual([('1', {'genes': 'a b'}), ('2', {'genes': 'c'})],
+                             list(streaming.iter_node_table_rows(path)))
+            self.assertEqual(node_table,
+                             enrichment_servicecmd.read_inputfile(path))
+
+    def test_get_node_table_columns_stops_after_columns(self):
+        path = os.path.join(self._temp_dir, 'x.json')
+        with open(path, 'w') as f:
+            f.write('{"columns": [{"id": "genes", "x": [1.5]}, '
+                    '{"id": "y"}], "rows": {"1": {"genes": ')
+        self.assertEqual([{'id': 'genes', 'x': [1.5]}, {'id': 'y'}],
+                         streaming.get_node_table_columns(path))
+
+        path = self._write_node_table({'rows': {}}, 'y.json')
+        self.assertEqual([], streaming.get_node_table_columns(path))
+
+    def test_update_tables_stream_writer(self):
+        out = io.StringIO()
+        writer = streaming.UpdateTablesStreamWriter(out, [{'id': 'x'}])
+        writer.end()
+        self.assertEqual([{'action': 'updateTables',
+                           'data': {'id': 'node', 'columns': [{'id': 'x'}],
+                                    'rows': {}}}],
+                         json.loads(out.getvalue()))
+
+        out = io.StringIO()
+        writer = streaming.UpdateTablesStreamWriter(out, [{'id': 'x'}])
+        writer.start()
+        writer.write_row('1', {'x': 1})
+        writer.write_row(2, {'x': 'b'})
+        writer.end()
+        self.assertEqual(2, writer.get_row_count())
+        self.assertEqual({'1': {'x': 1}, '2': {'x': 'b'}},
+                         json.loads(out.getvalue())[0]['data']['rows'])
+
+    def test_run_enrichment_streaming_matches_run_enrichment(self):
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {str(x): {'genes': 'g' + str(x % 2)}
+                               for x in range(10)}}
+        path = self._write_node_table(node_table, 'x.json.gz')
+        theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                         [path, '--stream',
+                                                          '--stream_chunksize',
+                                                          '3'])
+
+        def fake_gprofiler(genes, *args, **kwargs):
+            if genes == ['g0']:
+                return None
+            return {'CD_CommunityName': genes[0]}
+
+        out = io.StringIO()
+        stats = {}
+        with patch.object(enrichment_servicecmd, 'run_gprofiler',
+                          side_effect=fake_gprofiler):
+            self.assertTrue(enrichment_servicecmd.run_enrichment_streaming(path,
+                                                                           theargs,
+                                                                           'gprofiler',
+                                                                           out,
+                                                                           stats=stats))
+            expected = enrichment_servicecmd.run_enrichment(node_table,
+                                                            theargs,
+                                                            'gprofiler')
+        self.assertEqual(expected, json.loads(out.getvalue()))
+        self.assertEqual(10, stats['rows'])
+        # duplicates are only found within chunks of 3
+        self.assertEqual(7, stats['unique_genelists'])
+
+    def test_run_enrichment_streaming_invalid_columns(self):
+        path = self._write_node_table({'columns': [{'id': 'a'},
+                                                   {'id': 'b'}],
+                                       'rows': {}}, 'x.json')
+        theargs = enrichment_servicecmd._parse_arguments('desc', [path])
+        out = io.StringIO()
+        self.assertFalse(enrichment_servicecmd.run_enrichment_streaming(path,
+                                                                        theargs,
+                                                                        'gprofiler',
+                                                                        out))
+        self.assertEqual('', out.getvalue())
+
+    def test_read_iquery_result_keeps_top_results(self):
+        def result(name, similarity):
+            return {'description': name, 'hitGenes': ['a'],
+                    'details': {'similarity': similarity,
+                                'PValue': 0.01}}
+        fullresult = {'sources': [{'sourceName': 'enrichment',
+                                   'results': [result('r1', 0.1),
+                                               result('r2', 0.5),
+                                               result('r3', 0.3),
+                                               result('r4', 0.5)]},
+                                  {'sourceName': 'other',
+                                   'results': [result('r5', 0.4)]}],
+                      'status': 'complete'}
+        data = json.dumps(fullresult).encode('utf-8')
+
+        res = streaming.read_iquery_result(io.BytesIO(data))
+        self.assertEqual({'sources': [{'results': [result('r2', 0.5)]}]}, res)
+        res = streaming.read_iquery_result(io.BytesIO(data), topk=3)
+        self.assertEqual(['r2', 'r4', 'r5'],
+                         [r['description'] for r in res['sources'][0]['results']])
+
+        # same result as parsing it all
+        for topk in [1, 3]:
+            res = streaming.read_iquery_result(io.BytesIO(data), topk=topk)
+            self.assertEqual(enrichment_servicecmd.get_result_in_mapped_term_json(fullresult,
+                                                                                  ['a', 'b'],
+                                                                                  topk=topk),
+                             enrichment_servicecmd.get_result_in_mapped_term_json(res,
+                                                                                  ['a', 'b'],
+                                                                                  topk=topk))
+
+    def test_read_iquery_result_without_results(self):
+        for data in [b'null', b'{"a": 1}', b'{"sources": null}',
+                     b'{"sources": [{"results": null}]}']:
+            self.assertEqual({'sources': [{'results': []}]},
+                             streaming.read_iquery_result(io.BytesIO(data)))
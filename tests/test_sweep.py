@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `sweep` module."""
+
+import os
+import json
+import shutil
+import tempfile
+
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pandas
+
+from enrichment_service import sweep
+from enrichment_service import enrichment_servicecmd
+
+
+# (source, native, name, p_value, precision, recall) of terms
+# returned for every query
+TERMS = [('GO:BP', 'GO:1', 'term1', 0.001, 0.5, 0.5),
+         ('GO:BP', 'GO:2', 'term2', 0.04, 1.0, 0.5),
+         ('HP', 'HP:1', 'hp1', 0.0001, 1.0, 1.0),
+         ('GO:CC', 'GO:3', 'term3', 0.01, 0.5, 0.25),
+         ('GO:MF', 'GO:4', 'term4', 0.02, 0.5, 0.5)]
+
+
+def fake_profile(query=None, user_threshold=None, **kwargs):
+    """
+    Stands in for GProfiler.profile() returning terms in
+    :py:const:`TERMS` that pass **user_threshold** for each query
+    """
+    if not isinstance(query, dict):
+        query = {'query_1': query}
+    rows = []
+    for name, genes in query.items():
+        for source, native, term, p_value, precision, recall in TERMS:
+            if p_value <= user_threshold:
+                rows.append((name, source, native, term, p_value,
+                             precision, recall, genes[:1]))
+    return pandas.DataFrame(rows, columns=['query', 'source', 'native',
+                                           'name', 'p_value', 'precision',
+                                           'recall', 'intersections'])
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self._temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self._temp_dir)
+
+    def test_get_combinations(self):
+        theargs, enrichment_args = sweep._parse_arguments('desc',
+                                                          ['in.json', '--outdir',
+                                                           'out', '--maxpval',
+                                                           '0.01', '0.05',
+                                                           '--excludesource',
+                                                           'HP', '',
+                                                           '--organism',
+                                                           'mmusculus'])
+        self.assertEqual(['--organism', 'mmusculus'], enrichment_args)
+        enrichment_theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                                    ['in.json'])
+        self.assertEqual([{'maxpval': 0.01, 'minoverlap': 0.05,
+                           'excludesource': 'HP'},
+                          {'maxpval': 0.01, 'minoverlap': 0.05,
+                           'excludesource': ''},
+                          {'maxpval': 0.05, 'minoverlap': 0.05,
+                           'excludesource': 'HP'},
+                          {'maxpval': 0.05, 'minoverlap': 0.05,
+                           'excludesource': ''}],
+                         sweep.get_combinations(theargs, enrichment_theargs))
+
+    def test_fetch_terms_names_queries_by_position(self):
+        theargs = enrichment_servicecmd._parse_arguments('desc', ['in.json'])
+        unique_genes = [('node 1', ['a', 'b']), ('x,y', ['c']), (3, [''])]
+        gprof = MagicMock()
+        gprof.profile.side_effect = fake_profile
+        with patch.object(enrichment_servicecmd, '_gprofiler', gprof):
+            terms_by_node_id = sweep.fetch_terms(unique_genes, theargs, 0.01)
+        self.assertEqual({'node 1', 'x,y', 3}, set(terms_by_node_id.keys()))
+        self.assertIsNone(terms_by_node_id[3])
+        query_names = set()
+        for call in gprof.profile.call_args_list:
+            query_names.update(call[1]['query'].keys())
+        self.assertEqual({'q0', 'q1'}, query_names)
+        self.assertEqual(['GO:1', 'HP:1', 'GO:3'],
+                         list(terms_by_node_id['x,y']['native']))
+
+    def test_select_terms_ranks_like_run(self):
+        terms_by_node_id = {'1': fake_profile(query=['a'], user_threshold=0.05),
+                            '2': None}
+        with patch.object(enrichment_servicecmd, 'get_top_gprofiler_terms',
+                          wraps=enrichment_servicecmd.get_top_gprofiler_terms) as top:
+            res = sweep.select_terms(terms_by_node_id,
+                                     {'maxpval': 0.015, 'minoverlap': 0.2,
+                                      'excludesource': 'HP'}, topk=2)
+        self.assertEqual(1, top.call_count)
+        self.assertEqual(['GO:1', 'GO:3'], list(res['1']['native']))
+        self.assertEqual(['1'], list(res.keys()))
+
+    def test_main_matches_separate_runs(self):
+        node_table = {'columns': [{'id': 'genes'}],
+                      'rows': {'1': {'genes': 'a b'}, '2': {'genes': 'c d'},
+                               '3': {'genes': 'b a'}, '4': {'genes': ''}}}
+        inputfile = os.path.join(self._temp_dir, 'in.json')
+        with open(inputfile, 'w') as f:
+            json.dump(node_table, f)
+        outdir = os.path.join(self._temp_dir, 'out')
+        cache_dir = os.path.join(self._temp_dir, 'cache')
+
+        gprof = MagicMock()
+        gprof.profile.side_effect = fake_profile
+        with patch.object(enrichment_servicecmd, '_gprofiler', gprof):
+            self.assertEqual(0, enrichment_servicecmd.main(['prog', 'sweep',
+                                                            inputfile,
+                                                            '--outdir', outdir,
+                                                            '--maxpval', '0.005',
+                                                            '0.05',
+                                                            '--minoverlap', '0.2',
+                                                            '0.5',
+                                                            '--excludesource',
+                                                            'HP', '',
+                                                            '--top-k', '2',
+                                                            '--cache-dir',
+                                                            cache_dir]))
+            # each unique gene list fetched once at loosest threshold
+            self.assertEqual(2, gprof.profile.call_count)
+            for call in gprof.profile.call_args_list:
+                self.assertEqual(0.05, call[1]['user_threshold'])
+
+            with open(os.path.join(outdir, sweep.SUMMARY_FILENAME), 'r') as f:
+                summary = json.load(f)
+            self.assertEqual(8, len(summary['combinations']))
+            self.assertEqual(3, summary['unique_genelists'])
+
+            with_cache = MagicMock()
+            for combination in summary['combinations']:
+                theargs = enrichment_servicecmd._parse_arguments('desc',
+                                                                 [inputfile,
+                                                                  '--maxpval',
+                                                                  str(combination['maxpval']),
+                                                                  '--minoverlap',
+                                                                  str(combination['minoverlap']),
+                                                                  '--excludesource',
+                                                                  combination['excludesource'],
+                                                                  '--top-k', '2',
+                                                                  '--no-cache'])
+                expected = json.loads(json.dumps(enrichment_servicecmd.run_enrichment(node_table,
+                                                                                      theargs,
+                                                                                      'gprofiler')))
+                with open(combination['output'], 'r') as f:
+                    self.assertEqual(expected, json.load(f))
+
+                # sweep stored result of each combination in cache
+                theargs.no_cache = False
+                theargs.cache_dir = cache_dir
+                with patch.object(enrichment_servicecmd, '_gprofiler', with_cache):
+                    self.assertEqual(expected,
+                                     enrichment_servicecmd.run_enrichment(node_table,
+                                                                          theargs,
+                                                                          'gprofiler'))
+            with_cache.profile.assert_not_called()
+
+        with open(os.path.join(outdir, sweep.COMPARISON_FILENAME), 'r') as f:
+            lines = f.read().splitlines()
+        self.assertEqual('node_id\t' + '\t'.join(sweep.OUTPUT_PREFIX + str(x)
+                                                 for x in range(1, 9)),
+                         lines[0])
+        self.assertEqual(['1', '2', '3', '4'],
+                         [line.split('\t')[0] for line in lines[1:]])
+        self.assertEqual('hp1', lines[1].split('\t')[6])
+        self.assertEqual('term2', lines[1].split('\t')[5])
+        self.assertEqual([''] * 8, lines[4].split('\t')[1:])
+
+    def test_main_invalid_input(self):
+        inputfile = os.path.join(self._temp_dir, 'in.json')
+        with open(inputfile, 'w') as f:
+            json.dump({'columns': [{'id': 'a'}, {'id': 'b'}], 'rows': {}}, f)
+        self.assertEqual(2, sweep.main([inputfile, '--outdir',
+                                        os.path.join(self._temp_dir, 'out')]))